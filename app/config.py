@@ -45,7 +45,64 @@ class Settings(BaseSettings):
     # По умолчанию запускаем только одну генерацию одновременно, чтобы уменьшить вероятность E003/rate-limit
     MAX_WORKERS: int = Field(1, env="MAX_WORKERS")  # Максимум одновременных воркеров
     MAX_CONCURRENT_GENERATIONS: int = Field(1, env="MAX_CONCURRENT_GENERATIONS")  # Лимит активных задач на пользователя
-    
+    MAX_BATCH_VARIATIONS: int = Field(8, env="MAX_BATCH_VARIATIONS")  # Максимум вариантов в одном батче
+    RETRY_BACKOFF_BASE_SECONDS: float = Field(5.0, env="RETRY_BACKOFF_BASE_SECONDS")  # Базовая задержка повтора при 429/E003/таймауте
+    RETRY_BACKOFF_MAX_SECONDS: float = Field(300.0, env="RETRY_BACKOFF_MAX_SECONDS")  # Потолок задержки повтора (экспонента с jitter)
+    PAUSED_RELEASE_PER_SECOND: float = Field(2.0, env="PAUSED_RELEASE_PER_SECOND")  # Темп возврата paused-генераций модели после снятия паузы
+    CIRCUIT_BREAKER_ENABLED: bool = Field(True, env="CIRCUIT_BREAKER_ENABLED")  # Не отправлять генерации на деградировавшую модель
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = Field(5, env="CIRCUIT_BREAKER_FAILURE_THRESHOLD")  # Сбоев провайдера (5xx/таймаут) подряд до размыкания
+    CIRCUIT_BREAKER_OPEN_SECONDS: float = Field(60.0, env="CIRCUIT_BREAKER_OPEN_SECONDS")  # Сколько цепь разомкнута до пробной генерации
+    HEDGING_ENABLED: bool = Field(False, env="HEDGING_ENABLED")  # Hedged-запросы для генераций с hedge_api_key (ключом дубля)
+    HEDGE_CROSS_PROVIDER: bool = Field(False, env="HEDGE_CROSS_PROVIDER")  # Дубль у другого провайдера (Replicate ↔ Banana Lab); задача Banana Lab не отменяется и оплачивается
+    HEDGE_QUANTILE: float = Field(0.9, env="HEDGE_QUANTILE")  # Через какой квантиль длительности дублировать запрос
+    HEDGE_MIN_SAMPLES: int = Field(20, env="HEDGE_MIN_SAMPLES")  # Сколько генераций модели нужно, чтобы доверять квантилю
+    HEDGE_MAX_IN_FLIGHT: int = Field(4, env="HEDGE_MAX_IN_FLIGHT")  # Одновременных дублей на процесс (размер пула hedge)
+    GENERATION_COALESCING_ENABLED: bool = Field(True, env="GENERATION_COALESCING_ENABLED")  # Склеивать идентичные генерации с фиксированным seed
+    GENERATION_COALESCE_RECHECK_SECONDS: int = Field(30, env="GENERATION_COALESCE_RECHECK_SECONDS")  # Как часто дубликат проверяет лидера
+    RESULT_CACHE_ENABLED: bool = Field(False, env="RESULT_CACHE_ENABLED")  # Кэш результатов генераций Replicate с фиксированным seed
+    RESULT_CACHE_MAX_ENTRIES: int = Field(10000, env="RESULT_CACHE_MAX_ENTRIES")  # Записей кэша; лишние вытесняются по давности использования
+
+    # Очередь генераций в Postgres (generation_jobs)
+    JOB_LEASE_SECONDS: int = Field(120, env="JOB_LEASE_SECONDS")  # Аренда задачи воркером, продлевается heartbeat'ом
+    JOB_POLL_INTERVAL_SECONDS: float = Field(2.0, env="JOB_POLL_INTERVAL_SECONDS")  # Как часто воркер проверяет очередь
+    JOB_MAX_ATTEMPTS: int = Field(3, env="JOB_MAX_ATTEMPTS")  # Сколько раз задачу можно забрать после падения воркера
+    FAIR_SHARE_ENABLED: bool = Field(True, env="FAIR_SHARE_ENABLED")  # Взвешенная справедливая очередь по пользователям вместо FIFO
+    ADMIN_JOB_WEIGHT: float = Field(4.0, env="ADMIN_JOB_WEIGHT")  # Во сколько раз большую долю воркеров получают админы
+    # false — API только ставит задачи в очередь, генерации выполняет отдельный процесс python -m app.worker
+    RUN_WORKERS_IN_API: bool = Field(True, env="RUN_WORKERS_IN_API")
+    SHUTDOWN_DRAIN_SECONDS: int = Field(25, env="SHUTDOWN_DRAIN_SECONDS")  # Сколько при остановке ждать генераций; остальные возвращаются в очередь
+
+    # Асинхронный клиент Banana Lab: ожидание генераций на общем event loop вместо потоков пула
+    BANANALAB_ASYNC_ENABLED: bool = Field(True, env="BANANALAB_ASYNC_ENABLED")
+    MAX_ASYNC_GENERATIONS: int = Field(200, env="MAX_ASYNC_GENERATIONS")  # Сколько генераций Banana Lab процесс ждёт одновременно
+    HTTP_POOL_MAX_CONNECTIONS: int = Field(100, env="HTTP_POOL_MAX_CONNECTIONS")  # Лимит соединений общего HTTP пула
+    HTTP_POOL_MAX_KEEPALIVE: int = Field(20, env="HTTP_POOL_MAX_KEEPALIVE")  # Сколько keep-alive соединений держать открытыми
+    BANANALAB_POLL_MAX_IN_FLIGHT: int = Field(50, env="BANANALAB_POLL_MAX_IN_FLIGHT")  # Одновременных GET status_url в центральном поллере
+
+    # Replicate: predictions создаются без ожидания, результат приходит на webhook
+    # (POST {PUBLIC_API_URL}/api/v1/images/replicate/webhook) или забирается опросом
+    REPLICATE_ASYNC_PREDICTIONS: bool = Field(False, env="REPLICATE_ASYNC_PREDICTIONS")
+    REPLICATE_POLL_INTERVAL_SECONDS: float = Field(10.0, env="REPLICATE_POLL_INTERVAL_SECONDS")  # Опрос prediction, если webhook не пришёл
+    PUBLIC_API_URL: str = Field("", env="PUBLIC_API_URL")  # Внешний адрес API для webhook'ов; пусто — только опрос
+
+    # Адаптивная (AIMD) конкурентность по (провайдер, модель) вместо фиксированного MAX_WORKERS
+    ADAPTIVE_CONCURRENCY_ENABLED: bool = Field(False, env="ADAPTIVE_CONCURRENCY_ENABLED")
+    ADAPTIVE_CONCURRENCY_INITIAL: int = Field(1, env="ADAPTIVE_CONCURRENCY_INITIAL")  # Стартовый лимит для новой пары провайдер/модель
+    ADAPTIVE_CONCURRENCY_MAX: int = Field(16, env="ADAPTIVE_CONCURRENCY_MAX")  # Потолок лимита одной пары
+    ADAPTIVE_CONCURRENCY_MAX_TOTAL: int = Field(32, env="ADAPTIVE_CONCURRENCY_MAX_TOTAL")  # Потоков пула процесса в этом режиме
+    ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE: float = Field(2.0, env="ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE")  # Во сколько раз медленнее базовой задержки — сигнал перегрузки
+
+    # Проактивный лимит запросов к провайдеру по API ключу (token bucket, бюджет обучается на ответах 429/E003)
+    RATE_LIMIT_ENABLED: bool = Field(True, env="RATE_LIMIT_ENABLED")
+    RATE_LIMIT_BACKEND: str = Field("postgres", env="RATE_LIMIT_BACKEND")  # postgres — общий для всех воркеров, local — в памяти процесса
+    RATE_LIMIT_REQUESTS: int = Field(60, env="RATE_LIMIT_REQUESTS")  # Запросов за окно (начальный и максимальный бюджет)
+    RATE_LIMIT_WINDOW_SECONDS: int = Field(60, env="RATE_LIMIT_WINDOW_SECONDS")
+    RATE_LIMIT_MIN_REQUESTS: int = Field(1, env="RATE_LIMIT_MIN_REQUESTS")  # Ниже этого бюджет не опускается
+
+    # Автоочистка: генерации удаляются пачками в коротких транзакциях
+    RETENTION_PURGE_BATCH_SIZE: int = Field(500, env="RETENTION_PURGE_BATCH_SIZE")  # Генераций в одной транзакции DELETE
+    RETENTION_STORAGE_BATCH_SIZE: int = Field(1000, env="RETENTION_STORAGE_BATCH_SIZE")  # Объектов MinIO в одном remove_objects
+
     # CORS (для продакшена укажите конкретные домены)
     CORS_ORIGINS: str = Field("*", env="CORS_ORIGINS")
     
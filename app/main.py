@@ -10,59 +10,30 @@ from fastapi.responses import JSONResponse
 from starlette.requests import Request
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response
-from app.routers import images, auth, users
+from app.routers import images, auth, users, admin
 from app.services.DBService import db_service
 import logging
 import os
-from logging.handlers import RotatingFileHandler
-from app.services.ErrorLogger import get_logs_dir, save_error_to_file
+from app.services.ErrorLogger import save_error_to_file, setup_logging
 import asyncio
-from datetime import datetime, timedelta
-from typing import List
-from app.models.base import Generation
-from app.services.MinioService import MinioService
-from app.config import settings as app_settings
-
-# Создаем папки для логов если их нет
-logs_dir = get_logs_dir()
-os.makedirs(logs_dir, exist_ok=True)
-
-# Настройка логирования в файл с ротацией (лимит 1GB)
-log_file = os.path.join(logs_dir, "nano_banana.log")
-# 1GB = 1024 * 1024 * 1024 байт, но для удобства используем 1000MB
-max_bytes = 1000 * 1024 * 1024  # 1GB
-backup_count = 5  # Количество резервных файлов
-
-# Создаем ротирующий handler
-file_handler = RotatingFileHandler(
-    log_file,
-    maxBytes=max_bytes,
-    backupCount=backup_count,
-    encoding='utf-8'
+from datetime import datetime
+from app.services.JobQueueService import job_queue
+from app.services.generation_worker import (
+    WORKER_ID,
+    begin_drain,
+    drain_generation_workers,
+    draining,
+    start_generation_workers,
 )
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-))
-
-# Консольный handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-))
+from app.services.retention import auto_cleanup_task
+from app.services.generation_events import start_generation_event_listener
+from app.config import settings as app_settings
 
-# Настройка root logger
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
-root_logger.addHandler(file_handler)
-root_logger.addHandler(console_handler)
+# Логи в файл с ротацией (лимит 1GB) и в консоль
+setup_logging("nano_banana.log")
 
 logger = logging.getLogger(__name__)
 
-# Глобальный сервис MinIO для фоновых задач
-minio_background = MinioService()
-
 app = FastAPI(
     title="Nano Banana Pro API",
     description="API для генерации изображений через Nano Banana Pro (Replicate)",
@@ -161,121 +132,6 @@ async def global_exception_handler(request: Request, exc: Exception):
         content={"detail": "Внутренняя ошибка сервера"}
     )
 
-# Фоновая задача автоочистки старых генераций и связанных файлов,
-# а также сброса "зависших" генераций
-async def auto_cleanup_task():
-    """
-    Периодически удаляет генерации и файлы старше 7 дней
-    и помечает слишком долго висящие генерации как завершившиеся с ошибкой.
-    """
-    # Небольшая задержка после старта приложения, чтобы всё инициализировалось
-    await asyncio.sleep(60)
-    retention_days = 7
-    # Порог для "зависших" генераций (если висят дольше этого времени в статусе running/pending)
-    stuck_minutes = 20
-
-    while True:
-        try:
-            cutoff = datetime.utcnow() - timedelta(days=retention_days)
-            stuck_cutoff = datetime.utcnow() - timedelta(minutes=stuck_minutes)
-            deleted_generations = 0
-            deleted_files: List[str] = []
-            fixed_stuck = 0
-
-            with db_service.get_session() as session:
-                old_generations: List[Generation] = (
-                    session.query(Generation)
-                    .filter(Generation.created_at < cutoff)
-                    .all()
-                )
-
-                if old_generations:
-                    logger.info(
-                        f"[AUTO_CLEANUP] Найдено {len(old_generations)} генераций "
-                        f"старше {retention_days} дней для автоочистки"
-                    )
-
-                # Удаляем действительно старые генерации и их файлы
-                for gen in old_generations:
-                    # Удаляем результат из MinIO
-                    if gen.result_path:
-                        if minio_background.delete_image(gen.result_path):
-                            deleted_files.append(gen.result_path)
-
-                    # Удаляем референсы из MinIO по URL, если они больше нигде не используются
-                    if gen.generation_metadata:
-                        ref_urls = gen.generation_metadata.get("reference_image_urls") or []
-                        for url in ref_urls:
-                            if not url:
-                                continue
-
-                            # Проверяем использование в других генерациях
-                            other_gens: List[Generation] = (
-                                session.query(Generation)
-                                .filter(Generation.id != gen.id)
-                                .filter(Generation.generation_metadata.isnot(None))
-                                .all()
-                            )
-                            url_used_elsewhere = False
-                            for other in other_gens:
-                                other_urls = []
-                                if other.generation_metadata:
-                                    other_urls = other.generation_metadata.get("reference_image_urls") or []
-                                if url in other_urls:
-                                    url_used_elsewhere = True
-                                    break
-
-                            if url_used_elsewhere:
-                                continue
-
-                            marker = f"/{app_settings.MINIO_BUCKET}/"
-                            idx = url.find(marker)
-                            if idx == -1:
-                                continue
-                            path = url[idx + len(marker) :]
-
-                            if path and minio_background.delete_image(path):
-                                deleted_files.append(path)
-
-                    session.delete(gen)
-                    deleted_generations += 1
-
-                # Дополнительно: помечаем "зависшие" генерации как failed,
-                # чтобы они не висели бесконечно в статусе running/pending
-                stuck_generations: List[Generation] = (
-                    session.query(Generation)
-                    .filter(Generation.created_at < stuck_cutoff)
-                    .filter(Generation.status.in_(["running", "pending"]))
-                    .all()
-                )
-
-                for gen in stuck_generations:
-                    gen.status = "failed"
-                    gen.completed_at = datetime.utcnow()
-                    if not gen.generation_metadata:
-                        gen.generation_metadata = {}
-                    gen.generation_metadata["error"] = (
-                        f"Генерация была автоматически помечена как неудачная, "
-                        f"так как выполнялась дольше {stuck_minutes} минут без завершения."
-                    )
-                    fixed_stuck += 1
-
-                session.commit()
-
-            if deleted_generations or deleted_files or fixed_stuck:
-                logger.info(
-                    f"[AUTO_CLEANUP] Автоочистка завершена: "
-                    f"удалено генераций={deleted_generations}, файлов в MinIO={len(deleted_files)}, "
-                    f"сброшено зависших генераций={fixed_stuck}"
-                )
-        except Exception as e:
-            logger.error(f"[AUTO_CLEANUP] Ошибка автоочистки: {e}", exc_info=True)
-
-        # Запускаем проверку чаще (каждые 5 минут),
-        # чтобы оперативно сбрасывать зависшие генерации и чуть чаще чистить старые.
-        await asyncio.sleep(5 * 60)
-
-
 # Инициализация БД и запуск фоновых задач при старте
 @app.on_event("startup")
 async def startup_event():
@@ -283,10 +139,14 @@ async def startup_event():
     try:
         db_service.create_tables()
         logger.info("[STARTUP] База данных инициализирована")
-        # Запускаем воркер paused-очереди генераций
-        images.start_paused_queue_worker()
-        images.restore_paused_queue_from_db()
-        logger.info("[STARTUP] Воркер paused-очереди запущен")
+        # События статусов генераций со всех реплик и воркеров (LISTEN generation_status) для SSE
+        start_generation_event_listener()
+        # Воркеры генераций запускаем в API-процессе только если нет отдельного воркера (python -m app.worker)
+        if app_settings.RUN_WORKERS_IN_API:
+            start_generation_workers()
+            logger.info(f"[STARTUP] Воркеры генераций запущены в API-процессе (воркер {WORKER_ID})")
+        else:
+            logger.info("[STARTUP] RUN_WORKERS_IN_API=false: API только ставит задачи в очередь")
         
         # Миграция: проставляем model_name="nano-banana-pro" для старых записей
         try:
@@ -317,16 +177,22 @@ async def startup_event():
         except Exception as migration_error:
             logger.warning(f"[STARTUP] Ошибка при миграции model_name (не критично): {migration_error}")
 
-        # Сбрасываем "зависшие" генерации (running/pending), которые могли остаться после рестарта
+        # Сбрасываем "зависшие" генерации (running/pending), которые могли остаться после рестарта.
+        # Генерации с задачей в generation_jobs не трогаем: их заберёт воркер
+        # (после истечения аренды, если прежний воркер упал) и по сохранённому хэндлу
+        # задачи провайдера дождётся уже запущенной генерации, а не запустит её заново.
         from app.models.base import Generation
         from sqlalchemy.orm import Session
 
         with db_service.get_session() as session:  # type: Session
-            stuck_gens = (
+            queued_ids = job_queue.active_generation_ids(session)
+            stuck_query = (
                 session.query(Generation)
                 .filter(Generation.status.in_(["running", "pending"]))
-                .all()
             )
+            if queued_ids:
+                stuck_query = stuck_query.filter(Generation.id.notin_(queued_ids))
+            stuck_gens = stuck_query.all()
             if stuck_gens:
                 now = datetime.utcnow()
                 for gen in stuck_gens:
@@ -344,18 +210,45 @@ async def startup_event():
     except Exception as e:
         logger.error(f"[STARTUP] Ошибка инициализации БД: {e}")
     
-    # Запускаем фоновую задачу автоочистки
+    # Запускаем фоновую задачу автоочистки (в отдельном воркере она запускается там)
+    if not app_settings.RUN_WORKERS_IN_API:
+        return
     try:
         asyncio.create_task(auto_cleanup_task())
         logger.info("[STARTUP] Фоновая задача автоочистки старых генераций запущена")
     except Exception as e:
         logger.error(f"[STARTUP] Не удалось запустить фоновую задачу автоочистки: {e}", exc_info=True)
 
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Корректная остановка: /health/ready отвечает 503, генерации процесса дорабатывают
+    до SHUTDOWN_DRAIN_SECONDS или прерываются и возвращаются в очередь; закрытие пула async соединений с БД
+    """
+    unfinished = 0
+    if app_settings.RUN_WORKERS_IN_API:
+        unfinished = await asyncio.to_thread(drain_generation_workers, app_settings.SHUTDOWN_DRAIN_SECONDS)
+    else:
+        begin_drain()
+    await db_service.dispose_async_engine()
+    if unfinished:
+        # Как в app/worker.py: задачи уже в очереди, не ждём потоки пула, которые интерпретатор дожидается при выходе
+        logging.shutdown()
+        os._exit(0)
+
 # Health check endpoint (должен быть до статических файлов)
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+@app.get("/health/ready")
+async def health_ready():
+    """Готовность принимать трафик: с начала остановки (drain) — 503, балансировщик выводит реплику"""
+    if draining.is_set():
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "draining"})
+    return {"status": "ready"}
+
 @app.get("/api")
 async def api_info():
     return {
@@ -368,6 +261,7 @@ async def api_info():
 app.include_router(auth.router, prefix="/api/v1")
 app.include_router(images.router, prefix="/api/v1")
 app.include_router(users.router, prefix="/api/v1")
+app.include_router(admin.router, prefix="/api/v1")
 
 # Статические файлы (frontend) - монтируем после роутов
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
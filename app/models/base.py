@@ -2,7 +2,7 @@
 Модели базы данных для Nano Banana Pro
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, JSON, Float
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, JSON, Float, Index
 from sqlalchemy.orm import relationship
 from app.services.DBService import db_service
 
@@ -46,6 +46,7 @@ class Generation(Base):
     result_data = Column(JSON, nullable=True)  # Метаданные изображения
     generation_metadata = Column(JSON, nullable=True)  # Дополнительные метаданные (переименовано из metadata, т.к. metadata зарезервировано в SQLAlchemy)
     status = Column(String, default="pending")  # pending, running, paused, completed, failed
+    group_id = Column(String, nullable=True, index=True)  # Группа батча/вариантов (POST /images/generate/batch)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, onupdate=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
@@ -53,3 +54,106 @@ class Generation(Base):
     # Связь многие к 1 (Generation → User)
     user = relationship("User", back_populates="generations")
 
+    __table_args__ = (
+        # Keyset-пагинация галереи: WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC
+        Index("ix_generations_user_created_id", "user_id", "created_at", "id"),
+    )
+
+
+class GenerationJob(Base):
+    """Задача очереди генераций (durable-очередь поверх Postgres)"""
+    __tablename__ = "generation_jobs"
+    __table_args__ = (
+        Index("ix_generation_jobs_status_available_at", "status", "available_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    generation_id = Column(Integer, ForeignKey("generations.id", ondelete="CASCADE"), unique=True, nullable=False)
+    user_id = Column(Integer, nullable=False, index=True)
+    provider = Column(String, nullable=True)  # replicate / bananalab
+    model_name = Column(String, nullable=True)
+    payload = Column(JSON, nullable=True)  # request_data задачи (включая API ключ), очищается после завершения
+    status = Column(String, default="queued")  # queued, leased, waiting (ждёт провайдера), done, failed
+    attempts = Column(Integer, default=0)  # Сколько раз задачу забирал воркер
+    available_at = Column(DateTime, default=datetime.utcnow)  # Раньше этого времени задачу не забирают
+    lease_owner = Column(String, nullable=True)  # Идентификатор воркера, держащего аренду
+    lease_expires_at = Column(DateTime, nullable=True)
+    weight = Column(Float, default=1.0)  # Вес пользователя в fair-share очереди (у админов ADMIN_JOB_WEIGHT)
+    fingerprint = Column(String, nullable=True, index=True)  # Отпечаток запроса для склейки идентичных генераций
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class GenerationReference(Base):
+    """Референс генерации, сохранённый в MinIO: по нему очистка находит объекты, которые больше никому не нужны"""
+    __tablename__ = "generation_references"
+
+    generation_id = Column(Integer, ForeignKey("generations.id", ondelete="CASCADE"), primary_key=True)
+    object_path = Column(String, primary_key=True, index=True)  # Путь объекта в бакете (references/ref_...)
+
+
+class GenerationResultCache(Base):
+    """
+    Кэш результатов детерминированных генераций: ключ запроса → объект MinIO с готовым изображением.
+    Запись только указывает на файл чужой генерации; при попадании файл копируется.
+    """
+    __tablename__ = "generation_result_cache"
+
+    cache_key = Column(String, primary_key=True)  # result_cache_key(): модель, итоговый промпт, параметры, seed, референсы
+    model_name = Column(String, nullable=True)
+    result_path = Column(String, nullable=False)  # Путь объекта в бакете
+    result_url = Column(String, nullable=False)
+    stored_at = Column(DateTime, default=datetime.utcnow)  # Когда создан объект result_path (срок жизни — окно хранения)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)  # Для вытеснения давно не используемых записей
+    hits = Column(Integer, default=0)
+
+
+class StorageDeletion(Base):
+    """
+    Объект MinIO, ожидающий удаления. Пишется в той же транзакции, что и DELETE генераций,
+    поэтому прерванная очистка продолжает удаление файлов со следующего запуска.
+    """
+    __tablename__ = "storage_deletions"
+
+    object_path = Column(String, primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ProviderRateLimit(Base):
+    """Состояние token bucket лимита запросов к провайдеру для одного API ключа (общее для всех воркеров)"""
+    __tablename__ = "provider_rate_limits"
+
+    key_hash = Column(String, primary_key=True)  # sha256 API ключа, сам ключ не храним
+    provider = Column(String, nullable=True)  # replicate / bananalab
+    budget = Column(Float, nullable=False)  # Выученный бюджет: запросов за окно RATE_LIMIT_WINDOW_SECONDS
+    tokens = Column(Float, nullable=False)
+    throttled_until = Column(DateTime, nullable=True)  # Не ходить к провайдеру до этого времени (после 429)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class WorkerConcurrencyLimit(Base):
+    """Текущий адаптивный лимит конкурентности воркера для пары (провайдер, модель) — для админки"""
+    __tablename__ = "worker_concurrency_limits"
+
+    worker_id = Column(String, primary_key=True)
+    provider = Column(String, primary_key=True)
+    model_name = Column(String, primary_key=True)
+    limit = Column(Float, nullable=False)
+    in_flight = Column(Integer, default=0)
+    baseline_latency = Column(Float, nullable=True)  # Базовая длительность генерации, сек
+    successes = Column(Integer, default=0)
+    throttled = Column(Integer, default=0)
+    errors = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ModelAvailability(Base):
+    """Пауза модели у провайдера (общая для всех воркеров): когда снова проверять её доступность"""
+    __tablename__ = "model_availability"
+
+    provider = Column(String, primary_key=True)
+    model_name = Column(String, primary_key=True)
+    paused_until = Column(DateTime, nullable=True)  # None — модель доступна; иначе следующая проба не раньше
+    pause_streak = Column(Integer, default=0)  # Неудачных проб подряд (интервал проб растёт)
+    last_error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
@@ -56,6 +56,31 @@ class ImageGenerationRequest(BaseModel):
     reference_images: Optional[List[str]] = None  # URLs или base64 изображений
     api_key: Optional[str] = None  # Replicate (r8_…) или Banana Lab (nb_…), не сохраняется в БД
     model_name: Optional[str] = None  # Имя модели (например, "nano-banana-pro", "gemini-2.5-flash-image")
+    allow_fallback: bool = False  # Разрешить перевод на fallback-модель, пока модель деградировала (circuit breaker)
+    hedge_api_key: Optional[str] = None  # Ключ дубля для hedged-запросов (r8_… или nb_…), не сохраняется в БД
+
+# Батч/варианты: общий промпт и референсы + список отличий (seed, формат, модель)
+class GenerationVariation(BaseModel):
+    seed: Optional[int] = None
+    aspect_ratio: Optional[str] = None
+    resolution: Optional[str] = None
+    model_name: Optional[str] = None
+
+class ImageBatchGenerationRequest(ImageGenerationRequest):
+    variations: List[GenerationVariation]
+
+    @field_validator('variations')
+    @classmethod
+    def validate_variations(cls, v: List[GenerationVariation]) -> List[GenerationVariation]:
+        if not v:
+            raise ValueError('Укажите хотя бы один вариант генерации')
+        return v
+
+class ImageBatchGenerationResponse(BaseModel):
+    status: str
+    group_id: str
+    image_ids: List[int]
+    message: Optional[str] = None
 
 class ImageGenerationResponse(BaseModel):
     status: str
@@ -0,0 +1,85 @@
+"""
+Роутер для администраторов: состояние обработки генераций
+"""
+from datetime import datetime, timedelta
+from typing import Annotated, Dict, Tuple
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from app.config import settings
+from app.services.AuthService import auth_service
+from app.services.DBService import db_service
+from app.services.generation_worker import WORKER_ID, active_async_jobs, active_jobs, begin_drain
+from app.models.base import WorkerConcurrencyLimit
+from app.models.token import TokenPayload
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+# Воркер публикует лимиты каждые JOB_LEASE_SECONDS / 3; более старые записи — от остановленных процессов
+CONCURRENCY_STALE_SECONDS = 120
+
+
+def _require_admin(user: TokenPayload):
+    if not user.is_admin:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+
+@router.get("/concurrency")
+async def get_concurrency_limits(
+    user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
+):
+    """Текущие адаптивные лимиты одновременных генераций по (провайдер, модель) на каждом воркере"""
+    _require_admin(user)
+    cutoff = datetime.utcnow() - timedelta(seconds=max(CONCURRENCY_STALE_SECONDS, settings.JOB_LEASE_SECONDS))
+    async with db_service.get_async_session() as session:
+        rows = (await session.execute(
+            select(WorkerConcurrencyLimit)
+            .where(WorkerConcurrencyLimit.updated_at >= cutoff)
+            .order_by(WorkerConcurrencyLimit.provider, WorkerConcurrencyLimit.model_name, WorkerConcurrencyLimit.worker_id)
+        )).scalars().all()
+
+    workers = []
+    totals: Dict[Tuple[str, str], Dict[str, float]] = {}
+    for row in rows:
+        workers.append({
+            "worker_id": row.worker_id,
+            "provider": row.provider,
+            "model_name": row.model_name,
+            "limit": row.limit,
+            "in_flight": row.in_flight,
+            "baseline_latency": row.baseline_latency,
+            "successes": row.successes,
+            "throttled": row.throttled,
+            "errors": row.errors,
+            "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+        })
+        total = totals.setdefault((row.provider, row.model_name), {"limit": 0.0, "in_flight": 0})
+        total["limit"] += row.limit
+        total["in_flight"] += row.in_flight or 0
+
+    return {
+        "enabled": settings.ADAPTIVE_CONCURRENCY_ENABLED,
+        "targets": [
+            {"provider": provider, "model_name": model_name, "limit": round(total["limit"], 2), "in_flight": total["in_flight"]}
+            for (provider, model_name), total in totals.items()
+        ],
+        "workers": workers,
+    }
+
+
+@router.post("/drain")
+async def drain_replica(
+    user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
+):
+    """
+    Начинает вывод реплики перед деплоем: /health/ready отвечает 503, новые генерации
+    не забираются, paused-очередь передаётся в generation_jobs. Вызывается на конкретной
+    реплике (по адресу контейнера); выполняющиеся генерации дорабатывают до остановки процесса.
+    """
+    _require_admin(user)
+    await asyncio.to_thread(begin_drain)
+    return {
+        "worker_id": WORKER_ID,
+        "draining": True,
+        "in_flight": len(active_jobs) + len(active_async_jobs),
+    }
@@ -1,10 +1,11 @@
 """
 Роутер для аутентификации
 """
+import asyncio
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException, status
 from datetime import datetime
-from sqlalchemy import or_
+from sqlalchemy import or_, select
 from app.services.AuthService import auth_service
 from app.services.DBService import db_service
 from app.models.schemas import UserCreateRequest, UserLoginRequest, UserResponse
@@ -16,13 +17,15 @@ router = APIRouter(prefix="/auth", tags=["auth"])
 @router.post("/register", response_model=Token)
 async def register(user_data: UserCreateRequest):
     """Регистрация нового пользователя"""
-    with db_service.get_session() as session:
-        existing_user = session.query(User).filter(
-            or_(
-                User.username == user_data.username,
-                User.email == user_data.email
-            )
-        ).first()
+    async with db_service.get_async_session() as session:
+        existing_user = (await session.execute(
+            select(User).where(
+                or_(
+                    User.username == user_data.username,
+                    User.email == user_data.email
+                )
+            ).limit(1)
+        )).scalars().first()
         
         if existing_user:
             raise HTTPException(
@@ -30,7 +33,8 @@ async def register(user_data: UserCreateRequest):
                 detail="Пользователь с таким именем или email уже существует"
             )
 
-        hashed_password = auth_service.get_password_hash(user_data.password)
+        # bcrypt — CPU на сотни миллисекунд, считаем вне event loop
+        hashed_password = await asyncio.to_thread(auth_service.get_password_hash, user_data.password)
         new_user = User(
             username=user_data.username,
             email=user_data.email,
@@ -43,8 +47,8 @@ async def register(user_data: UserCreateRequest):
         )
         
         session.add(new_user)
-        session.commit()
-        session.refresh(new_user)
+        await session.commit()
+        await session.refresh(new_user)
 
         access_token = await auth_service.create_access_token(new_user)
         refresh_token = await auth_service.create_refresh_token(new_user)
@@ -58,15 +62,17 @@ async def register(user_data: UserCreateRequest):
 @router.post("/login", response_model=Token)
 async def login(user_data: UserLoginRequest):
     """Вход в систему"""
-    with db_service.get_session() as session:
-        user = session.query(User).filter(
-            or_(
-                User.username == user_data.username_or_email,
-                User.email == user_data.username_or_email
-            )
-        ).first()
+    async with db_service.get_async_session() as session:
+        user = (await session.execute(
+            select(User).where(
+                or_(
+                    User.username == user_data.username_or_email,
+                    User.email == user_data.username_or_email
+                )
+            ).limit(1)
+        )).scalars().first()
 
-        if not user or not auth_service.verify_password(user_data.password, user.hashed_password):
+        if not user or not await asyncio.to_thread(auth_service.verify_password, user_data.password, user.hashed_password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Неверное имя пользователя/email или пароль"
@@ -79,7 +85,7 @@ async def login(user_data: UserLoginRequest):
             )
 
         user.last_login = datetime.utcnow()
-        session.commit()
+        await session.commit()
 
         access_token = await auth_service.create_access_token(user)
         refresh_token = await auth_service.create_refresh_token(user)
@@ -95,8 +101,8 @@ async def get_current_user_info(
     user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
 ):
     """Получение информации о текущем пользователе"""
-    with db_service.get_session() as session:
-        db_user = session.query(User).filter(User.id == user.user_id).first()
+    async with db_service.get_async_session() as session:
+        db_user = await session.get(User, user.user_id)
         if not db_user:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
         
@@ -1,558 +1,192 @@
 """
 Роутер для генерации изображений: Replicate или Banana Lab (по префиксу API ключа).
 """
-from concurrent.futures import ThreadPoolExecutor
-from collections import deque
-import threading
-import time
-from typing import Annotated, Optional, List, Dict, Any
+from typing import Annotated, Optional, Dict, List, Tuple
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from starlette.requests import Request
 from datetime import datetime, timedelta
+import asyncio
+import base64
+import json
 import logging
 import uuid
-from app.models.schemas import ImageGenerationRequest, ImageGenerationResponse, ImageResponse
+from app.models.schemas import (
+    ImageBatchGenerationRequest,
+    ImageBatchGenerationResponse,
+    ImageGenerationRequest,
+    ImageGenerationResponse,
+    ImageResponse,
+)
 from app.services.ReplicateService import ReplicateService
-from app.services.BananalabService import BananalabService, SUPPORTED_BANANALAB_FRONTEND_MODELS
-from app.services.image_api_provider import infer_image_api_provider
+from app.services.BananalabService import SUPPORTED_BANANALAB_FRONTEND_MODELS
 from app.services.MinioService import MinioService
 from app.services.DBService import db_service
 from app.services.AuthService import auth_service
+from app.services.generation_events import GENERATION_STATUS_CHANNEL, generation_events
+from app.services.generation_fingerprint import generation_fingerprint, result_cache_key
+from app.services.image_api_provider import infer_image_api_provider
+from app.services.JobQueueService import job_queue
+from app.services.result_cache import complete_from_cache
+from app.services.retention import RETENTION_DAYS, purge_expired_generations, record_generation_references
+from app.services.generation_worker import (
+    MAX_GENERATION_RETRIES,
+    get_fallback_model,
+    get_user_generation_api_key,
+    handle_replicate_webhook,
+    submit_generation_group,
+    submit_generation_job,
+    verify_replicate_webhook_token,
+)
 from app.models.base import Generation, User
+from sqlalchemy import func, insert, select, tuple_
 from app.config import settings
 from app.models.token import TokenPayload
 
 logger = logging.getLogger(__name__)
 
-# Глобальный пул воркеров для обработки генераций
-executor = ThreadPoolExecutor(max_workers=settings.MAX_WORKERS)
-
-# Максимальное количество повторных попыток генерации при временных ошибках (E003 / 429)
-MAX_GENERATION_RETRIES = 5
-PAUSED_RETRY_DELAY_SECONDS = 30
-
 router = APIRouter(prefix="/images", tags=["images"])
 minio = MinioService()
 
-FALLBACK_MODEL_BY_MODEL = {}
-paused_queue = deque()
-paused_queue_ids = set()
-paused_queue_lock = threading.Lock()
-paused_worker_started = False
 
+def _encode_list_cursor(created_at: datetime, generation_id: int) -> str:
+    """Курсор /images/list: позиция последней отданной генерации (created_at, id)."""
+    raw = f"{created_at.isoformat()}|{generation_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
 
-def get_fallback_model(model_name: Optional[str]) -> Optional[str]:
-    """Возвращает fallback-модель для кнопки быстрого перезапуска."""
-    if not model_name:
-        return None
-    return FALLBACK_MODEL_BY_MODEL.get(model_name)
 
+def _decode_list_cursor(cursor: str) -> Optional[Tuple[datetime, int]]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at_str, generation_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at_str), int(generation_id)
+    except (ValueError, TypeError, UnicodeError):
+        return None
 
-def _is_paused_error(error_message: str) -> bool:
-    if not error_message:
-        return False
-    lower_err = error_message.lower()
-    return (
-        "is paused" in lower_err
-        or "model is paused" in lower_err
-        or ("project or nanobanana" in lower_err and "try again later" in lower_err)
-    )
+async def _active_generation_count(session, user_id: int) -> int:
+    """Активные генерации пользователя для лимита MAX_CONCURRENT_GENERATIONS; каждый вариант батча — отдельная."""
+    return (await session.execute(
+        select(func.count(Generation.id)).where(
+            Generation.user_id == user_id,
+            Generation.status.in_(["pending", "running", "paused"])
+        )
+    )).scalar()
 
 
-def enqueue_paused_generation(generation_id: int, user_id: int, request_data: dict, prioritize: bool = False):
-    with paused_queue_lock:
-        if generation_id in paused_queue_ids:
-            return
-        item = {
-            "generation_id": generation_id,
-            "user_id": user_id,
-            "request_data": request_data,
-            "retry_after": time.time() + PAUSED_RETRY_DELAY_SECONDS,
-        }
-        if prioritize:
-            paused_queue.appendleft(item)
-        else:
-            paused_queue.append(item)
-        paused_queue_ids.add(generation_id)
+async def _lock_generation_slots(session, user_id: int) -> None:
+    """
+    Блокирует строку пользователя до конца транзакции: подсчёт активных генераций и INSERT
+    выполняются под этой блокировкой, и параллельные запросы не превышают MAX_CONCURRENT_GENERATIONS.
+    """
+    await session.execute(select(User.id).where(User.id == user_id).with_for_update())
 
 
-def _build_resume_payload(generation: Generation, request_data: dict) -> Dict[str, Any]:
-    metadata = generation.generation_metadata or {}
-    return {
-        "api_key": request_data.get("api_key"),
-        "prompt": request_data.get("prompt") or generation.prompt,
-        "negative_prompt": request_data.get("negative_prompt") or generation.negative_prompt,
-        "resolution": request_data.get("resolution") or generation.resolution,
-        "aspect_ratio": request_data.get("aspect_ratio") or generation.aspect_ratio,
-        "guidance_scale": request_data.get("guidance_scale") or generation.guidance_scale,
-        "num_inference_steps": request_data.get("num_inference_steps") or generation.num_inference_steps,
-        "seed": request_data.get("seed") if request_data.get("seed") is not None else generation.seed,
-        "model_name": request_data.get("model_name") or generation.model_name or metadata.get("model_name"),
-        "reference_images": request_data.get("reference_images") or metadata.get("reference_image_urls") or [],
-    }
+def _notify_group_created(session, user_id: int, group_id: str, generation_ids: List[int]):
+    """
+    NOTIFY о созданных вариантах батча: Core INSERT не проходит через after_flush,
+    поэтому события отправляются явно в той же транзакции.
+    """
+    for generation_id in generation_ids:
+        db_service.notify(
+            session.connection(),
+            GENERATION_STATUS_CHANNEL,
+            {"id": generation_id, "user_id": user_id, "status": "pending", "group_id": group_id},
+        )
 
 
-def restore_paused_queue_from_db():
-    with db_service.get_session() as session:
-        paused_generations = (
-            session.query(Generation)
-            .filter(Generation.status == "paused")
-            .order_by(Generation.created_at.asc())
-            .all()
+def _check_batch_slots(active_count: int, variations_count: int) -> None:
+    """429, если вариантов батча больше, чем свободных слотов в MAX_CONCURRENT_GENERATIONS."""
+    max_concurrent = settings.MAX_CONCURRENT_GENERATIONS
+    if active_count >= max_concurrent:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Достигнут лимит одновременных генераций ({max_concurrent}). Дождитесь завершения текущих генераций."
         )
-        for generation in paused_generations:
-            metadata = generation.generation_metadata or {}
-            request_data = metadata.get("paused_request_data")
-            if request_data and request_data.get("api_key"):
-                enqueue_paused_generation(generation.id, generation.user_id, request_data, prioritize=False)
-
-
-def _paused_queue_worker_loop():
-    while True:
-        item = None
-        now_ts = time.time()
-        with paused_queue_lock:
-            if paused_queue:
-                candidate = paused_queue[0]
-                if candidate["retry_after"] <= now_ts:
-                    item = paused_queue.popleft()
-                    paused_queue_ids.discard(item["generation_id"])
-        if not item:
-            time.sleep(2)
-            continue
-        executor.submit(
-            process_generation_async,
-            item["generation_id"],
-            item["user_id"],
-            item["request_data"],
+    free_slots = max_concurrent - active_count
+    if variations_count > free_slots:
+        raise HTTPException(
+            status_code=429,
+            detail=(
+                f"Вариантов в батче ({variations_count}) больше, чем свободных слотов ({free_slots}) "
+                f"в лимите одновременных генераций ({max_concurrent}). Уменьшите батч или дождитесь завершения текущих генераций."
+            )
         )
-        time.sleep(1)
 
 
-def start_paused_queue_worker():
-    global paused_worker_started
-    if paused_worker_started:
-        return
-    with paused_queue_lock:
-        if paused_worker_started:
-            return
-        thread = threading.Thread(target=_paused_queue_worker_loop, daemon=True)
-        thread.start()
-        paused_worker_started = True
-
-
-def _extract_minio_path_from_url(url: str, bucket: str) -> Optional[str]:
-    """
-    Вспомогательная функция: из публичного URL MinIO достает путь объекта внутри бакета.
-    Ожидаемый формат:
-      {PUBLIC_URL}/{bucket}/{object_path}
-    Возвращает object_path или None, если разобрать не удалось.
-    """
-    try:
-        if not url:
-            return None
-
-        # Ищем подстроку "/{bucket}/"
-        marker = f"/{bucket}/"
-        idx = url.find(marker)
-        if idx == -1:
-            return None
-        return url[idx + len(marker) :]
-    except Exception:
-        return None
-
-def get_user_generation_api_key(user_id: int, api_key_from_request: Optional[str] = None) -> str:
+async def _store_reference_images(reference_images: Optional[List[str]]) -> List[str]:
     """
-    API ключ из запроса (Replicate r8_… или Banana Lab nb_…).
-    Ключи не сохраняются в БД.
+    Сохраняет референсы (data URL) в MinIO и возвращает их URL.
+    Готовые URL возвращаются как есть; при ошибке сохранения — исходный data URL.
     """
-    if not api_key_from_request or not api_key_from_request.strip():
-        raise ValueError(
-            "API ключ не указан. Введите ключ Replicate (r8_…) или Banana Lab (nb_…) в настройках."
-        )
-    return api_key_from_request.strip()
-
-def process_generation_async(generation_id: int, user_id: int, request_data: dict):
-    """Асинхронная обработка генерации"""
-    started_at = datetime.utcnow()
-    try:
-        with db_service.get_session() as session:
-            generation = session.query(Generation).filter(Generation.id == generation_id).first()
-            if not generation:
-                logger.error(f"[GENERATION] Генерация {generation_id} не найдена")
-                return
-            
-            # Обновляем статус на running
-            generation.status = "running"
-            session.commit()
-            
-            # Получаем API ключ из request_data (передан в запросе)
-            # ВАЖНО: Ключи пользователей НЕ сохраняются в БД для безопасности
-            api_key_from_request = request_data.get('api_key')
-            logger.info(f"[GENERATION] В process_generation_async: ключ из запроса: {'передан' if api_key_from_request else 'не передан'}")
-            if not api_key_from_request or not api_key_from_request.strip():
-                raise ValueError(
-                    "API ключ не указан. Введите ключ Replicate или Banana Lab в настройках."
-                )
-            api_key = get_user_generation_api_key(user_id, api_key_from_request)
-            provider = infer_image_api_provider(api_key)
-            provider_label = "Banana Lab" if provider == "bananalab" else "Replicate"
-
-            # Обрабатываем ошибки инициализации клиента
-            try:
-                if provider == "bananalab":
-                    generation_service = BananalabService(api_key=api_key)
-                else:
-                    generation_service = ReplicateService(api_token=api_key)
-            except Exception as init_error:
-                error_msg = f"Ошибка инициализации клиента ({provider_label}): {str(init_error)}"
-                logger.error(f"[GENERATION] {error_msg}")
-                generation.status = "failed"
-                generation.completed_at = datetime.utcnow()
-                if not generation.generation_metadata:
-                    generation.generation_metadata = {}
-                generation.generation_metadata['error'] = error_msg
-                # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
-                from sqlalchemy.orm.attributes import flag_modified
-                flag_modified(generation, "generation_metadata")
-                session.commit()
-                logger.error(f"[GENERATION] Генерация {generation_id} завершена с ошибкой инициализации: {error_msg}")
-                return
-            
-            try:
-                # Получаем модель из запроса или из БД (для старых записей)
-                model_name = request_data.get('model_name')
-                if not model_name:
-                    # Если модель не указана в запросе, берем из БД
-                    with db_service.get_session() as session:
-                        gen = session.query(Generation).filter(Generation.id == generation_id).first()
-                        if gen and gen.model_name:
-                            model_name = gen.model_name
-                        else:
-                            # Если в БД тоже нет, используем по умолчанию
-                            model_name = "nano-banana-pro"
-                
-                if provider == "bananalab" and model_name not in SUPPORTED_BANANALAB_FRONTEND_MODELS:
-                    logger.warning(
-                        "[GENERATION] Для Banana Lab передана неподдерживаемая модель '%s'. "
-                        "Banana Lab endpoint не принимает model в body, значение будет проигнорировано.",
-                        model_name,
-                    )
-
-                logger.info(
-                    f"[GENERATION] Провайдер {provider_label}, модель {model_name}, генерация {generation_id}"
-                )
-                
-                # Генерируем изображение
-                result = generation_service.generate_image(
-                    prompt=request_data['prompt'],
-                    negative_prompt=request_data.get('negative_prompt'),
-                    resolution=request_data.get('resolution', '1K'),
-                    aspect_ratio=request_data.get('aspect_ratio', '1:1'),
-                    guidance_scale=request_data.get('guidance_scale', 7.5),
-                    num_inference_steps=request_data.get('num_inference_steps', 50),
-                    seed=request_data.get('seed'),
-                    reference_images=request_data.get('reference_images'),
-                    model_name=model_name
+    reference_image_urls: List[str] = []
+    for idx, ref_img_data in enumerate(reference_images or []):
+        try:
+            # Если это base64 data URL, извлекаем данные
+            if ref_img_data.startswith('data:image'):
+                # Парсим data URL: data:image/jpeg;base64,/9j/4AAQ...
+                header, base64_data = ref_img_data.split(',', 1)
+                mime_type = header.split(';')[0].split(':')[1] if ':' in header else 'image/jpeg'
+                image_bytes = base64.b64decode(base64_data)
+
+                # Определяем расширение файла
+                ext = 'jpg'
+                if 'png' in mime_type:
+                    ext = 'png'
+                elif 'webp' in mime_type:
+                    ext = 'webp'
+
+                # Валидация формата изображения через PIL (только проверка, без изменения)
+                try:
+                    from PIL import Image as PILImage
+                    import io as image_io
+                    img = PILImage.open(image_io.BytesIO(image_bytes))
+                    img.verify()  # Проверяем что это валидное изображение
+                    img = PILImage.open(image_io.BytesIO(image_bytes))  # Пересоздаем после verify
+
+                    # Проверяем что изображение не слишком большое (максимум 8192x8192 для валидации)
+                    MAX_DIMENSION_VALIDATION = 8192
+                    if img.width > MAX_DIMENSION_VALIDATION or img.height > MAX_DIMENSION_VALIDATION:
+                        error_msg = f"Референс {idx + 1} слишком большой ({img.width}x{img.height}). Максимальный размер: {MAX_DIMENSION_VALIDATION}x{MAX_DIMENSION_VALIDATION}"
+                        logger.error(f"[GENERATION] {error_msg}")
+                        raise ValueError(error_msg)
+
+                    # Проверяем размер файла (максимум 20MB для сохранения в MinIO)
+                    MAX_REF_SIZE = 20 * 1024 * 1024  # 20MB
+                    if len(image_bytes) > MAX_REF_SIZE:
+                        error_msg = f"Референс {idx + 1} слишком большой ({len(image_bytes) / 1024 / 1024:.1f}MB). Максимальный размер: {MAX_REF_SIZE / 1024 / 1024}MB"
+                        logger.error(f"[GENERATION] {error_msg}")
+                        raise ValueError(error_msg)
+
+                except ValueError:
+                    raise  # Пробрасываем ValueError дальше
+                except Exception as img_error:
+                    error_msg = f"Референс {idx + 1} не является валидным изображением: {str(img_error)}"
+                    logger.error(f"[GENERATION] {error_msg}")
+                    raise ValueError(error_msg)
+
+                # Укороченное имя файла (только timestamp + короткий UUID)
+                # Формат: ref_YYYYMMDD_HHMMSS_XXXX.ext (где XXXX - первые 4 символа UUID)
+                ref_filename = f"references/ref_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:4]}.{ext}"
+
+                # ВАЖНО: Сохраняем ОРИГИНАЛЬНОЕ качество в MinIO (без обработки)
+                # Оптимизация будет происходить только при отправке в Replicate API
+                upload_result = await asyncio.to_thread(
+                    minio.upload_image,
+                    image_bytes,
+                    ref_filename,
+                    mime_type
                 )
-            except Exception as gen_error:
-                # Ошибка при генерации (например, неправильный API ключ, таймаут и т.д.)
-                # Улучшенное извлечение деталей ошибки
-                error_msg = str(gen_error)
-                
-                if hasattr(gen_error, 'message'):
-                    error_msg = str(gen_error.message)
-                elif hasattr(gen_error, 'args') and len(gen_error.args) > 0:
-                    error_msg = str(gen_error.args[0])
-                
-                full_error_msg = f"Ошибка генерации ({provider_label}): {error_msg}"
-                
-                logger.error(f"[GENERATION] {full_error_msg}", exc_info=True)
-                generation.status = "failed"
-                generation.completed_at = datetime.utcnow()
-                if not generation.generation_metadata:
-                    generation.generation_metadata = {}
-                generation.generation_metadata['error'] = full_error_msg
-                # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
-                from sqlalchemy.orm.attributes import flag_modified
-                flag_modified(generation, "generation_metadata")
-                session.commit()
-                logger.error(f"[GENERATION] Генерация {generation_id} завершена с ошибкой генерации: {full_error_msg}")
-                return
-            
-            if result['success']:
-                if generation.generation_metadata and generation.generation_metadata.get("paused_request_data"):
-                    generation.generation_metadata.pop("paused_request_data", None)
-                # Логируем что получили от ReplicateService
-                logger.info(f"[GENERATION] Результат от ReplicateService: image_url={'есть' if result.get('image_url') else 'отсутствует'}, image_data={'есть' if result.get('image_data') else 'отсутствует'}")
-                # Сохраняем в MinIO если есть данные
-                if result['image_data']:
-                    try:
-                        # Проверяем размер изображения перед сохранением
-                        image_size = len(result['image_data'])
-                        logger.info(f"[GENERATION] Размер изображения: {image_size} байт")
-                        
-                        if image_size < 1024:  # Меньше 1KB - подозрительно
-                            logger.warning(f"[GENERATION] Подозрительно маленький размер изображения: {image_size} байт")
-                            # Проверяем что это действительно изображение
-                            try:
-                                from PIL import Image as PILImage
-                                import io as io_module
-                                img = PILImage.open(io_module.BytesIO(result['image_data']))
-                                img.verify()
-                                img = PILImage.open(io_module.BytesIO(result['image_data']))  # Пересоздаем после verify
-                                logger.info(f"[GENERATION] Изображение валидно: {img.format}, размер: {img.size}")
-                                # Если изображение валидно, но маленькое - возможно это миниатюра, продолжаем
-                            except Exception as img_error:
-                                logger.error(f"[GENERATION] Данные не являются валидным изображением: {img_error}")
-                                # Если не валидное изображение, пробуем загрузить полное изображение по URL от Replicate
-                                image_url = result.get('image_url')
-                                logger.info(f"[GENERATION] Проверка URL от Replicate: {image_url[:100] if image_url else 'URL отсутствует'}...")
-                                if image_url:
-                                    # Пробуем загрузить полное изображение по URL и сохранить в MinIO
-                                    try:
-                                        import requests as req_module
-                                        logger.info(f"[GENERATION] Загрузка полного изображения по URL от Replicate: {image_url[:100]}...")
-                                        img_response = req_module.get(image_url, timeout=30)
-                                        if img_response.status_code == 200:
-                                            full_image_data = img_response.content
-                                            logger.info(f"[GENERATION] Полное изображение загружено, размер: {len(full_image_data)} байт")
-                                            
-                                            # Проверяем, что это валидное изображение
-                                            try:
-                                                from PIL import Image as PILImage
-                                                import io as io_module
-                                                img = PILImage.open(io_module.BytesIO(full_image_data))
-                                                img.verify()
-                                                img = PILImage.open(io_module.BytesIO(full_image_data))
-                                                logger.info(f"[GENERATION] Полное изображение валидно: {img.format}, размер: {img.size}")
-                                                
-                                                # Сохраняем полное изображение в MinIO
-                                                filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
-                                                logger.info(f"[GENERATION] Сохранение полного изображения в MinIO: {filename}")
-                                                upload_result = minio.upload_image(
-                                                    full_image_data,
-                                                    filename,
-                                                    "image/jpeg"
-                                                )
-                                                generation.result_url = upload_result['url']
-                                                generation.result_path = upload_result['path']
-                                                logger.info(f"[GENERATION] Полное изображение сохранено в MinIO, URL: {generation.result_url[:100]}...")
-                                                generation.status = "completed"
-                                                generation.completed_at = datetime.utcnow()
-                                                session.commit()
-                                                logger.info(f"[GENERATION] Генерация {generation.id} завершена с полным изображением из MinIO")
-                                                return
-                                            except Exception as full_img_error:
-                                                logger.error(f"[GENERATION] Полное изображение также невалидно: {full_img_error}")
-                                                # Используем URL от Replicate как fallback
-                                                generation.result_url = image_url
-                                                logger.warning(f"[GENERATION] Используется URL от Replicate как fallback: {generation.result_url[:100]}...")
-                                                generation.status = "completed"
-                                                generation.completed_at = datetime.utcnow()
-                                                session.commit()
-                                                logger.info(f"[GENERATION] Генерация {generation.id} завершена с URL от Replicate")
-                                                return
-                                        else:
-                                            logger.warning(f"[GENERATION] Не удалось загрузить полное изображение, статус: {img_response.status_code}")
-                                            # Используем URL от Replicate как fallback
-                                            generation.result_url = image_url
-                                            logger.warning(f"[GENERATION] Используется URL от Replicate как fallback: {generation.result_url[:100]}...")
-                                            generation.status = "completed"
-                                            generation.completed_at = datetime.utcnow()
-                                            session.commit()
-                                            logger.info(f"[GENERATION] Генерация {generation.id} завершена с URL от Replicate")
-                                            return
-                                    except Exception as download_error:
-                                        logger.error(f"[GENERATION] Ошибка загрузки полного изображения: {download_error}")
-                                        # Используем URL от Replicate как fallback
-                                        generation.result_url = image_url
-                                        logger.warning(f"[GENERATION] Используется URL от Replicate как fallback: {generation.result_url[:100]}...")
-                                        generation.status = "completed"
-                                        generation.completed_at = datetime.utcnow()
-                                        session.commit()
-                                        logger.info(f"[GENERATION] Генерация {generation.id} завершена с URL от Replicate")
-                                        return
-                                else:
-                                    # Нет валидного изображения и нет URL - ошибка
-                                    error_msg = f"Получены невалидные данные изображения: {image_size} байт, URL отсутствует"
-                                    logger.error(f"[GENERATION] {error_msg}")
-                                    generation.status = "failed"
-                                    generation.completed_at = datetime.utcnow()
-                                    if not generation.generation_metadata:
-                                        generation.generation_metadata = {}
-                                    generation.generation_metadata['error'] = error_msg
-                                    # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
-                                    from sqlalchemy.orm.attributes import flag_modified
-                                    flag_modified(generation, "generation_metadata")
-                                    session.commit()
-                                    logger.error(f"[GENERATION] Генерация {generation.id} завершена с ошибкой: {error_msg}")
-                                    return
-                        
-                        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
-                        logger.info(f"[GENERATION] Сохранение изображения в MinIO: {filename}")
-                        upload_result = minio.upload_image(
-                            result['image_data'],
-                            filename,
-                            "image/jpeg"
-                        )
-                        generation.result_url = upload_result['url']
-                        generation.result_path = upload_result['path']
-                        logger.info(f"[GENERATION] Изображение сохранено, URL: {generation.result_url[:100]}...")
-                    except Exception as e:
-                        logger.error(f"[GENERATION] Ошибка сохранения в MinIO: {e}", exc_info=True)
-                        # Если не удалось сохранить в MinIO, используем URL от Replicate
-                        if result.get('image_url'):
-                            generation.result_url = result['image_url']
-                            logger.warning(f"[GENERATION] Используется URL от Replicate: {generation.result_url}")
-                        else:
-                            raise
-                elif result['image_url']:
-                    generation.result_url = result['image_url']
-                    logger.info(f"[GENERATION] Используется URL от Replicate: {generation.result_url}")
-                
-                generation.status = "completed"
-                generation.completed_at = datetime.utcnow()
-                total_elapsed = (generation.completed_at - started_at).total_seconds()
-                logger.info(f"[GENERATION] Генерация {generation_id} заняла {total_elapsed:.1f} сек")
+                reference_image_urls.append(upload_result['url'])
+                logger.info(f"[GENERATION] Референс {idx + 1} сохранен в MinIO: {upload_result['url'][:100]}...")
             else:
-                # Генерация не удалась - сохраняем ошибку
-                # Сначала пытаемся понять, можно ли повторить генерацию (временная ошибка типа E003/429)
-                if not generation.generation_metadata:
-                    generation.generation_metadata = {}
-
-                error_message = result.get('error')
-                if not error_message or (isinstance(error_message, str) and error_message.strip() == ''):
-                    error_message = result.get('message') or result.get('detail') or result.get('error_message')
-                if not error_message or (isinstance(error_message, str) and error_message.strip() == ''):
-                    error_message = 'Неизвестная ошибка генерации'
-
-                if not isinstance(error_message, str):
-                    error_message = str(error_message)
-
-                if _is_paused_error(error_message):
-                    generation.status = "paused"
-                    generation.completed_at = None
-                    paused_payload = _build_resume_payload(generation, request_data)
-                    generation.generation_metadata["error"] = error_message
-                    generation.generation_metadata["paused_at"] = datetime.utcnow().isoformat()
-                    generation.generation_metadata["paused_request_data"] = paused_payload
-                    from sqlalchemy.orm.attributes import flag_modified
-                    flag_modified(generation, "generation_metadata")
-                    session.commit()
-                    enqueue_paused_generation(
-                        generation_id=generation_id,
-                        user_id=user_id,
-                        request_data=paused_payload,
-                        prioritize=False,
-                    )
-                    return
-
-                # Проверяем, является ли ошибка временной (rate limit / high demand)
-                # Приоритет у явного флага из ReplicateService, чтобы ретраи не зависели от текста user-friendly сообщения.
-                lower_err = error_message.lower()
-                service_retryable = bool(result.get("retryable"))
-                is_retryable = service_retryable or (
-                    "e003" in lower_err
-                    or "high demand" in lower_err
-                    or "429" in lower_err
-                    or "ratelimit" in lower_err
-                )
-
-                current_retries = generation.generation_metadata.get("retry_count", 0)
-
-                if is_retryable and current_retries < MAX_GENERATION_RETRIES:
-                    # Увеличиваем счетчик попыток и ставим задачу обратно в очередь
-                    generation.generation_metadata["retry_count"] = current_retries + 1
-                    generation.status = "pending"
-                    generation.completed_at = None
-
-                    from sqlalchemy.orm.attributes import flag_modified
-                    flag_modified(generation, "generation_metadata")
-
-                    session.commit()
-
-                    logger.warning(
-                        f"[GENERATION] Генерация {generation_id} получила временную ошибку "
-                        f"и будет автоматически повторена ({current_retries + 1}/{MAX_GENERATION_RETRIES}): "
-                        f"{error_message[:200]}"
-                    )
-
-                    # Повторно отправляем в executor с теми же входными данными
-                    executor.submit(process_generation_async, generation_id, user_id, request_data)
-                    return
-
-                # Если ошибка не временная или исчерпаны попытки — помечаем как failed
-                generation.status = "failed"
-                generation.completed_at = datetime.utcnow()
-                total_elapsed = (generation.completed_at - started_at).total_seconds()
-                generation.generation_metadata.pop("paused_request_data", None)
-
-                # Обрезаем слишком длинные сообщения об ошибках (максимум 2000 символов)
-                if len(error_message) > 2000:
-                    error_message = error_message[:2000] + "... (сообщение обрезано)"
-
-                generation.generation_metadata['error'] = error_message
-
-                # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
-                from sqlalchemy.orm.attributes import flag_modified
-                flag_modified(generation, "generation_metadata")
+                # Если это уже URL, сохраняем как есть
+                reference_image_urls.append(ref_img_data)
+        except Exception as e:
+            logger.error(f"[GENERATION] Ошибка сохранения референса {idx + 1}: {e}", exc_info=True)
+            # В случае ошибки сохраняем оригинальный data URL как fallback
+            reference_image_urls.append(ref_img_data)
+    return reference_image_urls
 
-                logger.error(
-                    f"[GENERATION] Генерация {generation_id} завершена с ошибкой "
-                    f"после {current_retries} попыток за {total_elapsed:.1f} сек. "
-                    f"error_message: {error_message[:200]}..."
-                )
-                logger.info(f"[GENERATION] generation_metadata перед commit: {generation.generation_metadata}")
-
-                # Сохраняем ошибку в файл
-                from app.services.ErrorLogger import save_error_to_file
-                error_data = {
-                    "type": "generation_error",
-                    "generation_id": generation_id,
-                    "user_id": user_id,
-                    "prompt": request_data.get('prompt'),
-                    "error": error_message,
-                    "status": "failed"
-                }
-                save_error_to_file(error_data)
-            
-            session.commit()
-            logger.info(f"[GENERATION] Генерация {generation_id} завершена со статусом {generation.status}")
-            
-            # Проверяем что error_message сохранился
-            if generation.status == 'failed':
-                session.refresh(generation)
-                saved_error = generation.generation_metadata.get('error') if generation.generation_metadata else None
-                logger.info(f"[GENERATION] Проверка сохранения error_message для генерации {generation_id}: {saved_error[:200] if saved_error else 'НЕ СОХРАНЕНО!'}...")
-            
-    except Exception as e:
-        logger.error(f"[GENERATION] Ошибка обработки генерации {generation_id}: {e}", exc_info=True)
-        
-        # Сохраняем ошибку в файл
-        from app.services.ErrorLogger import save_error_to_file
-        error_data = {
-            "type": "generation_exception",
-            "generation_id": generation_id,
-            "user_id": user_id,
-            "error": str(e),
-            "error_type": type(e).__name__,
-        }
-        save_error_to_file(error_data)
-        
-        with db_service.get_session() as session:
-            generation = session.query(Generation).filter(Generation.id == generation_id).first()
-            if generation:
-                generation.status = "failed"
-                generation.completed_at = datetime.utcnow()
-                if not generation.generation_metadata:
-                    generation.generation_metadata = {}
-                generation.generation_metadata.pop("paused_request_data", None)
-                generation.generation_metadata['error'] = str(e)
-                # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
-                from sqlalchemy.orm.attributes import flag_modified
-                flag_modified(generation, "generation_metadata")
-                session.commit()
 
 @router.post("/generate", response_model=ImageGenerationResponse)
 async def generate_image(
@@ -576,18 +210,12 @@ async def generate_image(
         # Проверяем лимиты активных генераций по API ключу
         # Создаем хеш API ключа для группировки (первые 8 символов для идентификации)
         api_key_hash = api_key[:8] if len(api_key) >= 8 else api_key
-        with db_service.get_session() as session:
-            # Подсчитываем активные генерации для этого API ключа
-            # Используем generation_metadata для хранения хеша ключа (безопасно, не храним сам ключ)
-            active_generations = session.query(Generation).filter(
-                Generation.user_id == user.user_id,
-                Generation.status.in_(["pending", "running", "paused"])
-            ).all()
-            
-            # Фильтруем по API ключу через metadata (если храним хеш)
-            # Или просто считаем все активные генерации пользователя
+        async with db_service.get_async_session() as session:
+            # Подсчёт и INSERT — в одной транзакции под блокировкой пользователя,
+            # иначе параллельные запросы проходят проверку лимита одновременно
+            await _lock_generation_slots(session, user.user_id)
             # Для простоты считаем все активные генерации пользователя
-            active_count = len(active_generations)
+            active_count = await _active_generation_count(session, user.user_id)
             max_concurrent = settings.MAX_CONCURRENT_GENERATIONS
             
             if active_count >= max_concurrent:
@@ -597,9 +225,8 @@ async def generate_image(
                 )
             
             logger.info(f"[GENERATION] Активных генераций для пользователя {user.user_id}: {active_count}/{max_concurrent}")
-        
-        # Создаем запись в БД
-        with db_service.get_session() as session:
+            
+            # Создаем запись в БД
             # Определяем модель для сохранения (по умолчанию "nano-banana-pro")
             selected_model = request.model_name if request.model_name else "nano-banana-pro"
             logger.info(f"[GENERATION] Выбрана модель: {selected_model}")
@@ -625,93 +252,28 @@ async def generate_image(
                 generation_metadata=generation_metadata
             )
             session.add(generation)
-            session.commit()
-            session.refresh(generation)
+            await session.commit()
             
             generation_id = generation.id
             logger.info(f"[GENERATION] Генерация {generation_id} создана в БД для пользователя {user.user_id}")
             
             # Теперь сохраняем референсные изображения в MinIO и получаем их URL
-            reference_image_urls = []
+            reference_image_urls = await _store_reference_images(request.reference_images)
             if request.reference_images:
-                import base64
-                for idx, ref_img_data in enumerate(request.reference_images):
-                    try:
-                        # Если это base64 data URL, извлекаем данные
-                        if ref_img_data.startswith('data:image'):
-                            # Парсим data URL: data:image/jpeg;base64,/9j/4AAQ...
-                            header, base64_data = ref_img_data.split(',', 1)
-                            mime_type = header.split(';')[0].split(':')[1] if ':' in header else 'image/jpeg'
-                            image_bytes = base64.b64decode(base64_data)
-                            
-                            # Определяем расширение файла
-                            ext = 'jpg'
-                            if 'png' in mime_type:
-                                ext = 'png'
-                            elif 'webp' in mime_type:
-                                ext = 'webp'
-                            
-                            # Валидация формата изображения через PIL (только проверка, без изменения)
-                            try:
-                                from PIL import Image as PILImage
-                                import io as image_io
-                                img = PILImage.open(image_io.BytesIO(image_bytes))
-                                img.verify()  # Проверяем что это валидное изображение
-                                img = PILImage.open(image_io.BytesIO(image_bytes))  # Пересоздаем после verify
-                                
-                                # Проверяем что изображение не слишком большое (максимум 8192x8192 для валидации)
-                                MAX_DIMENSION_VALIDATION = 8192
-                                if img.width > MAX_DIMENSION_VALIDATION or img.height > MAX_DIMENSION_VALIDATION:
-                                    error_msg = f"Референс {idx + 1} слишком большой ({img.width}x{img.height}). Максимальный размер: {MAX_DIMENSION_VALIDATION}x{MAX_DIMENSION_VALIDATION}"
-                                    logger.error(f"[GENERATION] {error_msg}")
-                                    raise ValueError(error_msg)
-                                
-                                # Проверяем размер файла (максимум 20MB для сохранения в MinIO)
-                                MAX_REF_SIZE = 20 * 1024 * 1024  # 20MB
-                                if len(image_bytes) > MAX_REF_SIZE:
-                                    error_msg = f"Референс {idx + 1} слишком большой ({len(image_bytes) / 1024 / 1024:.1f}MB). Максимальный размер: {MAX_REF_SIZE / 1024 / 1024}MB"
-                                    logger.error(f"[GENERATION] {error_msg}")
-                                    raise ValueError(error_msg)
-                                
-                            except ValueError:
-                                raise  # Пробрасываем ValueError дальше
-                            except Exception as img_error:
-                                error_msg = f"Референс {idx + 1} не является валидным изображением: {str(img_error)}"
-                                logger.error(f"[GENERATION] {error_msg}")
-                                raise ValueError(error_msg)
-                            
-                            # Укороченное имя файла (только timestamp + короткий UUID)
-                            # Формат: ref_YYYYMMDD_HHMMSS_XXXX.ext (где XXXX - первые 4 символа UUID)
-                            ref_filename = f"references/ref_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:4]}.{ext}"
-                            
-                            # ВАЖНО: Сохраняем ОРИГИНАЛЬНОЕ качество в MinIO (без обработки)
-                            # Оптимизация будет происходить только при отправке в Replicate API
-                            upload_result = minio.upload_image(
-                                image_bytes,
-                                ref_filename,
-                                mime_type
-                            )
-                            reference_image_urls.append(upload_result['url'])
-                            logger.info(f"[GENERATION] Референс {idx + 1} сохранен в MinIO: {upload_result['url'][:100]}...")
-                        else:
-                            # Если это уже URL, сохраняем как есть
-                            reference_image_urls.append(ref_img_data)
-                    except Exception as e:
-                        logger.error(f"[GENERATION] Ошибка сохранения референса {idx + 1}: {e}", exc_info=True)
-                        # В случае ошибки сохраняем оригинальный data URL как fallback
-                        reference_image_urls.append(ref_img_data)
                 
                 # Обновляем generation_metadata с URL референсов
                 if not generation.generation_metadata:
                     generation.generation_metadata = {}
                 generation.generation_metadata['reference_images_count'] = len(request.reference_images)
                 generation.generation_metadata['reference_image_urls'] = reference_image_urls
+                # Связи с объектами MinIO для очистки (generation_references)
+                record_generation_references(session, generation_id, reference_image_urls)
                 # Модель уже сохранена в отдельное поле model_name, но для совместимости сохраняем и в metadata
                 if not generation.generation_metadata.get('model_name'):
                     generation.generation_metadata['model_name'] = generation.model_name or "nano-banana-pro"
                 from sqlalchemy.orm.attributes import flag_modified
                 flag_modified(generation, "generation_metadata")
-                session.commit()
+                await session.commit()
                 logger.info(f"[GENERATION] Референсы сохранены для генерации {generation_id}: {len(reference_image_urls)} URL")
         
         # Запускаем асинхронную обработку
@@ -720,14 +282,44 @@ async def generate_image(
         # (используется /v1/nb2/url-generations), чтобы не грузить base64 повторно.
         if reference_image_urls:
             request_data["reference_images"] = reference_image_urls
-        executor.submit(process_generation_async, generation_id, user.user_id, request_data)
+        provider = infer_image_api_provider(api_key)
+        fingerprint_data = {**request_data, "provider": provider, "model_name": selected_model}
+        # Кэш результатов только для Replicate: Banana Lab игнорирует seed, и результат не детерминирован
+        if settings.RESULT_CACHE_ENABLED and provider == "replicate" and selected_model in ReplicateService.AVAILABLE_MODELS:
+            cache_key = result_cache_key(fingerprint_data, request.reference_images)
+            if cache_key:
+                cached_url = await asyncio.to_thread(complete_from_cache, generation_id, cache_key, minio)
+                if cached_url:
+                    return ImageGenerationResponse(
+                        status="completed",
+                        image_id=generation_id,
+                        image_url=cached_url,
+                        message="Результат взят из кэша"
+                    )
+                request_data["result_cache_key"] = cache_key
+        # Идентичный запрос с тем же seed (двойной клик, "повторить") не отправляем провайдеру повторно
+        fingerprint = None
+        if settings.GENERATION_COALESCING_ENABLED:
+            fingerprint = generation_fingerprint(fingerprint_data, request.reference_images)
+        leader_id = await asyncio.to_thread(
+            submit_generation_job,
+            generation_id,
+            user.user_id,
+            request_data,
+            weight=settings.ADMIN_JOB_WEIGHT if user.is_admin else 1.0,
+            fingerprint=fingerprint,
+        )
         
         logger.info(f"[GENERATION] Задача {generation_id} добавлена в очередь пользователем {user.user_id}")
         
         return ImageGenerationResponse(
             status="pending",
             image_id=generation_id,
-            message="Генерация добавлена в очередь"
+            message=(
+                "Генерация добавлена в очередь"
+                if leader_id is None
+                else f"Идентичная генерация {leader_id} уже выполняется — результат будет скопирован из неё"
+            )
         )
         
     except HTTPException:
@@ -736,6 +328,113 @@ async def generate_image(
         logger.error(f"[GENERATION] Ошибка создания задачи: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Ошибка создания задачи генерации: {str(e)}")
 
+@router.post("/generate/batch", response_model=ImageBatchGenerationResponse)
+async def generate_image_batch(
+    request: ImageBatchGenerationRequest,
+    user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
+):
+    """
+    Батч/варианты: один промпт и набор референсов, список отличий (seed, формат, модель).
+    
+    Референсы загружаются в MinIO один раз, все генерации создаются одним INSERT
+    и ставятся в очередь группой с общим group_id (прогресс — GET /images/groups/{group_id}).
+    Каждый вариант занимает слот в лимите MAX_CONCURRENT_GENERATIONS.
+    """
+    try:
+        if not request.api_key or not request.api_key.strip():
+            raise HTTPException(
+                status_code=400,
+                detail="API ключ не указан. Введите ключ Replicate (r8_…) или Banana Lab (nb_…) в настройках.",
+            )
+        max_variations = settings.MAX_BATCH_VARIATIONS
+        if len(request.variations) > max_variations:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Слишком много вариантов ({len(request.variations)}). Максимум: {max_variations}",
+            )
+        get_user_generation_api_key(user.user_id, request.api_key)
+        
+        # Предварительная проверка без блокировки — чтобы не грузить референсы для заведомо отклонённого батча
+        async with db_service.get_async_session() as session:
+            _check_batch_slots(await _active_generation_count(session, user.user_id), len(request.variations))
+        
+        # Референсы общие для всех вариантов — сохраняем один раз
+        reference_image_urls = await _store_reference_images(request.reference_images)
+        group_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        
+        base_request = request.dict(exclude={"variations"})
+        if reference_image_urls:
+            base_request["reference_images"] = reference_image_urls
+        variant_requests = []
+        rows = []
+        for variation in request.variations:
+            overrides = {key: value for key, value in variation.dict().items() if value is not None}
+            request_data = {**base_request, **overrides}
+            request_data["model_name"] = request_data.get("model_name") or "nano-banana-pro"
+            variant_requests.append(request_data)
+            generation_metadata = {
+                'model_name': request_data["model_name"],
+                'retry_count': 0,
+                'max_retries': MAX_GENERATION_RETRIES,
+            }
+            if reference_image_urls:
+                generation_metadata['reference_images_count'] = len(reference_image_urls)
+                generation_metadata['reference_image_urls'] = reference_image_urls
+            rows.append({
+                "user_id": user.user_id,
+                "prompt": request.prompt,
+                "negative_prompt": request.negative_prompt,
+                "generation_mode": request.generation_mode,
+                "model_name": request_data["model_name"],
+                "resolution": request_data["resolution"],
+                "aspect_ratio": request_data["aspect_ratio"],
+                "guidance_scale": request.guidance_scale,
+                "num_inference_steps": request.num_inference_steps,
+                "seed": request_data.get("seed"),
+                "status": "pending",
+                "group_id": group_id,
+                "generation_metadata": generation_metadata,
+                "created_at": now,
+            })
+        
+        async with db_service.get_async_session() as session:
+            # Окончательная проверка и INSERT — в одной транзакции под блокировкой пользователя
+            await _lock_generation_slots(session, user.user_id)
+            _check_batch_slots(await _active_generation_count(session, user.user_id), len(request.variations))
+            # Один INSERT ... RETURNING id на все варианты (порядок id совпадает с порядком вариантов)
+            generation_ids = list((await session.execute(
+                insert(Generation).returning(Generation.id, sort_by_parameter_order=True),
+                rows,
+            )).scalars().all())
+            for generation_id in generation_ids:
+                record_generation_references(session, generation_id, reference_image_urls)
+            await session.run_sync(_notify_group_created, user.user_id, group_id, generation_ids)
+            await session.commit()
+        logger.info(
+            f"[GENERATION] Группа {group_id}: {len(generation_ids)} генераций создано в БД для пользователя {user.user_id}"
+        )
+        
+        await asyncio.to_thread(
+            submit_generation_group,
+            user.user_id,
+            list(zip(generation_ids, variant_requests)),
+            weight=settings.ADMIN_JOB_WEIGHT if user.is_admin else 1.0,
+        )
+        
+        return ImageBatchGenerationResponse(
+            status="pending",
+            group_id=group_id,
+            image_ids=generation_ids,
+            message=f"{len(generation_ids)} генераций добавлено в очередь"
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[GENERATION] Ошибка создания группы генераций: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Ошибка создания группы генераций: {str(e)}")
+
 @router.get("/list", response_model=list[ImageResponse])
 async def list_generations(
     request: Request,
@@ -769,51 +468,72 @@ async def list_generations(
         except (ValueError, TypeError):
             offset_val = 0
         
-        logger.info(f"[LIST] Запрос списка генераций для пользователя {user.user_id}, limit={limit_val}, offset={offset_val}")
-        with db_service.get_session() as session:
+        # Некорректный курсор, как и limit/offset, не ошибка — отдаём первую страницу
+        cursor_str = query_params.get("cursor")
+        cursor_val = _decode_list_cursor(cursor_str) if cursor_str else None
+
+        logger.info(f"[LIST] Запрос списка генераций для пользователя {user.user_id}, limit={limit_val}, offset={offset_val}, cursor={'есть' if cursor_val else 'нет'}")
+        async with db_service.get_async_session() as session:
             # Проверяем, что пользователь существует
-            db_user = session.query(User).filter(User.id == user.user_id).first()
+            db_user = (await session.execute(select(User.id).where(User.id == user.user_id))).first()
             if not db_user:
                 logger.error(f"[LIST] Пользователь {user.user_id} не найден в БД")
                 raise HTTPException(status_code=404, detail="Пользователь не найден")
             
-            # Получаем общее количество генераций пользователя
-            total_count = session.query(Generation).filter(Generation.user_id == user.user_id).count()
+            # Общее количество считаем только для первой страницы: при листании курсором оно не нужно
+            total_count = None
+            if cursor_val is None and offset_val == 0:
+                total_count = (await session.execute(
+                    select(func.count(Generation.id)).where(Generation.user_id == user.user_id)
+                )).scalar()
             
-            # Получаем все генерации пользователя
-            all_generations = session.query(Generation).filter(
-                Generation.user_id == user.user_id
-            ).order_by(Generation.created_at.desc()).all()
+            # Только нужные ImageResponse колонки: generation_metadata целиком (в нём бывают
+            # base64 референсы paused-генераций) и result_data не загружаем
+            query = select(
+                Generation.id,
+                Generation.user_id,
+                Generation.prompt,
+                Generation.negative_prompt,
+                Generation.generation_mode,
+                Generation.resolution,
+                Generation.aspect_ratio,
+                Generation.result_url,
+                Generation.status,
+                Generation.created_at,
+                Generation.model_name,
+                Generation.generation_metadata["error"].as_string().label("error"),
+                Generation.generation_metadata["model_name"].as_string().label("metadata_model_name"),
+                Generation.generation_metadata["retry_count"].as_string().label("retry_count"),
+                Generation.generation_metadata["max_retries"].as_string().label("max_retries"),
+            ).where(Generation.user_id == user.user_id).order_by(Generation.created_at.desc(), Generation.id.desc())
+            
+            # Keyset-пагинация по индексу ix_generations_user_created_id: (created_at, id) строго меньше курсора
+            if cursor_val is not None:
+                query = query.where(tuple_(Generation.created_at, Generation.id) < tuple_(*cursor_val))
+            elif offset_val:
+                query = query.offset(offset_val)
             
-            # Применяем limit и offset
-            generations = all_generations[offset_val:offset_val+limit_val]
+            # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+            rows = (await session.execute(query.limit(limit_val + 1))).all()
+            has_more = len(rows) > limit_val
+            generations = rows[:limit_val]
+            next_cursor = _encode_list_cursor(generations[-1].created_at, generations[-1].id) if has_more else None
             
             result = []
             for gen in generations:
-                # Извлекаем error_message из generation_metadata
-                # Для старых генераций (до добавления error_message) будет None
-                error_msg = None
-                if gen.generation_metadata:
-                    error_msg = gen.generation_metadata.get('error')
-                    # Логируем только для failed генераций без error_message (проблема!)
-                    if gen.status == 'failed' and not error_msg:
-                        logger.warning(f"[LIST] Генерация {gen.id} имеет статус 'failed', но error_message отсутствует в generation_metadata: {gen.generation_metadata}")
-                elif gen.status == 'failed':
-                    logger.warning(f"[LIST] Генерация {gen.id} имеет статус 'failed', но generation_metadata отсутствует")
+                # error_message из generation_metadata; для старых генераций (до добавления error_message) будет None
+                error_msg = gen.error
+                if gen.status == 'failed' and not error_msg:
+                    logger.warning(f"[LIST] Генерация {gen.id} имеет статус 'failed', но error_message отсутствует в generation_metadata")
                 
                 # Извлекаем model_name из поля или метаданных (для обратной совместимости)
-                model_name = gen.model_name
-                if not model_name and gen.generation_metadata:
-                    model_name = gen.generation_metadata.get('model_name')
+                model_name = gen.model_name or gen.metadata_model_name
                 # Если модель все еще не найдена, используем по умолчанию
                 if not model_name:
                     model_name = "nano-banana-pro"
 
-                retry_count = 0
-                max_retries = MAX_GENERATION_RETRIES
-                if gen.generation_metadata:
-                    retry_count = int(gen.generation_metadata.get("retry_count", 0) or 0)
-                    max_retries = int(gen.generation_metadata.get("max_retries", MAX_GENERATION_RETRIES) or MAX_GENERATION_RETRIES)
+                retry_count = int(gen.retry_count or 0)
+                max_retries = int(gen.max_retries or MAX_GENERATION_RETRIES)
                 
                 result.append(ImageResponse(
                     id=gen.id,
@@ -867,8 +587,9 @@ async def list_generations(
                     "shown": len(result),
                     "limit": limit_val,
                     "offset": offset_val,
+                    "next_cursor": next_cursor,
                     "storage_info": {
-                        "retention_days": 7,
+                        "retention_days": RETENTION_DAYS,
                         "message": "Изображения хранятся 7 дней, затем автоматически удаляются"
                     }
                 }
@@ -877,17 +598,105 @@ async def list_generations(
         logger.error(f"[LIST] Ошибка получения списка генераций: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Ошибка получения списка генераций: {str(e)}")
 
+# Как часто слать комментарий-heartbeat в SSE, чтобы прокси не закрывали простаивающее соединение
+EVENTS_HEARTBEAT_SECONDS = 15
+
+
+@router.get("/events")
+async def generation_events_stream(
+    request: Request,
+    user: Annotated[TokenPayload, Depends(auth_service.get_current_user_from_query)]
+):
+    """
+    Server-Sent Events: дельты статусов генераций пользователя
+    ({"id", "user_id", "status", "result_url"/"error"}) вместо периодического опроса /images/list.
+
+    EventSource не передаёт заголовки, поэтому токен можно передать в ?token=.
+    """
+    queue = generation_events.subscribe(user.user_id)
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    event_data = await asyncio.wait_for(queue.get(), timeout=EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: generation\ndata: {json.dumps(event_data, ensure_ascii=False, default=str)}\n\n"
+        finally:
+            generation_events.unsubscribe(user.user_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/groups/{group_id}", response_model=dict)
+async def get_generation_group(
+    group_id: str,
+    user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
+):
+    """Прогресс группы батча/вариантов: счётчики по статусам и краткие данные генераций"""
+    async with db_service.get_async_session() as session:
+        rows = (await session.execute(
+            select(
+                Generation.id,
+                Generation.status,
+                Generation.result_url,
+                Generation.seed,
+                Generation.aspect_ratio,
+                Generation.resolution,
+                Generation.model_name,
+            )
+            .where(Generation.group_id == group_id, Generation.user_id == user.user_id)
+            .order_by(Generation.id)
+        )).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Группа генераций не найдена")
+    
+    counts: Dict[str, int] = {}
+    for row in rows:
+        counts[row.status] = counts.get(row.status, 0) + 1
+    finished = counts.get("completed", 0) + counts.get("failed", 0) + counts.get("cancelled", 0)
+    return {
+        "group_id": group_id,
+        "total": len(rows),
+        "finished": finished,
+        "status": "completed" if finished == len(rows) else "pending",
+        "counts": counts,
+        "generations": [
+            {
+                "id": row.id,
+                "status": row.status,
+                "result_url": row.result_url,
+                "seed": row.seed,
+                "aspect_ratio": row.aspect_ratio,
+                "resolution": row.resolution,
+                "model_name": row.model_name,
+            }
+            for row in rows
+        ],
+    }
+
 @router.get("/{generation_id}", response_model=dict)
 async def get_generation_full(
     generation_id: int,
     user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
 ):
     """Получение полных данных генерации для редактирования"""
-    with db_service.get_session() as session:
-        generation = session.query(Generation).filter(
-            Generation.id == generation_id,
-            Generation.user_id == user.user_id
-        ).first()
+    async with db_service.get_async_session() as session:
+        generation = (await session.execute(
+            select(Generation).where(
+                Generation.id == generation_id,
+                Generation.user_id == user.user_id
+            )
+        )).scalars().first()
         
         if not generation:
             raise HTTPException(status_code=404, detail="Генерация не найдена")
@@ -938,31 +747,132 @@ async def get_available_models():
         "replicate_key_prefix_hint": "r8_",
     }
 
+def _mark_generation_cancelled(generation: Generation):
+    """Переводит генерацию в cancelled; при commit воркер получает NOTIFY generation_status и прерывается."""
+    metadata = dict(generation.generation_metadata or {})
+    metadata.pop("paused_request_data", None)
+    metadata["cancelled_at"] = datetime.utcnow().isoformat()
+    generation.generation_metadata = metadata
+    generation.status = "cancelled"
+    generation.completed_at = datetime.utcnow()
+
+
+async def _cancel_generation_job(generation_id: int):
+    """Снимает задачу с очереди и отменяет prediction Replicate у провайдера."""
+    payload = await asyncio.to_thread(job_queue.cancel, generation_id) or {}
+    provider_job = payload.get("provider_job") or {}
+    if provider_job.get("provider") == "replicate" and payload.get("api_key"):
+        # Запаркованный prediction (REPLICATE_ASYNC_PREDICTIONS) ни один воркер не ждёт — отменяем сами
+        try:
+            service = ReplicateService(api_token=payload["api_key"])
+            await asyncio.to_thread(service.cancel_prediction, provider_job["id"])
+        except Exception as e:
+            logger.warning(f"[GENERATION] Не удалось отменить prediction {provider_job['id']}: {e}")
+
+
+@router.post("/{generation_id}/cancel")
+async def cancel_generation(
+    generation_id: int,
+    user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
+):
+    """
+    Отмена генерации в очереди или в работе. Задача снимается с очереди, воркер,
+    ожидающий провайдера, прерывается (NOTIFY generation_status), а prediction
+    Replicate отменяется и у провайдера. Слот MAX_CONCURRENT_GENERATIONS освобождается сразу.
+    """
+    async with db_service.get_async_session() as session:
+        generation = (await session.execute(
+            select(Generation).where(
+                Generation.id == generation_id,
+                Generation.user_id == user.user_id
+            ).with_for_update()
+        )).scalars().first()
+
+        if not generation:
+            raise HTTPException(status_code=404, detail="Генерация не найдена")
+        if generation.status in ("completed", "failed", "cancelled"):
+            raise HTTPException(status_code=409, detail="Генерация уже завершена")
+
+        _mark_generation_cancelled(generation)
+        await session.commit()
+
+    await _cancel_generation_job(generation_id)
+
+    logger.info(f"[GENERATION] Генерация {generation_id} отменена пользователем {user.user_id}")
+    return {"id": generation_id, "status": "cancelled", "message": "Генерация отменена"}
+
+
 @router.delete("/{generation_id}")
 async def delete_generation(
     generation_id: int,
     user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
 ):
-    """Удаление генерации"""
-    with db_service.get_session() as session:
-        generation = session.query(Generation).filter(
-            Generation.id == generation_id,
-            Generation.user_id == user.user_id
-        ).first()
+    """
+    Удаление генерации. Незавершённая генерация сначала отменяется так же, как в
+    POST /{generation_id}/cancel, иначе воркер и prediction Replicate продолжают работу.
+    """
+    async with db_service.get_async_session() as session:
+        generation = (await session.execute(
+            select(Generation).where(
+                Generation.id == generation_id,
+                Generation.user_id == user.user_id
+            ).with_for_update()
+        )).scalars().first()
         
         if not generation:
             raise HTTPException(status_code=404, detail="Генерация не найдена")
         
+        if generation.status not in ("completed", "failed", "cancelled"):
+            # Задачу очереди удалил бы CASCADE вместе с payload — отменяем до удаления строки
+            _mark_generation_cancelled(generation)
+            await session.commit()
+            await _cancel_generation_job(generation_id)
+            logger.info(f"[GENERATION] Генерация {generation_id} отменена перед удалением")
+        
         # Удаляем из MinIO результат, если есть
         if generation.result_path:
-            minio.delete_image(generation.result_path)
+            await asyncio.to_thread(minio.delete_image, generation.result_path)
 
-        session.delete(generation)
-        session.commit()
+        await session.delete(generation)
+        await session.commit()
 
         return {"message": "Генерация удалена"}
 
 
+@router.post("/replicate/webhook")
+async def replicate_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    generation_id: int,
+    token: str,
+):
+    """
+    Webhook Replicate (событие completed) для генераций в режиме REPLICATE_ASYNC_PREDICTIONS.
+
+    Авторизация — подпись generation_id в query (token), её выдаёт воркер при создании prediction.
+    Скачивание результата и загрузка в MinIO выполняются после ответа Replicate.
+    """
+    if not verify_replicate_webhook_token(generation_id, token):
+        raise HTTPException(status_code=403, detail="Неверная подпись webhook")
+
+    try:
+        prediction = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Тело webhook не JSON")
+    if not isinstance(prediction, dict):
+        raise HTTPException(status_code=400, detail="Неожиданный формат webhook")
+
+    if prediction.get("status") not in ("succeeded", "failed", "canceled"):
+        return {"status": "ignored"}
+
+    logger.info(
+        f"[GENERATION] Webhook Replicate: генерация {generation_id}, prediction {prediction.get('id')}, "
+        f"статус {prediction.get('status')}"
+    )
+    background_tasks.add_task(handle_replicate_webhook, generation_id, prediction)
+    return {"status": "accepted"}
+
+
 @router.post("/cleanup")
 async def cleanup_old_generations(
     user: Annotated[TokenPayload, Depends(auth_service.get_current_user)]
@@ -976,65 +886,10 @@ async def cleanup_old_generations(
     if not user.is_admin:
         raise HTTPException(status_code=403, detail="Доступ запрещен")
 
-    retention_days = 7
+    retention_days = RETENTION_DAYS
     cutoff = datetime.utcnow() - timedelta(days=retention_days)
 
-    deleted_count = 0
-    deleted_files: List[str] = []
-
-    from app.config import settings as app_settings
-
-    with db_service.get_session() as session:
-        old_generations: List[Generation] = (
-            session.query(Generation)
-            .filter(Generation.created_at < cutoff)
-            .all()
-        )
-
-        logger.info(
-            f"[CLEANUP] Найдено {len(old_generations)} генераций старше {retention_days} дней для удаления"
-        )
-
-        for gen in old_generations:
-            # Удаляем результат из MinIO
-            if gen.result_path:
-                if minio.delete_image(gen.result_path):
-                    deleted_files.append(gen.result_path)
-            # Удаляем референсы из MinIO (по сохраненным публичным URL),
-            # только если этот URL не используется ни в одной другой генерации.
-            if gen.generation_metadata:
-                ref_urls: List[str] = gen.generation_metadata.get("reference_image_urls") or []
-                for url in ref_urls:
-                    if not url:
-                        continue
-                    # Проверяем, есть ли другие генерации (кроме текущей),
-                    # у которых в metadata присутствует этот же URL
-                    other_gens: List[Generation] = (
-                        session.query(Generation)
-                        .filter(Generation.id != gen.id)
-                        .filter(Generation.generation_metadata.isnot(None))
-                        .all()
-                    )
-                    url_used_elsewhere = False
-                    for other in other_gens:
-                        other_urls = []
-                        if other.generation_metadata:
-                            other_urls = other.generation_metadata.get("reference_image_urls") or []
-                        if url in other_urls:
-                            url_used_elsewhere = True
-                            break
-
-                    if url_used_elsewhere:
-                        continue
-
-                    path = _extract_minio_path_from_url(url, app_settings.MINIO_BUCKET)
-                    if path and minio.delete_image(path):
-                        deleted_files.append(path)
-
-            session.delete(gen)
-            deleted_count += 1
-
-        session.commit()
+    deleted_count, deleted_files = await asyncio.to_thread(purge_expired_generations, minio, cutoff, "CLEANUP")
 
     logger.info(
         f"[CLEANUP] Удалено генераций: {deleted_count}, файлов в MinIO: {len(deleted_files)}"
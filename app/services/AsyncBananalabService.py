@@ -0,0 +1,191 @@
+"""
+Асинхронный клиент Banana Lab на общем event loop (app.services.async_runtime).
+
+Логика запроса, разбора статусов задачи и ошибок общая с BananalabService;
+здесь отличается только транспорт: httpx.AsyncClient из общего пула, а статус
+задачи ждёт центральный поллер (app.services.bananalab_poller). Один поток
+event loop обслуживает сотни ожидающих генераций вместо потока пула на каждую.
+"""
+import asyncio
+import base64
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from app.services.async_runtime import async_runtime
+from app.services.bananalab_poller import bananalab_poller
+from app.services.BananalabService import (
+    BananalabService,
+    _optimize_image_for_api,
+    _safe_response_body_for_log,
+    failure_result,
+    success_result,
+)
+from app.services.retry_backoff import parse_retry_after
+from app.services.bananalab_response import (
+    absolute_job_status_url,
+    find_image_in_json,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _response_body(resp: httpx.Response) -> Any:
+    try:
+        return resp.json()
+    except Exception:
+        return resp.text
+
+
+class AsyncBananalabService(BananalabService):
+    """Banana Lab: тот же контракт generate_image(), но корутиной"""
+
+    def _client(self) -> httpx.AsyncClient:
+        return async_runtime.http_client()
+
+    async def _poll_job_until_done(self, initial: Dict[str, Any]) -> Dict[str, Any]:
+        """Ждёт завершения задачи в центральном поллере вместо собственного цикла опроса."""
+        status_url = absolute_job_status_url(self.base_url, initial)
+        if not status_url:
+            return initial
+        if self.provider_job_callback is not None:
+            # Колбэк пишет в БД — не блокируем event loop
+            await asyncio.to_thread(self.provider_job_callback, self._provider_job(initial, status_url))
+        return await bananalab_poller.wait(
+            status_url, self._headers(), initial, self.JOB_TIMEOUT_SECONDS, self.cancellation
+        )
+
+    async def _fallback_b64_from_urls(self, input_url_list: List[str]) -> List[str]:
+        fallback_b64: List[str] = []
+        for idx, img_url in enumerate(input_url_list, 1):
+            try:
+                r = await self._client().get(img_url, timeout=30)
+                if r.status_code == 200:
+                    img_data = await asyncio.to_thread(_optimize_image_for_api, r.content, idx)
+                    fallback_b64.append(base64.b64encode(img_data).decode("ascii"))
+            except Exception as e:
+                logger.warning("[BANANALAB] fallback URL->base64 не удался для ref %s: %s", idx, e)
+        return fallback_b64
+
+    async def _download_result(self, image_url: str) -> Dict[str, Any]:
+        try:
+            img_r = await self._client().get(image_url, timeout=60)
+            if img_r.status_code != 200:
+                logger.warning(
+                    "[BANANALAB] Скачивание результата HTTP %s: %s",
+                    img_r.status_code,
+                    _safe_response_body_for_log(img_r.text[:2000] if img_r.text else ""),
+                )
+                return success_result(image_url, None)
+            return success_result(image_url, img_r.content)
+        except Exception as dl_e:
+            logger.warning("[BANANALAB] Не удалось скачать изображение: %s", dl_e)
+            return success_result(image_url, None)
+
+    async def _job_result(self, data: Any) -> Dict[str, Any]:
+        if isinstance(data, dict) and data.get("__bananalab_job_failed__"):
+            return self._job_failure_result(data)
+
+        raw_bytes, image_url = find_image_in_json(data)
+        if raw_bytes:
+            logger.info("[BANANALAB] Получены бинарные данные изображения, %s байт", len(raw_bytes))
+            return success_result(image_url, raw_bytes)
+        if image_url:
+            return await self._download_result(image_url)
+
+        return self._unexpected_format_result(data)
+
+    async def resume_job(self, provider_job: Dict[str, Any]) -> Dict[str, Any]:
+        logger.info("[BANANALAB] job_id=%s: возобновляем ожидание задачи", provider_job.get("job_id"))
+        initial = {"job_id": provider_job.get("job_id"), "status_url": provider_job.get("status_url")}
+        return await self._job_result(await self._poll_job_until_done(initial))
+
+    async def generate_image(
+        self,
+        prompt: str,
+        negative_prompt: Optional[str] = None,
+        resolution: str = "1K",
+        aspect_ratio: str = "1:1",
+        guidance_scale: float = 7.5,
+        num_inference_steps: int = 50,
+        seed: Optional[int] = None,
+        reference_images: Optional[List] = None,
+        model_name: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        self._log_ignored_params(negative_prompt, guidance_scale, num_inference_steps, seed, model_name)
+        reference_images = reference_images or []
+        # Оптимизация референсов (PIL) — CPU, не блокируем event loop
+        input_b64_list, input_url_list = await asyncio.to_thread(
+            self._collect_reference_inputs, reference_images
+        )
+        final_prompt = self._final_prompt(prompt, reference_images, input_b64_list, input_url_list)
+
+        url, payload = self._endpoint_for(
+            final_prompt, aspect_ratio, resolution, input_b64_list, input_url_list, use_url_refs=True
+        )
+
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            try:
+                logger.info(
+                    "[BANANALAB] POST %s (попытка %s/%s), refs(base64)=%s refs(url)=%s",
+                    url,
+                    attempt,
+                    self.MAX_RETRIES,
+                    len(input_b64_list),
+                    len(input_url_list),
+                )
+                resp = await self._client().post(
+                    url,
+                    headers=self._headers(),
+                    json=payload,
+                    timeout=self.TIMEOUT,
+                )
+
+                if resp.status_code >= 400:
+                    msg, error_result = self._http_error_result(
+                        resp.status_code, _response_body(resp), parse_retry_after(resp.headers.get("Retry-After"))
+                    )
+                    # Авто-fallback: если URL endpoint запрещен для аккаунта, пересобираем запрос в base64 endpoint.
+                    if self._is_url_endpoint_disabled(url, resp.status_code, msg):
+                        logger.warning(
+                            "[BANANALAB] URL endpoint не включен для аккаунта, fallback на /v1/nb2/generations"
+                        )
+                        url, payload = self._endpoint_for(
+                            final_prompt,
+                            aspect_ratio,
+                            resolution,
+                            input_b64_list,
+                            input_url_list,
+                            use_url_refs=False,
+                            fallback_b64=await self._fallback_b64_from_urls(input_url_list),
+                        )
+                        if payload.get("input_images_base64"):
+                            continue
+                        return failure_result(
+                            "URL endpoint Banana Lab недоступен и fallback в base64 не удался.", False
+                        )
+                    return error_result
+
+                try:
+                    data = resp.json()
+                except Exception as e:
+                    return failure_result(f"Ответ Banana Lab не JSON: {e}", False)
+
+                if isinstance(data, dict) and (data.get("job_id") or data.get("status_url")):
+                    data = await self._poll_job_until_done(data)
+                return await self._job_result(data)
+
+            except httpx.TimeoutException:
+                return failure_result(
+                    "Таймаут запроса к Banana Lab. Попробуйте проще промпт или позже.", True
+                )
+            except Exception as e:
+                logger.exception("[BANANALAB] Сбой запроса: %s", e)
+                lower = str(e).lower()
+                return failure_result(
+                    str(e) or "Ошибка сети при обращении к Banana Lab",
+                    any(x in lower for x in ("timeout", "connection", "429")),
+                )
+
+        return failure_result("Неизвестная ошибка", True)
@@ -6,7 +6,7 @@ from typing import Optional
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
 import bcrypt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, status
 from app.config import settings
 from app.models.base import User        
 from app.models.token import TokenData, TokenPayload
@@ -96,7 +96,29 @@ class AuthService:
                 headers={"WWW-Authenticate": "Bearer"},
             )
 
-        token = credentials.credentials
+        return self.decode_token(credentials.credentials)
+
+    async def get_current_user_from_query(
+        self,
+        token: Optional[str] = Query(None),
+        credentials: HTTPAuthorizationCredentials = Depends(oauth2_scheme)
+    ):
+        """
+        Текущий пользователь для потоковых эндпоинтов (SSE): EventSource в браузере
+        не умеет передавать заголовки, поэтому токен можно передать в ?token=.
+        """
+        if credentials is not None:
+            return self.decode_token(credentials.credentials)
+        if not token:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Authorization token missing",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return self.decode_token(token)
+
+    def decode_token(self, token: str) -> TokenPayload:
+        """Проверка JWT и извлечение данных пользователя"""
         try:
             payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
             token_payload = TokenPayload(
@@ -6,12 +6,14 @@ import base64
 import json
 import logging
 import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
 
 from app.config import settings
 from app.services.generation_prompt import enhance_prompt_for_image_generation
+from app.services.cancellation import CancellationToken
+from app.services.retry_backoff import parse_retry_after
 from app.services.bananalab_response import (
     absolute_job_status_url,
     detail_from_response_body,
@@ -52,12 +54,66 @@ def _optimize_image_for_api(image_data: bytes, ref_index: int) -> bytes:
     return ReplicateService._optimize_image_for_api(_RefOptimizeShim(), image_data, ref_index)
 
 
+# Статусы задачи GET /v1/jobs/{id}
+JOB_DONE_STATUSES = ("completed", "succeeded", "success", "done", "finished")
+JOB_FAILED_STATUSES = ("failed", "error", "cancelled", "canceled")
+JOB_PENDING_STATUSES = (
+    "",
+    "queued",
+    "pending",
+    "processing",
+    "running",
+    "in_progress",
+    "started",
+    "working",
+)
+
+
+def failure_result(error: str, retryable: bool) -> Dict[str, Any]:
+    """Результат generate_image() при ошибке (общий контракт с ReplicateService)."""
+    return {
+        "success": False,
+        "image_url": None,
+        "image_data": None,
+        "error": error,
+        "retryable": retryable,
+    }
+
+
+def success_result(image_url: Optional[str], image_data: Optional[bytes]) -> Dict[str, Any]:
+    return {
+        "success": True,
+        "image_url": image_url,
+        "image_data": image_data,
+        "error": None,
+    }
+
+
+def parked_result(provider_job: Dict[str, Any]) -> Dict[str, Any]:
+    """Результат generate_image() с park_jobs: задача создана у провайдера, ждать её будет очередь."""
+    return {
+        "success": False,
+        "parked": True,
+        "provider_job": provider_job,
+        "image_url": None,
+        "image_data": None,
+        "error": None,
+    }
+
+
 class BananalabService:
     TIMEOUT = 900
     JOB_TIMEOUT_SECONDS = 420
+    # Запросов на генерацию: второй — только fallback URL-референсов в base64. 429/503 и таймауты
+    # не повторяются здесь: повтор с экспоненциальной задержкой планирует воркер через очередь
     MAX_RETRIES = 3
-    RETRY_DELAY_SECONDS = 5
     JOB_POLL_INTERVAL_SECONDS = 3.0
+    # Токен отмены генерации (выставляет воркер); None — ожидание не прерывается
+    cancellation: Optional[CancellationToken] = None
+    # Вызывается с хэндлом задачи сразу после её создания у провайдера (воркер сохраняет его в БД)
+    provider_job_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+    # Не ждать созданную задачу: generate_image() сразу вернёт parked_result() с её хэндлом
+    park_jobs: bool = False
 
     def __init__(self, api_key: str, base_url: Optional[str] = None):
         if not api_key or not api_key.strip():
@@ -75,115 +131,70 @@ class BananalabService:
     def _job_status_normalized(data: Dict[str, Any]) -> str:
         return str(data.get("status") or "").strip().lower()
 
-    def _poll_job_until_done(self, initial: Dict[str, Any]) -> Dict[str, Any]:
-        """Опрос GET status_url пока задача не завершится или не истечёт TIMEOUT."""
-        status_url = absolute_job_status_url(self.base_url, initial)
-        if not status_url:
-            return initial
-
-        poll_started_at = time.time()
-        deadline = time.time() + self.JOB_TIMEOUT_SECONDS
-        current: Any = initial
-        last_logged: Optional[str] = None
-        job_id = initial.get("job_id")
-
-        while time.time() < deadline:
-            if not isinstance(current, dict):
-                break
-
-            st = self._job_status_normalized(current)
-            # Banana Lab иногда сообщает о паузе модели текстом, не меняя status на failed.
-            diag = (
-                f"{current.get('error') or ''} "
-                f"{current.get('message') or ''} "
-                f"{current.get('detail') or ''}"
-            ).lower()
-            if "paused" in diag:
-                return {
-                    "__bananalab_job_failed__": True,
-                    "error": str(
-                        current.get("error")
-                        or current.get("message")
-                        or current.get("detail")
-                        or "Модель Banana Lab временно на паузе"
-                    ),
-                    "retryable": False,
-                    "_raw": current,
-                }
-            if st != last_logged:
-                elapsed = time.time() - poll_started_at
-                logger.info(
-                    "[BANANALAB] job_id=%s status=%s elapsed=%.1fs",
-                    job_id,
-                    current.get("status"),
-                    elapsed,
-                )
-                last_logged = st
-
-            if st in ("completed", "succeeded", "success", "done", "finished"):
-                return current
-            if st in ("failed", "error", "cancelled", "canceled"):
-                err = (
+    @classmethod
+    def _job_terminal_state(cls, current: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Разбирает очередной ответ GET status_url.
+        Возвращает итоговый ответ задачи (успех или маркер __bananalab_job_failed__)
+        либо None, если задача ещё выполняется.
+        """
+        st = cls._job_status_normalized(current)
+        # Banana Lab иногда сообщает о паузе модели текстом, не меняя status на failed.
+        diag = (
+            f"{current.get('error') or ''} "
+            f"{current.get('message') or ''} "
+            f"{current.get('detail') or ''}"
+        ).lower()
+        if "paused" in diag:
+            return {
+                "__bananalab_job_failed__": True,
+                "error": str(
                     current.get("error")
                     or current.get("message")
-                    or detail_from_response_body(current)
-                )
-                return {"__bananalab_job_failed__": True, "error": str(err), "_raw": current}
-
-            img_b, img_u = find_image_in_json(current)
-            if img_b or img_u:
-                return current
-
-            if st not in (
-                "",
-                "queued",
-                "pending",
-                "processing",
-                "running",
-                "in_progress",
-                "started",
-                "working",
-            ):
-                logger.warning(
-                    "[BANANALAB] Неизвестный status=%r — проверьте документацию API",
-                    current.get("status"),
-                )
-
-            time.sleep(self.JOB_POLL_INTERVAL_SECONDS)
+                    or current.get("detail")
+                    or "Модель Banana Lab временно на паузе"
+                ),
+                "retryable": False,
+                "_raw": current,
+            }
+
+        if st in JOB_DONE_STATUSES:
+            return current
+        if st in JOB_FAILED_STATUSES:
+            err = (
+                current.get("error")
+                or current.get("message")
+                or detail_from_response_body(current)
+            )
+            return {"__bananalab_job_failed__": True, "error": str(err), "_raw": current}
 
-            try:
-                pr = requests.get(status_url, headers=self._headers(), timeout=120)
-            except requests.RequestException as e:
-                logger.warning("[BANANALAB] Ошибка GET job: %s", e)
-                continue
+        img_b, img_u = find_image_in_json(current)
+        if img_b or img_u:
+            return current
 
-            if pr.status_code >= 400:
-                try:
-                    body = pr.json()
-                except Exception:
-                    body = pr.text
-                logger.error(
-                    "[BANANALAB] GET job HTTP %s: %s",
-                    pr.status_code,
-                    _safe_response_body_for_log(body),
-                )
-                return {
-                    "__bananalab_job_failed__": True,
-                    "error": detail_from_response_body(body),
-                    "retryable": False,
-                    "_raw": body,
-                }
+        if st not in JOB_PENDING_STATUSES:
+            logger.warning(
+                "[BANANALAB] Неизвестный status=%r — проверьте документацию API",
+                current.get("status"),
+            )
+        return None
 
-            try:
-                current = pr.json()
-            except Exception as e:
-                return {
-                    "__bananalab_job_failed__": True,
-                    "error": f"Ответ job не JSON: {e}",
-                    "retryable": False,
-                    "_raw": None,
-                }
+    @staticmethod
+    def _job_http_error(status_code: int, body: Any) -> Dict[str, Any]:
+        logger.error(
+            "[BANANALAB] GET job HTTP %s: %s",
+            status_code,
+            _safe_response_body_for_log(body),
+        )
+        return {
+            "__bananalab_job_failed__": True,
+            "error": detail_from_response_body(body),
+            "retryable": False,
+            "_raw": body,
+        }
 
+    @staticmethod
+    def _job_timeout(poll_started_at: float, current: Any) -> Dict[str, Any]:
         elapsed = time.time() - poll_started_at
         return {
             "__bananalab_job_failed__": True,
@@ -192,18 +203,64 @@ class BananalabService:
             "_raw": current,
         }
 
-    def generate_image(
-        self,
-        prompt: str,
-        negative_prompt: Optional[str] = None,
-        resolution: str = "1K",
-        aspect_ratio: str = "1:1",
-        guidance_scale: float = 7.5,
-        num_inference_steps: int = 50,
-        seed: Optional[int] = None,
-        reference_images: Optional[List] = None,
-        model_name: Optional[str] = None,
-    ) -> Dict[str, Any]:
+    @staticmethod
+    def _job_cancelled() -> Dict[str, Any]:
+        return {
+            "__bananalab_job_failed__": True,
+            "error": "Генерация отменена",
+            "retryable": False,
+            "_raw": None,
+        }
+
+    @staticmethod
+    def _provider_job(initial: Dict[str, Any], status_url: str) -> Dict[str, Any]:
+        """Хэндл задачи Banana Lab, по которому к ней можно вернуться после перезапуска воркера."""
+        return {"provider": "bananalab", "job_id": initial.get("job_id"), "status_url": status_url}
+
+    def _poll_job_until_done(self, initial: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Ждёт завершения задачи через центральный поллер (app.services.bananalab_poller),
+        пока задача не завершится или не истечёт JOB_TIMEOUT_SECONDS.
+        С park_jobs не ждёт, а возвращает маркер с хэндлом задачи.
+        """
+        status_url = absolute_job_status_url(self.base_url, initial)
+        if not status_url:
+            return initial
+        if self.park_jobs:
+            return {"__bananalab_job_parked__": True, "provider_job": self._provider_job(initial, status_url)}
+        if self.provider_job_callback is not None:
+            self.provider_job_callback(self._provider_job(initial, status_url))
+
+        # Ленивый импорт: поллер сам импортирует этот модуль
+        from app.services.async_runtime import async_runtime
+        from app.services.bananalab_poller import bananalab_poller
+
+        future = async_runtime.submit(
+            bananalab_poller.wait(status_url, self._headers(), initial, self.JOB_TIMEOUT_SECONDS, self.cancellation)
+        )
+        return future.result()
+
+    @staticmethod
+    def _job_failure_result(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Итог задачи с маркером __bananalab_job_failed__ → результат generate_image()."""
+        err_msg = str(data.get("error") or "Ошибка задачи Banana Lab")
+        low = err_msg.lower()
+        explicit_retryable = bool(data.get("retryable"))
+        return failure_result(
+            err_msg,
+            explicit_retryable or any(
+                x in low for x in ("timeout", "таймаут", "429", "503", "unavailable")
+            ),
+        )
+
+    @staticmethod
+    def _log_ignored_params(
+        negative_prompt: Optional[str],
+        guidance_scale: float,
+        num_inference_steps: int,
+        seed: Optional[int],
+        model_name: Optional[str],
+    ):
         if negative_prompt:
             logger.debug("[BANANALAB] negative_prompt игнорируется API Banana Lab")
         if guidance_scale != 7.5 or num_inference_steps != 50 or seed is not None:
@@ -213,9 +270,12 @@ class BananalabService:
 
         if model_name and model_name not in SUPPORTED_BANANALAB_FRONTEND_MODELS:
             logger.warning("[BANANALAB] Модель %s не поддерживается клиентом, игнорируем", model_name)
+
+    @staticmethod
+    def _collect_reference_inputs(reference_images: List) -> Tuple[List[str], List[str]]:
+        """Делит референсы на base64 (оптимизированные) и URL (для url-generations)."""
         input_b64_list: List[str] = []
         input_url_list: List[str] = []
-        reference_images = reference_images or []
 
         for idx, img in enumerate(reference_images[:14], 1):
             try:
@@ -236,70 +296,216 @@ class BananalabService:
                     input_b64_list.append(base64.b64encode(img_data).decode("ascii"))
             except Exception as e:
                 logger.error("[BANANALAB] Ошибка референса %s: %s", idx, e)
+        return input_b64_list, input_url_list
 
+    @staticmethod
+    def _final_prompt(prompt: str, reference_images: List, input_b64_list: List[str], input_url_list: List[str]) -> str:
         num_refs_effective = len(input_b64_list) + len(input_url_list)
         if reference_images and num_refs_effective == 0:
             num_refs_effective = len(reference_images)
 
-        final_prompt = enhance_prompt_for_image_generation(
+        return enhance_prompt_for_image_generation(
             prompt, reference_images if reference_images else None, num_refs_effective
         )
 
+    def _endpoint_for(
+        self,
+        final_prompt: str,
+        aspect_ratio: str,
+        resolution: str,
+        input_b64_list: List[str],
+        input_url_list: List[str],
+        use_url_refs: bool,
+        fallback_b64: Optional[List[str]] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Выбирает endpoint и тело запроса. fallback_b64 — референсы, скачанные по URL
+        и перекодированные в base64 (если URL endpoint выключен на аккаунте).
+        """
         has_b64_refs = len(input_b64_list) > 0
         has_url_refs = len(input_url_list) > 0 and not has_b64_refs
-
-        def _build_request(use_url_refs: bool) -> tuple[str, Dict[str, Any]]:
-            if has_b64_refs:
-                return (
-                    f"{self.base_url}/v1/nb2/generations",
-                    {
-                        "prompt": final_prompt,
-                        "aspect_ratio": aspect_ratio,
-                        "resolution": resolution,
-                        "input_images_base64": input_b64_list,
-                    },
-                )
-            if use_url_refs and has_url_refs:
-                return (
-                    f"{self.base_url}/v1/nb2/url-generations",
-                    {
-                        "prompt": final_prompt,
-                        "aspect_ratio": aspect_ratio,
-                        "resolution": resolution,
-                        "input_images_urls": input_url_list,
-                    },
-                )
-            if has_url_refs:
-                # URL endpoint может быть выключен на аккаунте; fallback в base64.
-                fallback_b64: List[str] = []
-                for idx, img_url in enumerate(input_url_list, 1):
-                    try:
-                        r = requests.get(img_url, timeout=30)
-                        if r.status_code == 200:
-                            img_data = _optimize_image_for_api(r.content, idx)
-                            fallback_b64.append(base64.b64encode(img_data).decode("ascii"))
-                    except Exception as e:
-                        logger.warning("[BANANALAB] fallback URL->base64 не удался для ref %s: %s", idx, e)
-                return (
-                    f"{self.base_url}/v1/nb2/generations",
-                    {
-                        "prompt": final_prompt,
-                        "aspect_ratio": aspect_ratio,
-                        "resolution": resolution,
-                        "input_images_base64": fallback_b64,
-                    },
-                )
+        if has_b64_refs:
+            return (
+                f"{self.base_url}/v1/nb2/generations",
+                {
+                    "prompt": final_prompt,
+                    "aspect_ratio": aspect_ratio,
+                    "resolution": resolution,
+                    "input_images_base64": input_b64_list,
+                },
+            )
+        if use_url_refs and has_url_refs:
+            return (
+                f"{self.base_url}/v1/nb2/url-generations",
+                {
+                    "prompt": final_prompt,
+                    "aspect_ratio": aspect_ratio,
+                    "resolution": resolution,
+                    "input_images_urls": input_url_list,
+                },
+            )
+        if has_url_refs:
+            # URL endpoint может быть выключен на аккаунте; fallback в base64.
             return (
-                f"{self.base_url}/v1/nb2/text-generations",
+                f"{self.base_url}/v1/nb2/generations",
                 {
                     "prompt": final_prompt,
                     "aspect_ratio": aspect_ratio,
                     "resolution": resolution,
+                    "input_images_base64": fallback_b64 or [],
                 },
             )
+        return (
+            f"{self.base_url}/v1/nb2/text-generations",
+            {
+                "prompt": final_prompt,
+                "aspect_ratio": aspect_ratio,
+                "resolution": resolution,
+            },
+        )
+
+    @staticmethod
+    def _fallback_b64_from_urls(input_url_list: List[str]) -> List[str]:
+        fallback_b64: List[str] = []
+        for idx, img_url in enumerate(input_url_list, 1):
+            try:
+                r = requests.get(img_url, timeout=30)
+                if r.status_code == 200:
+                    img_data = _optimize_image_for_api(r.content, idx)
+                    fallback_b64.append(base64.b64encode(img_data).decode("ascii"))
+            except Exception as e:
+                logger.warning("[BANANALAB] fallback URL->base64 не удался для ref %s: %s", idx, e)
+        return fallback_b64
+
+    @staticmethod
+    def _is_url_endpoint_disabled(url: str, status_code: int, msg: str) -> bool:
+        return (
+            url.endswith("/v1/nb2/url-generations")
+            and status_code == 403
+            and "url" in msg.lower()
+            and "not enabled" in msg.lower()
+        )
+
+    @staticmethod
+    def _http_error_result(status_code: int, body: Any, retry_after: Optional[float] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        HTTP 4xx/5xx от POST generations → (текст ошибки, результат generate_image()).
+        retry_after — заголовок Retry-After в секундах, передаётся воркеру вместе с результатом.
+        """
+        msg = detail_from_response_body(body)
+        lower = msg.lower()
+        retryable = status_code in (429, 503) or any(
+            x in lower for x in ("429", "rate limit", "too many", "temporarily", "unavailable")
+        )
+        logger.error(
+            "[BANANALAB] POST generations HTTP %s. Кратко: %s | Полное тело: %s",
+            status_code,
+            msg[:500],
+            _safe_response_body_for_log(body),
+        )
+        uf = msg
+        if retryable:
+            uf = (
+                "Сервис Banana Lab временно перегружен или лимит запросов. "
+                "Подождите и повторите. Детали: " + msg[:300]
+            )
+        result = failure_result(uf, retryable)
+        if retryable and retry_after is not None:
+            result["retry_after"] = retry_after
+        return msg, result
+
+    @staticmethod
+    def _unexpected_format_result(data: Any) -> Dict[str, Any]:
+        logger.error(
+            "[BANANALAB] Не удалось извлечь изображение из ответа. Ключи верхнего уровня: %s",
+            list(data.keys()) if isinstance(data, dict) else type(data),
+        )
+        return failure_result(
+            "Неожиданный формат ответа Banana Lab: нет URL и base64 изображения. "
+            "Проверьте логи сервера (ключи JSON).",
+            False,
+        )
+
+    def _job_result(self, data: Any) -> Dict[str, Any]:
+        """Итоговый ответ задачи → результат generate_image() (с загрузкой изображения по URL)."""
+        if isinstance(data, dict) and data.get("__bananalab_job_failed__"):
+            return self._job_failure_result(data)
+        if isinstance(data, dict) and data.get("__bananalab_job_parked__"):
+            return parked_result(data["provider_job"])
+
+        raw_bytes, image_url = find_image_in_json(data)
+        if raw_bytes:
+            logger.info("[BANANALAB] Получены бинарные данные изображения, %s байт", len(raw_bytes))
+            return success_result(image_url, raw_bytes)
+        if image_url:
+            try:
+                img_r = requests.get(image_url, timeout=60)
+                if img_r.status_code != 200:
+                    logger.warning(
+                        "[BANANALAB] Скачивание результата HTTP %s: %s",
+                        img_r.status_code,
+                        _safe_response_body_for_log(img_r.text[:2000] if img_r.text else ""),
+                    )
+                if img_r.status_code == 200:
+                    return success_result(image_url, img_r.content)
+                return success_result(image_url, None)
+            except Exception as dl_e:
+                logger.warning("[BANANALAB] Не удалось скачать изображение: %s", dl_e)
+                return success_result(image_url, None)
+
+        return self._unexpected_format_result(data)
+
+    def check_job(self, provider_job: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Один опрос запаркованной задачи (хэндл из provider_job): результат generate_image()
+        или None, пока задача выполняется. Генерация у провайдера повторно не запускается.
+        """
+        initial = {"job_id": provider_job.get("job_id"), "status_url": provider_job.get("status_url")}
+        status_url = absolute_job_status_url(self.base_url, initial)
+        try:
+            pr = requests.get(status_url, headers=self._headers(), timeout=60)
+        except requests.RequestException as e:
+            logger.warning("[BANANALAB] Ошибка GET job: %s", e)
+            return None
+
+        if pr.status_code >= 400:
+            try:
+                body = pr.json()
+            except Exception:
+                body = pr.text
+            return self._job_result(self._job_http_error(pr.status_code, body))
+
+        try:
+            current = pr.json()
+        except Exception as e:
+            return failure_result(f"Ответ job не JSON: {e}", False)
+        if not isinstance(current, dict):
+            return self._unexpected_format_result(current)
+        terminal = self._job_terminal_state(current)
+        if terminal is None:
+            return None
+        return self._job_result(terminal)
+
+    def generate_image(
+        self,
+        prompt: str,
+        negative_prompt: Optional[str] = None,
+        resolution: str = "1K",
+        aspect_ratio: str = "1:1",
+        guidance_scale: float = 7.5,
+        num_inference_steps: int = 50,
+        seed: Optional[int] = None,
+        reference_images: Optional[List] = None,
+        model_name: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        self._log_ignored_params(negative_prompt, guidance_scale, num_inference_steps, seed, model_name)
+        reference_images = reference_images or []
+        input_b64_list, input_url_list = self._collect_reference_inputs(reference_images)
+        final_prompt = self._final_prompt(prompt, reference_images, input_b64_list, input_url_list)
 
-        url, payload = _build_request(use_url_refs=True)
-        last_exc: Optional[Exception] = None
+        url, payload = self._endpoint_for(
+            final_prompt, aspect_ratio, resolution, input_b64_list, input_url_list, use_url_refs=True
+        )
 
         for attempt in range(1, self.MAX_RETRIES + 1):
             try:
@@ -318,173 +524,54 @@ class BananalabService:
                     timeout=self.TIMEOUT,
                 )
 
-                if resp.status_code == 429 or resp.status_code == 503:
-                    text = detail_from_response_body(
-                        resp.json() if resp.headers.get("content-type", "").startswith("application/json") else resp.text
-                    )
-                    last_exc = RuntimeError(text)
-                    if attempt < self.MAX_RETRIES:
-                        logger.warning("[BANANALAB] %s, повтор через %ss", text, self.RETRY_DELAY_SECONDS)
-                        time.sleep(self.RETRY_DELAY_SECONDS)
-                        continue
-
                 if resp.status_code >= 400:
                     try:
                         body = resp.json()
                     except Exception:
                         body = resp.text
-                    msg = detail_from_response_body(body)
-                    lower = msg.lower()
-                    retryable = resp.status_code == 429 or any(
-                        x in lower for x in ("429", "rate limit", "too many", "temporarily", "unavailable")
-                    )
-                    logger.error(
-                        "[BANANALAB] POST generations HTTP %s. Кратко: %s | Полное тело: %s",
-                        resp.status_code,
-                        msg[:500],
-                        _safe_response_body_for_log(body),
+                    msg, error_result = self._http_error_result(
+                        resp.status_code, body, parse_retry_after(resp.headers.get("Retry-After"))
                     )
                     # Авто-fallback: если URL endpoint запрещен для аккаунта, пересобираем запрос в base64 endpoint.
-                    if (
-                        url.endswith("/v1/nb2/url-generations")
-                        and resp.status_code == 403
-                        and "url" in msg.lower()
-                        and "not enabled" in msg.lower()
-                    ):
+                    if self._is_url_endpoint_disabled(url, resp.status_code, msg):
                         logger.warning(
                             "[BANANALAB] URL endpoint не включен для аккаунта, fallback на /v1/nb2/generations"
                         )
-                        url, payload = _build_request(use_url_refs=False)
+                        url, payload = self._endpoint_for(
+                            final_prompt,
+                            aspect_ratio,
+                            resolution,
+                            input_b64_list,
+                            input_url_list,
+                            use_url_refs=False,
+                            fallback_b64=self._fallback_b64_from_urls(input_url_list),
+                        )
                         if payload.get("input_images_base64"):
                             continue
-                        return {
-                            "success": False,
-                            "image_url": None,
-                            "image_data": None,
-                            "error": "URL endpoint Banana Lab недоступен и fallback в base64 не удался.",
-                            "retryable": False,
-                        }
-                    uf = msg
-                    if retryable:
-                        uf = (
-                            "Сервис Banana Lab временно перегружен или лимит запросов. "
-                            "Подождите и повторите. Детали: " + msg[:300]
+                        return failure_result(
+                            "URL endpoint Banana Lab недоступен и fallback в base64 не удался.", False
                         )
-                    return {
-                        "success": False,
-                        "image_url": None,
-                        "image_data": None,
-                        "error": uf,
-                        "retryable": retryable,
-                    }
+                    return error_result
 
                 try:
                     data = resp.json()
                 except Exception as e:
-                    return {
-                        "success": False,
-                        "image_url": None,
-                        "image_data": None,
-                        "error": f"Ответ Banana Lab не JSON: {e}",
-                        "retryable": False,
-                    }
+                    return failure_result(f"Ответ Banana Lab не JSON: {e}", False)
 
                 if isinstance(data, dict) and (data.get("job_id") or data.get("status_url")):
                     data = self._poll_job_until_done(data)
-                    if isinstance(data, dict) and data.get("__bananalab_job_failed__"):
-                        err_msg = str(data.get("error") or "Ошибка задачи Banana Lab")
-                        low = err_msg.lower()
-                        explicit_retryable = bool(data.get("retryable"))
-                        return {
-                            "success": False,
-                            "image_url": None,
-                            "image_data": None,
-                            "error": err_msg,
-                            "retryable": explicit_retryable or any(
-                                x in low for x in ("timeout", "таймаут", "429", "503", "unavailable")
-                            ),
-                        }
-
-                raw_bytes, image_url = find_image_in_json(data)
-                if raw_bytes:
-                    logger.info("[BANANALAB] Получены бинарные данные изображения, %s байт", len(raw_bytes))
-                    return {
-                        "success": True,
-                        "image_url": image_url,
-                        "image_data": raw_bytes,
-                        "error": None,
-                    }
-                if image_url:
-                    try:
-                        img_r = requests.get(image_url, timeout=60)
-                        if img_r.status_code != 200:
-                            logger.warning(
-                                "[BANANALAB] Скачивание результата HTTP %s: %s",
-                                img_r.status_code,
-                                _safe_response_body_for_log(img_r.text[:2000] if img_r.text else ""),
-                            )
-                        if img_r.status_code == 200:
-                            return {
-                                "success": True,
-                                "image_url": image_url,
-                                "image_data": img_r.content,
-                                "error": None,
-                            }
-                        return {
-                            "success": True,
-                            "image_url": image_url,
-                            "image_data": None,
-                            "error": None,
-                        }
-                    except Exception as dl_e:
-                        logger.warning("[BANANALAB] Не удалось скачать изображение: %s", dl_e)
-                        return {
-                            "success": True,
-                            "image_url": image_url,
-                            "image_data": None,
-                            "error": None,
-                        }
-
-                logger.error(
-                    "[BANANALAB] Не удалось извлечь изображение из ответа. Ключи верхнего уровня: %s",
-                    list(data.keys()) if isinstance(data, dict) else type(data),
+                return self._job_result(data)
+
+            except requests.Timeout:
+                return failure_result(
+                    "Таймаут запроса к Banana Lab. Попробуйте проще промпт или позже.", True
                 )
-                return {
-                    "success": False,
-                    "image_url": None,
-                    "image_data": None,
-                    "error": "Неожиданный формат ответа Banana Lab: нет URL и base64 изображения. "
-                    "Проверьте логи сервера (ключи JSON).",
-                    "retryable": False,
-                }
-
-            except requests.Timeout as e:
-                last_exc = e
-                if attempt < self.MAX_RETRIES:
-                    time.sleep(self.RETRY_DELAY_SECONDS)
-                    continue
-                return {
-                    "success": False,
-                    "image_url": None,
-                    "image_data": None,
-                    "error": "Таймаут запроса к Banana Lab. Попробуйте проще промпт или позже.",
-                    "retryable": True,
-                }
             except Exception as e:
                 logger.exception("[BANANALAB] Сбой запроса: %s", e)
                 lower = str(e).lower()
-                return {
-                    "success": False,
-                    "image_url": None,
-                    "image_data": None,
-                    "error": str(e) or "Ошибка сети при обращении к Banana Lab",
-                    "retryable": any(x in lower for x in ("timeout", "connection", "429")),
-                }
+                return failure_result(
+                    str(e) or "Ошибка сети при обращении к Banana Lab",
+                    any(x in lower for x in ("timeout", "connection", "429")),
+                )
 
-        return {
-            "success": False,
-            "image_url": None,
-            "image_data": None,
-            "error": str(last_exc) if last_exc else "Неизвестная ошибка",
-            "retryable": True,
-        }
+        return failure_result("Неизвестная ошибка", True)
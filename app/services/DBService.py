@@ -1,13 +1,18 @@
 """
 Сервис для работы с базой данных
 """
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 from urllib.parse import quote_plus
+import json
 import logging
-from typing import Generator
+import select
+import threading
+import time
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, List, Optional
 from app.config import settings
 
 logger = logging.getLogger(__name__)
@@ -17,9 +22,17 @@ class DBService:
         self.Base = declarative_base()
         self.engine = None
         self.SessionLocal = None
+        # Async engine (asyncpg) для HTTP обработчиков создаётся при первом обращении
+        self._async_engine: Optional[AsyncEngine] = None
+        self._async_session_factory: Optional[async_sessionmaker] = None
+        self._async_lock = threading.Lock()
+        # Pub/sub поверх LISTEN/NOTIFY: канал -> обработчики событий
+        self._listeners: Dict[str, List[Callable[[Dict[str, Any]], None]]] = {}
+        self._listeners_lock = threading.Lock()
+        self._listener_thread = None
         self._init_db()
 
-    def _get_safe_db_url(self) -> str:
+    def _get_safe_db_url(self, driver: str = "psycopg2") -> str:
         """Генерирует безопасный URL подключения с экранированными спецсимволами"""
         try:
             safe_user = quote_plus(settings.POSTGRES_USER)
@@ -27,11 +40,12 @@ class DBService:
             safe_host = quote_plus(settings.POSTGRES_HOST)
             safe_db = quote_plus(settings.POSTGRES_DB)
             
-            return (
-                f"postgresql+psycopg2://{safe_user}:{safe_password}@"
+            url = (
+                f"postgresql+{driver}://{safe_user}:{safe_password}@"
                 f"{safe_host}:{settings.POSTGRES_PORT}/{safe_db}"
-                "?client_encoding=utf-8"
             )
+            # asyncpg всегда работает в UTF-8 и не принимает client_encoding
+            return url if driver == "asyncpg" else f"{url}?client_encoding=utf-8"
         except Exception as e:
             logger.error(f"DB URL encoding error: {e}")
             raise
@@ -80,14 +94,75 @@ class DBService:
         finally:
             session.close()
 
+    @property
+    def async_engine(self) -> AsyncEngine:
+        """Async engine (asyncpg) с теми же настройками пула, что и синхронный"""
+        with self._async_lock:
+            if self._async_engine is None:
+                self._async_engine = create_async_engine(
+                    self._get_safe_db_url("asyncpg"),
+                    pool_size=10,
+                    max_overflow=5,
+                    pool_pre_ping=True,
+                    pool_recycle=3600,
+                    connect_args={
+                        "timeout": 10,
+                        "server_settings": {"statement_timeout": "30000"}
+                    },
+                    echo=False
+                )
+                # Тот же класс сессии, что у SessionLocal: события (NOTIFY статусов) срабатывают и в async сессиях
+                self._async_session_factory = async_sessionmaker(
+                    self._async_engine,
+                    autoflush=False,
+                    expire_on_commit=False,
+                    sync_session_class=self.SessionLocal.class_
+                )
+            return self._async_engine
+
+    @asynccontextmanager
+    async def get_async_session(self) -> AsyncGenerator[AsyncSession, None]:
+        """Контекстный менеджер для async сессий (HTTP обработчики): запросы не блокируют event loop"""
+        if self._async_session_factory is None:
+            self.async_engine
+        session = self._async_session_factory()
+        try:
+            yield session
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            logger.error(f"Database operation failed: {str(e)}")
+            raise
+        finally:
+            await session.close()
+
+    async def dispose_async_engine(self):
+        """Закрывает пул async соединений (при остановке API)"""
+        if self._async_engine is not None:
+            await self._async_engine.dispose()
+
     def create_tables(self):
         """Создание таблиц в БД"""
         try:
+            from sqlalchemy import inspect
+            existing_tables = set(inspect(self.engine).get_table_names())
             self.Base.metadata.create_all(bind=self.engine)
             logger.info("Database tables created successfully")
             
+            # Миграция: заполняем generation_references из generation_metadata, если таблица только что создана
+            if 'generations' in existing_tables and 'generation_references' not in existing_tables:
+                self._migrate_backfill_generation_references()
+            
             # Миграция: добавляем колонку model_name если её нет
             self._migrate_add_model_name_column()
+            # Миграция: индекс для keyset-пагинации /images/list на существующей таблице
+            self._migrate_add_generations_list_index()
+            # Миграция: вес задачи в fair-share очереди
+            self._migrate_add_generation_jobs_weight_column()
+            # Миграция: группа батча/вариантов у генераций
+            self._migrate_add_generations_group_id_column()
+            # Миграция: отпечаток запроса у задач очереди (склейка дубликатов)
+            self._migrate_add_generation_jobs_fingerprint_column()
         except Exception as e:
             logger.error(f"Failed to create tables: {str(e)}")
             raise
@@ -122,6 +197,147 @@ class DBService:
             logger.warning(f"[MIGRATION] Ошибка при добавлении колонки model_name (не критично): {e}")
             # Не пробрасываем ошибку, чтобы не блокировать запуск приложения
 
+    def _migrate_add_generations_list_index(self):
+        """Создаёт индекс (user_id, created_at, id) на generations, если его нет (create_all не трогает существующие таблицы)"""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_generations_user_created_id "
+                    "ON generations (user_id, created_at, id)"
+                ))
+        except Exception as e:
+            logger.warning(f"[MIGRATION] Ошибка при создании индекса ix_generations_user_created_id (не критично): {e}")
+
+    def _migrate_add_generation_jobs_weight_column(self):
+        """Добавляет колонку weight в generation_jobs, если её нет"""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text(
+                    "ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS weight DOUBLE PRECISION DEFAULT 1.0"
+                ))
+        except Exception as e:
+            logger.warning(f"[MIGRATION] Ошибка при добавлении колонки weight в generation_jobs (не критично): {e}")
+
+    def _migrate_add_generations_group_id_column(self):
+        """Добавляет колонку group_id (и индекс по ней) в generations, если её нет"""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE generations ADD COLUMN IF NOT EXISTS group_id VARCHAR"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_generations_group_id ON generations (group_id)"
+                ))
+        except Exception as e:
+            logger.warning(f"[MIGRATION] Ошибка при добавлении колонки group_id в generations (не критично): {e}")
+
+    def _migrate_add_generation_jobs_fingerprint_column(self):
+        """Добавляет колонку fingerprint (и индекс по ней) в generation_jobs, если её нет"""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS fingerprint VARCHAR"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_generation_jobs_fingerprint ON generation_jobs (fingerprint)"
+                ))
+        except Exception as e:
+            logger.warning(f"[MIGRATION] Ошибка при добавлении колонки fingerprint в generation_jobs (не критично): {e}")
+
+    def _migrate_backfill_generation_references(self):
+        """Переносит reference_image_urls существующих генераций в generation_references"""
+        marker = f"/{settings.MINIO_BUCKET}/"
+        try:
+            with self.engine.begin() as conn:
+                result = conn.execute(
+                    text(
+                        """
+                        INSERT INTO generation_references (generation_id, object_path)
+                        SELECT DISTINCT g.id, substr(u.url, strpos(u.url, :marker) + length(:marker))
+                        FROM generations g
+                        CROSS JOIN LATERAL json_array_elements_text(
+                            CASE WHEN json_typeof(g.generation_metadata -> 'reference_image_urls') = 'array'
+                                 THEN g.generation_metadata -> 'reference_image_urls'
+                                 ELSE '[]'::json END
+                        ) AS u(url)
+                        WHERE u.url LIKE 'http%' AND strpos(u.url, :marker) > 0
+                        ON CONFLICT DO NOTHING
+                        """
+                    ),
+                    {"marker": marker},
+                )
+            logger.info(f"[MIGRATION] generation_references заполнена: {result.rowcount} записей")
+        except Exception as e:
+            logger.warning(f"[MIGRATION] Ошибка при заполнении generation_references (не критично): {e}")
+
+    def notify(self, connection, channel: str, payload: Dict[str, Any]):
+        """
+        NOTIFY в рамках текущей транзакции: слушатели получат событие только после commit,
+        при rollback оно не уйдёт. connection — Connection SQLAlchemy (например, session.connection()).
+        """
+        connection.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": channel, "payload": json.dumps(payload, ensure_ascii=False, default=str)},
+        )
+
+    def listen(self, channel: str, callback: Callable[[Dict[str, Any]], None]):
+        """
+        Подписывает callback на канал. На процесс держится одно LISTEN-соединение
+        в фоновом потоке; callback вызывается из этого потока.
+        """
+        with self._listeners_lock:
+            self._listeners.setdefault(channel, []).append(callback)
+            if self._listener_thread is None:
+                self._listener_thread = threading.Thread(target=self._listener_loop, name="db-listener", daemon=True)
+                self._listener_thread.start()
+
+    def _listener_loop(self):
+        """Держит LISTEN-соединение и раздаёт уведомления; при обрыве переподключается."""
+        reconnect_delay = 1
+        while True:
+            connection = None
+            try:
+                raw = self.engine.raw_connection()
+                connection = raw.driver_connection
+                raw.detach()  # соединение живёт вне пула всё время работы процесса
+                connection.autocommit = True
+                listening = set()
+                logger.info("[PUBSUB] LISTEN-соединение установлено")
+                reconnect_delay = 1
+                while True:
+                    with self._listeners_lock:
+                        channels = set(self._listeners.keys())
+                    with connection.cursor() as cursor:
+                        for channel in channels - listening:
+                            cursor.execute(f'LISTEN "{channel}"')
+                            listening.add(channel)
+
+                    if select.select([connection], [], [], 5) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        self._dispatch_notification(notification.channel, notification.payload)
+            except Exception as e:
+                logger.error(f"[PUBSUB] LISTEN-соединение потеряно: {e}. Переподключение через {reconnect_delay} сек")
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, 30)
+
+    def _dispatch_notification(self, channel: str, payload: str):
+        try:
+            data = json.loads(payload) if payload else {}
+        except ValueError:
+            logger.warning(f"[PUBSUB] Некорректный payload в канале {channel}: {payload[:200]}")
+            return
+        with self._listeners_lock:
+            callbacks = list(self._listeners.get(channel, []))
+        for callback in callbacks:
+            try:
+                callback(data)
+            except Exception as e:
+                logger.error(f"[PUBSUB] Ошибка обработчика канала {channel}: {e}", exc_info=True)
+
 # Инициализация сервиса
 db_service = DBService()
 
@@ -4,6 +4,7 @@
 import os
 import json
 import logging
+from logging.handlers import RotatingFileHandler
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -39,9 +40,31 @@ def save_error_to_file(error_data: dict):
     except Exception as e:
         logger.error(f"[ERROR_LOG] Не удалось сохранить ошибку: {e}")
 
+def setup_logging(log_filename: str):
+    """
+    Настраивает root logger: файл с ротацией (лимит 1GB) в папке logs и консоль.
+    Используется и API-процессом, и отдельным воркером (у каждого свой файл).
+    """
+    logs_dir = get_logs_dir()
+    os.makedirs(logs_dir, exist_ok=True)
 
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+    # 1GB = 1024 * 1024 * 1024 байт, но для удобства используем 1000MB
+    file_handler = RotatingFileHandler(
+        os.path.join(logs_dir, log_filename),
+        maxBytes=1000 * 1024 * 1024,
+        backupCount=5,  # Количество резервных файлов
+        encoding='utf-8'
+    )
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(formatter)
 
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(formatter)
 
-
-
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(file_handler)
+    root_logger.addHandler(console_handler)
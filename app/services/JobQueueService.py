@@ -0,0 +1,568 @@
+"""
+Durable-очередь генераций поверх Postgres (таблица generation_jobs).
+
+Воркеры забирают задачи через SELECT ... FOR UPDATE SKIP LOCKED и держат их
+под арендой (lease). Аренду продлевает heartbeat воркера; если воркер упал,
+аренда истекает и задачу забирает другой процесс.
+
+Задача, отправленная провайдеру без ожидания результата (Replicate prediction),
+«паркуется» в статусе waiting: аренды нет, payload с хэндлом провайдера хранится
+в строке. Её завершает webhook или воркер, забравший её на очередной опрос.
+Так же ждёт дубликат уже выполняющейся генерации (payload["coalesced_into"]):
+его будят, когда задача лидера завершается. Хэндл задачи провайдера сохраняется
+в payload и у генерации, которую воркер ждёт синхронно: после падения воркера
+задача возвращается к запущенной у провайдера генерации, а не повторяет её.
+"""
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm.attributes import flag_modified
+
+from app.config import settings
+from app.models.base import Generation, GenerationJob
+from app.services.DBService import db_service
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_JOB_STATUSES = ("queued", "leased", "waiting")
+
+
+def default_worker_id() -> str:
+    """Идентификатор воркера: hostname + pid (уникален в пределах кластера)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueueService:
+    """Очередь задач генерации с арендой и повторной выдачей после падения воркера"""
+
+    def __init__(self, lease_seconds: Optional[int] = None, max_attempts: Optional[int] = None):
+        self.lease_seconds = lease_seconds or settings.JOB_LEASE_SECONDS
+        self.max_attempts = max_attempts or settings.JOB_MAX_ATTEMPTS
+        self.fair_share = settings.FAIR_SHARE_ENABLED
+
+    def enqueue(
+        self,
+        generation_id: int,
+        user_id: int,
+        payload: Dict[str, Any],
+        provider: Optional[str] = None,
+        model_name: Optional[str] = None,
+        delay_seconds: float = 0.0,
+        weight: Optional[float] = None,
+    ) -> None:
+        """
+        Ставит генерацию в очередь (или возвращает её туда при ретрае).
+        На одну генерацию приходится одна строка generation_jobs — повторная постановка
+        обновляет существующую запись и снимает аренду.
+        weight — вес пользователя в fair-share очереди; None при повторной постановке сохраняет прежний.
+        """
+        now = datetime.utcnow()
+        values = self._job_values(generation_id, user_id, payload, provider, model_name, delay_seconds, weight, now)
+        stmt = pg_insert(GenerationJob).values(**values)
+        update_values = {
+            "provider": stmt.excluded.provider,
+            "model_name": stmt.excluded.model_name,
+            "payload": stmt.excluded.payload,
+            "status": "queued",
+            "attempts": 0,
+            "available_at": stmt.excluded.available_at,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "updated_at": now,
+        }
+        if weight is not None:
+            update_values["weight"] = stmt.excluded.weight
+        stmt = stmt.on_conflict_do_update(index_elements=[GenerationJob.generation_id], set_=update_values)
+        with db_service.get_session() as session:
+            session.execute(stmt)
+            session.commit()
+        logger.info(
+            f"[JOB_QUEUE] Генерация {generation_id} поставлена в очередь "
+            f"(provider={provider}, model={model_name}, задержка={delay_seconds:.0f} сек)"
+        )
+
+    def enqueue_coalesced(
+        self,
+        generation_id: int,
+        user_id: int,
+        payload: Dict[str, Any],
+        fingerprint: str,
+        provider: Optional[str] = None,
+        model_name: Optional[str] = None,
+        weight: Optional[float] = None,
+    ) -> Optional[int]:
+        """
+        Ставит генерацию в очередь с отпечатком запроса. Если у пользователя уже
+        выполняется генерация с тем же отпечатком, провайдер второй раз не вызывается:
+        задача паркуется в waiting с payload["coalesced_into"] = ID лидера и возвращается
+        этот ID. Иначе — обычная постановка, результат None. Как и enqueue, обновляет
+        существующую строку (дубликат, чей лидер удалён, ставится заново); weight=None
+        сохраняет прежний вес.
+        """
+        now = datetime.utcnow()
+        with db_service.get_session() as session:
+            # Две одинаковые заявки одновременно (двойной клик) не должны обе стать лидерами
+            session.execute(select(func.pg_advisory_xact_lock(func.hashtext(fingerprint))))
+            leader_id = session.execute(
+                select(GenerationJob.generation_id)
+                .where(
+                    GenerationJob.user_id == user_id,
+                    GenerationJob.fingerprint == fingerprint,
+                    GenerationJob.generation_id != generation_id,
+                    GenerationJob.status.in_(ACTIVE_JOB_STATUSES),
+                    GenerationJob.payload["coalesced_into"].as_string().is_(None),
+                )
+                .order_by(GenerationJob.id.asc())
+                .limit(1)
+            ).scalar()
+            if leader_id is None:
+                values = self._job_values(generation_id, user_id, payload, provider, model_name, 0.0, weight, now)
+            else:
+                values = self._job_values(
+                    generation_id,
+                    user_id,
+                    {**payload, "coalesced_into": leader_id},
+                    None,
+                    model_name,
+                    settings.GENERATION_COALESCE_RECHECK_SECONDS,
+                    weight,
+                    now,
+                )
+                values["status"] = "waiting"
+            values["fingerprint"] = fingerprint
+            stmt = pg_insert(GenerationJob).values(**values)
+            update_keys = ["provider", "model_name", "payload", "status", "attempts", "available_at", "lease_owner", "lease_expires_at", "fingerprint"]
+            if weight is not None:
+                update_keys.append("weight")
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[GenerationJob.generation_id],
+                set_={key: stmt.excluded[key] for key in update_keys} | {"updated_at": now},
+            )
+            session.execute(stmt)
+            session.commit()
+        if leader_id is None:
+            logger.info(
+                f"[JOB_QUEUE] Генерация {generation_id} поставлена в очередь "
+                f"(provider={provider}, model={model_name}, задержка=0 сек)"
+            )
+        else:
+            logger.info(
+                f"[JOB_QUEUE] Генерация {generation_id} совпадает с выполняющейся {leader_id} "
+                f"и получит её результат без повторного вызова провайдера"
+            )
+        return leader_id
+
+    def enqueue_many(self, jobs: List[Dict[str, Any]], weight: Optional[float] = None) -> None:
+        """
+        Ставит в очередь группу новых генераций одним INSERT (батч/варианты).
+        jobs — словари с generation_id, user_id, payload, provider, model_name.
+        """
+        if not jobs:
+            return
+        now = datetime.utcnow()
+        rows = [
+            self._job_values(
+                job["generation_id"],
+                job["user_id"],
+                job["payload"],
+                job.get("provider"),
+                job.get("model_name"),
+                0.0,
+                weight,
+                now,
+            )
+            for job in jobs
+        ]
+        stmt = pg_insert(GenerationJob).values(rows).on_conflict_do_nothing(
+            index_elements=[GenerationJob.generation_id]
+        )
+        with db_service.get_session() as session:
+            session.execute(stmt)
+            session.commit()
+        logger.info(f"[JOB_QUEUE] Группа из {len(rows)} генераций поставлена в очередь")
+
+    @staticmethod
+    def _job_values(
+        generation_id: int,
+        user_id: int,
+        payload: Dict[str, Any],
+        provider: Optional[str],
+        model_name: Optional[str],
+        delay_seconds: float,
+        weight: Optional[float],
+        now: datetime,
+    ) -> Dict[str, Any]:
+        return {
+            "generation_id": generation_id,
+            "user_id": user_id,
+            "provider": provider,
+            "model_name": model_name,
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "available_at": now + timedelta(seconds=max(delay_seconds, 0.0)),
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "weight": weight if weight is not None else 1.0,
+            "created_at": now,
+            "updated_at": now,
+        }
+
+    def claim(
+        self,
+        worker_id: str,
+        limit: int = 1,
+        providers: Optional[Iterable[str]] = None,
+        exclude_providers: Optional[Iterable[str]] = None,
+        exclude_targets: Optional[Iterable[Tuple[str, str]]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Забирает до limit готовых задач: в статусе queued или waiting (пора опросить
+        провайдера) с наступившим available_at или leased с истекшей арендой (воркер упал). Строки, уже заблокированные
+        другими воркерами, пропускаются (SKIP LOCKED).
+        providers / exclude_providers ограничивают выборку по провайдеру задачи
+        (у задач без провайдера provider IS NULL — они попадают только под exclude).
+        exclude_targets — пары (провайдер, модель) без свободных слотов: их новые задачи
+        не забираются (пустая строка соответствует NULL); опрос запаркованных задач не исключается.
+        """
+        if limit <= 0:
+            return []
+
+        now = datetime.utcnow()
+        claimed: List[Dict[str, Any]] = []
+        conditions = [
+            or_(
+                and_(GenerationJob.status.in_(("queued", "waiting")), GenerationJob.available_at <= now),
+                and_(GenerationJob.status == "leased", GenerationJob.lease_expires_at < now),
+            )
+        ]
+        if providers is not None:
+            conditions.append(GenerationJob.provider.in_(list(providers)))
+        if exclude_providers is not None:
+            conditions.append(
+                or_(
+                    GenerationJob.provider.is_(None),
+                    GenerationJob.provider.notin_(list(exclude_providers)),
+                )
+            )
+        exclude_targets = list(exclude_targets or [])
+        if exclude_targets:
+            conditions.append(
+                or_(
+                    GenerationJob.status == "waiting",
+                    tuple_(
+                        func.coalesce(GenerationJob.provider, ""),
+                        func.coalesce(GenerationJob.model_name, ""),
+                    ).notin_(exclude_targets),
+                )
+            )
+
+        with db_service.get_session() as session:
+            # Условия повторяются во внешнем запросе: после ожидания блокировки Postgres
+            # перепроверяет их на свежей версии строки, и задачу не заберут дважды
+            query = session.query(GenerationJob).filter(*conditions)
+            if self.fair_share:
+                query = self._fair_share_order(query, conditions, now)
+            else:
+                query = query.order_by(GenerationJob.available_at.asc(), GenerationJob.id.asc())
+            jobs: List[GenerationJob] = (
+                query
+                .limit(limit)
+                .with_for_update(skip_locked=True, of=GenerationJob)
+                .all()
+            )
+
+            for job in jobs:
+                if job.status == "leased":
+                    logger.warning(
+                        f"[JOB_QUEUE] Аренда задачи {job.id} (генерация {job.generation_id}) "
+                        f"воркером {job.lease_owner} истекла, забираем повторно"
+                    )
+                    if (job.attempts or 0) >= self.max_attempts:
+                        self._fail_abandoned_job(session, job, now)
+                        continue
+
+                if job.status != "waiting":
+                    # Опрос провайдера по запаркованной задаче не считается новой попыткой
+                    job.attempts = (job.attempts or 0) + 1
+                job.status = "leased"
+                job.lease_owner = worker_id
+                job.lease_expires_at = now + timedelta(seconds=self.lease_seconds)
+                job.updated_at = now
+                claimed.append({
+                    "job_id": job.id,
+                    "generation_id": job.generation_id,
+                    "user_id": job.user_id,
+                    "provider": job.provider,
+                    "model_name": job.model_name,
+                    "request_data": dict(job.payload or {}),
+                    "attempts": job.attempts,
+                    "fingerprint": job.fingerprint,
+                })
+            session.commit()
+
+        return claimed
+
+    @staticmethod
+    def _fair_share_order(query, conditions: List[Any], now: datetime):
+        """
+        Взвешенная справедливая очередь по user_id: k-я готовая задача пользователя получает
+        виртуальное время (задач пользователя в работе + k) / вес, и задачи выдаются по его
+        возрастанию. Пользователь с сотней задач не задерживает остальных дольше, чем на одну
+        свою задачу каждого из них; вес админов — ADMIN_JOB_WEIGHT. Опрос запаркованных
+        задач (waiting) идёт первым: он короткий и не занимает провайдера.
+        """
+        in_flight = (
+            select(GenerationJob.user_id, func.count().label("in_flight"))
+            .where(GenerationJob.status == "leased", GenerationJob.lease_expires_at >= now)
+            .group_by(GenerationJob.user_id)
+            .subquery()
+        )
+        ranked = (
+            select(
+                GenerationJob.id.label("job_id"),
+                func.row_number()
+                .over(
+                    partition_by=GenerationJob.user_id,
+                    order_by=(GenerationJob.available_at, GenerationJob.id),
+                )
+                .label("user_rank"),
+            )
+            .where(*conditions)
+            .subquery()
+        )
+        virtual_time = (
+            func.coalesce(in_flight.c.in_flight, 0) + ranked.c.user_rank
+        ) / func.coalesce(GenerationJob.weight, 1.0)
+        return (
+            query.join(ranked, ranked.c.job_id == GenerationJob.id)
+            .outerjoin(in_flight, in_flight.c.user_id == GenerationJob.user_id)
+            .order_by(
+                (GenerationJob.status == "waiting").desc(),
+                virtual_time.asc(),
+                GenerationJob.available_at.asc(),
+                GenerationJob.id.asc(),
+            )
+        )
+
+    def _fail_abandoned_job(self, session, job: GenerationJob, now: datetime) -> None:
+        """Задача несколько раз терялась вместе с воркером — больше не выдаём её."""
+        job.status = "failed"
+        job.payload = None
+        job.lease_owner = None
+        job.lease_expires_at = None
+        job.updated_at = now
+
+        generation = session.query(Generation).filter(Generation.id == job.generation_id).first()
+        if generation and generation.status in ("pending", "running"):
+            generation.status = "failed"
+            generation.completed_at = now
+            if not generation.generation_metadata:
+                generation.generation_metadata = {}
+            generation.generation_metadata["error"] = (
+                f"Генерация прервана: обработчик завершился аварийно {job.attempts} раз(а) подряд."
+            )
+            flag_modified(generation, "generation_metadata")
+        logger.error(
+            f"[JOB_QUEUE] Задача {job.id} (генерация {job.generation_id}) исчерпала "
+            f"{self.max_attempts} попыток и помечена как failed"
+        )
+
+    def extend_leases(self, worker_id: str, job_ids: Iterable[int]) -> int:
+        """Heartbeat: продлевает аренду задач, которые воркер ещё обрабатывает."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return 0
+        now = datetime.utcnow()
+        with db_service.get_session() as session:
+            result = session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id.in_(job_ids))
+                .where(GenerationJob.status == "leased")
+                .where(GenerationJob.lease_owner == worker_id)
+                .values(lease_expires_at=now + timedelta(seconds=self.lease_seconds), updated_at=now)
+            )
+            session.commit()
+            return result.rowcount
+
+    def complete(self, job_id: int, worker_id: str) -> bool:
+        """
+        Завершает задачу и удаляет payload (в нём API ключ пользователя).
+        Если за время обработки задачу вернули в очередь (ретрай), запись не трогаем.
+        """
+        now = datetime.utcnow()
+        with db_service.get_session() as session:
+            finished = session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == job_id)
+                .where(GenerationJob.status == "leased")
+                .where(GenerationJob.lease_owner == worker_id)
+                .values(
+                    status="done",
+                    payload=None,
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    updated_at=now,
+                )
+                .returning(GenerationJob.generation_id, GenerationJob.user_id, GenerationJob.fingerprint)
+            ).first()
+            if finished is not None:
+                self._wake_coalesced(session, finished, now)
+            session.commit()
+            return finished is not None
+
+    def cancel(self, generation_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Снимает активную задачу генерации с очереди (отмена пользователем).
+        Возвращает прежний payload (по нему можно отменить задачу у провайдера)
+        или None, если активной задачи не было. Воркер, державший аренду, узнаёт
+        об отмене по NOTIFY, а его complete() уже ничего не меняет.
+        """
+        now = datetime.utcnow()
+        with db_service.get_session() as session:
+            job = (
+                session.query(GenerationJob)
+                .filter(
+                    GenerationJob.generation_id == generation_id,
+                    GenerationJob.status.in_(ACTIVE_JOB_STATUSES),
+                )
+                .with_for_update()
+                .first()
+            )
+            if job is None:
+                return None
+            payload = dict(job.payload or {})
+            job.status = "cancelled"
+            job.payload = None
+            job.lease_owner = None
+            job.lease_expires_at = None
+            job.updated_at = now
+            self._wake_coalesced(session, job, now)
+            session.commit()
+        logger.info(f"[JOB_QUEUE] Задача генерации {generation_id} отменена")
+        return payload
+
+    @staticmethod
+    def _wake_coalesced(session, job, now: datetime) -> None:
+        """Дубликаты, ждущие эту генерацию, забираются сразу, а не по таймеру перепроверки."""
+        if not job.fingerprint:
+            return
+        session.execute(
+            update(GenerationJob)
+            .where(
+                GenerationJob.status == "waiting",
+                GenerationJob.user_id == job.user_id,
+                GenerationJob.fingerprint == job.fingerprint,
+                GenerationJob.payload["coalesced_into"].as_string() == str(job.generation_id),
+            )
+            .values(available_at=now)
+        )
+
+    def release(self, job_id: int, worker_id: str, delay_seconds: float = 0.0) -> bool:
+        """Возвращает арендованную задачу в очередь без выполнения (например, при остановке воркера)."""
+        now = datetime.utcnow()
+        with db_service.get_session() as session:
+            result = session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == job_id)
+                .where(GenerationJob.status == "leased")
+                .where(GenerationJob.lease_owner == worker_id)
+                .values(
+                    status="queued",
+                    attempts=GenerationJob.attempts - 1,
+                    available_at=now + timedelta(seconds=max(delay_seconds, 0.0)),
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    updated_at=now,
+                )
+            )
+            session.commit()
+            return result.rowcount > 0
+
+    def park(self, generation_id: int, worker_id: str, payload: Dict[str, Any], delay_seconds: float) -> bool:
+        """
+        Снимает аренду с задачи, которая ждёт результата у провайдера, и сохраняет
+        payload с хэндлом задачи провайдера. Через delay_seconds задачу заберут на опрос.
+        """
+        now = datetime.utcnow()
+        with db_service.get_session() as session:
+            result = session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.generation_id == generation_id)
+                .where(GenerationJob.status == "leased")
+                .where(GenerationJob.lease_owner == worker_id)
+                .values(
+                    status="waiting",
+                    payload=payload,
+                    available_at=now + timedelta(seconds=max(delay_seconds, 0.0)),
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    updated_at=now,
+                )
+            )
+            session.commit()
+            return result.rowcount > 0
+
+    def attach_provider_job(self, generation_id: int, worker_id: str, payload: Dict[str, Any]) -> bool:
+        """
+        Сохраняет в арендованной задаче payload с хэндлом задачи провайдера, не снимая аренды.
+        Если воркер упадёт, задачу заберёт другой и вернётся к уже запущенной генерации
+        у провайдера, а не запустит её заново.
+        """
+        with db_service.get_session() as session:
+            result = session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.generation_id == generation_id)
+                .where(GenerationJob.status == "leased")
+                .where(GenerationJob.lease_owner == worker_id)
+                .values(payload=payload, updated_at=datetime.utcnow())
+            )
+            session.commit()
+            return result.rowcount > 0
+
+    def take_waiting(self, generation_id: int, worker_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Забирает запаркованную задачу генерации вне очереди (например, по webhook'у).
+        None — задачи в статусе waiting нет: её уже завершили или она ещё не запаркована.
+        """
+        now = datetime.utcnow()
+        with db_service.get_session() as session:
+            row = session.execute(
+                update(GenerationJob)
+                .where(GenerationJob.generation_id == generation_id)
+                .where(GenerationJob.status == "waiting")
+                .values(
+                    status="leased",
+                    lease_owner=worker_id,
+                    lease_expires_at=now + timedelta(seconds=self.lease_seconds),
+                    updated_at=now,
+                )
+                .returning(GenerationJob.id, GenerationJob.user_id, GenerationJob.payload, GenerationJob.attempts)
+            ).first()
+            session.commit()
+        if row is None:
+            return None
+        return {
+            "job_id": row.id,
+            "generation_id": generation_id,
+            "user_id": row.user_id,
+            "request_data": dict(row.payload or {}),
+            "attempts": row.attempts,
+        }
+
+    def active_generation_ids(self, session) -> List[int]:
+        """ID генераций, у которых есть задача в очереди или в работе."""
+        rows = (
+            session.query(GenerationJob.generation_id)
+            .filter(GenerationJob.status.in_(ACTIVE_JOB_STATUSES))
+            .all()
+        )
+        return [row[0] for row in rows]
+
+
+job_queue = JobQueueService()
@@ -7,7 +7,7 @@ from datetime import timedelta
 from app.config import settings
 import logging
 import io
-from typing import Dict
+from typing import Dict, List
 
 logger = logging.getLogger(__name__)
 
@@ -96,6 +96,28 @@ class MinioService:
             logger.error(f"[MINIO] Неожиданная ошибка при загрузке: {e}", exc_info=True)
             raise
 
+    def copy_image(self, source_path: str, filename: str) -> Dict[str, str]:
+        """
+        Копирует объект внутри бакета (на стороне MinIO, без скачивания)
+        
+        Returns:
+            dict: {'url': str, 'path': str}
+        """
+        from minio.commonconfig import CopySource
+
+        if not filename.startswith('images/'):
+            filename = f"images/{filename}"
+        try:
+            self.client.copy_object(self.bucket, filename, CopySource(self.bucket, source_path))
+        except S3Error as e:
+            logger.error(f"[MINIO] Ошибка копирования {source_path}: {e}", exc_info=True)
+            raise ValueError(f"MinIO copy error: {e}")
+        logger.info(f"[MINIO] Изображение {source_path} скопировано в {filename}")
+        return {
+            'url': f"{self.public_url.rstrip('/')}/{self.bucket}/{filename}",
+            'path': filename
+        }
+
     def get_image_url(self, filename: str, expires: int = 3600) -> str:
         """Получает presigned URL для изображения"""
         try:
@@ -116,3 +138,21 @@ class MinioService:
             logger.error(f"[MINIO] Ошибка удаления: {e}")
             return False
 
+
+    def delete_images(self, filenames: List[str]) -> List[str]:
+        """
+        Пакетное удаление (remove_objects, до 1000 объектов на запрос).
+        Возвращает пути, которые удалось удалить.
+        """
+        from minio.deleteobjects import DeleteObject
+
+        failed = set()
+        try:
+            for error in self.client.remove_objects(self.bucket, (DeleteObject(name) for name in filenames)):
+                logger.error(f"[MINIO] Ошибка удаления {error.name}: {error.code} {error.message}")
+                failed.add(error.name)
+        except Exception as e:
+            # Сетевые сбои тоже не пробрасываем: неудалённые пути останутся в очереди удаления
+            logger.error(f"[MINIO] Ошибка пакетного удаления: {e}")
+            return []
+        return [name for name in filenames if name not in failed]
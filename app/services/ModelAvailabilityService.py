@@ -0,0 +1,129 @@
+"""
+Доступность моделей, поставленных провайдером на паузу ("model is paused").
+
+Пауза — состояние модели у провайдера, общее для всех API ключей, поэтому строка одна
+на (провайдер, модель). Состояние (model_availability) общее для всех воркеров: до
+paused_until модель считается на паузе, и paused-генерации всех процессов ждут этого
+срока. Когда срок наступает, ровно один воркер забирает пробу (claim_probe, строка
+блокируется) и проверяет модель; остальные видят уже сдвинутый срок.
+Интервал проб растёт экспоненциально с jitter, пока модель остаётся на паузе.
+Успешная генерация модели на любом воркере снимает паузу.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.models.base import ModelAvailability
+from app.services.DBService import db_service
+from app.services.retry_backoff import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+
+class ModelAvailabilityService:
+    """Общая пауза пары (провайдер, модель) и очередь проб её доступности"""
+
+    # Интервал между пробами: от PROBE_INTERVAL_SECONDS, растёт до MAX_PROBE_INTERVAL_SECONDS
+    PROBE_INTERVAL_SECONDS = 30.0
+    MAX_PROBE_INTERVAL_SECONDS = 600.0
+
+    def _next_probe_delay(self, pause_streak: int) -> float:
+        return backoff_delay(
+            pause_streak,
+            self.PROBE_INTERVAL_SECONDS,
+            self.MAX_PROBE_INTERVAL_SECONDS,
+            retry_after=self.PROBE_INTERVAL_SECONDS,
+        )
+
+    @staticmethod
+    def _remaining(paused_until: Optional[datetime], now: datetime) -> Optional[float]:
+        if paused_until is None:
+            return None
+        return max((paused_until - now).total_seconds(), 0.0)
+
+    def _locked_row(self, session, provider: str, model_name: str) -> ModelAvailability:
+        session.execute(
+            pg_insert(ModelAvailability)
+            .values(provider=provider, model_name=model_name, pause_streak=0, updated_at=datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=["provider", "model_name"])
+        )
+        return (
+            session.query(ModelAvailability)
+            .filter(ModelAvailability.provider == provider, ModelAvailability.model_name == model_name)
+            .with_for_update()
+            .one()
+        )
+
+    def record_paused(self, provider: str, model_name: str, error: Optional[str] = None) -> float:
+        """
+        Провайдер ответил, что модель на паузе. Ставит паузу, если её ещё нет.
+        Возвращает, через сколько секунд проверять модель.
+        """
+        with db_service.get_session() as session:
+            row = self._locked_row(session, provider, model_name)
+            now = datetime.utcnow()
+            if row.paused_until is None:
+                delay = self._next_probe_delay(0)
+                row.pause_streak = 1
+                row.paused_until = now + timedelta(seconds=delay)
+                logger.warning(f"[PAUSED_QUEUE] Модель {provider}/{model_name} на паузе, проба через {delay:.0f} сек")
+            row.last_error = (error or "")[:2000] or row.last_error
+            row.updated_at = now
+            remaining = self._remaining(row.paused_until, now)
+            session.commit()
+            return remaining
+
+    def paused_for(self, provider: str, model_name: str) -> Optional[float]:
+        """Сколько секунд модель ещё на паузе (0 — пора проверять) или None, если она доступна."""
+        with db_service.get_session() as session:
+            row = (
+                session.query(ModelAvailability)
+                .filter(ModelAvailability.provider == provider, ModelAvailability.model_name == model_name)
+                .first()
+            )
+            return self._remaining(row.paused_until, datetime.utcnow()) if row else None
+
+    def claim_probe(self, provider: str, model_name: str) -> Tuple[bool, Optional[float]]:
+        """
+        Забирает пробу модели, если её срок наступил: срок сразу сдвигается на следующий
+        интервал, поэтому за интервал модель проверяет один воркер.
+        Возвращает (проба забрана, секунды паузы или None, если модель доступна).
+        """
+        with db_service.get_session() as session:
+            row = self._locked_row(session, provider, model_name)
+            now = datetime.utcnow()
+            if row.paused_until is None or row.paused_until > now:
+                remaining = self._remaining(row.paused_until, now)
+                session.commit()
+                return False, remaining
+            delay = self._next_probe_delay(row.pause_streak or 0)
+            row.paused_until = now + timedelta(seconds=delay)
+            row.pause_streak = (row.pause_streak or 0) + 1
+            row.updated_at = now
+            session.commit()
+            return True, delay
+
+    def record_available(self, provider: str, model_name: str) -> bool:
+        """Модель ответила: пауза снята. True, если пауза действительно была."""
+        with db_service.get_session() as session:
+            updated = (
+                session.query(ModelAvailability)
+                .filter(
+                    ModelAvailability.provider == provider,
+                    ModelAvailability.model_name == model_name,
+                    ModelAvailability.paused_until.isnot(None),
+                )
+                .update(
+                    {"paused_until": None, "pause_streak": 0, "updated_at": datetime.utcnow()},
+                    synchronize_session=False,
+                )
+            )
+            session.commit()
+        if updated:
+            logger.info(f"[PAUSED_QUEUE] Модель {provider}/{model_name} снова доступна")
+        return bool(updated)
+
+
+model_availability = ModelAvailabilityService()
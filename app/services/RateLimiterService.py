@@ -0,0 +1,114 @@
+"""
+Проактивный лимит запросов к провайдерам по API ключу.
+
+Перед вызовом провайдера воркер забирает токен из ведра своего API ключа
+(ключ — sha256 от API ключа). Если токена нет, задача возвращается в очередь
+с задержкой, а не тратит попытку и квоту на заведомо отклонённый запрос.
+Бюджет ведра обучается: rate limit от провайдера уменьшает его вдвое,
+успешные вызовы постепенно возвращают к RATE_LIMIT_REQUESTS.
+
+Состояние хранится в Postgres (provider_rate_limits, строка блокируется
+на время пересчёта) и общее для всех воркеров; RATE_LIMIT_BACKEND=local
+держит его в памяти процесса.
+"""
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Optional, TypeVar
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.config import settings
+from app.models.base import ProviderRateLimit
+from app.services.DBService import db_service
+from app.services.token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def api_key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.strip().encode("utf-8")).hexdigest()
+
+
+class RateLimiterService:
+    """Token bucket на API ключ провайдера, общий для всех воркеров"""
+
+    def __init__(self, backend: Optional[str] = None):
+        self.backend = backend or settings.RATE_LIMIT_BACKEND
+        self.window_seconds = float(settings.RATE_LIMIT_WINDOW_SECONDS)
+        self.max_budget = float(settings.RATE_LIMIT_REQUESTS)
+        self.min_budget = float(settings.RATE_LIMIT_MIN_REQUESTS)
+        self._local: Dict[str, TokenBucket] = {}
+        self._local_lock = threading.Lock()
+
+    def acquire(self, api_key: str, provider: Optional[str] = None) -> float:
+        """
+        Забирает токен для запроса к провайдеру.
+        Возвращает 0, если запрос можно отправлять, иначе — через сколько секунд повторить.
+        """
+        return self._update(api_key, provider, lambda bucket, now: bucket.take(now, self.window_seconds))
+
+    def record_throttled(self, api_key: str, provider: Optional[str] = None, retry_after: Optional[float] = None):
+        """Провайдер ответил rate limit: бюджет ключа уменьшается, запросы приостанавливаются."""
+        def throttle(bucket: TokenBucket, now: datetime):
+            bucket.throttle(now, self.window_seconds, self.min_budget, retry_after)
+            return bucket.budget
+
+        budget = self._update(api_key, provider, throttle)
+        logger.warning(
+            f"[RATE_LIMIT] {provider or 'provider'}: rate limit по ключу, бюджет снижен до "
+            f"{budget:.1f} запросов за {self.window_seconds:.0f} сек"
+        )
+
+    def record_success(self, api_key: str, provider: Optional[str] = None):
+        """Успешный вызов провайдера: бюджет ключа растёт обратно к RATE_LIMIT_REQUESTS."""
+        self._update(api_key, provider, lambda bucket, now: bucket.reward(self.max_budget))
+
+    def _update(self, api_key: str, provider: Optional[str], fn: Callable[[TokenBucket, datetime], T]) -> T:
+        key = api_key_hash(api_key)
+        if self.backend == "local":
+            return self._update_local(key, fn)
+        return self._update_postgres(key, provider, fn)
+
+    def _update_local(self, key: str, fn: Callable[[TokenBucket, datetime], T]) -> T:
+        with self._local_lock:
+            bucket = self._local.get(key)
+            if bucket is None:
+                bucket = self._local[key] = TokenBucket(self.max_budget)
+            return fn(bucket, datetime.utcnow())
+
+    def _update_postgres(self, key: str, provider: Optional[str], fn: Callable[[TokenBucket, datetime], T]) -> T:
+        with db_service.get_session() as session:
+            session.execute(
+                pg_insert(ProviderRateLimit)
+                .values(
+                    key_hash=key,
+                    provider=provider,
+                    budget=self.max_budget,
+                    tokens=self.max_budget,
+                    updated_at=datetime.utcnow(),
+                )
+                .on_conflict_do_nothing(index_elements=["key_hash"])
+            )
+            row = (
+                session.query(ProviderRateLimit)
+                .filter(ProviderRateLimit.key_hash == key)
+                .with_for_update()
+                .one()
+            )
+            # Время берём после блокировки строки: пересчёты разных воркеров идут строго по очереди
+            now = datetime.utcnow()
+            bucket = TokenBucket(row.budget, row.tokens, row.updated_at, row.throttled_until)
+            result = fn(bucket, now)
+            row.budget = bucket.budget
+            row.tokens = bucket.tokens
+            row.updated_at = bucket.updated_at or now
+            row.throttled_until = bucket.throttled_until
+            session.commit()
+            return result
+
+
+rate_limiter = RateLimiterService()
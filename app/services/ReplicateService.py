@@ -5,14 +5,16 @@ import replicate
 import requests
 import io
 import logging
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable
 from PIL import Image
 import time
 
 from replicate.exceptions import ModelError, ReplicateError
 import re
 
+from app.services.cancellation import CancellationToken, GenerationCancelled
 from app.services.generation_prompt import enhance_prompt_for_image_generation
+from app.services.retry_backoff import retry_after_from_text
 
 logger = logging.getLogger(__name__)
 
@@ -63,9 +65,12 @@ class ReplicateService:
     MODEL_NAME = "google/nano-banana-pro"  # Для обратной совместимости
     TIMEOUT = 900  # 15 минут (увеличено для сложных генераций)
 
-    # Параметры повторных попыток при временных ошибках (E003 / 429)
-    MAX_RETRIES = 3
-    RETRY_DELAY_SECONDS = 5
+    # Интервал опроса prediction при ожидании с токеном отмены
+    PREDICTION_POLL_INTERVAL_SECONDS = 1.0
+    # Токен отмены генерации (выставляет воркер); None — обычный блокирующий client.run()
+    cancellation: Optional[CancellationToken] = None
+    # Вызывается с хэндлом prediction сразу после его создания (воркер сохраняет его в БД)
+    provider_job_callback: Optional[Callable[[Dict[str, Any]], None]] = None
     
     # Лимиты Nano Banana Pro API для референсных изображений
     MAX_REF_DIMENSION = 2048  # Максимальный размер по большей стороне
@@ -214,159 +219,16 @@ class ReplicateService:
             }
         """
         try:
-            # Определяем модель для использования
-            if model_name and model_name in self.AVAILABLE_MODELS:
-                selected_model = self.AVAILABLE_MODELS[model_name]["name"]
-                logger.info(f"[REPLICATE] Используется модель: {model_name} ({selected_model})")
-            elif model_name:
-                # Если указана модель, которой нет в списке, пробуем использовать как есть (для кастомных моделей)
-                selected_model = model_name
-                logger.warning(f"[REPLICATE] Модель '{model_name}' не найдена в списке доступных, используется как есть")
-            else:
-                selected_model = self.AVAILABLE_MODELS[self.DEFAULT_MODEL]["name"]
-                logger.info(f"[REPLICATE] Используется модель по умолчанию: {self.DEFAULT_MODEL} ({selected_model})")
-            
-            logger.info(f"[REPLICATE] Начало генерации. Промпт: {prompt[:100]}...")
-            logger.info(f"[REPLICATE] Параметры: resolution={resolution}, aspect_ratio={aspect_ratio}, model={selected_model}")
-            
-            # Определяем, какая модель используется (для адаптации параметров)
-            current_model_key = model_name if model_name and model_name in self.AVAILABLE_MODELS else self.DEFAULT_MODEL
-            
-            # Подготовка параметров в зависимости от модели (без автоподмены)
-            input_params = {"prompt": prompt}
-            
-            # Imagen 4 / Fast / Ultra: только prompt и aspect_ratio
-            if current_model_key in ("imagen-4", "imagen-4-fast", "imagen-4-ultra"):
-                input_params["aspect_ratio"] = aspect_ratio
-                if seed is not None:
-                    input_params["seed"] = int(seed)
-            else:
-                # Nano Banana / Gemini: resolution, aspect_ratio и остальное
-                input_params["resolution"] = resolution
-                input_params["aspect_ratio"] = aspect_ratio
-                if negative_prompt:
-                    input_params["negative_prompt"] = negative_prompt
-                if guidance_scale != 7.5:
-                    input_params["guidance_scale"] = guidance_scale
-                if num_inference_steps != 50:
-                    input_params["num_inference_steps"] = num_inference_steps
-                if seed is not None:
-                    input_params["seed"] = int(seed)
-            
-            # Обработка референсных изображений (Imagen 4 не использует image_input в том же формате — не передаём)
-            processed_images: List = []
-            if reference_images and len(reference_images) > 0 and current_model_key not in ("imagen-4", "imagen-4-fast", "imagen-4-ultra"):
-                for idx, img in enumerate(reference_images[:14], 1):  # Максимум 14 изображений
-                    try:
-                        if isinstance(img, str):
-                            # Если это base64 или URL
-                            if img.startswith('data:image'):
-                                # Base64 изображение
-                                import base64
-                                header, encoded = img.split(',', 1)
-                                img_data = base64.b64decode(encoded)
-                                
-                                # Оптимизируем изображение для Nano Banana Pro API (если нужно)
-                                img_data = self._optimize_image_for_api(img_data, idx)
-                                
-                                processed_images.append(io.BytesIO(img_data))
-                                logger.debug(f"[REPLICATE] Референс {idx}: обработан base64 изображение")
-                            elif img.startswith(('http://', 'https://')):
-                                # URL изображение - загружаем и оптимизируем
-                                img_response = requests.get(img, timeout=30)
-                                if img_response.status_code == 200:
-                                    img_data = img_response.content
-                                    
-                                    # Оптимизируем изображение для Nano Banana Pro API (если нужно)
-                                    img_data = self._optimize_image_for_api(img_data, idx)
-                                    
-                                    processed_images.append(io.BytesIO(img_data))
-                                    logger.debug(f"[REPLICATE] Референс {idx}: загружен с URL и оптимизирован")
-                                else:
-                                    logger.warning(f"[REPLICATE] Референс {idx}: не удалось загрузить с URL (статус {img_response.status_code})")
-                            else:
-                                # Прямой путь к файлу
-                                processed_images.append(img)
-                                logger.debug(f"[REPLICATE] Референс {idx}: используется файл")
-                        elif hasattr(img, 'read'):
-                            # Если это файлоподобный объект
-                            img.seek(0)
-                            img_data = img.read()
-                            
-                            # Оптимизируем изображение для Nano Banana Pro API (если нужно)
-                            img_data = self._optimize_image_for_api(img_data, idx)
-                            
-                            processed_images.append(io.BytesIO(img_data))
-                            logger.debug(f"[REPLICATE] Референс {idx}: обработан файлоподобный объект и оптимизирован")
-                    except Exception as e:
-                        logger.error(f"[REPLICATE] Ошибка обработки референса {idx}: {e}")
-                        continue
-                
-                if processed_images:
-                    # Все модели Nano Banana используют image_input для референсных изображений
-                    input_params["image_input"] = processed_images
-                    logger.info(f"[REPLICATE] Загружено {len(processed_images)} референсных изображений в порядке: 1-{len(processed_images)}")
-                else:
-                    logger.warning("[REPLICATE] Не удалось обработать ни одного референсного изображения")
-            
-            # Если aspect_ratio начинается с "user", соотношение уже вычислено на фронтенде
-            # и передано как стандартное (например "16:9", "4:3" и т.д.)
-            # Nano Banana Pro поддерживает только стандартные соотношения
-            # Пользовательские соотношения конвертируются в ближайшее стандартное на фронтенде
-            
-            if reference_images and len(reference_images) > 0:
-                num_refs_effective = len(processed_images) if processed_images else len(reference_images)
-            else:
-                num_refs_effective = 0
-            input_params["prompt"] = enhance_prompt_for_image_generation(
-                prompt, reference_images, num_refs_effective
+            selected_model, input_params = self._prepare_request(
+                prompt, negative_prompt, resolution, aspect_ratio, guidance_scale,
+                num_inference_steps, seed, reference_images, model_name
             )
-            
-            # Вызов API с повторными попытками при временных ошибках (rate limit / high demand)
-            start_time = time.time()
-            logger.info("[REPLICATE] Отправка запроса в Replicate API...")
-
-            last_error: Optional[Exception] = None
-            output = None
 
-            for attempt in range(1, self.MAX_RETRIES + 1):
-                try:
-                    logger.info(f"[REPLICATE] Попытка {attempt}/{self.MAX_RETRIES} вызова модели {selected_model}...")
-                    output = self.client.run(selected_model, input=input_params)
-                    # Успех – выходим из цикла
-                    last_error = None
-                    break
-                except ModelError as me:
-                    error_text = str(me) if me else ""
-                    # Проверяем на E003 / 429
-                    is_rate_limit = (
-                        "E003" in error_text
-                        or "high demand" in error_text
-                        or "429" in error_text
-                        or "ModelRateLimitError" in error_text
-                    )
-
-                    if is_rate_limit and attempt < self.MAX_RETRIES:
-                        last_error = me
-                        logger.warning(
-                            "[REPLICATE] Временная ошибка модели (rate limit / high demand): "
-                            f"\"{error_text}\". Попытка {attempt}/{self.MAX_RETRIES}, "
-                            f"ждем {self.RETRY_DELAY_SECONDS} секунд и пробуем ещё раз..."
-                        )
-                        time.sleep(self.RETRY_DELAY_SECONDS)
-                        continue
-
-                    # Либо не rate-limit ошибка, либо исчерпали попытки – пробрасываем
-                    last_error = me
-                    raise
-                except Exception as e:
-                    # Другие ошибки не считаем временными – пробрасываем сразу
-                    last_error = e
-                    raise
-
-            if output is None and last_error is not None:
-                # На всякий случай, если по какой-то причине не вышли через raise
-                raise last_error
+            # Вызов API. Временные ошибки (E003 / 429) здесь не повторяются: _error_result помечает
+            # их retryable, и воркер ставит повтор в очередь с экспоненциальной задержкой
+            start_time = time.time()
+            logger.info(f"[REPLICATE] Отправка запроса в Replicate API, модель {selected_model}...")
+            output = self._run(selected_model, input_params)
             
             # Обработка результата
             result_data = None
@@ -533,243 +395,532 @@ class ReplicateService:
             
             logger.info(f"[REPLICATE] После обработки результата: result_url={'есть' if result_url else 'отсутствует'}, result_data={'есть' if result_data else 'отсутствует'}")
             
-            # Загрузка изображения если есть URL
-            if result_url and not result_data:
+            return self._result_from_output(result_url, result_data)
+
+        except GenerationCancelled:
+            # Отмена — не ошибка провайдера: воркер просто прекращает обработку
+            raise
+        except Exception as e:
+            return self._error_result(e)
+
+    def create_prediction(
+        self,
+        prompt: str,
+        negative_prompt: Optional[str] = None,
+        resolution: str = "1K",
+        aspect_ratio: str = "1:1",
+        guidance_scale: float = 7.5,
+        num_inference_steps: int = 50,
+        seed: Optional[int] = None,
+        reference_images: Optional[List] = None,
+        model_name: Optional[str] = None,
+        webhook_url: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Создаёт prediction и сразу возвращается, не дожидаясь результата.
+        Результат приходит на webhook_url (событие completed) или забирается через get_prediction().
+
+        Returns:
+            dict: {'success': True, 'prediction_id': str, 'status': str, 'error': None}
+                  либо ответ об ошибке в формате generate_image()
+        """
+        try:
+            selected_model, input_params = self._prepare_request(
+                prompt, negative_prompt, resolution, aspect_ratio, guidance_scale,
+                num_inference_steps, seed, reference_images, model_name
+            )
+            params: Dict[str, Any] = {}
+            if webhook_url:
+                params["webhook"] = webhook_url
+                params["webhook_events_filter"] = ["completed"]
+
+            prediction = self._create(selected_model, input_params, **params)
+            logger.info(
+                f"[REPLICATE] Создан prediction {prediction.id} (модель {selected_model}, "
+                f"статус {prediction.status}, webhook {'есть' if webhook_url else 'нет'})"
+            )
+            return {
+                'success': True,
+                'prediction_id': prediction.id,
+                'status': prediction.status,
+                'error': None
+            }
+        except Exception as e:
+            return self._error_result(e)
+
+    def _create(self, selected_model: str, input_params: Dict[str, Any], **params):
+        if ":" in selected_model:
+            # owner/name:version — кастомная модель с зафиксированной версией
+            return self.client.predictions.create(
+                version=selected_model.split(":", 1)[1], input=input_params, **params
+            )
+        return self.client.models.predictions.create(
+            model=selected_model, input=input_params, **params
+        )
+
+    def _run(self, selected_model: str, input_params: Dict[str, Any]) -> Any:
+        """
+        client.run() с возможностью отмены и сохранения хэндла. Без токена и колбэка —
+        обычный блокирующий вызов; иначе prediction создаётся явно (его ID сразу уходит
+        в provider_job_callback) и ожидается с проверкой отмены, а отменённый prediction
+        останавливается и у Replicate.
+        """
+        if self.cancellation is None and self.provider_job_callback is None:
+            return self.client.run(selected_model, input=input_params)
+
+        prediction = self._create(selected_model, input_params)
+        if self.provider_job_callback is not None:
+            self.provider_job_callback({"provider": "replicate", "id": prediction.id})
+        cancellation = self.cancellation or CancellationToken()
+        started_at = time.time()
+        while prediction.status not in ("succeeded", "failed", "canceled"):
+            cancelled = cancellation.wait(self.PREDICTION_POLL_INTERVAL_SECONDS)
+            if cancelled or time.time() - started_at > self.TIMEOUT:
                 try:
-                    logger.info(f"[REPLICATE] Загрузка изображения по URL: {result_url[:100]}...")
-                    img_response = requests.get(result_url, timeout=30)
-                    if img_response.status_code == 200:
-                        result_data = img_response.content
-                        logger.info(f"[REPLICATE] Изображение загружено, размер: {len(result_data)} байт")
-                        
-                        # Проверяем что это валидное изображение
-                        # Сначала проверяем размер - если меньше 1KB, это подозрительно
-                        if len(result_data) < 1024:
-                            logger.warning(f"[REPLICATE] Подозрительно маленький размер данных: {len(result_data)} байт")
-                            # Пробуем открыть через Pillow - если не получается, используем URL
-                            try:
-                                img = Image.open(io.BytesIO(result_data))
-                                img.verify()
-                                img = Image.open(io.BytesIO(result_data))  # Пересоздаем после verify
-                                logger.info(f"[REPLICATE] Изображение валидно несмотря на малый размер: {img.format}, размер: {img.size}")
-                            except Exception as small_img_error:
-                                logger.error(f"[REPLICATE] Данные слишком маленькие и невалидны (вероятно обрезано): {small_img_error}")
-                                logger.warning(f"[REPLICATE] Первые 200 байт данных (hex): {result_data[:200].hex()}")
-                                # Используем URL напрямую, не сохраняем невалидные данные
-                                result_data = None
-                                logger.info(f"[REPLICATE] Будет использован URL напрямую: {result_url[:100]}...")
-                        else:
-                            # Размер нормальный, проверяем что это валидное изображение
-                            try:
-                                # Быстрая проверка по магическим байтам (заголовкам файлов)
-                                image_signatures = {
-                                    b'\xff\xd8\xff': 'JPEG',
-                                    b'\x89PNG\r\n\x1a\n': 'PNG',
-                                    b'GIF87a': 'GIF',
-                                    b'GIF89a': 'GIF',
-                                    b'RIFF': 'WEBP',  # WEBP начинается с RIFF
-                                }
-                                
-                                is_image = False
-                                detected_format = None
-                                for signature, fmt in image_signatures.items():
-                                    if result_data.startswith(signature):
-                                        is_image = True
-                                        detected_format = fmt
-                                        break
-                                
-                                if is_image:
-                                    logger.info(f"[REPLICATE] Обнаружен формат изображения по заголовку: {detected_format}")
-                                
-                                # Проверяем через Pillow
-                                img = Image.open(io.BytesIO(result_data))
-                                img.verify()
-                                img = Image.open(io.BytesIO(result_data))  # Пересоздаем после verify
-                                logger.info(f"[REPLICATE] Изображение валидно: {img.format}, размер: {img.size}, размер файла: {len(result_data)} байт")
-                            except Exception as img_error:
-                                logger.error(f"[REPLICATE] Загруженные данные не являются валидным изображением: {img_error}")
-                                logger.warning(f"[REPLICATE] Первые 200 байт данных (hex): {result_data[:200].hex()}")
-                                logger.warning(f"[REPLICATE] Первые 200 байт данных (text): {result_data[:200]}")
-                                # Используем URL напрямую, не сохраняем невалидные данные
-                                result_data = None
-                                logger.info(f"[REPLICATE] Будет использован URL напрямую: {result_url[:100]}...")
+                    prediction.cancel()
                 except Exception as e:
-                    logger.error(f"[REPLICATE] Не удалось загрузить изображение по URL: {e}", exc_info=True)
-            
-            if result_data:
-                logger.info(f"[REPLICATE] Возвращаем результат с данными изображения (размер: {len(result_data)} байт) и URL: {result_url[:100] if result_url else 'URL отсутствует'}...")
-                return {
-                    'success': True,
-                    'image_url': result_url,
-                    'image_data': result_data,
-                    'error': None
-                }
-            elif result_url:
-                logger.info(f"[REPLICATE] Возвращаем результат только с URL (данные изображения невалидны или отсутствуют): {result_url[:100]}...")
-                return {
-                    'success': True,
-                    'image_url': result_url,
-                    'image_data': None,
-                    'error': None
-                }
-            else:
-                logger.error(f"[REPLICATE] Не удалось получить результат генерации: нет ни данных, ни URL")
-                raise ValueError("Не удалось получить результат генерации")
-                
+                    logger.warning(f"[REPLICATE] Не удалось отменить prediction {prediction.id}: {e}")
+                if cancelled:
+                    raise GenerationCancelled("Генерация отменена")
+                raise TimeoutError(f"Таймаут генерации ({self.TIMEOUT} секунд)")
+            prediction.reload()
+
+        if prediction.status == "canceled":
+            raise GenerationCancelled("Генерация отменена")
+        if prediction.status == "failed":
+            raise ModelError(prediction)
+        return prediction.output
+
+    def get_prediction(self, prediction_id: str) -> Dict[str, Any]:
+        """Текущее состояние prediction в том же виде, что и тело webhook'а Replicate."""
+        prediction = self.client.predictions.get(prediction_id)
+        return {
+            "id": prediction.id,
+            "status": prediction.status,
+            "output": prediction.output,
+            "error": prediction.error,
+        }
+
+    def cancel_prediction(self, prediction_id: str) -> None:
+        self.client.predictions.cancel(prediction_id)
+
+    def probe_model(self, model_name: Optional[str] = None) -> Optional[str]:
+        """
+        Проба доступности модели (paused-очередь): prediction с минимальным входом без референсов
+        создаётся и сразу отменяется, результат не ждём.
+        Возвращает None, если модель приняла запрос, иначе текст ошибки (например, "model is paused").
+        """
+        try:
+            selected_model, input_params = self._prepare_request(
+                "availability probe", None, "1K", "1:1", 7.5, 1, None, None, model_name
+            )
+            prediction = self._create(selected_model, input_params)
         except Exception as e:
-            logger.error(f"[REPLICATE] Ошибка генерации: {e}", exc_info=True)
-            
-            # Базовый текст из исключения
-            raw_error = str(e)
-            error_message = raw_error
+            return self._error_result(e)["error"]
+        try:
+            self.cancel_prediction(prediction.id)
+        except Exception as e:
+            logger.warning(f"[REPLICATE] Не удалось отменить пробный prediction {prediction.id}: {e}")
+        if prediction.status == "failed":
+            return str(prediction.error or "Пробный prediction завершился со статусом failed")
+        logger.info(f"[REPLICATE] Проба модели {selected_model}: запрос принят, prediction {prediction.id} отменён")
+        return None
 
-            # Для ModelError от replicate SDK часто str(e) пустой.
-            # Пытаемся извлечь деталь ошибки из prediction/error.
-            if isinstance(e, ModelError):
+    def prediction_result(self, prediction: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Результат завершённого prediction (тело webhook'а или get_prediction()) в формате generate_image().
+        None — prediction ещё выполняется.
+        """
+        status = prediction.get("status")
+        if status not in ("succeeded", "failed", "canceled"):
+            return None
+        try:
+            if status != "succeeded":
+                raise RuntimeError(prediction.get("error") or f"Prediction завершился со статусом {status}")
+
+            output = prediction.get("output")
+            if isinstance(output, list):
+                output = output[0] if output else None
+            result_url = None
+            if isinstance(output, str) and output.startswith(('http://', 'https://')):
+                result_url = output
+            logger.info(f"[REPLICATE] Prediction {prediction.get('id')} завершён, URL: {result_url[:100] if result_url else 'URL отсутствует'}")
+            return self._result_from_output(result_url, None)
+        except Exception as e:
+            return self._error_result(e)
+
+    def _resolve_model(self, model_name: Optional[str]):
+        """Имя модели Replicate (owner/name) и ключ модели для адаптации параметров."""
+        # Определяем модель для использования
+        if model_name and model_name in self.AVAILABLE_MODELS:
+            selected_model = self.AVAILABLE_MODELS[model_name]["name"]
+            logger.info(f"[REPLICATE] Используется модель: {model_name} ({selected_model})")
+        elif model_name:
+            # Если указана модель, которой нет в списке, пробуем использовать как есть (для кастомных моделей)
+            selected_model = model_name
+            logger.warning(f"[REPLICATE] Модель '{model_name}' не найдена в списке доступных, используется как есть")
+        else:
+            selected_model = self.AVAILABLE_MODELS[self.DEFAULT_MODEL]["name"]
+            logger.info(f"[REPLICATE] Используется модель по умолчанию: {self.DEFAULT_MODEL} ({selected_model})")
+
+        # Определяем, какая модель используется (для адаптации параметров)
+        current_model_key = model_name if model_name and model_name in self.AVAILABLE_MODELS else self.DEFAULT_MODEL
+        return selected_model, current_model_key
+
+    def _prepare_request(
+        self,
+        prompt: str,
+        negative_prompt: Optional[str],
+        resolution: str,
+        aspect_ratio: str,
+        guidance_scale: float,
+        num_inference_steps: int,
+        seed: Optional[int],
+        reference_images: Optional[List],
+        model_name: Optional[str],
+    ):
+        """Выбирает модель и собирает input для Replicate (параметры модели, референсы, итоговый промпт)."""
+        selected_model, current_model_key = self._resolve_model(model_name)
+
+        logger.info(f"[REPLICATE] Начало генерации. Промпт: {prompt[:100]}...")
+        logger.info(f"[REPLICATE] Параметры: resolution={resolution}, aspect_ratio={aspect_ratio}, model={selected_model}")
+        
+        
+        # Подготовка параметров в зависимости от модели (без автоподмены)
+        input_params = {"prompt": prompt}
+        
+        # Imagen 4 / Fast / Ultra: только prompt и aspect_ratio
+        if current_model_key in ("imagen-4", "imagen-4-fast", "imagen-4-ultra"):
+            input_params["aspect_ratio"] = aspect_ratio
+            if seed is not None:
+                input_params["seed"] = int(seed)
+        else:
+            # Nano Banana / Gemini: resolution, aspect_ratio и остальное
+            input_params["resolution"] = resolution
+            input_params["aspect_ratio"] = aspect_ratio
+            if negative_prompt:
+                input_params["negative_prompt"] = negative_prompt
+            if guidance_scale != 7.5:
+                input_params["guidance_scale"] = guidance_scale
+            if num_inference_steps != 50:
+                input_params["num_inference_steps"] = num_inference_steps
+            if seed is not None:
+                input_params["seed"] = int(seed)
+        
+        # Обработка референсных изображений (Imagen 4 не использует image_input в том же формате — не передаём)
+        processed_images: List = []
+        if reference_images and len(reference_images) > 0 and current_model_key not in ("imagen-4", "imagen-4-fast", "imagen-4-ultra"):
+            for idx, img in enumerate(reference_images[:14], 1):  # Максимум 14 изображений
                 try:
-                    prediction = getattr(e, "prediction", None)
-                    if prediction:
-                        # В большинстве случаев причина лежит в prediction.error
-                        pred_error = getattr(prediction, "error", None)
-                        if pred_error:
-                            error_message = str(pred_error)
+                    if isinstance(img, str):
+                        # Если это base64 или URL
+                        if img.startswith('data:image'):
+                            # Base64 изображение
+                            import base64
+                            header, encoded = img.split(',', 1)
+                            img_data = base64.b64decode(encoded)
+                            
+                            # Оптимизируем изображение для Nano Banana Pro API (если нужно)
+                            img_data = self._optimize_image_for_api(img_data, idx)
+                            
+                            processed_images.append(io.BytesIO(img_data))
+                            logger.debug(f"[REPLICATE] Референс {idx}: обработан base64 изображение")
+                        elif img.startswith(('http://', 'https://')):
+                            # URL изображение - загружаем и оптимизируем
+                            img_response = requests.get(img, timeout=30)
+                            if img_response.status_code == 200:
+                                img_data = img_response.content
+                                
+                                # Оптимизируем изображение для Nano Banana Pro API (если нужно)
+                                img_data = self._optimize_image_for_api(img_data, idx)
+                                
+                                processed_images.append(io.BytesIO(img_data))
+                                logger.debug(f"[REPLICATE] Референс {idx}: загружен с URL и оптимизирован")
+                            else:
+                                logger.warning(f"[REPLICATE] Референс {idx}: не удалось загрузить с URL (статус {img_response.status_code})")
                         else:
-                            # Фолбэк: сериализуем prediction целиком для диагностики
-                            error_message = str(prediction)
-                    elif not error_message:
-                        # Последний фолбэк: repr исключения
-                        error_message = repr(e)
-                except Exception as parse_error:
-                    logger.warning(f"[REPLICATE] Не удалось извлечь детали ModelError: {parse_error}")
-                    if not error_message:
-                        error_message = repr(e)
-            
-            # Специальная обработка ошибки 499 "Client Closed Request"
-            if "499" in error_message or "client closed request" in error_message.lower():
-                error_message = (
-                    "Соединение было закрыто до завершения генерации. "
-                    "Это может произойти, если генерация занимает слишком много времени или есть проблемы с сетью. "
-                    "Попробуйте повторить запрос или упростить промпт."
-                )
-                logger.warning(
-                    "[REPLICATE] Обнаружена ошибка 499 (Client Closed Request). "
-                    "Возможные причины: таймаут, проблемы с сетью, слишком долгая генерация."
-                )
+                            # Прямой путь к файлу
+                            processed_images.append(img)
+                            logger.debug(f"[REPLICATE] Референс {idx}: используется файл")
+                    elif hasattr(img, 'read'):
+                        # Если это файлоподобный объект
+                        img.seek(0)
+                        img_data = img.read()
+                        
+                        # Оптимизируем изображение для Nano Banana Pro API (если нужно)
+                        img_data = self._optimize_image_for_api(img_data, idx)
+                        
+                        processed_images.append(io.BytesIO(img_data))
+                        logger.debug(f"[REPLICATE] Референс {idx}: обработан файлоподобный объект и оптимизирован")
+                except Exception as e:
+                    logger.error(f"[REPLICATE] Ошибка обработки референса {idx}: {e}")
+                    continue
             
-            # Если это ошибка от Replicate API, пытаемся извлечь более удобочитаемый текст
-            if hasattr(e, "message"):
-                error_message = str(e.message)
-            elif hasattr(e, "args") and len(e.args) > 0:
-                arg0 = e.args[0]
-                # Для ModelError args[0] иногда это объект prediction.
-                # В таком случае лучше брать поле error.
-                if isinstance(e, ModelError):
-                    pred_error = getattr(arg0, "error", None)
+            if processed_images:
+                # Все модели Nano Banana используют image_input для референсных изображений
+                input_params["image_input"] = processed_images
+                logger.info(f"[REPLICATE] Загружено {len(processed_images)} референсных изображений в порядке: 1-{len(processed_images)}")
+            else:
+                logger.warning("[REPLICATE] Не удалось обработать ни одного референсного изображения")
+        
+        # Если aspect_ratio начинается с "user", соотношение уже вычислено на фронтенде
+        # и передано как стандартное (например "16:9", "4:3" и т.д.)
+        # Nano Banana Pro поддерживает только стандартные соотношения
+        # Пользовательские соотношения конвертируются в ближайшее стандартное на фронтенде
+        
+        if reference_images and len(reference_images) > 0:
+            num_refs_effective = len(processed_images) if processed_images else len(reference_images)
+        else:
+            num_refs_effective = 0
+        input_params["prompt"] = enhance_prompt_for_image_generation(
+            prompt, reference_images, num_refs_effective
+        )
+        return selected_model, input_params
+
+    def _result_from_output(self, result_url: Optional[str], result_data: Optional[bytes]) -> Dict[str, Any]:
+        """Скачивает и проверяет изображение по URL результата, формирует ответ generate_image()."""
+        # Загрузка изображения если есть URL
+        if result_url and not result_data:
+            try:
+                logger.info(f"[REPLICATE] Загрузка изображения по URL: {result_url[:100]}...")
+                img_response = requests.get(result_url, timeout=30)
+                if img_response.status_code == 200:
+                    result_data = img_response.content
+                    logger.info(f"[REPLICATE] Изображение загружено, размер: {len(result_data)} байт")
+                    
+                    # Проверяем что это валидное изображение
+                    # Сначала проверяем размер - если меньше 1KB, это подозрительно
+                    if len(result_data) < 1024:
+                        logger.warning(f"[REPLICATE] Подозрительно маленький размер данных: {len(result_data)} байт")
+                        # Пробуем открыть через Pillow - если не получается, используем URL
+                        try:
+                            img = Image.open(io.BytesIO(result_data))
+                            img.verify()
+                            img = Image.open(io.BytesIO(result_data))  # Пересоздаем после verify
+                            logger.info(f"[REPLICATE] Изображение валидно несмотря на малый размер: {img.format}, размер: {img.size}")
+                        except Exception as small_img_error:
+                            logger.error(f"[REPLICATE] Данные слишком маленькие и невалидны (вероятно обрезано): {small_img_error}")
+                            logger.warning(f"[REPLICATE] Первые 200 байт данных (hex): {result_data[:200].hex()}")
+                            # Используем URL напрямую, не сохраняем невалидные данные
+                            result_data = None
+                            logger.info(f"[REPLICATE] Будет использован URL напрямую: {result_url[:100]}...")
+                    else:
+                        # Размер нормальный, проверяем что это валидное изображение
+                        try:
+                            # Быстрая проверка по магическим байтам (заголовкам файлов)
+                            image_signatures = {
+                                b'\xff\xd8\xff': 'JPEG',
+                                b'\x89PNG\r\n\x1a\n': 'PNG',
+                                b'GIF87a': 'GIF',
+                                b'GIF89a': 'GIF',
+                                b'RIFF': 'WEBP',  # WEBP начинается с RIFF
+                            }
+                            
+                            is_image = False
+                            detected_format = None
+                            for signature, fmt in image_signatures.items():
+                                if result_data.startswith(signature):
+                                    is_image = True
+                                    detected_format = fmt
+                                    break
+                            
+                            if is_image:
+                                logger.info(f"[REPLICATE] Обнаружен формат изображения по заголовку: {detected_format}")
+                            
+                            # Проверяем через Pillow
+                            img = Image.open(io.BytesIO(result_data))
+                            img.verify()
+                            img = Image.open(io.BytesIO(result_data))  # Пересоздаем после verify
+                            logger.info(f"[REPLICATE] Изображение валидно: {img.format}, размер: {img.size}, размер файла: {len(result_data)} байт")
+                        except Exception as img_error:
+                            logger.error(f"[REPLICATE] Загруженные данные не являются валидным изображением: {img_error}")
+                            logger.warning(f"[REPLICATE] Первые 200 байт данных (hex): {result_data[:200].hex()}")
+                            logger.warning(f"[REPLICATE] Первые 200 байт данных (text): {result_data[:200]}")
+                            # Используем URL напрямую, не сохраняем невалидные данные
+                            result_data = None
+                            logger.info(f"[REPLICATE] Будет использован URL напрямую: {result_url[:100]}...")
+            except Exception as e:
+                logger.error(f"[REPLICATE] Не удалось загрузить изображение по URL: {e}", exc_info=True)
+        
+        if result_data:
+            logger.info(f"[REPLICATE] Возвращаем результат с данными изображения (размер: {len(result_data)} байт) и URL: {result_url[:100] if result_url else 'URL отсутствует'}...")
+            return {
+                'success': True,
+                'image_url': result_url,
+                'image_data': result_data,
+                'error': None
+            }
+        elif result_url:
+            logger.info(f"[REPLICATE] Возвращаем результат только с URL (данные изображения невалидны или отсутствуют): {result_url[:100]}...")
+            return {
+                'success': True,
+                'image_url': result_url,
+                'image_data': None,
+                'error': None
+            }
+        else:
+            logger.error(f"[REPLICATE] Не удалось получить результат генерации: нет ни данных, ни URL")
+            raise ValueError("Не удалось получить результат генерации")
+
+    def _error_result(self, e: Exception) -> Dict[str, Any]:
+        """Классифицирует ошибку Replicate и формирует ответ generate_image() с флагом retryable."""
+        logger.error(f"[REPLICATE] Ошибка генерации: {e}", exc_info=True)
+        
+        # Базовый текст из исключения
+        raw_error = str(e)
+        error_message = raw_error
+
+        # Для ModelError от replicate SDK часто str(e) пустой.
+        # Пытаемся извлечь деталь ошибки из prediction/error.
+        if isinstance(e, ModelError):
+            try:
+                prediction = getattr(e, "prediction", None)
+                if prediction:
+                    # В большинстве случаев причина лежит в prediction.error
+                    pred_error = getattr(prediction, "error", None)
                     if pred_error:
                         error_message = str(pred_error)
-                    elif not error_message:
-                        error_message = str(arg0)
-                else:
+                    else:
+                        # Фолбэк: сериализуем prediction целиком для диагностики
+                        error_message = str(prediction)
+                elif not error_message:
+                    # Последний фолбэк: repr исключения
+                    error_message = repr(e)
+            except Exception as parse_error:
+                logger.warning(f"[REPLICATE] Не удалось извлечь детали ModelError: {parse_error}")
+                if not error_message:
+                    error_message = repr(e)
+        
+        # Специальная обработка ошибки 499 "Client Closed Request"
+        if "499" in error_message or "client closed request" in error_message.lower():
+            error_message = (
+                "Соединение было закрыто до завершения генерации. "
+                "Это может произойти, если генерация занимает слишком много времени или есть проблемы с сетью. "
+                "Попробуйте повторить запрос или упростить промпт."
+            )
+            logger.warning(
+                "[REPLICATE] Обнаружена ошибка 499 (Client Closed Request). "
+                "Возможные причины: таймаут, проблемы с сетью, слишком долгая генерация."
+            )
+        
+        # Если это ошибка от Replicate API, пытаемся извлечь более удобочитаемый текст
+        if hasattr(e, "message"):
+            error_message = str(e.message)
+        elif hasattr(e, "args") and len(e.args) > 0:
+            arg0 = e.args[0]
+            # Для ModelError args[0] иногда это объект prediction.
+            # В таком случае лучше брать поле error.
+            if isinstance(e, ModelError):
+                pred_error = getattr(arg0, "error", None)
+                if pred_error:
+                    error_message = str(pred_error)
+                elif not error_message:
                     error_message = str(arg0)
-            
-            # Собираем дополнительные детали (cause / context)
-            error_details = []
-            if hasattr(e, "__cause__") and e.__cause__:
-                cause_str = str(e.__cause__)
-                error_details.append(f"Причина: {cause_str}")
-            if hasattr(e, "__context__") and e.__context__:
-                context_str = str(e.__context__)
-                error_details.append(f"Контекст: {context_str}")
-            
-            # Классификация ошибки для пользователя
-            # Нормализуем пустую строку после всех попыток извлечения
-            if not error_message or (isinstance(error_message, str) and not error_message.strip()):
-                error_message = "Не удалось получить текст ошибки от Replicate API"
+            else:
+                error_message = str(arg0)
+        
+        # Собираем дополнительные детали (cause / context)
+        error_details = []
+        if hasattr(e, "__cause__") and e.__cause__:
+            cause_str = str(e.__cause__)
+            error_details.append(f"Причина: {cause_str}")
+        if hasattr(e, "__context__") and e.__context__:
+            context_str = str(e.__context__)
+            error_details.append(f"Контекст: {context_str}")
+        
+        # Классификация ошибки для пользователя
+        # Нормализуем пустую строку после всех попыток извлечения
+        if not error_message or (isinstance(error_message, str) and not error_message.strip()):
+            error_message = "Не удалось получить текст ошибки от Replicate API"
 
-            lower_msg = (error_message or "").lower()
-            user_friendly = error_message or "Неизвестная ошибка генерации"
-            
-            # 1) Политика безопасности / цензура
-            if any(
-                key in lower_msg
-                for key in [
-                    "content policy",
-                    "violates safety",
-                    "safety",
-                    "disallowed",
-                    "not allowed",
-                    "nsfw",
-                    "sexual content",
-                ]
-            ):
-                user_friendly = (
-                    "Запрос заблокирован политикой безопасности модели. "
-                    "Сервис не может сгенерировать такое изображение. "
-                    "Попробуйте переформулировать промпт, убрав откровенный, насильственный "
-                    "или другой запрещённый контент."
-                )
-            
-            # 2) Лимиты / перегрузка (часто приходит как E003 / 429 / high demand)
-            elif any(
-                key in lower_msg
-                for key in [
-                    "e003",
-                    "rate limit",
-                    "ratelimit",
-                    "429",
-                    "high demand",
-                    "too many requests",
-                ]
-            ):
-                user_friendly = (
-                    "Сервис генерации временно перегружен или достигнут лимит запросов по API. "
-                    "Подождите немного и попробуйте снова. "
-                    "Если ошибка повторяется часто, проверьте лимиты вашего Replicate API ключа."
-                )
-            
-            # 3) Таймауты / сетевые ошибки
-            elif any(
-                key in lower_msg
-                for key in [
-                    "timeout",
-                    "timed out",
-                    "connection error",
-                    "network error",
-                    "client closed request",
-                ]
-            ):
-                user_friendly = (
-                    "Во время генерации произошла сетевая ошибка или таймаут. "
-                    "Проверьте соединение с интернетом и попробуйте ещё раз."
-                )
-            
-            # Добавляем технические детали в лог, но не показываем пользователю полностью
-            if error_details:
-                logger.error(
-                    "[REPLICATE] Дополнительные детали ошибки: "
-                    + " | ".join(error_details)
-                )
-            
-            logger.error(f"[REPLICATE] Итоговое сообщение об ошибке для пользователя: {user_friendly}")
-            
-            # Явный флаг для backend-ретраев: не зависит от локализации сообщения пользователю.
-            is_retryable = any(
-                key in lower_msg
-                for key in [
-                    "e003",
-                    "rate limit",
-                    "ratelimit",
-                    "429",
-                    "high demand",
-                    "too many requests",
-                ]
+        lower_msg = (error_message or "").lower()
+        user_friendly = error_message or "Неизвестная ошибка генерации"
+        
+        # 1) Политика безопасности / цензура
+        if any(
+            key in lower_msg
+            for key in [
+                "content policy",
+                "violates safety",
+                "safety",
+                "disallowed",
+                "not allowed",
+                "nsfw",
+                "sexual content",
+            ]
+        ):
+            user_friendly = (
+                "Запрос заблокирован политикой безопасности модели. "
+                "Сервис не может сгенерировать такое изображение. "
+                "Попробуйте переформулировать промпт, убрав откровенный, насильственный "
+                "или другой запрещённый контент."
             )
+        
+        # 2) Лимиты / перегрузка (часто приходит как E003 / 429 / high demand)
+        elif any(
+            key in lower_msg
+            for key in [
+                "e003",
+                "rate limit",
+                "ratelimit",
+                "429",
+                "high demand",
+                "too many requests",
+            ]
+        ):
+            user_friendly = (
+                "Сервис генерации временно перегружен или достигнут лимит запросов по API. "
+                "Подождите немного и попробуйте снова. "
+                "Если ошибка повторяется часто, проверьте лимиты вашего Replicate API ключа."
+            )
+        
+        # 3) Таймауты / сетевые ошибки
+        elif any(
+            key in lower_msg
+            for key in [
+                "timeout",
+                "timed out",
+                "connection error",
+                "network error",
+                "client closed request",
+            ]
+        ):
+            user_friendly = (
+                "Во время генерации произошла сетевая ошибка или таймаут. "
+                "Проверьте соединение с интернетом и попробуйте ещё раз."
+            )
+        
+        # Добавляем технические детали в лог, но не показываем пользователю полностью
+        if error_details:
+            logger.error(
+                "[REPLICATE] Дополнительные детали ошибки: "
+                + " | ".join(error_details)
+            )
+        
+        logger.error(f"[REPLICATE] Итоговое сообщение об ошибке для пользователя: {user_friendly}")
+        
+        # Явный флаг для backend-ретраев: не зависит от локализации сообщения пользователю.
+        is_retryable = any(
+            key in lower_msg
+            for key in [
+                "e003",
+                "rate limit",
+                "ratelimit",
+                "429",
+                "high demand",
+                "too many requests",
+            ]
+        )
 
-            return {
-                "success": False,
-                "image_url": None,
-                "image_data": None,
-                "error": user_friendly,
-                "retryable": is_retryable,
-            }
-
+        result = {
+            "success": False,
+            "image_url": None,
+            "image_data": None,
+            "error": user_friendly,
+            "retryable": is_retryable,
+        }
+        # "Request was throttled. Expected available in N seconds" — подсказка для задержки повтора
+        retry_after = retry_after_from_text(raw_error) if is_retryable else None
+        if retry_after is not None:
+            result["retry_after"] = retry_after
+        return result
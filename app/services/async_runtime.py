@@ -0,0 +1,92 @@
+"""
+Общий event loop для сетевых вызовов провайдеров.
+
+Цикл работает в отдельном daemon-потоке процесса (API или воркера). Корутины
+отправляются в него из синхронного кода через submit() и возвращают обычный
+concurrent.futures.Future. Здесь же живёт общий httpx.AsyncClient с пулом
+keep-alive соединений, чтобы сотни ожидающих генераций не открывали
+соединение на каждый запрос.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Optional
+
+import httpx
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRuntime:
+    """Фоновый event loop + пул HTTP соединений"""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+
+    def _run_loop(self, loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        """Запускает event loop (один раз на процесс)."""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._run_loop, args=(loop,), name="async-runtime", daemon=True)
+                thread.start()
+                self._loop = loop
+                self._thread = thread
+                logger.info("[ASYNC_RUNTIME] Event loop для провайдеров запущен")
+            return self._loop
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> Future:
+        """Выполняет корутину на общем event loop; результат — concurrent Future."""
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def http_client(self) -> httpx.AsyncClient:
+        """
+        Общий AsyncClient. Вызывать только из корутин, выполняющихся на этом loop:
+        клиент привязан к нему.
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=settings.HTTP_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.HTTP_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=30.0,
+                ),
+                timeout=httpx.Timeout(120.0, connect=15.0),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def _close_client(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def shutdown(self, timeout: float = 10.0):
+        """Закрывает пул соединений и останавливает loop."""
+        with self._lock:
+            loop = self._loop
+            if loop is None:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_client(), loop).result(timeout)
+            except Exception as e:
+                logger.warning(f"[ASYNC_RUNTIME] Не удалось закрыть HTTP клиент: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+            if self._thread is not None:
+                self._thread.join(timeout)
+            self._loop = None
+            self._thread = None
+
+
+async_runtime = AsyncRuntime()
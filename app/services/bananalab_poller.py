@@ -0,0 +1,200 @@
+"""
+Центральный опрос статусов задач Banana Lab.
+
+Раньше каждая генерация крутила свой цикл GET status_url со sleep между запросами.
+Теперь все незавершённые задачи регистрируются в одном поллере на общем event loop
+(app.services.async_runtime): он опрашивает их по общему расписанию через пул
+HTTP соединений и резолвит future задачи, когда статус становится финальным
+или в ответе появляется изображение. Память и число потоков не зависят
+от количества ожидающих задач.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.config import settings
+from app.services.async_runtime import async_runtime
+from app.services.BananalabService import BananalabService
+from app.services.cancellation import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+
+class _PolledJob:
+    __slots__ = (
+        "status_url",
+        "headers",
+        "job_id",
+        "current",
+        "future",
+        "started_at",
+        "deadline",
+        "next_poll_at",
+        "in_flight",
+        "last_logged",
+    )
+
+    def __init__(self, status_url: str, headers: Dict[str, str], initial: Dict[str, Any], future: asyncio.Future, timeout: float, interval: float):
+        now = time.time()
+        self.status_url = status_url
+        self.headers = headers
+        self.job_id = initial.get("job_id")
+        self.current: Any = initial
+        self.future = future
+        self.started_at = now
+        self.deadline = now + timeout
+        self.next_poll_at = now + interval
+        self.in_flight = False
+        self.last_logged: Optional[str] = None
+
+
+class BananalabJobPoller:
+    """Один цикл опроса на все задачи Banana Lab процесса"""
+
+    def __init__(self, interval: Optional[float] = None, max_in_flight: Optional[int] = None):
+        self.interval = interval or BananalabService.JOB_POLL_INTERVAL_SECONDS
+        self.max_in_flight = max_in_flight or settings.BANANALAB_POLL_MAX_IN_FLIGHT
+        self._jobs: Dict[int, _PolledJob] = {}
+        self._ids = itertools.count(1)
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._in_flight = 0
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._jobs)
+
+    async def wait(
+        self,
+        status_url: str,
+        headers: Dict[str, str],
+        initial: Dict[str, Any],
+        timeout: float,
+        cancellation: Optional[CancellationToken] = None,
+    ) -> Dict[str, Any]:
+        """
+        Ждёт завершения задачи. Возвращает итоговый ответ задачи или маркер
+        __bananalab_job_failed__ (как BananalabService._job_terminal_state).
+        Отмена генерации (cancellation) сразу завершает ожидание.
+        Вызывать только на event loop async_runtime.
+        """
+        loop = asyncio.get_running_loop()
+        key = next(self._ids)
+        job = _PolledJob(status_url, headers, initial, loop.create_future(), timeout, self.interval)
+        self._log_status(job)
+        terminal = BananalabService._job_terminal_state(initial)
+        if terminal is not None:
+            return terminal
+
+        self._jobs[key] = job
+        self._ensure_running()
+        if cancellation is not None:
+            cancellation.add_callback(lambda: loop.call_soon_threadsafe(self._cancel, job))
+        try:
+            return await job.future
+        finally:
+            self._jobs.pop(key, None)
+
+    @staticmethod
+    def _cancel(job: _PolledJob):
+        if not job.future.done():
+            logger.info("[BANANALAB] job_id=%s: генерация отменена, опрос остановлен", job.job_id)
+            job.future.set_result(BananalabService._job_cancelled())
+
+    def _ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    async def _run(self):
+        while self._jobs:
+            now = time.time()
+            next_wake = now + self.interval
+            for job in list(self._jobs.values()):
+                if job.future.done() or job.in_flight:
+                    continue
+                if now >= job.deadline:
+                    job.future.set_result(BananalabService._job_timeout(job.started_at, job.current))
+                    continue
+                if job.next_poll_at <= now:
+                    if self._in_flight >= self.max_in_flight:
+                        # Пул запросов занят — остальные задачи опросим, когда освободится слот
+                        break
+                    job.in_flight = True
+                    self._in_flight += 1
+                    asyncio.get_running_loop().create_task(self._poll(job))
+                else:
+                    next_wake = min(next_wake, job.next_poll_at, job.deadline)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_wake - time.time(), 0.05))
+            except asyncio.TimeoutError:
+                pass
+        self._task = None
+
+    async def _poll(self, job: _PolledJob):
+        try:
+            result = await self._fetch(job)
+            if result is not None and not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            logger.error("[BANANALAB] Ошибка опроса job_id=%s: %s", job.job_id, e, exc_info=True)
+        finally:
+            job.in_flight = False
+            job.next_poll_at = time.time() + self.interval
+            self._in_flight -= 1
+            self._wakeup.set()
+
+    async def _fetch(self, job: _PolledJob) -> Optional[Dict[str, Any]]:
+        try:
+            pr = await async_runtime.http_client().get(job.status_url, headers=job.headers, timeout=120)
+        except httpx.HTTPError as e:
+            logger.warning("[BANANALAB] Ошибка GET job: %s", e)
+            return None
+
+        if pr.status_code >= 400:
+            try:
+                body = pr.json()
+            except Exception:
+                body = pr.text
+            return BananalabService._job_http_error(pr.status_code, body)
+
+        try:
+            current = pr.json()
+        except Exception as e:
+            return {
+                "__bananalab_job_failed__": True,
+                "error": f"Ответ job не JSON: {e}",
+                "retryable": False,
+                "_raw": None,
+            }
+
+        job.current = current
+        if not isinstance(current, dict):
+            return BananalabService._job_timeout(job.started_at, current)
+        self._log_status(job)
+        return BananalabService._job_terminal_state(current)
+
+    @staticmethod
+    def _log_status(job: _PolledJob):
+        if not isinstance(job.current, dict):
+            return
+        st = BananalabService._job_status_normalized(job.current)
+        if st != job.last_logged:
+            logger.info(
+                "[BANANALAB] job_id=%s status=%s elapsed=%.1fs",
+                job.job_id,
+                job.current.get("status"),
+                time.time() - job.started_at,
+            )
+            job.last_logged = st
+
+
+bananalab_poller = BananalabJobPoller()
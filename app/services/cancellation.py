@@ -0,0 +1,80 @@
+"""
+Токены отмены генераций (POST /images/{id}/cancel).
+
+API помечает генерацию cancelled; смена статуса расходится по NOTIFY
+generation_status, и процесс воркера, выполняющий генерацию, взводит её токен.
+Токен проверяют места, где генерация ждёт провайдера: центральный поллер
+Banana Lab и ожидание prediction Replicate. Поток или корутина сразу
+освобождаются, а слот возвращается очереди.
+"""
+import threading
+from typing import Callable, Dict, List
+
+
+class GenerationCancelled(Exception):
+    """Генерация отменена пользователем во время ожидания провайдера"""
+
+
+class CancellationToken:
+    """Флаг отмены одной генерации; потокобезопасен"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        """Ждёт до timeout секунд; True, если генерацию отменили."""
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback: Callable[[], None]):
+        """callback вызывается один раз при отмене (сразу, если токен уже отменён)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class CancellationRegistry:
+    """Токены генераций, выполняющихся в этом процессе"""
+
+    def __init__(self):
+        self._tokens: Dict[int, CancellationToken] = {}
+        self._lock = threading.Lock()
+
+    def register(self, generation_id: int) -> CancellationToken:
+        token = CancellationToken()
+        with self._lock:
+            self._tokens[generation_id] = token
+        return token
+
+    def unregister(self, generation_id: int, token: CancellationToken):
+        with self._lock:
+            if self._tokens.get(generation_id) is token:
+                self._tokens.pop(generation_id, None)
+
+    def cancel(self, generation_id: int) -> bool:
+        """Отменяет генерацию, если она выполняется в этом процессе."""
+        with self._lock:
+            token = self._tokens.get(generation_id)
+        if token is None:
+            return False
+        token.cancel()
+        return True
+
+
+cancellation_registry = CancellationRegistry()
@@ -0,0 +1,100 @@
+"""
+Circuit breaker по (провайдер, модель).
+
+CIRCUIT_BREAKER_FAILURE_THRESHOLD подряд сбоев провайдера (5xx, таймаут — retryable ответы)
+размыкают цепь на CIRCUIT_BREAKER_OPEN_SECONDS. Rate limit (429 / E003) относится к API ключу
+пользователя и цепь, общую для всех ключей, не трогает. "Модель на паузе" — тоже состояние модели,
+общее для всех ключей, но его ведёт model_availability; цепь его не дублирует, а генерации с
+allow_fallback уходят с модели на паузе на fallback так же, как с разомкнутой цепи. Новые генерации модели
+не отправляются провайдеру, а переводятся на fallback-модель (если пользователь разрешил)
+или сразу завершаются ошибкой — вместо ретраев на деградировавшей модели. После паузы
+одна пробная генерация (half-open) решает, замкнуть цепь или разомкнуть снова.
+Состояние — в памяти процесса.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from app.services.concurrency_limiter import Target
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class _BreakerState:
+    __slots__ = ("state", "failures", "opened_at", "trial_started_at")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+
+
+class CircuitBreaker:
+    """Размыкатели по (провайдер, модель)"""
+
+    def __init__(self, failure_threshold: int, open_seconds: float, clock: Callable[[], float] = time.time):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._targets: Dict[Target, _BreakerState] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, target: Target) -> bool:
+        """
+        Можно ли отправить генерацию провайдеру. После открытого периода пропускает одну
+        пробную генерацию; если её исход не пришёл за open_seconds, пропускает следующую.
+        """
+        with self._lock:
+            state = self._targets.get(target)
+            if state is None or state.state == CLOSED:
+                return True
+            now = self._clock()
+            if state.state == OPEN and now - state.opened_at < self.open_seconds:
+                return False
+            if state.state == HALF_OPEN and now - state.trial_started_at < self.open_seconds:
+                return False
+            state.state = HALF_OPEN
+            state.trial_started_at = now
+            return True
+
+    def is_open(self, target: Target) -> bool:
+        """Цепь разомкнута и пробная генерация ещё не положена (без побочных эффектов, в отличие от allow)."""
+        with self._lock:
+            state = self._targets.get(target)
+            return state is not None and state.state == OPEN and self._clock() - state.opened_at < self.open_seconds
+
+    def record(self, target: Target, failed: bool) -> bool:
+        """
+        Исход генерации: failed — пауза модели, rate limit или таймаут; успех замыкает цепь.
+        Возвращает True, если цепь только что разомкнулась.
+        """
+        with self._lock:
+            state = self._targets.setdefault(target, _BreakerState())
+            if not failed:
+                state.state = CLOSED
+                state.failures = 0
+                return False
+            state.failures += 1
+            if state.state == OPEN:
+                return False
+            if state.state == HALF_OPEN or state.failures >= self.failure_threshold:
+                state.state = OPEN
+                state.opened_at = self._clock()
+                return True
+            return False
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    "provider": target[0],
+                    "model_name": target[1],
+                    "state": state.state,
+                    "failures": state.failures,
+                    "opened_at": state.opened_at or None,
+                }
+                for target, state in self._targets.items()
+            ]
@@ -0,0 +1,124 @@
+"""
+Адаптивный лимит одновременных генераций по (провайдер, модель) — AIMD.
+
+Каждая успешная генерация увеличивает лимит цели на 1/limit (примерно +1 за
+"окно" успешных ответов), rate limit (429 / E003) уменьшает его вдвое, а рост
+задержки выше базовой в ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE раз — на 10%.
+Так процесс сам находит, сколько генераций провайдер выдерживает одновременно,
+вместо одного глобального MAX_WORKERS. Состояние — в памяти процесса;
+диспетчер воркера публикует его в worker_concurrency_limits для админки.
+"""
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+Target = Tuple[str, str]
+
+# Во сколько раз уменьшается лимит при rate limit и при росте задержки
+THROTTLE_DECREASE_FACTOR = 0.5
+LATENCY_DECREASE_FACTOR = 0.9
+# Насколько быстро базовая задержка "забывает" старый минимум
+BASELINE_DRIFT = 0.05
+
+
+def concurrency_target(provider: Optional[str], model_name: Optional[str]) -> Target:
+    return (provider or "", model_name or "")
+
+
+class _TargetState:
+    __slots__ = ("limit", "in_flight", "baseline_latency", "successes", "throttled", "errors", "updated_at")
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.baseline_latency: Optional[float] = None
+        self.successes = 0
+        self.throttled = 0
+        self.errors = 0
+        self.updated_at = time.time()
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD-лимиты in-flight генераций на каждую пару (провайдер, модель)"""
+
+    def __init__(self, initial_limit: float, min_limit: float, max_limit: float, latency_tolerance: float):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self._targets: Dict[Target, _TargetState] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, target: Target) -> _TargetState:
+        state = self._targets.get(target)
+        if state is None:
+            state = self._targets[target] = _TargetState(self.initial_limit)
+        return state
+
+    def try_acquire(self, target: Target) -> bool:
+        """Занимает слот цели, если её текущий лимит не исчерпан."""
+        with self._lock:
+            state = self._state(target)
+            if state.in_flight >= max(int(state.limit), 1):
+                return False
+            state.in_flight += 1
+            return True
+
+    def release(self, target: Target):
+        with self._lock:
+            state = self._state(target)
+            state.in_flight = max(state.in_flight - 1, 0)
+
+    def record(self, target: Target, outcome: str, latency_seconds: Optional[float] = None):
+        """
+        Сигнал от завершившейся генерации: outcome — success, throttled или error.
+        Ошибки, не связанные с перегрузкой (error), лимит не меняют.
+        """
+        with self._lock:
+            state = self._state(target)
+            state.updated_at = time.time()
+            if outcome == "throttled":
+                state.throttled += 1
+                state.limit = max(self.min_limit, state.limit * THROTTLE_DECREASE_FACTOR)
+                return
+            if outcome != "success":
+                state.errors += 1
+                return
+
+            state.successes += 1
+            if latency_seconds is not None and latency_seconds > 0:
+                baseline = state.baseline_latency
+                if baseline is None or latency_seconds < baseline:
+                    state.baseline_latency = latency_seconds
+                else:
+                    state.baseline_latency = baseline + (latency_seconds - baseline) * BASELINE_DRIFT
+                    if latency_seconds > baseline * self.latency_tolerance:
+                        # Провайдер отвечает заметно медленнее обычного — очередь у него растёт
+                        state.limit = max(self.min_limit, state.limit * LATENCY_DECREASE_FACTOR)
+                        return
+            state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+
+    def saturated_targets(self) -> List[Target]:
+        """Цели, у которых сейчас нет свободных слотов (их задачи не стоит забирать из очереди)."""
+        with self._lock:
+            return [
+                target
+                for target, state in self._targets.items()
+                if state.in_flight >= max(int(state.limit), 1)
+            ]
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    "provider": target[0],
+                    "model_name": target[1],
+                    "limit": round(state.limit, 2),
+                    "in_flight": state.in_flight,
+                    "baseline_latency": state.baseline_latency,
+                    "successes": state.successes,
+                    "throttled": state.throttled,
+                    "errors": state.errors,
+                }
+                for target, state in self._targets.items()
+            ]
@@ -0,0 +1,106 @@
+"""
+События смены статуса генераций для SSE (GET /api/v1/images/events).
+
+Каждый flush, в котором у Generation поменялся status, отправляет
+NOTIFY generation_status с небольшой дельтой {id, user_id, status, ...}
+в той же транзакции — событие уходит только после commit. Любой процесс
+(API, отдельный воркер) публикует события, а каждая реплика API держит одно
+LISTEN-соединение (start_generation_event_listener) и раздаёт дельты своим
+SSE подписчикам — asyncio-очередям открытых соединений.
+"""
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import event, inspect as sa_inspect
+
+from app.models.base import Generation
+from app.services.DBService import db_service
+
+logger = logging.getLogger(__name__)
+
+GENERATION_STATUS_CHANNEL = "generation_status"
+
+# Сколько событий может накопиться у медленного клиента, прежде чем они начнут отбрасываться
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class GenerationEventBus:
+    """Раздача событий генераций подписчикам в пределах процесса"""
+
+    def __init__(self):
+        self._subscribers: Dict[int, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        """Очередь событий пользователя. Вызывать из корутины (очередь привязана к текущему loop)."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(user_id, []).append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        with self._lock:
+            subscribers = [item for item in self._subscribers.get(user_id, []) if item[1] is not queue]
+            if subscribers:
+                self._subscribers[user_id] = subscribers
+            else:
+                self._subscribers.pop(user_id, None)
+
+    def publish(self, event_data: Dict[str, Any]):
+        """Отправляет событие всем подписчикам его пользователя (потокобезопасно)."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(event_data.get("user_id"), []))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._put_nowait, queue, event_data)
+            except RuntimeError:
+                # loop уже закрыт — соединение отписывается само
+                pass
+
+    @staticmethod
+    def _put_nowait(queue: asyncio.Queue, event_data: Dict[str, Any]):
+        try:
+            queue.put_nowait(event_data)
+        except asyncio.QueueFull:
+            logger.warning(f"[EVENTS] Очередь SSE клиента переполнена, событие генерации {event_data.get('id')} отброшено")
+
+
+generation_events = GenerationEventBus()
+
+
+def generation_event(generation: Generation) -> Dict[str, Any]:
+    """Дельта статуса генерации для клиента."""
+    metadata = generation.generation_metadata or {}
+    data: Dict[str, Any] = {
+        "id": generation.id,
+        "user_id": generation.user_id,
+        "status": generation.status,
+    }
+    if generation.group_id:
+        data["group_id"] = generation.group_id
+    if generation.status == "completed":
+        data["result_url"] = generation.result_url
+    elif generation.status in ("failed", "paused"):
+        error = metadata.get("error")
+        data["error"] = error[:500] if isinstance(error, str) else error
+    return data
+
+
+def _notify_status_changes(session, flush_context):
+    """after_flush: NOTIFY по генерациям, у которых изменился status (история ещё доступна)."""
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Generation):
+            continue
+        if not sa_inspect(obj).attrs.status.history.has_changes():
+            continue
+        db_service.notify(session.connection(), GENERATION_STATUS_CHANNEL, generation_event(obj))
+
+
+def start_generation_event_listener():
+    """Подписывает процесс на события всех реплик (вызывается при старте API)."""
+    db_service.listen(GENERATION_STATUS_CHANNEL, generation_events.publish)
+
+
+event.listen(db_service.SessionLocal, "after_flush", _notify_status_changes)
@@ -0,0 +1,64 @@
+"""
+Отпечаток запроса генерации для склейки идентичных заявок (двойной клик, "повторить").
+
+Совпадение отпечатков означает одинаковый результат у провайдера, поэтому он
+считается только для запросов с фиксированным seed. Референсы учитываются по
+содержимому (sha256 декодированного data URL), а не по URL в MinIO: одна и та же
+картинка при каждой отправке загружается под новым именем.
+"""
+import base64
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+from app.services.generation_prompt import enhance_prompt_for_image_generation
+
+# Поля запроса, от которых зависит результат генерации
+FINGERPRINT_FIELDS = (
+    "provider",
+    "model_name",
+    "generation_mode",
+    "prompt",
+    "negative_prompt",
+    "resolution",
+    "aspect_ratio",
+    "guidance_scale",
+    "num_inference_steps",
+    "seed",
+)
+
+
+def reference_digest(reference: str) -> str:
+    """sha256 содержимого референса; для обычного URL — самого URL."""
+    data = reference.encode("utf-8")
+    if reference.startswith("data:") and "," in reference:
+        try:
+            data = base64.b64decode(reference.split(",", 1)[1])
+        except ValueError:
+            pass
+    return hashlib.sha256(data).hexdigest()
+
+
+def generation_fingerprint(request_data: Dict[str, Any], reference_images: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Отпечаток запроса или None, если запрос недетерминирован (seed не задан).
+    request_data должен содержать provider и итоговое model_name.
+    """
+    if request_data.get("seed") is None:
+        return None
+    canonical = {field: request_data.get(field) for field in FINGERPRINT_FIELDS}
+    canonical["reference_images"] = [reference_digest(ref) for ref in reference_images or []]
+    raw = json.dumps(canonical, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def result_cache_key(request_data: Dict[str, Any], reference_images: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Ключ кэша результатов: тот же отпечаток, но по итоговому промпту, который уйдёт провайдеру
+    (после enhance_prompt_for_image_generation) — смена шаблона промпта не отдаёт старые картинки.
+    """
+    references = reference_images or []
+    final_prompt = enhance_prompt_for_image_generation(
+        request_data.get("prompt") or "", references or None, len(references)
+    )
+    return generation_fingerprint({**request_data, "prompt": final_prompt}, references)
@@ -0,0 +1,1847 @@
+"""
+Обработка генераций: выполнение задач из durable-очереди, ретраи и paused-очередь.
+
+Модуль не зависит от FastAPI: его используют и API-процесс (RUN_WORKERS_IN_API=true),
+и отдельный воркер (python -m app.worker).
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import functools
+import hashlib
+import hmac
+import threading
+import time
+from typing import Optional, Dict, Any, List, Tuple, Callable
+from datetime import datetime
+import logging
+import uuid
+from sqlalchemy.orm.attributes import flag_modified
+from app.services.ReplicateService import ReplicateService
+from app.services.BananalabService import BananalabService, SUPPORTED_BANANALAB_FRONTEND_MODELS
+from app.services.AsyncBananalabService import AsyncBananalabService
+from app.services.async_runtime import async_runtime
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.cancellation import CancellationToken, GenerationCancelled, cancellation_registry
+from app.services.image_api_provider import infer_image_api_provider
+from app.services.MinioService import MinioService
+from app.services.DBService import db_service
+from app.services.JobQueueService import job_queue, default_worker_id
+from app.services.RateLimiterService import rate_limiter
+from app.services.concurrency_limiter import AdaptiveConcurrencyLimiter, concurrency_target
+from app.services.latency_tracker import LatencyTracker
+from app.services.ModelAvailabilityService import model_availability
+from app.services.paused_scheduler import PausedScheduler
+from app.services.result_cache import store_result as store_cached_result
+from app.services.retry_backoff import backoff_delay
+# Импорт регистрирует NOTIFY generation_status на смену статусов (события для SSE на всех репликах API
+# и отмена генераций в воркерах)
+from app.services.generation_events import GENERATION_STATUS_CHANNEL
+from app.models.base import Generation, WorkerConcurrencyLimit
+from app.config import settings
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+logger = logging.getLogger(__name__)
+
+# Пул воркеров процесса. Задачи попадают сюда только из durable-очереди generation_jobs.
+# С ADAPTIVE_CONCURRENCY_ENABLED число одновременных генераций определяют AIMD-лимиты
+# по (провайдер, модель), а пул — только общий потолок процесса
+THREAD_SLOTS = (
+    settings.ADAPTIVE_CONCURRENCY_MAX_TOTAL if settings.ADAPTIVE_CONCURRENCY_ENABLED else settings.MAX_WORKERS
+)
+executor = ThreadPoolExecutor(max_workers=THREAD_SLOTS)
+WORKER_ID = default_worker_id()
+
+# Дублирующие запросы hedged-генераций. Основной запрос выполняется в потоке генерации, дубль
+# получает поток только при свободном слоте hedge_slots и никогда не ждёт в очереди пула
+hedge_executor = ThreadPoolExecutor(max_workers=settings.HEDGE_MAX_IN_FLIGHT, thread_name_prefix="hedge")
+hedge_slots = threading.BoundedSemaphore(settings.HEDGE_MAX_IN_FLIGHT)
+# Длительность успешных генераций по (провайдер, модель, разрешение) — порог hedged-запроса
+generation_latency = LatencyTracker(min_samples=settings.HEDGE_MIN_SAMPLES)
+
+concurrency_limiter = AdaptiveConcurrencyLimiter(
+    initial_limit=settings.ADAPTIVE_CONCURRENCY_INITIAL,
+    min_limit=1,
+    max_limit=settings.ADAPTIVE_CONCURRENCY_MAX,
+    latency_tolerance=settings.ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE,
+)
+
+# Максимальное количество повторных попыток генерации при временных ошибках (E003 / 429)
+MAX_GENERATION_RETRIES = 5
+PAUSED_RETRY_DELAY_SECONDS = 30
+# Срок, после которого проба модели без исхода заменяется новой
+PAUSED_PROBE_TIMEOUT_SECONDS = 900
+
+minio = MinioService()
+
+# Fallback-модель на том же провайдере: кнопка быстрого перезапуска и автоматический перевод
+# генераций с allow_fallback, пока цепь исходной модели разомкнута
+FALLBACK_MODEL_BY_MODEL = {"nano-banana-pro": "nano-banana-2"}
+circuit_breaker = CircuitBreaker(
+    failure_threshold=settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    open_seconds=settings.CIRCUIT_BREAKER_OPEN_SECONDS,
+)
+paused_queue = PausedScheduler(
+    release_per_second=settings.PAUSED_RELEASE_PER_SECOND,
+    probe_timeout=PAUSED_PROBE_TIMEOUT_SECONDS,
+)
+paused_worker_lock = threading.Lock()
+paused_worker_started = False
+
+# Задачи очереди, которые сейчас выполняются в этом процессе: job_id -> задача
+active_jobs: Dict[int, Dict[str, Any]] = {}
+# То же для генераций Banana Lab на общем event loop (BANANALAB_ASYNC_ENABLED)
+active_async_jobs: Dict[int, Dict[str, Any]] = {}
+active_jobs_lock = threading.Lock()
+job_dispatcher_wakeup = threading.Event()
+job_dispatcher_started = False
+# Остановка процесса: новые задачи не забираются, paused-очередь передана в generation_jobs
+draining = threading.Event()
+
+
+def get_fallback_model(model_name: Optional[str]) -> Optional[str]:
+    """Возвращает fallback-модель для кнопки быстрого перезапуска."""
+    if not model_name:
+        return None
+    return FALLBACK_MODEL_BY_MODEL.get(model_name)
+
+
+def _is_rate_limit_error(error_message: str) -> bool:
+    """Временная ошибка из-за лимитов провайдера (E003 / 429 / high demand)."""
+    lower_err = error_message.lower()
+    return any(
+        marker in lower_err
+        for marker in ("e003", "high demand", "429", "ratelimit", "rate limit", "too many requests")
+    )
+
+
+def _is_degraded_result(result: Dict[str, Any]) -> bool:
+    """
+    Таймаут или 5xx (retryable) — сбой модели у провайдера для всех ключей. Rate limit относится
+    к конкретному API ключу, а пауза модели — общая для всех ключей, но её учитывает
+    model_availability, поэтому цепь размыкают только сбои.
+    """
+    error_message = str(result.get("error") or "")
+    return (
+        bool(result.get("retryable"))
+        and not _is_paused_error(error_message)
+        and not _is_rate_limit_error(error_message)
+    )
+
+
+def _breaker_fallback(provider: str, model_name: str, request_data: dict) -> Optional[str]:
+    """
+    Fallback-модель для генерации, чья модель за разомкнутой цепью или на паузе: только если пользователь
+    разрешил (allow_fallback), на Replicate и с замкнутой цепью у fallback-модели. Banana Lab
+    выбирает модель по endpoint, а не по имени, поэтому там переключать нечего.
+    """
+    if not request_data.get("allow_fallback") or provider != "replicate":
+        return None
+    fallback = get_fallback_model(model_name)
+    if not fallback or fallback not in ReplicateService.AVAILABLE_MODELS:
+        return None
+    if not circuit_breaker.allow(concurrency_target(provider, fallback)):
+        return None
+    return fallback
+
+
+def _reroute_immediately(request_data: dict, model_paused: bool = False) -> bool:
+    """
+    Модель недоступна для всех ключей (цепь разомкнута или модель на паузе у провайдера),
+    а генерация может уйти на fallback: повтор не ждёт задержки.
+    """
+    if not request_data.get("allow_fallback"):
+        return False
+    provider, model_name = _paused_target(request_data)
+    if provider != "replicate" or get_fallback_model(model_name) is None:
+        return False
+    return model_paused or (settings.CIRCUIT_BREAKER_ENABLED and circuit_breaker.is_open((provider, model_name)))
+
+
+def _model_paused(provider: str, model_name: str) -> bool:
+    """Модель на паузе у провайдера (общее состояние model_availability)."""
+    try:
+        return model_availability.paused_for(provider, model_name) is not None
+    except Exception as e:
+        logger.warning(f"[PAUSED_QUEUE] Не удалось проверить паузу модели {provider}/{model_name}: {e}")
+        return False
+
+
+def _is_paused_error(error_message: str) -> bool:
+    if not error_message:
+        return False
+    lower_err = error_message.lower()
+    return (
+        "is paused" in lower_err
+        or "model is paused" in lower_err
+        or ("project or nanobanana" in lower_err and "try again later" in lower_err)
+    )
+
+
+def _paused_target(request_data: dict):
+    """Группа paused-очереди: пара (провайдер, модель) генерации."""
+    return concurrency_target(
+        infer_image_api_provider((request_data.get("api_key") or "").strip()),
+        request_data.get("model_name"),
+    )
+
+
+def enqueue_paused_generation(
+    generation_id: int,
+    user_id: int,
+    request_data: dict,
+    prioritize: bool = False,
+    paused_error: Optional[str] = None,
+):
+    """
+    Ставит генерацию в paused-очередь процесса. paused_error — ответ провайдера о паузе модели:
+    он ставит общую паузу модели (и завершает пробу, если генерация была ею); без него
+    генерация ждёт уже известного срока паузы.
+    """
+    item = {
+        "generation_id": generation_id,
+        "user_id": user_id,
+        "request_data": request_data,
+    }
+    if draining.is_set():
+        # Процесс останавливается: paused-очередь в памяти больше никто не разберёт
+        _hand_over_paused_item({**item, "retry_after": time.time() + PAUSED_RETRY_DELAY_SECONDS})
+        return
+    target = _paused_target(request_data)
+    try:
+        if paused_error is not None:
+            paused_for = model_availability.record_paused(*target, error=paused_error)
+        else:
+            paused_for = model_availability.paused_for(*target)
+    except Exception as e:
+        logger.error(f"[PAUSED_QUEUE] Не удалось получить состояние модели {target[0]}/{target[1]}: {e}")
+        paused_for = PAUSED_RETRY_DELAY_SECONDS
+    paused_queue.add(item, target, paused_for, prioritize=prioritize)
+    if paused_error is not None and paused_for is not None:
+        paused_queue.mark_paused(target, paused_for)
+
+
+def _hand_over_paused_item(item: Dict[str, Any]):
+    """
+    Переносит генерацию из paused-очереди процесса в generation_jobs с оставшейся задержкой.
+    paused_request_data снимается, чтобы restore_paused_queue_from_db не поставил её второй раз.
+    """
+    generation_id = item["generation_id"]
+    try:
+        submit_generation_job(
+            generation_id,
+            item["user_id"],
+            item["request_data"],
+            delay_seconds=max(item["retry_after"] - time.time(), 0.0),
+        )
+        with db_service.get_session() as session:
+            generation = session.query(Generation).filter(Generation.id == generation_id).first()
+            if generation and generation.generation_metadata:
+                generation.generation_metadata.pop("paused_request_data", None)
+                flag_modified(generation, "generation_metadata")
+                session.commit()
+    except Exception as e:
+        # paused_request_data осталась в БД — генерацию восстановит следующий запуск воркера
+        logger.error(f"[PAUSED_QUEUE] Не удалось передать генерацию {generation_id} в очередь: {e}")
+
+
+def _build_resume_payload(generation: Generation, request_data: dict) -> Dict[str, Any]:
+    metadata = generation.generation_metadata or {}
+    return {
+        "api_key": request_data.get("api_key"),
+        "prompt": request_data.get("prompt") or generation.prompt,
+        "negative_prompt": request_data.get("negative_prompt") or generation.negative_prompt,
+        "resolution": request_data.get("resolution") or generation.resolution,
+        "aspect_ratio": request_data.get("aspect_ratio") or generation.aspect_ratio,
+        "guidance_scale": request_data.get("guidance_scale") or generation.guidance_scale,
+        "num_inference_steps": request_data.get("num_inference_steps") or generation.num_inference_steps,
+        "seed": request_data.get("seed") if request_data.get("seed") is not None else generation.seed,
+        "model_name": request_data.get("model_name") or generation.model_name or metadata.get("model_name"),
+        "reference_images": request_data.get("reference_images") or metadata.get("reference_image_urls") or [],
+        "allow_fallback": bool(request_data.get("allow_fallback")),
+        "hedge_api_key": request_data.get("hedge_api_key"),
+    }
+
+
+def restore_paused_queue_from_db():
+    with db_service.get_session() as session:
+        paused_generations = (
+            session.query(Generation)
+            .filter(Generation.status == "paused")
+            .order_by(Generation.created_at.asc())
+            .all()
+        )
+        for generation in paused_generations:
+            metadata = generation.generation_metadata or {}
+            request_data = metadata.get("paused_request_data")
+            if request_data and request_data.get("api_key"):
+                enqueue_paused_generation(generation.id, generation.user_id, request_data, prioritize=False)
+
+
+def _probe_replicate_model(model_name: str, request_data: dict) -> Optional[str]:
+    """
+    Отдельная проба модели Replicate: prediction без референсов создаётся и сразу отменяется
+    (ReplicateService.probe_model). Возвращает текст ошибки или None, если модель приняла запрос.
+    """
+    try:
+        return ReplicateService(api_token=request_data["api_key"]).probe_model(model_name)
+    except Exception as e:
+        return str(e)
+
+
+def _check_model_availability(target, item: Dict[str, Any]):
+    """
+    Срок паузы модели наступил: пробу забирает один воркер (model_availability.claim_probe),
+    остальные получают уже сдвинутый срок. Модель Replicate проверяется отдельным минимальным
+    запросом (_probe_replicate_model), paused-генерации ждут его исхода. У Banana Lab нет ни
+    запроса метаданных, ни отмены задачи — любая проба была бы оплаченной генерацией, поэтому
+    пробой служит сама paused-генерация: она возвращается в generation_jobs, и её исход снимает
+    паузу (_record_model_available) или продлевает её (enqueue_paused_generation с paused_error).
+    """
+    provider, model_name = target
+    generation_id = item["generation_id"]
+    try:
+        claimed, paused_for = model_availability.claim_probe(provider, model_name)
+    except Exception as e:
+        logger.error(f"[PAUSED_QUEUE] Не удалось проверить модель {provider}/{model_name}: {e}")
+        claimed, paused_for = False, PAUSED_RETRY_DELAY_SECONDS
+    if claimed and provider == "replicate":
+        error = _probe_replicate_model(model_name, item["request_data"])
+        if error is not None and not _is_paused_error(error):
+            # Ошибка ключа или сети ничего не говорит о паузе — следующая проба по расписанию
+            logger.warning(f"[PAUSED_QUEUE] Проба модели {provider}/{model_name} не удалась: {error}")
+        try:
+            if error is None:
+                model_availability.record_available(provider, model_name)
+                paused_for = None
+            elif _is_paused_error(error):
+                model_availability.record_paused(provider, model_name, error=error)
+        except Exception as e:
+            logger.error(f"[PAUSED_QUEUE] Не удалось сохранить исход пробы {provider}/{model_name}: {e}")
+    # Генерацию могли отменить, пока планировщик её выдавал, — тогда проба ждёт следующего срока
+    elif claimed and paused_queue.remove(generation_id):
+        try:
+            submit_generation_job(generation_id, item["user_id"], item["request_data"])
+            logger.info(f"[PAUSED_QUEUE] Генерация {generation_id} возвращена в очередь как проба модели {provider}/{model_name}")
+        except Exception as e:
+            logger.error(f"[PAUSED_QUEUE] Не удалось вернуть пробу {generation_id} в очередь: {e}")
+            paused_queue.add(item, target, paused_for, prioritize=True)
+    if paused_for is None:
+        paused_queue.mark_available(target)
+    else:
+        paused_queue.mark_paused(target, paused_for)
+
+
+def _paused_queue_worker_loop():
+    """
+    Возвращает в generation_jobs генерации, которые выпускает планировщик paused-очереди,
+    и пробы моделей, чей срок паузы наступил.
+    """
+    while True:
+        target, item, probe = paused_queue.take()
+        if probe:
+            _check_model_availability(target, item)
+            continue
+        try:
+            submit_generation_job(item["generation_id"], item["user_id"], item["request_data"])
+            logger.info(f"[PAUSED_QUEUE] Генерация {item['generation_id']} возвращена в очередь")
+        except Exception as e:
+            logger.error(f"[PAUSED_QUEUE] Не удалось вернуть генерацию {item['generation_id']} в очередь: {e}")
+            enqueue_paused_generation(item["generation_id"], item["user_id"], item["request_data"])
+
+
+def start_paused_queue_worker():
+    global paused_worker_started
+    if paused_worker_started:
+        return
+    with paused_worker_lock:
+        if paused_worker_started:
+            return
+        thread = threading.Thread(target=_paused_queue_worker_loop, daemon=True)
+        thread.start()
+        paused_worker_started = True
+
+
+def submit_generation_job(
+    generation_id: int,
+    user_id: int,
+    request_data: dict,
+    delay_seconds: float = 0.0,
+    weight: Optional[float] = None,
+    fingerprint: Optional[str] = None,
+) -> Optional[int]:
+    """
+    Ставит генерацию в durable-очередь; выполнит её любой свободный воркер.
+    weight — вес пользователя в fair-share очереди (при ретраях не передаётся и сохраняется).
+    С fingerprint идентичная уже выполняющаяся генерация пользователя не дублируется:
+    возвращается её ID, и эта генерация получит её результат.
+    """
+    api_key = (request_data.get("api_key") or "").strip()
+    provider = infer_image_api_provider(api_key) if api_key else None
+    leader_id = None
+    if fingerprint:
+        leader_id = job_queue.enqueue_coalesced(
+            generation_id=generation_id,
+            user_id=user_id,
+            payload=request_data,
+            fingerprint=fingerprint,
+            provider=provider,
+            model_name=request_data.get("model_name"),
+            weight=weight,
+        )
+    else:
+        job_queue.enqueue(
+            generation_id=generation_id,
+            user_id=user_id,
+            payload=request_data,
+            provider=provider,
+            model_name=request_data.get("model_name"),
+            delay_seconds=delay_seconds,
+            weight=weight,
+        )
+    job_dispatcher_wakeup.set()
+    return leader_id
+
+
+def submit_generation_group(user_id: int, jobs: List[Tuple[int, dict]], weight: Optional[float] = None):
+    """Ставит группу генераций (батч/варианты) в очередь одним запросом; jobs — пары (generation_id, request_data)."""
+    queued = []
+    for generation_id, request_data in jobs:
+        api_key = (request_data.get("api_key") or "").strip()
+        queued.append({
+            "generation_id": generation_id,
+            "user_id": user_id,
+            "payload": request_data,
+            "provider": infer_image_api_provider(api_key) if api_key else None,
+            "model_name": request_data.get("model_name"),
+        })
+    job_queue.enqueue_many(queued, weight=weight)
+    job_dispatcher_wakeup.set()
+
+
+def _finish_claimed_job(job: Dict[str, Any], registry: Dict[int, Dict[str, Any]]):
+    _release_concurrency_slot(job)
+    try:
+        job_queue.complete(job["job_id"], WORKER_ID)
+    except Exception as e:
+        logger.error(f"[JOB_QUEUE] Не удалось завершить задачу {job['job_id']}: {e}")
+    with active_jobs_lock:
+        # Ретрай мог уже вернуть ту же задачу в работу — удаляем только свою аренду
+        if registry.get(job["job_id"]) is job:
+            registry.pop(job["job_id"], None)
+    job_dispatcher_wakeup.set()
+
+
+def _run_claimed_job(job: Dict[str, Any]):
+    try:
+        if job["request_data"].get("provider_job"):
+            # Запаркованная задача: пора опросить провайдера
+            resume_provider_job(job)
+        elif job["request_data"].get("coalesced_into"):
+            # Дубликат выполняющейся генерации: проверяем, готов ли результат лидера
+            resume_coalesced_job(job)
+        else:
+            process_generation_async(job["generation_id"], job["user_id"], job["request_data"])
+    finally:
+        _finish_claimed_job(job, active_jobs)
+
+
+def _submit_async_job(job: Dict[str, Any]):
+    """Генерация Banana Lab выполняется корутиной на общем event loop."""
+    if job["request_data"].get("provider_job"):
+        # Задача уже создана у провайдера до перезапуска воркера — только дожидаемся результата
+        coro = resume_bananalab_job_coro(job)
+    elif _wants_cross_provider_hedge("bananalab", job["request_data"]):
+        # Дубль в Replicate гоняется синхронно — генерация занимает поток, но слот остаётся async
+        coro = asyncio.to_thread(process_generation_async, job["generation_id"], job["user_id"], job["request_data"])
+    else:
+        coro = process_generation_coro(job["generation_id"], job["user_id"], job["request_data"])
+    future = async_runtime.submit(coro)
+    # complete() ходит в БД — выполняем его в пуле, а не в потоке event loop
+    future.add_done_callback(lambda _f: executor.submit(_finish_claimed_job, job, active_async_jobs))
+
+
+def _is_parked_job(job: Dict[str, Any]) -> bool:
+    """Задача ждёт чужого результата (prediction провайдера или генерацию-лидера) и провайдера не вызывает."""
+    return bool(job["request_data"].get("provider_job") or job["request_data"].get("coalesced_into"))
+
+
+def _acquire_concurrency_slot(job: Dict[str, Any]) -> bool:
+    """
+    Занимает слот адаптивного лимита пары (провайдер, модель) задачи.
+    Если слотов нет, возвращает задачу в очередь (попытка не тратится) и возвращает False.
+    """
+    if not settings.ADAPTIVE_CONCURRENCY_ENABLED or _is_parked_job(job):
+        return True
+    target = concurrency_target(job.get("provider"), job.get("model_name"))
+    if concurrency_limiter.try_acquire(target):
+        job["concurrency_target"] = target
+        return True
+    job_queue.release(job["job_id"], WORKER_ID)
+    return False
+
+
+def _release_concurrency_slot(job: Dict[str, Any]):
+    target = job.pop("concurrency_target", None)
+    if target is not None:
+        concurrency_limiter.release(target)
+
+
+def _publish_concurrency_limits():
+    """Публикует текущие AIMD-лимиты процесса в worker_concurrency_limits (GET /admin/concurrency)."""
+    rows = concurrency_limiter.snapshot()
+    if not rows:
+        return
+    now = datetime.utcnow()
+    with db_service.get_session() as session:
+        for row in rows:
+            stmt = pg_insert(WorkerConcurrencyLimit).values(worker_id=WORKER_ID, updated_at=now, **row)
+            session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["worker_id", "provider", "model_name"],
+                    set_={
+                        key: stmt.excluded[key]
+                        for key in ("limit", "in_flight", "baseline_latency", "successes", "throttled", "errors", "updated_at")
+                    },
+                )
+            )
+        session.commit()
+
+
+def _acquire_rate_limit_token(generation_id: int, api_key: str, provider: Optional[str]) -> float:
+    """
+    Берёт токен лимита запросов для API ключа. 0 — токен взят (или лимит выключен),
+    иначе — через сколько секунд он появится (токен не тратится).
+    """
+    if not settings.RATE_LIMIT_ENABLED or not api_key:
+        return 0.0
+    try:
+        return rate_limiter.acquire(api_key, provider or infer_image_api_provider(api_key))
+    except Exception as e:
+        # Лимитер недоступен — не блокируем генерации, провайдер ответит сам
+        logger.warning(f"[RATE_LIMIT] Не удалось проверить лимит для генерации {generation_id}: {e}")
+        return 0.0
+
+
+def _defer_rate_limited_job(job: Dict[str, Any]) -> bool:
+    """
+    Берёт токен лимита запросов для API ключа задачи. Если бюджет ключа исчерпан,
+    возвращает задачу в очередь до появления токена (попытка не тратится) и возвращает True.
+    """
+    if _is_parked_job(job):
+        return False
+    api_key = (job["request_data"].get("api_key") or "").strip()
+    wait_seconds = _acquire_rate_limit_token(job["generation_id"], api_key, job.get("provider"))
+    if wait_seconds <= 0:
+        return False
+    job_queue.release(job["job_id"], WORKER_ID, delay_seconds=wait_seconds)
+    logger.info(
+        f"[RATE_LIMIT] Генерация {job['generation_id']} отложена на {wait_seconds:.1f} сек: "
+        f"исчерпан бюджет запросов API ключа"
+    )
+    return True
+
+
+def _record_provider_outcome(request_data: dict, result: Dict[str, Any], started_at: datetime):
+    """
+    Учит лимиты по ответу провайдера: бюджет запросов API ключа и AIMD-лимит
+    конкурентности пары (провайдер, модель). Rate limit уменьшает оба, успех — увеличивает.
+    """
+    api_key = (request_data.get("api_key") or "").strip()
+    if not api_key:
+        return
+    provider = infer_image_api_provider(api_key)
+    if result.get("success"):
+        outcome = "success"
+    elif _is_rate_limit_error(str(result.get("error") or "")):
+        outcome = "throttled"
+    else:
+        outcome = "error"
+
+    if outcome == "success":
+        generation_latency.record(
+            _latency_key(provider, request_data.get("model_name"), request_data.get("resolution")),
+            (datetime.utcnow() - started_at).total_seconds(),
+        )
+    if settings.CIRCUIT_BREAKER_ENABLED and (outcome == "success" or _is_degraded_result(result)):
+        target = concurrency_target(provider, request_data.get("model_name"))
+        if circuit_breaker.record(target, failed=outcome != "success"):
+            logger.warning(
+                f"[CIRCUIT_BREAKER] Цепь {target[0]}/{target[1]} разомкнута на "
+                f"{settings.CIRCUIT_BREAKER_OPEN_SECONDS:.0f} сек: "
+                f"{settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD} сбоев подряд"
+            )
+
+    if settings.ADAPTIVE_CONCURRENCY_ENABLED:
+        concurrency_limiter.record(
+            concurrency_target(provider, request_data.get("model_name")),
+            outcome,
+            (datetime.utcnow() - started_at).total_seconds(),
+        )
+    if not settings.RATE_LIMIT_ENABLED or outcome == "error":
+        return
+    try:
+        if outcome == "success":
+            rate_limiter.record_success(api_key, provider)
+        else:
+            rate_limiter.record_throttled(api_key, provider, retry_after=result.get("retry_after"))
+    except Exception as e:
+        logger.warning(f"[RATE_LIMIT] Не удалось обновить лимит API ключа: {e}")
+
+
+def _claim_into(registry: Dict[int, Dict[str, Any]], free_slots: int, run, **claim_filters):
+    if free_slots <= 0:
+        return
+    if settings.ADAPTIVE_CONCURRENCY_ENABLED:
+        claim_filters["exclude_targets"] = concurrency_limiter.saturated_targets()
+    jobs = job_queue.claim(WORKER_ID, limit=free_slots, **claim_filters)
+    for job in jobs:
+        if not _acquire_concurrency_slot(job):
+            continue
+        if _defer_rate_limited_job(job):
+            _release_concurrency_slot(job)
+            continue
+        with active_jobs_lock:
+            registry[job["job_id"]] = job
+        logger.info(
+            f"[JOB_QUEUE] Воркер {WORKER_ID} забрал генерацию {job['generation_id']} "
+            f"(попытка {job['attempts']})"
+        )
+        run(job)
+
+
+def _job_dispatcher_loop():
+    """
+    Забирает задачи из generation_jobs, пока есть свободные слоты, и продлевает
+    аренду задач, которые ещё выполняются в этом процессе. При BANANALAB_ASYNC_ENABLED
+    задачи Banana Lab идут на общий event loop (до MAX_ASYNC_GENERATIONS),
+    остальные — в пул потоков (до MAX_WORKERS). С ADAPTIVE_CONCURRENCY_ENABLED задачи
+    пар (провайдер, модель), исчерпавших свой AIMD-лимит, не забираются.
+    """
+    heartbeat_interval = max(job_queue.lease_seconds / 3, 1)
+    last_heartbeat = 0.0
+    async_enabled = settings.BANANALAB_ASYNC_ENABLED
+    while True:
+        try:
+            now_ts = time.time()
+            with active_jobs_lock:
+                held_job_ids = list(active_jobs.keys()) + list(active_async_jobs.keys())
+                free_slots = THREAD_SLOTS - len(active_jobs)
+                free_async_slots = settings.MAX_ASYNC_GENERATIONS - len(active_async_jobs)
+            if now_ts - last_heartbeat >= heartbeat_interval:
+                if held_job_ids:
+                    job_queue.extend_leases(WORKER_ID, held_job_ids)
+                if settings.ADAPTIVE_CONCURRENCY_ENABLED:
+                    _publish_concurrency_limits()
+                last_heartbeat = now_ts
+
+            if draining.is_set():
+                # Остановка: только продлеваем аренду задач, которые ещё выполняются
+                free_slots = free_async_slots = 0
+            if async_enabled:
+                _claim_into(
+                    active_async_jobs, free_async_slots, _submit_async_job, providers=("bananalab",)
+                )
+                _claim_into(
+                    active_jobs,
+                    free_slots,
+                    lambda job: executor.submit(_run_claimed_job, job),
+                    exclude_providers=("bananalab",),
+                )
+            else:
+                _claim_into(active_jobs, free_slots, lambda job: executor.submit(_run_claimed_job, job))
+        except Exception as e:
+            logger.error(f"[JOB_QUEUE] Ошибка диспетчера очереди: {e}", exc_info=True)
+
+        job_dispatcher_wakeup.wait(settings.JOB_POLL_INTERVAL_SECONDS)
+        job_dispatcher_wakeup.clear()
+
+
+def start_job_dispatcher():
+    global job_dispatcher_started
+    if job_dispatcher_started:
+        return
+    with active_jobs_lock:
+        if job_dispatcher_started:
+            return
+        thread = threading.Thread(target=_job_dispatcher_loop, daemon=True)
+        thread.start()
+        job_dispatcher_started = True
+
+
+def get_user_generation_api_key(user_id: int, api_key_from_request: Optional[str] = None) -> str:
+    """
+    API ключ из запроса (Replicate r8_… или Banana Lab nb_…).
+    Ключи не сохраняются в БД.
+    """
+    if not api_key_from_request or not api_key_from_request.strip():
+        raise ValueError(
+            "API ключ не указан. Введите ключ Replicate (r8_…) или Banana Lab (nb_…) в настройках."
+        )
+    return api_key_from_request.strip()
+
+def _prepare_generation(
+    generation_id: int,
+    user_id: int,
+    request_data: dict,
+    use_async: bool = False,
+    cancellation: Optional[CancellationToken] = None,
+    on_provider_job: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Переводит генерацию в running и готовит клиент провайдера.
+    Возвращает контекст генерации или None, если продолжать нельзя
+    (генерация не найдена, отменена, уже завершена или клиент не удалось инициализировать).
+    cancellation — токен отмены, который проверяет клиент провайдера при ожидании результата;
+    on_provider_job получает хэндл задачи провайдера сразу после её создания.
+    """
+    with db_service.get_session() as session:
+        generation = session.query(Generation).filter(Generation.id == generation_id).first()
+        if not generation:
+            logger.error(f"[GENERATION] Генерация {generation_id} не найдена")
+            return None
+        if generation.status == "cancelled":
+            logger.info(f"[GENERATION] Генерация {generation_id} отменена до начала выполнения")
+            return None
+        if generation.status in ("completed", "failed"):
+            # Задачу вернул в очередь остановленный воркер, но генерацию он всё же успел завершить
+            logger.info(f"[GENERATION] Генерация {generation_id} уже завершена ({generation.status}), пропускаем")
+            return None
+
+        # Обновляем статус на running
+        generation.status = "running"
+        session.commit()
+
+        # Получаем API ключ из request_data (передан в запросе)
+        # ВАЖНО: Ключи пользователей НЕ сохраняются в БД для безопасности
+        api_key_from_request = request_data.get('api_key')
+        logger.info(f"[GENERATION] В process_generation_async: ключ из запроса: {'передан' if api_key_from_request else 'не передан'}")
+        if not api_key_from_request or not api_key_from_request.strip():
+            raise ValueError(
+                "API ключ не указан. Введите ключ Replicate или Banana Lab в настройках."
+            )
+        api_key = get_user_generation_api_key(user_id, api_key_from_request)
+        provider = infer_image_api_provider(api_key)
+        provider_label = "Banana Lab" if provider == "bananalab" else "Replicate"
+
+        # Обрабатываем ошибки инициализации клиента
+        try:
+            if provider == "bananalab":
+                if use_async:
+                    generation_service = AsyncBananalabService(api_key=api_key)
+                else:
+                    generation_service = BananalabService(api_key=api_key)
+            else:
+                generation_service = ReplicateService(api_token=api_key)
+            generation_service.cancellation = cancellation
+            generation_service.provider_job_callback = on_provider_job
+        except Exception as init_error:
+            error_msg = f"Ошибка инициализации клиента ({provider_label}): {str(init_error)}"
+            logger.error(f"[GENERATION] {error_msg}")
+            _mark_generation_failed(session, generation, error_msg)
+            logger.error(f"[GENERATION] Генерация {generation_id} завершена с ошибкой инициализации: {error_msg}")
+            return None
+
+        # Получаем модель из запроса или из БД (для старых записей)
+        model_name = request_data.get('model_name')
+        if not model_name:
+            # Если в БД тоже нет, используем по умолчанию
+            model_name = generation.model_name or "nano-banana-pro"
+
+        fallback = None
+        if settings.CIRCUIT_BREAKER_ENABLED and not circuit_breaker.allow(concurrency_target(provider, model_name)):
+            fallback = _breaker_fallback(provider, model_name, request_data)
+            if fallback is None:
+                logger.warning(
+                    f"[CIRCUIT_BREAKER] Генерация {generation_id}: цепь {provider}/{model_name} разомкнута, "
+                    f"генерация не отправлена провайдеру"
+                )
+                _mark_generation_failed(
+                    session,
+                    generation,
+                    f"Модель {model_name} сейчас недоступна у провайдера ({provider_label}). "
+                    f"Повторите позже или перезапустите генерацию на другой модели.",
+                )
+                return None
+        elif request_data.get("allow_fallback") and provider == "replicate" and _model_paused(provider, model_name):
+            # Пауза модели общая для всех ключей: генерация с allow_fallback не ждёт её снятия
+            fallback = _breaker_fallback(provider, model_name, request_data)
+        if fallback is not None:
+            logger.warning(f"[CIRCUIT_BREAKER] Генерация {generation_id} переведена с {model_name} на {fallback}")
+            # request_data задачи дальше описывает фактическую модель: по ней учитываются исход,
+            # ретраи и paused-очередь; ключ кэша результатов относится к исходной модели
+            request_data["model_name"] = fallback
+            request_data.pop("result_cache_key", None)
+            generation.model_name = fallback
+            if not generation.generation_metadata:
+                generation.generation_metadata = {}
+            generation.generation_metadata["model_name"] = fallback
+            generation.generation_metadata["fallback_from"] = model_name
+            flag_modified(generation, "generation_metadata")
+            session.commit()
+            model_name = fallback
+
+    if provider == "bananalab" and model_name not in SUPPORTED_BANANALAB_FRONTEND_MODELS:
+        logger.warning(
+            "[GENERATION] Для Banana Lab передана неподдерживаемая модель '%s'. "
+            "Banana Lab endpoint не принимает model в body, значение будет проигнорировано.",
+            model_name,
+        )
+
+    logger.info(
+        f"[GENERATION] Провайдер {provider_label}, модель {model_name}, генерация {generation_id}"
+    )
+    return {
+        "provider": provider,
+        "provider_label": provider_label,
+        "model_name": model_name,
+        "service": generation_service,
+    }
+
+
+def _generation_kwargs(request_data: dict, model_name: str) -> Dict[str, Any]:
+    """Параметры generate_image() провайдера из request_data задачи."""
+    return {
+        "prompt": request_data['prompt'],
+        "negative_prompt": request_data.get('negative_prompt'),
+        "resolution": request_data.get('resolution', '1K'),
+        "aspect_ratio": request_data.get('aspect_ratio', '1:1'),
+        "guidance_scale": request_data.get('guidance_scale', 7.5),
+        "num_inference_steps": request_data.get('num_inference_steps', 50),
+        "seed": request_data.get('seed'),
+        "reference_images": request_data.get('reference_images'),
+        "model_name": model_name,
+    }
+
+
+def _latency_key(provider: Optional[str], model_name: Optional[str], resolution: Optional[str]):
+    return (provider or "", model_name or "", resolution or "1K")
+
+
+def _wants_cross_provider_hedge(provider: Optional[str], request_data: dict) -> bool:
+    """
+    Дубль генерации пойдёт к другому провайдеру (HEDGE_CROSS_PROVIDER): Replicate ↔ Banana Lab
+    для моделей, которые есть у обоих. Такая генерация выполняется в потоке пула — гонка
+    запросов в _generate_hedged синхронная.
+    """
+    hedge_key = (request_data.get("hedge_api_key") or "").strip()
+    return (
+        settings.HEDGING_ENABLED
+        and settings.HEDGE_CROSS_PROVIDER
+        and bool(hedge_key)
+        and infer_image_api_provider(hedge_key) != provider
+        and request_data.get("model_name") in ReplicateService.AVAILABLE_MODELS
+        and request_data.get("model_name") in SUPPORTED_BANANALAB_FRONTEND_MODELS
+    )
+
+
+def _hedge_plan(context: Dict[str, Any], request_data: dict) -> Optional[Dict[str, Any]]:
+    """
+    Дубль для hedged-запроса или None. У того же провайдера — только Replicate: prediction
+    проигравшего отменяется у провайдера. К другому провайдеру (Replicate ↔ Banana Lab) — только
+    с HEDGE_CROSS_PROVIDER: проигравшую задачу Banana Lab отменить нельзя, она оплачивается,
+    а её результат отбрасывается. Нужны ключ дубля (hedge_api_key, может совпадать с основным)
+    и набранная статистика длительности модели (порог — квантиль HEDGE_QUANTILE).
+    """
+    hedge_key = (request_data.get("hedge_api_key") or "").strip()
+    if not settings.HEDGING_ENABLED or not hedge_key:
+        return None
+    model_name = context["model_name"]
+    hedge_provider = infer_image_api_provider(hedge_key)
+    if hedge_provider == context["provider"]:
+        if hedge_provider != "replicate" or model_name not in ReplicateService.AVAILABLE_MODELS:
+            return None
+    elif not _wants_cross_provider_hedge(context["provider"], {**request_data, "model_name": model_name}):
+        return None
+    delay = generation_latency.quantile(
+        _latency_key(context["provider"], model_name, request_data.get("resolution")), settings.HEDGE_QUANTILE
+    )
+    if delay is None:
+        return None
+    return {
+        "provider": hedge_provider,
+        "provider_label": "Banana Lab" if hedge_provider == "bananalab" else "Replicate",
+        "api_key": hedge_key,
+        "delay": delay,
+        "target": concurrency_target(hedge_provider, model_name),
+    }
+
+
+def _admit_hedge(generation_id: int, plan: Dict[str, Any]) -> bool:
+    """
+    Допуск дубля теми же проверками, что и основного запроса: свободный слот hedge_slots,
+    замкнутая цепь, слот AIMD-лимита и токен лимита запросов API ключа дубля.
+    Занятое освобождает _release_hedge.
+    """
+    target = plan["target"]
+    if not hedge_slots.acquire(blocking=False):
+        logger.info(f"[HEDGE] Генерация {generation_id}: нет свободных слотов HEDGE_MAX_IN_FLIGHT, дубль не отправлен")
+        return False
+    reason = None
+    if settings.CIRCUIT_BREAKER_ENABLED and not circuit_breaker.allow(target):
+        reason = "цепь модели разомкнута"
+    elif settings.ADAPTIVE_CONCURRENCY_ENABLED and not concurrency_limiter.try_acquire(target):
+        reason = "исчерпан AIMD-лимит модели"
+    else:
+        plan["concurrency_acquired"] = settings.ADAPTIVE_CONCURRENCY_ENABLED
+        if _acquire_rate_limit_token(generation_id, plan["api_key"], plan["provider"]) > 0:
+            reason = "исчерпан бюджет запросов API ключа"
+    if reason is None:
+        return True
+    _release_hedge(plan)
+    logger.info(f"[HEDGE] Генерация {generation_id}: дубль не отправлен — {reason}")
+    return False
+
+
+def _release_hedge(plan: Dict[str, Any]):
+    if plan.pop("concurrency_acquired", False):
+        concurrency_limiter.release(plan["target"])
+    hedge_slots.release()
+
+
+def _generate_hedged(
+    generation_id: int,
+    context: Dict[str, Any],
+    plan: Dict[str, Any],
+    request_data: dict,
+    kwargs: Dict[str, Any],
+    cancellation: CancellationToken,
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Hedged-запрос: основной запрос выполняется в потоке генерации; если он не ответил
+    за plan["delay"] (наблюдаемый p90), тот же запрос после допуска (_admit_hedge) уходит
+    дублем. Побеждает первый успешный результат, prediction проигравшего отменяется
+    у провайдера; проигравшую задачу Banana Lab перестаём ждать, и её результат отбрасывается.
+    Если успешных нет, возвращается результат (или исключение) основного.
+    Возвращает (результат, победил ли дубль).
+    """
+    service = context["service"]
+    # У каждого запроса свой токен: проигравший отменяется, отмена генерации отменяет оба
+    primary_token = CancellationToken()
+    cancellation.add_callback(primary_token.cancel)
+    service.cancellation = primary_token
+    hedge_token = CancellationToken()
+    cancellation.add_callback(hedge_token.cancel)
+    lock = threading.Lock()
+    race: Dict[str, Any] = {"winner": None, "hedge_future": None}
+    primary_started_at = datetime.utcnow()
+
+    def run_hedge(hedge_service) -> Dict[str, Any]:
+        try:
+            result = hedge_service.generate_image(**kwargs)
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            logger.warning(f"[HEDGE] Генерация {generation_id}: ошибка дубля: {e}")
+            result = {"success": False, "error": str(e)}
+        finally:
+            _release_hedge(plan)
+        with lock:
+            if result.get("success") and race["winner"] is None:
+                race["winner"] = "hedge"
+                primary_token.cancel()
+                return result
+        if not result.get("success"):
+            # Победивший дубль учитывается в _finalize_generation, проигравший — здесь
+            _record_provider_outcome(_hedge_winner_request(request_data, plan), result, plan["started_at"])
+        return result
+
+    def launch_hedge():
+        if cancellation.is_cancelled or not _admit_hedge(generation_id, plan):
+            return
+        try:
+            if plan["provider"] == "bananalab":
+                hedge_service = BananalabService(api_key=plan["api_key"])
+            else:
+                hedge_service = ReplicateService(api_token=plan["api_key"])
+        except Exception as e:
+            _release_hedge(plan)
+            logger.warning(f"[HEDGE] Генерация {generation_id}: не удалось создать клиент дубля: {e}")
+            return
+        hedge_service.cancellation = hedge_token
+        with lock:
+            if race["winner"] is not None:
+                _release_hedge(plan)
+                return
+            plan["started_at"] = datetime.utcnow()
+            race["hedge_future"] = hedge_executor.submit(run_hedge, hedge_service)
+        logger.info(
+            f"[HEDGE] Генерация {generation_id}: {context['provider_label']} не ответил за {plan['delay']:.0f} сек "
+            f"(p{settings.HEDGE_QUANTILE * 100:.0f}), дублируем запрос ({plan['provider_label']})"
+        )
+
+    timer = threading.Timer(plan["delay"], launch_hedge)
+    timer.daemon = True
+    timer.start()
+    primary_result: Optional[Dict[str, Any]] = None
+    primary_error: Optional[BaseException] = None
+    try:
+        primary_result = service.generate_image(**kwargs)
+    except GenerationCancelled as e:
+        if race["winner"] != "hedge":
+            hedge_token.cancel()
+            raise
+        primary_error = e
+    except Exception as e:
+        primary_error = e
+    finally:
+        timer.cancel()
+
+    with lock:
+        if race["winner"] is None and primary_result is not None and primary_result.get("success"):
+            race["winner"] = "primary"
+            hedge_token.cancel()
+        hedge_future: Optional[Future] = race["hedge_future"]
+        if hedge_future is None:
+            # Дубль не запущен: больше никто не объявит победителя
+            race["winner"] = race["winner"] or "primary"
+    if race["winner"] == "primary":
+        if primary_error is not None:
+            raise primary_error
+        if hedge_future is not None and plan["provider"] == "bananalab":
+            logger.info(f"[HEDGE] Генерация {generation_id}: задача дубля в Banana Lab не отменяется, её результат отброшен")
+        return primary_result, False
+
+    try:
+        hedge_result = hedge_future.result()
+    except GenerationCancelled:
+        hedge_result = None
+    if race["winner"] != "hedge":
+        # Ни один запрос не успешен — результат основного
+        if primary_error is not None:
+            raise primary_error
+        return primary_result, False
+
+    elapsed = (datetime.utcnow() - primary_started_at).total_seconds()
+    if primary_result is not None:
+        # Основной успел завершиться ошибкой до победы дубля
+        _record_provider_outcome(request_data, primary_result, primary_started_at)
+    elif isinstance(primary_error, GenerationCancelled):
+        # Основной отменён: его длительность не меньше порога — цензурированная выборка,
+        # иначе квантиль учился бы только на быстрых генерациях и сползал вниз
+        generation_latency.record(
+            _latency_key(context["provider"], context["model_name"], request_data.get("resolution")),
+            max(elapsed, plan["delay"]),
+        )
+    logger.info(f"[HEDGE] Генерация {generation_id}: первым ответил дубль через {elapsed:.0f} сек")
+    if context["provider"] == "bananalab":
+        logger.info(f"[HEDGE] Генерация {generation_id}: основная задача Banana Lab не отменяется, её результат отброшен")
+    return hedge_result, True
+
+
+def _hedge_winner_request(request_data: dict, plan: Dict[str, Any]) -> dict:
+    """
+    request_data для результата дубля: исход (лимиты, latency) учитывается по ключу дубля.
+    Модель та же; ключ кэша результатов сохраняется, только если провайдер тоже Replicate
+    (результат Banana Lab не детерминирован и в кэш не попадает).
+    """
+    winner = {**request_data, "api_key": plan["api_key"], "hedge_api_key": request_data.get("api_key")}
+    if plan["provider"] != "replicate":
+        winner.pop("result_cache_key", None)
+    return winner
+
+
+def _mark_generation_failed(session, generation: Generation, error_msg: str):
+    """Помечает генерацию как failed с текстом ошибки в generation_metadata (отменённую не трогает)."""
+    if generation.status == "cancelled":
+        return
+    generation.status = "failed"
+    generation.completed_at = datetime.utcnow()
+    if not generation.generation_metadata:
+        generation.generation_metadata = {}
+    generation.generation_metadata.pop("paused_request_data", None)
+    generation.generation_metadata['error'] = error_msg
+    # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
+    flag_modified(generation, "generation_metadata")
+    session.commit()
+
+
+def _fail_on_provider_exception(generation_id: int, provider_label: str, gen_error: Exception):
+    """Ошибка при генерации (например, неправильный API ключ, таймаут и т.д.)"""
+    # Улучшенное извлечение деталей ошибки
+    error_msg = str(gen_error)
+
+    if hasattr(gen_error, 'message'):
+        error_msg = str(gen_error.message)
+    elif hasattr(gen_error, 'args') and len(gen_error.args) > 0:
+        error_msg = str(gen_error.args[0])
+
+    full_error_msg = f"Ошибка генерации ({provider_label}): {error_msg}"
+
+    logger.error(f"[GENERATION] {full_error_msg}", exc_info=gen_error)
+    with db_service.get_session() as session:
+        generation = session.query(Generation).filter(Generation.id == generation_id).first()
+        if generation:
+            _mark_generation_failed(session, generation, full_error_msg)
+    logger.error(f"[GENERATION] Генерация {generation_id} завершена с ошибкой генерации: {full_error_msg}")
+
+
+def _handle_generation_exception(generation_id: int, user_id: int, e: Exception):
+    """Непредвиденная ошибка обработки: логируем в файл и помечаем генерацию как failed."""
+    logger.error(f"[GENERATION] Ошибка обработки генерации {generation_id}: {e}", exc_info=True)
+    
+    # Сохраняем ошибку в файл
+    from app.services.ErrorLogger import save_error_to_file
+    error_data = {
+        "type": "generation_exception",
+        "generation_id": generation_id,
+        "user_id": user_id,
+        "error": str(e),
+        "error_type": type(e).__name__,
+    }
+    save_error_to_file(error_data)
+    
+    with db_service.get_session() as session:
+        generation = session.query(Generation).filter(Generation.id == generation_id).first()
+        if generation:
+            _mark_generation_failed(session, generation, str(e))
+
+
+def _record_model_available(request_data: dict):
+    """Успешная генерация снимает паузу модели — общую и в paused-очереди процесса."""
+    target = _paused_target(request_data)
+    paused_queue.mark_available(target)
+    try:
+        model_availability.record_available(*target)
+    except Exception as e:
+        logger.warning(f"[PAUSED_QUEUE] Не удалось снять паузу модели {target[0]}/{target[1]}: {e}")
+
+
+def _finalize_generation(generation_id: int, user_id: int, request_data: dict, result: Dict[str, Any], started_at: datetime):
+    """
+    Обрабатывает результат провайдера: сохраняет изображение в MinIO и статус,
+    ставит ретрай в очередь или отправляет генерацию в paused-очередь.
+    """
+    _record_provider_outcome(request_data, result, started_at)
+    with db_service.get_session() as session:
+        generation = session.query(Generation).filter(Generation.id == generation_id).first()
+        if not generation:
+            logger.warning(f"[GENERATION] Генерация {generation_id} удалена до получения результата")
+            return
+        if generation.status == "cancelled":
+            logger.info(f"[GENERATION] Генерация {generation_id} отменена, результат провайдера не сохраняется")
+            return
+
+        if result['success']:
+            if generation.generation_metadata and generation.generation_metadata.get("paused_request_data"):
+                generation.generation_metadata.pop("paused_request_data", None)
+            # Логируем что получили от ReplicateService
+            logger.info(f"[GENERATION] Результат от ReplicateService: image_url={'есть' if result.get('image_url') else 'отсутствует'}, image_data={'есть' if result.get('image_data') else 'отсутствует'}")
+            # Сохраняем в MinIO если есть данные
+            if result['image_data']:
+                try:
+                    # Проверяем размер изображения перед сохранением
+                    image_size = len(result['image_data'])
+                    logger.info(f"[GENERATION] Размер изображения: {image_size} байт")
+                    
+                    if image_size < 1024:  # Меньше 1KB - подозрительно
+                        logger.warning(f"[GENERATION] Подозрительно маленький размер изображения: {image_size} байт")
+                        # Проверяем что это действительно изображение
+                        try:
+                            from PIL import Image as PILImage
+                            import io as io_module
+                            img = PILImage.open(io_module.BytesIO(result['image_data']))
+                            img.verify()
+                            img = PILImage.open(io_module.BytesIO(result['image_data']))  # Пересоздаем после verify
+                            logger.info(f"[GENERATION] Изображение валидно: {img.format}, размер: {img.size}")
+                            # Если изображение валидно, но маленькое - возможно это миниатюра, продолжаем
+                        except Exception as img_error:
+                            logger.error(f"[GENERATION] Данные не являются валидным изображением: {img_error}")
+                            # Если не валидное изображение, пробуем загрузить полное изображение по URL от Replicate
+                            image_url = result.get('image_url')
+                            logger.info(f"[GENERATION] Проверка URL от Replicate: {image_url[:100] if image_url else 'URL отсутствует'}...")
+                            if image_url:
+                                # Пробуем загрузить полное изображение по URL и сохранить в MinIO
+                                try:
+                                    import requests as req_module
+                                    logger.info(f"[GENERATION] Загрузка полного изображения по URL от Replicate: {image_url[:100]}...")
+                                    img_response = req_module.get(image_url, timeout=30)
+                                    if img_response.status_code == 200:
+                                        full_image_data = img_response.content
+                                        logger.info(f"[GENERATION] Полное изображение загружено, размер: {len(full_image_data)} байт")
+                                        
+                                        # Проверяем, что это валидное изображение
+                                        try:
+                                            from PIL import Image as PILImage
+                                            import io as io_module
+                                            img = PILImage.open(io_module.BytesIO(full_image_data))
+                                            img.verify()
+                                            img = PILImage.open(io_module.BytesIO(full_image_data))
+                                            logger.info(f"[GENERATION] Полное изображение валидно: {img.format}, размер: {img.size}")
+                                            
+                                            # Сохраняем полное изображение в MinIO
+                                            filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
+                                            logger.info(f"[GENERATION] Сохранение полного изображения в MinIO: {filename}")
+                                            upload_result = minio.upload_image(
+                                                full_image_data,
+                                                filename,
+                                                "image/jpeg"
+                                            )
+                                            generation.result_url = upload_result['url']
+                                            generation.result_path = upload_result['path']
+                                            logger.info(f"[GENERATION] Полное изображение сохранено в MinIO, URL: {generation.result_url[:100]}...")
+                                            generation.status = "completed"
+                                            generation.completed_at = datetime.utcnow()
+                                            session.commit()
+                                            logger.info(f"[GENERATION] Генерация {generation.id} завершена с полным изображением из MinIO")
+                                            return
+                                        except Exception as full_img_error:
+                                            logger.error(f"[GENERATION] Полное изображение также невалидно: {full_img_error}")
+                                            # Используем URL от Replicate как fallback
+                                            generation.result_url = image_url
+                                            logger.warning(f"[GENERATION] Используется URL от Replicate как fallback: {generation.result_url[:100]}...")
+                                            generation.status = "completed"
+                                            generation.completed_at = datetime.utcnow()
+                                            session.commit()
+                                            logger.info(f"[GENERATION] Генерация {generation.id} завершена с URL от Replicate")
+                                            return
+                                    else:
+                                        logger.warning(f"[GENERATION] Не удалось загрузить полное изображение, статус: {img_response.status_code}")
+                                        # Используем URL от Replicate как fallback
+                                        generation.result_url = image_url
+                                        logger.warning(f"[GENERATION] Используется URL от Replicate как fallback: {generation.result_url[:100]}...")
+                                        generation.status = "completed"
+                                        generation.completed_at = datetime.utcnow()
+                                        session.commit()
+                                        logger.info(f"[GENERATION] Генерация {generation.id} завершена с URL от Replicate")
+                                        return
+                                except Exception as download_error:
+                                    logger.error(f"[GENERATION] Ошибка загрузки полного изображения: {download_error}")
+                                    # Используем URL от Replicate как fallback
+                                    generation.result_url = image_url
+                                    logger.warning(f"[GENERATION] Используется URL от Replicate как fallback: {generation.result_url[:100]}...")
+                                    generation.status = "completed"
+                                    generation.completed_at = datetime.utcnow()
+                                    session.commit()
+                                    logger.info(f"[GENERATION] Генерация {generation.id} завершена с URL от Replicate")
+                                    return
+                            else:
+                                # Нет валидного изображения и нет URL - ошибка
+                                error_msg = f"Получены невалидные данные изображения: {image_size} байт, URL отсутствует"
+                                logger.error(f"[GENERATION] {error_msg}")
+                                generation.status = "failed"
+                                generation.completed_at = datetime.utcnow()
+                                if not generation.generation_metadata:
+                                    generation.generation_metadata = {}
+                                generation.generation_metadata['error'] = error_msg
+                                # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
+                                from sqlalchemy.orm.attributes import flag_modified
+                                flag_modified(generation, "generation_metadata")
+                                session.commit()
+                                logger.error(f"[GENERATION] Генерация {generation.id} завершена с ошибкой: {error_msg}")
+                                return
+                    
+                    filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
+                    logger.info(f"[GENERATION] Сохранение изображения в MinIO: {filename}")
+                    upload_result = minio.upload_image(
+                        result['image_data'],
+                        filename,
+                        "image/jpeg"
+                    )
+                    generation.result_url = upload_result['url']
+                    generation.result_path = upload_result['path']
+                    logger.info(f"[GENERATION] Изображение сохранено, URL: {generation.result_url[:100]}...")
+                except Exception as e:
+                    logger.error(f"[GENERATION] Ошибка сохранения в MinIO: {e}", exc_info=True)
+                    # Если не удалось сохранить в MinIO, используем URL от Replicate
+                    if result.get('image_url'):
+                        generation.result_url = result['image_url']
+                        logger.warning(f"[GENERATION] Используется URL от Replicate: {generation.result_url}")
+                    else:
+                        raise
+            elif result['image_url']:
+                generation.result_url = result['image_url']
+                logger.info(f"[GENERATION] Используется URL от Replicate: {generation.result_url}")
+            
+            generation.status = "completed"
+            generation.completed_at = datetime.utcnow()
+            total_elapsed = (generation.completed_at - started_at).total_seconds()
+            logger.info(f"[GENERATION] Генерация {generation_id} заняла {total_elapsed:.1f} сек")
+            # Модель отвечает — её генерации из paused-очереди выпускаются без ожидания пробы
+            _record_model_available(request_data)
+        else:
+            # Генерация не удалась - сохраняем ошибку
+            # Сначала пытаемся понять, можно ли повторить генерацию (временная ошибка типа E003/429)
+            if not generation.generation_metadata:
+                generation.generation_metadata = {}
+
+            error_message = result.get('error')
+            if not error_message or (isinstance(error_message, str) and error_message.strip() == ''):
+                error_message = result.get('message') or result.get('detail') or result.get('error_message')
+            if not error_message or (isinstance(error_message, str) and error_message.strip() == ''):
+                error_message = 'Неизвестная ошибка генерации'
+
+            if not isinstance(error_message, str):
+                error_message = str(error_message)
+
+            if _is_paused_error(error_message) and _reroute_immediately(request_data, model_paused=True):
+                # Пауза общая для модели: отмечаем её, и повтор сразу уходит на fallback-модель (_prepare_generation)
+                try:
+                    model_availability.record_paused(*_paused_target(request_data), error=error_message)
+                except Exception as e:
+                    logger.warning(f"[PAUSED_QUEUE] Не удалось сохранить паузу модели: {e}")
+                generation.status = "pending"
+                generation.completed_at = None
+                session.commit()
+                logger.warning(f"[CIRCUIT_BREAKER] Генерация {generation_id}: модель на паузе, повтор на fallback-модели")
+                submit_generation_job(generation_id, user_id, request_data)
+                return
+
+            if _is_paused_error(error_message):
+                generation.status = "paused"
+                generation.completed_at = None
+                paused_payload = _build_resume_payload(generation, request_data)
+                generation.generation_metadata["error"] = error_message
+                generation.generation_metadata["paused_at"] = datetime.utcnow().isoformat()
+                generation.generation_metadata["paused_request_data"] = paused_payload
+                from sqlalchemy.orm.attributes import flag_modified
+                flag_modified(generation, "generation_metadata")
+                session.commit()
+                enqueue_paused_generation(
+                    generation_id=generation_id,
+                    user_id=user_id,
+                    request_data=paused_payload,
+                    prioritize=False,
+                    paused_error=error_message,
+                )
+                return
+
+            # Проверяем, является ли ошибка временной (rate limit / high demand)
+            # Приоритет у явного флага из ReplicateService, чтобы ретраи не зависели от текста user-friendly сообщения.
+            service_retryable = bool(result.get("retryable"))
+            is_retryable = service_retryable or _is_rate_limit_error(error_message)
+
+            current_retries = generation.generation_metadata.get("retry_count", 0)
+
+            if is_retryable and current_retries < MAX_GENERATION_RETRIES:
+                # Увеличиваем счетчик попыток и ставим задачу обратно в очередь
+                # Повтор, который уйдёт на fallback-модель (цепь разомкнута), не ждёт задержки
+                retry_delay = 0.0 if _reroute_immediately(request_data) else backoff_delay(
+                    current_retries,
+                    settings.RETRY_BACKOFF_BASE_SECONDS,
+                    settings.RETRY_BACKOFF_MAX_SECONDS,
+                    result.get("retry_after"),
+                )
+                generation.generation_metadata["retry_count"] = current_retries + 1
+                generation.status = "pending"
+                generation.completed_at = None
+
+                from sqlalchemy.orm.attributes import flag_modified
+                flag_modified(generation, "generation_metadata")
+
+                session.commit()
+
+                logger.warning(
+                    f"[GENERATION] Генерация {generation_id} получила временную ошибку "
+                    f"и будет автоматически повторена ({current_retries + 1}/{MAX_GENERATION_RETRIES}) "
+                    f"через {retry_delay:.1f} сек: {error_message[:200]}"
+                )
+
+                # Возвращаем задачу в durable-очередь с теми же входными данными; до available_at
+                # её не заберёт ни один воркер, поток и слот свободны
+                submit_generation_job(generation_id, user_id, request_data, delay_seconds=retry_delay)
+                return
+
+            # Если ошибка не временная или исчерпаны попытки — помечаем как failed
+            generation.status = "failed"
+            generation.completed_at = datetime.utcnow()
+            total_elapsed = (generation.completed_at - started_at).total_seconds()
+            generation.generation_metadata.pop("paused_request_data", None)
+
+            # Обрезаем слишком длинные сообщения об ошибках (максимум 2000 символов)
+            if len(error_message) > 2000:
+                error_message = error_message[:2000] + "... (сообщение обрезано)"
+
+            generation.generation_metadata['error'] = error_message
+
+            # ВАЖНО: Уведомляем SQLAlchemy об изменении JSON поля
+            from sqlalchemy.orm.attributes import flag_modified
+            flag_modified(generation, "generation_metadata")
+
+            logger.error(
+                f"[GENERATION] Генерация {generation_id} завершена с ошибкой "
+                f"после {current_retries} попыток за {total_elapsed:.1f} сек. "
+                f"error_message: {error_message[:200]}..."
+            )
+            logger.info(f"[GENERATION] generation_metadata перед commit: {generation.generation_metadata}")
+
+            # Сохраняем ошибку в файл
+            from app.services.ErrorLogger import save_error_to_file
+            error_data = {
+                "type": "generation_error",
+                "generation_id": generation_id,
+                "user_id": user_id,
+                "prompt": request_data.get('prompt'),
+                "error": error_message,
+                "status": "failed"
+            }
+            save_error_to_file(error_data)
+        
+        session.commit()
+        logger.info(f"[GENERATION] Генерация {generation_id} завершена со статусом {generation.status}")
+
+        if generation.status == "completed" and generation.result_path and request_data.get("result_cache_key"):
+            store_cached_result(
+                request_data["result_cache_key"], generation.model_name, generation.result_path, generation.result_url
+            )
+        
+        # Проверяем что error_message сохранился
+        if generation.status == 'failed':
+            session.refresh(generation)
+            saved_error = generation.generation_metadata.get('error') if generation.generation_metadata else None
+            logger.info(f"[GENERATION] Проверка сохранения error_message для генерации {generation_id}: {saved_error[:200] if saved_error else 'НЕ СОХРАНЕНО!'}...")
+
+
+def process_generation_async(generation_id: int, user_id: int, request_data: dict):
+    """Асинхронная обработка генерации"""
+    started_at = datetime.utcnow()
+    cancellation = cancellation_registry.register(generation_id)
+    try:
+        context = _prepare_generation(
+            generation_id,
+            user_id,
+            request_data,
+            cancellation=cancellation,
+            on_provider_job=functools.partial(_persist_provider_job, generation_id, request_data, started_at),
+        )
+        if not context:
+            return
+        hedge = _hedge_plan(context, request_data)
+        if hedge is None and context["provider"] == "replicate" and settings.REPLICATE_ASYNC_PREDICTIONS:
+            _start_replicate_prediction(generation_id, user_id, request_data, context, started_at)
+            return
+        if hedge is None and context["provider"] == "bananalab":
+            # Поток пула не ждёт задачу Banana Lab: после создания она паркуется и опрашивается из очереди
+            context["service"].park_jobs = True
+        hedge_won = False
+        try:
+            # Генерируем изображение
+            kwargs = _generation_kwargs(request_data, context["model_name"])
+            if hedge is not None:
+                result, hedge_won = _generate_hedged(generation_id, context, hedge, request_data, kwargs, cancellation)
+            else:
+                result = context["service"].generate_image(**kwargs)
+        except GenerationCancelled:
+            _log_cancelled(generation_id)
+            return
+        except Exception as gen_error:
+            _fail_on_provider_exception(generation_id, context["provider_label"], gen_error)
+            return
+        if cancellation.is_cancelled:
+            _log_cancelled(generation_id)
+            return
+        if result.get("parked"):
+            _park_bananalab_job(generation_id, request_data, result["provider_job"], started_at)
+            return
+        if hedge_won:
+            _finalize_generation(generation_id, user_id, _hedge_winner_request(request_data, hedge), result, hedge["started_at"])
+        else:
+            _finalize_generation(generation_id, user_id, request_data, result, started_at)
+    except Exception as e:
+        _handle_generation_exception(generation_id, user_id, e)
+    finally:
+        cancellation_registry.unregister(generation_id, cancellation)
+
+
+def _log_cancelled(generation_id: int):
+    logger.info(f"[GENERATION] Генерация {generation_id} отменена, ожидание провайдера прервано")
+
+
+def _save_provider_job_metadata(generation_id: int, provider_job: Dict[str, Any]):
+    with db_service.get_session() as session:
+        generation = session.query(Generation).filter(Generation.id == generation_id).first()
+        if generation:
+            if not generation.generation_metadata:
+                generation.generation_metadata = {}
+            generation.generation_metadata["provider_job"] = provider_job
+            flag_modified(generation, "generation_metadata")
+            session.commit()
+
+
+def _persist_provider_job(generation_id: int, request_data: dict, started_at: datetime, provider_job: Dict[str, Any]):
+    """
+    Сохраняет хэндл задачи провайдера (prediction Replicate, job Banana Lab) у генерации
+    и в задаче очереди, пока воркер ждёт результат. Если процесс перезапустится,
+    задачу заберёт другой воркер и вернётся к оплаченной генерации (resume_provider_job).
+    """
+    provider_job = {**provider_job, "started_at": started_at.isoformat()}
+    try:
+        _save_provider_job_metadata(generation_id, provider_job)
+        job_queue.attach_provider_job(generation_id, WORKER_ID, {**request_data, "provider_job": provider_job})
+    except Exception as e:
+        # Без хэндла генерация просто не переживёт перезапуск — ожидание не прерываем
+        logger.warning(f"[GENERATION] Не удалось сохранить хэндл задачи провайдера для генерации {generation_id}: {e}")
+
+
+def replicate_webhook_token(generation_id: int) -> str:
+    """Подпись webhook'а Replicate для генерации (HMAC от SECRET_KEY)."""
+    return hmac.new(
+        settings.SECRET_KEY.encode("utf-8"),
+        f"replicate-webhook:{generation_id}".encode("utf-8"),
+        hashlib.sha256,
+    ).hexdigest()
+
+
+def verify_replicate_webhook_token(generation_id: int, token: str) -> bool:
+    return hmac.compare_digest(replicate_webhook_token(generation_id), token or "")
+
+
+def _replicate_webhook_url(generation_id: int) -> Optional[str]:
+    """URL webhook'а или None, если PUBLIC_API_URL не задан (локальный запуск — только опрос)."""
+    if not settings.PUBLIC_API_URL:
+        return None
+    return (
+        f"{settings.PUBLIC_API_URL.rstrip('/')}/api/v1/images/replicate/webhook"
+        f"?generation_id={generation_id}&token={replicate_webhook_token(generation_id)}"
+    )
+
+
+def _start_replicate_prediction(generation_id: int, user_id: int, request_data: dict, context: Dict[str, Any], started_at: datetime):
+    """
+    Создаёт prediction Replicate и паркует задачу до результата: поток воркера
+    освобождается сразу, генерацию завершит webhook или опрос из очереди.
+    """
+    created = context["service"].create_prediction(
+        **_generation_kwargs(request_data, context["model_name"]),
+        webhook_url=_replicate_webhook_url(generation_id),
+    )
+    if not created["success"]:
+        _finalize_generation(generation_id, user_id, request_data, created, started_at)
+        return
+
+    provider_job = {
+        "provider": "replicate",
+        "id": created["prediction_id"],
+        "started_at": started_at.isoformat(),
+    }
+    _save_provider_job_metadata(generation_id, provider_job)
+
+    job_queue.park(
+        generation_id,
+        WORKER_ID,
+        {**request_data, "provider_job": provider_job},
+        delay_seconds=settings.REPLICATE_POLL_INTERVAL_SECONDS,
+    )
+    logger.info(
+        f"[GENERATION] Генерация {generation_id} ждёт prediction {provider_job['id']} "
+        f"(webhook {'включён' if settings.PUBLIC_API_URL else 'выключен, только опрос'})"
+    )
+
+
+def _park_bananalab_job(generation_id: int, request_data: dict, provider_job: Dict[str, Any], started_at: datetime):
+    """Паркует задачу, созданную у Banana Lab: её статус раз в JOB_POLL_INTERVAL_SECONDS опрашивает очередь."""
+    provider_job = {**provider_job, "started_at": started_at.isoformat()}
+    _save_provider_job_metadata(generation_id, provider_job)
+    job_queue.park(
+        generation_id,
+        WORKER_ID,
+        {**request_data, "provider_job": provider_job},
+        delay_seconds=BananalabService.JOB_POLL_INTERVAL_SECONDS,
+    )
+    logger.info(f"[GENERATION] Генерация {generation_id} ждёт задачу Banana Lab {provider_job.get('job_id')}")
+
+
+def _complete_provider_job(job: Dict[str, Any], prediction: Dict[str, Any]) -> bool:
+    """
+    Завершает запаркованную генерацию по состоянию prediction.
+    Возвращает False, если prediction ещё выполняется (задачу нужно запарковать снова).
+    """
+    request_data = dict(job["request_data"])
+    provider_job = request_data.pop("provider_job")
+    started_at = datetime.fromisoformat(provider_job["started_at"])
+    service = ReplicateService(api_token=request_data.get("api_key"))
+
+    result = service.prediction_result(prediction)
+    if result is None:
+        elapsed = (datetime.utcnow() - started_at).total_seconds()
+        if elapsed <= service.TIMEOUT:
+            return False
+        try:
+            service.cancel_prediction(provider_job["id"])
+        except Exception as e:
+            logger.warning(f"[GENERATION] Не удалось отменить prediction {provider_job['id']}: {e}")
+        result = service._error_result(TimeoutError(f"Таймаут генерации ({service.TIMEOUT} секунд)"))
+
+    _finalize_generation(job["generation_id"], job["user_id"], request_data, result, started_at)
+    return True
+
+
+def resume_provider_job(job: Dict[str, Any]):
+    """
+    Опрос запаркованной задачи: забрать результат prediction Replicate или задачи Banana Lab
+    либо запарковать снова. Сюда же попадает задача, чей воркер упал, пока ждал провайдера:
+    она дальше тоже опрашивается из очереди.
+    """
+    generation_id = job["generation_id"]
+    provider_job = job["request_data"]["provider_job"]
+    if provider_job.get("provider") == "bananalab":
+        _resume_bananalab_job(job)
+        return
+    try:
+        service = ReplicateService(api_token=job["request_data"].get("api_key"))
+        try:
+            prediction = service.get_prediction(provider_job["id"])
+        except Exception as e:
+            logger.warning(f"[GENERATION] Не удалось получить prediction {provider_job['id']}: {e}")
+            prediction = {"id": provider_job["id"], "status": "processing"}
+        if not _complete_provider_job(job, prediction):
+            job_queue.park(
+                generation_id,
+                WORKER_ID,
+                job["request_data"],
+                delay_seconds=settings.REPLICATE_POLL_INTERVAL_SECONDS,
+            )
+    except Exception as e:
+        _handle_generation_exception(generation_id, job["user_id"], e)
+
+
+def _resume_bananalab_job(job: Dict[str, Any]):
+    generation_id = job["generation_id"]
+    request_data = dict(job["request_data"])
+    provider_job = request_data.pop("provider_job")
+    started_at = datetime.fromisoformat(provider_job["started_at"])
+    try:
+        service = BananalabService(api_key=request_data.get("api_key"))
+        result = service.check_job(provider_job)
+        if result is None:
+            elapsed = (datetime.utcnow() - started_at).total_seconds()
+            if elapsed <= service.JOB_TIMEOUT_SECONDS:
+                job_queue.park(generation_id, WORKER_ID, job["request_data"], delay_seconds=service.JOB_POLL_INTERVAL_SECONDS)
+                return
+            result = service._job_failure_result(service._job_timeout(time.time() - elapsed, None))
+        _finalize_generation(generation_id, job["user_id"], request_data, result, started_at)
+    except Exception as e:
+        _handle_generation_exception(generation_id, job["user_id"], e)
+
+
+async def resume_bananalab_job_coro(job: Dict[str, Any]):
+    """Задача Banana Lab, созданная до перезапуска воркера: дожидаемся её на общем event loop."""
+    generation_id = job["generation_id"]
+    request_data = dict(job["request_data"])
+    provider_job = request_data.pop("provider_job")
+    started_at = datetime.fromisoformat(provider_job["started_at"])
+    cancellation = cancellation_registry.register(generation_id)
+    try:
+        service = AsyncBananalabService(api_key=request_data.get("api_key"))
+        service.cancellation = cancellation
+        result = await service.resume_job(provider_job)
+        if cancellation.is_cancelled:
+            _log_cancelled(generation_id)
+            return
+        await asyncio.to_thread(_finalize_generation, generation_id, job["user_id"], request_data, result, started_at)
+    except Exception as e:
+        await asyncio.to_thread(_handle_generation_exception, generation_id, job["user_id"], e)
+    finally:
+        cancellation_registry.unregister(generation_id, cancellation)
+
+
+def resume_coalesced_job(job: Dict[str, Any]):
+    """
+    Дубликат идентичной генерации: копирует результат лидера, когда тот завершился,
+    ждёт дальше, пока лидер выполняется, или выполняется сам, если лидер удалён.
+    """
+    generation_id = job["generation_id"]
+    request_data = dict(job["request_data"])
+    leader_id = request_data.pop("coalesced_into")
+    try:
+        with db_service.get_session() as session:
+            leader = session.query(Generation).filter(Generation.id == leader_id).first()
+            if leader is not None and leader.status not in ("completed", "failed", "cancelled"):
+                job_queue.park(
+                    generation_id,
+                    WORKER_ID,
+                    job["request_data"],
+                    delay_seconds=settings.GENERATION_COALESCE_RECHECK_SECONDS,
+                )
+                return
+            generation = session.query(Generation).filter(Generation.id == generation_id).first()
+            if not generation:
+                logger.warning(f"[GENERATION] Генерация {generation_id} удалена до получения результата")
+                return
+            if leader is None or leader.status == "cancelled":
+                # Лидер удалён или отменён: первый из его дубликатов становится новым лидером, остальные ждут его
+                new_leader_id = submit_generation_job(
+                    generation_id, job["user_id"], request_data, fingerprint=job.get("fingerprint")
+                )
+                logger.info(
+                    f"[GENERATION] Генерация {leader_id} удалена или отменена, дубликат {generation_id} "
+                    f"{'выполняется самостоятельно' if new_leader_id is None else f'ждёт генерацию {new_leader_id}'}"
+                )
+                return
+
+            if not generation.generation_metadata:
+                generation.generation_metadata = {}
+            generation.generation_metadata["coalesced_from"] = leader_id
+            flag_modified(generation, "generation_metadata")
+            if leader.status == "failed":
+                _mark_generation_failed(
+                    session,
+                    generation,
+                    (leader.generation_metadata or {}).get("error") or "Неизвестная ошибка генерации",
+                )
+            else:
+                if leader.result_path:
+                    # Своя копия файла: удаление одной из генераций не ломает другую
+                    copied = minio.copy_image(
+                        leader.result_path,
+                        f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg",
+                    )
+                    generation.result_url = copied["url"]
+                    generation.result_path = copied["path"]
+                else:
+                    generation.result_url = leader.result_url
+                generation.status = "completed"
+                generation.completed_at = datetime.utcnow()
+                session.commit()
+            logger.info(
+                f"[GENERATION] Генерация {generation_id} получила результат идентичной генерации {leader_id} "
+                f"({generation.status})"
+            )
+    except Exception as e:
+        _handle_generation_exception(generation_id, job["user_id"], e)
+
+
+def handle_replicate_webhook(generation_id: int, prediction: Dict[str, Any]):
+    """
+    Webhook Replicate о завершении prediction: скачивает результат, сохраняет в MinIO
+    и обновляет статус. Повторные webhook'и и гонка с опросом безопасны — задачу
+    забирает только тот, кто первым перевёл её из waiting.
+    """
+    job = job_queue.take_waiting(generation_id, WORKER_ID)
+    if not job:
+        logger.info(f"[GENERATION] Webhook для генерации {generation_id}: задача уже обработана или ещё не запаркована")
+        return
+
+    provider_job = job["request_data"].get("provider_job") or {}
+    if provider_job.get("id") != prediction.get("id"):
+        logger.warning(
+            f"[GENERATION] Webhook для генерации {generation_id} от чужого prediction "
+            f"{prediction.get('id')} (ожидался {provider_job.get('id')}), игнорируем"
+        )
+        job_queue.park(generation_id, WORKER_ID, job["request_data"], delay_seconds=0)
+        return
+
+    try:
+        if not _complete_provider_job(job, prediction):
+            job_queue.park(
+                generation_id,
+                WORKER_ID,
+                job["request_data"],
+                delay_seconds=settings.REPLICATE_POLL_INTERVAL_SECONDS,
+            )
+            return
+    except Exception as e:
+        _handle_generation_exception(generation_id, job["user_id"], e)
+    job_queue.complete(job["job_id"], WORKER_ID)
+
+
+async def process_generation_coro(generation_id: int, user_id: int, request_data: dict):
+    """
+    Та же обработка генерации, но вызов провайдера выполняется на общем event loop
+    (AsyncBananalabService): ожидание Banana Lab не занимает поток пула.
+    Короткие синхронные шаги (БД, MinIO) выполняются в отдельных потоках.
+    """
+    started_at = datetime.utcnow()
+    cancellation = cancellation_registry.register(generation_id)
+    try:
+        context = await asyncio.to_thread(
+            _prepare_generation,
+            generation_id,
+            user_id,
+            request_data,
+            True,
+            cancellation,
+            functools.partial(_persist_provider_job, generation_id, request_data, started_at),
+        )
+        if not context:
+            return
+        try:
+            kwargs = _generation_kwargs(request_data, context["model_name"])
+            result = await context["service"].generate_image(**kwargs)
+        except GenerationCancelled:
+            _log_cancelled(generation_id)
+            return
+        except Exception as gen_error:
+            await asyncio.to_thread(_fail_on_provider_exception, generation_id, context["provider_label"], gen_error)
+            return
+        if cancellation.is_cancelled:
+            _log_cancelled(generation_id)
+            return
+        await asyncio.to_thread(_finalize_generation, generation_id, user_id, request_data, result, started_at)
+    except Exception as e:
+        await asyncio.to_thread(_handle_generation_exception, generation_id, user_id, e)
+    finally:
+        cancellation_registry.unregister(generation_id, cancellation)
+
+
+def _on_generation_status(event_data: Dict[str, Any]):
+    """NOTIFY generation_status: отменённая генерация прерывается, если выполняется в этом процессе."""
+    if event_data.get("status") != "cancelled":
+        return
+    generation_id = event_data.get("id")
+    paused_queue.remove(generation_id)
+    if cancellation_registry.cancel(generation_id):
+        logger.info(f"[GENERATION] Генерация {generation_id} отменена пользователем, прерываем ожидание провайдера")
+
+
+def begin_drain():
+    """
+    Переводит процесс в режим остановки: новые задачи не забираются, а paused-очередь
+    из памяти передаётся в generation_jobs. Повторный вызов ничего не делает.
+    """
+    if draining.is_set():
+        return
+    draining.set()
+    job_dispatcher_wakeup.set()
+    items = paused_queue.drain()
+    for item in items:
+        _hand_over_paused_item(item)
+    logger.info(
+        f"[JOB_QUEUE] Воркер {WORKER_ID} останавливается: новые задачи не забираются, "
+        f"генераций из paused-очереди передано в generation_jobs: {len(items)}"
+    )
+
+
+def drain_generation_workers(timeout_seconds: float) -> int:
+    """
+    Корректная остановка: ждёт до timeout_seconds, пока выполняющиеся генерации завершатся,
+    прерывает оставшиеся (токен отмены) и возвращает их в очередь. Задачи с сохранённым хэндлом провайдера другой воркер
+    дождётся у провайдера (resume_provider_job), остальные выполнит заново.
+    Возвращает число генераций, которые не успели завершиться.
+    """
+    begin_drain()
+    deadline = time.time() + max(timeout_seconds, 0)
+    while True:
+        with active_jobs_lock:
+            remaining = list(active_jobs.values()) + list(active_async_jobs.values())
+        if not remaining or time.time() >= deadline:
+            break
+        time.sleep(0.5)
+
+    # Задачи, ещё не начатые пулом, не запускаем: они уходят в очередь вместе с остальными
+    executor.shutdown(wait=False, cancel_futures=True)
+    for job in remaining:
+        # Сначала прерываем ожидание провайдера: иначе поток завершит генерацию,
+        # которую после release уже выполняет другой воркер
+        cancellation_registry.cancel(job["generation_id"])
+        try:
+            job_queue.release(job["job_id"], WORKER_ID)
+        except Exception as e:
+            logger.error(f"[JOB_QUEUE] Не удалось вернуть задачу {job['job_id']} в очередь: {e}")
+    if remaining:
+        logger.warning(
+            f"[JOB_QUEUE] Воркер {WORKER_ID} не дождался {len(remaining)} генераций за {timeout_seconds:.0f} сек, "
+            f"задачи возвращены в очередь"
+        )
+    else:
+        logger.info(f"[JOB_QUEUE] Воркер {WORKER_ID} завершил все генерации и остановлен")
+    return len(remaining)
+
+
+def start_generation_workers():
+    """Запускает диспетчер очереди и воркер paused-очереди в текущем процессе."""
+    db_service.listen(GENERATION_STATUS_CHANNEL, _on_generation_status)
+    start_paused_queue_worker()
+    restore_paused_queue_from_db()
+    if settings.BANANALAB_ASYNC_ENABLED:
+        async_runtime.start()
+    start_job_dispatcher()
@@ -0,0 +1,43 @@
+"""
+Наблюдаемая длительность успешных генераций по (провайдер, модель, разрешение).
+
+Хранит последние WINDOW_SIZE значений каждой цели и отдаёт квантиль (p90 для
+hedged-запросов), когда наблюдений набралось не меньше min_samples. Состояние —
+в памяти процесса.
+"""
+import math
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+LatencyKey = Tuple[str, str, str]
+
+WINDOW_SIZE = 200
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей генераций"""
+
+    def __init__(self, min_samples: int, window_size: int = WINDOW_SIZE):
+        self.min_samples = max(min_samples, 1)
+        self.window_size = window_size
+        self._samples: Dict[LatencyKey, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: LatencyKey, seconds: float):
+        if seconds <= 0:
+            return
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window_size)
+            samples.append(seconds)
+
+    def quantile(self, key: LatencyKey, q: float) -> Optional[float]:
+        """Квантиль q (0..1) длительности или None, если наблюдений меньше min_samples."""
+        with self._lock:
+            samples = sorted(self._samples.get(key) or ())
+        if len(samples) < self.min_samples:
+            return None
+        index = min(max(math.ceil(q * len(samples)) - 1, 0), len(samples) - 1)
+        return samples[index]
@@ -0,0 +1,200 @@
+"""
+Планировщик paused-очереди: генерации на моделях, которые провайдер поставил на паузу.
+
+Генерации сгруппированы по (провайдер, модель), внутри группы — min-heap по сроку
+возврата в очередь. Пока модель на паузе, генерации группы не выходят: когда срок
+паузы наступает, планировщик один раз выдаёт группу на проверку доступности (проба)
+и ждёт её исхода — новой паузы (mark_paused) или доступности (mark_available).
+Доступная модель выпускает накопленные генерации с темпом release_per_second, а не
+все разом. Поток планировщика спит на Condition до ближайшего срока, а не опрашивает
+очередь по таймеру. Состояние — в памяти процесса; общий срок паузы хранит
+ModelAvailabilityService.
+"""
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.services.concurrency_limiter import Target
+
+# Что выдаёт планировщик: (модель, генерация, проба). Для пробы генерация остаётся в очереди:
+# обработчик сам снимает её (remove), если пробу выполняет эта генерация
+Release = Tuple[Target, Dict[str, Any], bool]
+
+
+class _ModelBacklog:
+    __slots__ = ("heap", "available", "paused_until", "probing", "probe_deadline", "next_release")
+
+    def __init__(self):
+        # (срок, порядковый номер, generation_id)
+        self.heap: List[Tuple[float, int, int]] = []
+        self.available = False
+        self.paused_until = 0.0
+        self.probing = False
+        self.probe_deadline = 0.0
+        self.next_release = 0.0
+
+
+class PausedScheduler:
+    """Paused-генерации процесса, сгруппированные по модели"""
+
+    def __init__(
+        self,
+        release_per_second: float,
+        probe_timeout: float,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.release_interval = 1.0 / release_per_second if release_per_second > 0 else 0.0
+        self.probe_timeout = probe_timeout
+        self._clock = clock
+        self._models: Dict[Target, _ModelBacklog] = {}
+        # generation_id -> (модель, порядковый номер актуальной записи в heap, элемент)
+        self._items: Dict[int, Tuple[Target, int, Dict[str, Any]]] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def __contains__(self, generation_id: int) -> bool:
+        with self._cond:
+            return generation_id in self._items
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._items)
+
+    def add(
+        self,
+        item: Dict[str, Any],
+        target: Target,
+        paused_for: Optional[float],
+        prioritize: bool = False,
+    ) -> bool:
+        """
+        Ставит генерацию (item с generation_id) в группу модели. paused_for — сколько секунд
+        модель ещё на паузе (None — модель доступна). False, если генерация уже в очереди.
+        """
+        generation_id = item["generation_id"]
+        with self._cond:
+            if generation_id in self._items:
+                return False
+            now = self._clock()
+            backlog = self._models.setdefault(target, _ModelBacklog())
+            if paused_for is None:
+                self._resume(backlog, now)
+            elif not backlog.probing:
+                backlog.available = False
+                backlog.paused_until = now + paused_for
+            due = now if prioritize else now + (paused_for or 0.0)
+            seq = next(self._seq)
+            heapq.heappush(backlog.heap, (due, seq, generation_id))
+            self._items[generation_id] = (target, seq, item)
+            self._cond.notify()
+            return True
+
+    def remove(self, generation_id: int) -> bool:
+        """Снимает генерацию с очереди (отмена). Запись в heap удаляется лениво."""
+        with self._cond:
+            return self._items.pop(generation_id, None) is not None
+
+    def _resume(self, backlog: _ModelBacklog, now: float):
+        if not backlog.available:
+            backlog.next_release = now
+        backlog.available = True
+        backlog.probing = False
+        backlog.paused_until = 0.0
+
+    def mark_available(self, target: Target):
+        """Модель доступна: накопленные генерации выпускаются с заданным темпом."""
+        with self._cond:
+            backlog = self._models.get(target)
+            if backlog is not None:
+                self._resume(backlog, self._clock())
+                self._cond.notify()
+
+    def mark_paused(self, target: Target, paused_for: float):
+        """Модель всё ещё на паузе: следующая проба через paused_for секунд."""
+        with self._cond:
+            backlog = self._models.get(target)
+            if backlog is None:
+                return
+            backlog.available = False
+            backlog.probing = False
+            backlog.paused_until = self._clock() + paused_for
+            self._cond.notify()
+
+    def _head(self, backlog: _ModelBacklog) -> Optional[Tuple[float, int, int]]:
+        while backlog.heap:
+            due, seq, generation_id = backlog.heap[0]
+            entry = self._items.get(generation_id)
+            if entry is not None and entry[1] == seq:
+                return backlog.heap[0]
+            heapq.heappop(backlog.heap)
+        return None
+
+    def _ready_at(self, backlog: _ModelBacklog, due: float) -> float:
+        if backlog.available:
+            return backlog.next_release
+        if backlog.probing:
+            return backlog.probe_deadline
+        return max(due, backlog.paused_until)
+
+    def pop_ready(self) -> Tuple[Optional[Release], Optional[float]]:
+        """
+        Выдаёт генерацию или пробу, чей срок наступил: (release, None). Иначе (None, секунды
+        до ближайшего срока) или (None, None), если очередь пуста.
+        """
+        with self._cond:
+            return self._pop_ready()
+
+    def _pop_ready(self) -> Tuple[Optional[Release], Optional[float]]:
+        now = self._clock()
+        best: Optional[Tuple[float, Target]] = None
+        for target, backlog in self._models.items():
+            head = self._head(backlog)
+            if head is None:
+                continue
+            ready_at = self._ready_at(backlog, head[0])
+            if best is None or ready_at < best[0]:
+                best = (ready_at, target)
+        if best is None:
+            return None, None
+        ready_at, target = best
+        if ready_at > now:
+            return None, ready_at - now
+
+        backlog = self._models[target]
+        if not backlog.available:
+            # Срок паузы (или ожидания исхода прошлой пробы) истёк — модель пора проверить
+            backlog.probing = True
+            backlog.probe_deadline = now + self.probe_timeout
+            _, _, item = self._items[self._head(backlog)[2]]
+            return (target, item, True), None
+        _, _, generation_id = heapq.heappop(backlog.heap)
+        _, _, item = self._items.pop(generation_id)
+        backlog.next_release = max(backlog.next_release, now) + self.release_interval
+        return (target, item, False), None
+
+    def take(self) -> Release:
+        """Ждёт (на Condition, без опроса) и возвращает следующую генерацию или пробу."""
+        with self._cond:
+            while True:
+                release, wait_seconds = self._pop_ready()
+                if release is not None:
+                    return release
+                self._cond.wait(wait_seconds)
+
+    def drain(self) -> List[Dict[str, Any]]:
+        """
+        Забирает все генерации (остановка процесса). retry_after у элементов — момент,
+        когда планировщик выпустил бы их сам.
+        """
+        with self._cond:
+            now = self._clock()
+            items = []
+            for target, _, item in self._items.values():
+                backlog = self._models[target]
+                due = now if backlog.available else max(backlog.paused_until, now)
+                items.append({**item, "retry_after": due})
+            self._items.clear()
+            self._models.clear()
+            return items
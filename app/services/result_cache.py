@@ -0,0 +1,107 @@
+"""
+Кэш результатов детерминированных генераций (RESULT_CACHE_ENABLED).
+
+Ключ — result_cache_key(): модель, итоговый промпт, параметры, seed и содержимое
+референсов. Запись указывает на уже сохранённый объект MinIO. При попадании объект
+копируется на стороне MinIO для новой генерации (у каждой генерации свой файл —
+удаление одной не ломает другие); запись по-прежнему указывает на исходный объект,
+и stored_at меняется только при записи нового результата (store_result), поэтому
+запись живёт не дольше окна хранения исходной генерации. Записи, чьи файлы старше
+окна хранения, и лишние сверх RESULT_CACHE_MAX_ENTRIES (по давности использования)
+удаляет автоочистка (retention.prune_result_cache).
+"""
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm.attributes import flag_modified
+
+from app.models.base import Generation, GenerationResultCache
+from app.services.DBService import db_service
+from app.services.MinioService import MinioService
+from app.services.retention import RETENTION_DAYS
+
+logger = logging.getLogger(__name__)
+
+
+def complete_from_cache(generation_id: int, cache_key: str, minio: MinioService) -> Optional[str]:
+    """
+    Завершает генерацию готовым результатом из кэша без обращения к провайдеру.
+    Возвращает URL результата или None, если в кэше ничего нет (или файл уже удалён).
+    """
+    now = datetime.utcnow()
+    with db_service.get_session() as session:
+        entry = (
+            session.query(GenerationResultCache)
+            .filter(GenerationResultCache.cache_key == cache_key)
+            .with_for_update()
+            .first()
+        )
+        if entry is None:
+            return None
+        if entry.stored_at < now - timedelta(days=RETENTION_DAYS):
+            session.delete(entry)
+            session.commit()
+            return None
+
+        generation = session.query(Generation).filter(Generation.id == generation_id).first()
+        if not generation:
+            return None
+        try:
+            copied = minio.copy_image(
+                entry.result_path,
+                f"{now.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg",
+            )
+        except Exception as e:
+            # Файл удалили вместе с исходной генерацией — запись больше не нужна
+            logger.warning(f"[RESULT_CACHE] Объект {entry.result_path} недоступен, запись кэша удалена: {e}")
+            session.delete(entry)
+            session.commit()
+            return None
+
+        generation.result_url = copied["url"]
+        generation.result_path = copied["path"]
+        generation.status = "completed"
+        generation.completed_at = now
+        if not generation.generation_metadata:
+            generation.generation_metadata = {}
+        generation.generation_metadata["cache_hit"] = True
+        flag_modified(generation, "generation_metadata")
+
+        # Копия принадлежит новой генерации; срок жизни записи по-прежнему отсчитывается от исходного объекта
+        entry.last_used_at = now
+        entry.hits = (entry.hits or 0) + 1
+        session.commit()
+        logger.info(f"[RESULT_CACHE] Генерация {generation_id} завершена из кэша (попаданий: {entry.hits})")
+        return copied["url"]
+
+
+def store_result(cache_key: str, model_name: Optional[str], result_path: str, result_url: str):
+    """Запоминает результат завершённой генерации. Ошибки кэша не влияют на генерацию."""
+    now = datetime.utcnow()
+    stmt = pg_insert(GenerationResultCache).values(
+        cache_key=cache_key,
+        model_name=model_name,
+        result_path=result_path,
+        result_url=result_url,
+        stored_at=now,
+        last_used_at=now,
+        hits=0,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[GenerationResultCache.cache_key],
+        set_={
+            "result_path": stmt.excluded.result_path,
+            "result_url": stmt.excluded.result_url,
+            "stored_at": now,
+            "last_used_at": now,
+        },
+    )
+    try:
+        with db_service.get_session() as session:
+            session.execute(stmt)
+            session.commit()
+    except Exception as e:
+        logger.warning(f"[RESULT_CACHE] Не удалось сохранить результат в кэш: {e}")
@@ -0,0 +1,253 @@
+"""
+Фоновое обслуживание хранилища: автоочистка генераций старше срока хранения
+и сброс "зависших" генераций. Запускается в процессе воркера
+(или в API-процессе при RUN_WORKERS_IN_API=true).
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased
+from app.models.base import Generation, GenerationReference, GenerationResultCache, StorageDeletion
+from app.services.DBService import db_service
+from app.services.MinioService import MinioService
+from app.services.JobQueueService import job_queue
+from app.config import settings as app_settings
+
+logger = logging.getLogger(__name__)
+
+# Срок хранения генераций (и их файлов в MinIO)
+RETENTION_DAYS = 7
+
+# Глобальный сервис MinIO для фоновых задач
+minio_background = MinioService()
+
+
+def extract_minio_path_from_url(url: str, bucket: str) -> Optional[str]:
+    """
+    Из публичного URL MinIO достает путь объекта внутри бакета.
+    Ожидаемый формат:
+      {PUBLIC_URL}/{bucket}/{object_path}
+    Возвращает object_path или None, если разобрать не удалось.
+    """
+    if not url or not url.startswith("http"):
+        return None
+    # Ищем подстроку "/{bucket}/"
+    marker = f"/{bucket}/"
+    idx = url.find(marker)
+    if idx == -1:
+        return None
+    return url[idx + len(marker) :] or None
+
+
+def record_generation_references(session, generation_id: int, urls: Iterable[str]):
+    """Запоминает объекты MinIO, на которые ссылается генерация (внешние URL и data URL пропускаются)."""
+    paths = {extract_minio_path_from_url(url, app_settings.MINIO_BUCKET) for url in urls}
+    for path in sorted(p for p in paths if p):
+        session.add(GenerationReference(generation_id=generation_id, object_path=path))
+
+
+def _orphaned_reference_paths(session, generation_ids: List[int]) -> List[str]:
+    """
+    Референсы пачки генераций, на которые не ссылается ни одна генерация вне пачки.
+    Один anti-join по generation_references вместо перебора метаданных всех генераций.
+    """
+    other = aliased(GenerationReference)
+    still_used = (
+        session.query(other.generation_id)
+        .filter(other.object_path == GenerationReference.object_path)
+        .filter(other.generation_id.notin_(generation_ids))
+        .exists()
+    )
+    rows = (
+        session.query(GenerationReference.object_path)
+        .filter(GenerationReference.generation_id.in_(generation_ids))
+        .filter(~still_used)
+        .distinct()
+        .all()
+    )
+    return [row.object_path for row in rows]
+
+
+def _purge_generation_batch(cutoff: datetime, batch_size: int) -> int:
+    """
+    Удаляет одну пачку генераций старше cutoff одной короткой транзакцией:
+    DELETE ... RETURNING result_path, а пути файлов (результаты и осиротевшие референсы)
+    в той же транзакции записываются в storage_deletions. Возвращает число удалённых генераций.
+    """
+    with db_service.get_session() as session:
+        # SKIP LOCKED: строки, которые сейчас обновляет воркер, заберём в следующий раз
+        generation_ids = [
+            row.id
+            for row in session.query(Generation.id)
+            .filter(Generation.created_at < cutoff)
+            .order_by(Generation.created_at, Generation.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        ]
+        if not generation_ids:
+            return 0
+
+        # Референсы считаем до удаления строк: после него связи generation_references исчезнут каскадом
+        paths = set(_orphaned_reference_paths(session, generation_ids))
+        deleted = session.execute(
+            delete(Generation)
+            .where(Generation.id.in_(generation_ids))
+            .returning(Generation.result_path)
+        ).all()
+        paths.update(row.result_path for row in deleted if row.result_path)
+
+        if paths:
+            session.execute(
+                pg_insert(StorageDeletion)
+                .values([{"object_path": path, "created_at": datetime.utcnow()} for path in sorted(paths)])
+                .on_conflict_do_nothing(index_elements=["object_path"])
+            )
+        session.commit()
+        return len(deleted)
+
+
+def _drain_storage_deletions(minio: MinioService, batch_size: int) -> List[str]:
+    """
+    Удаляет из MinIO объекты очереди storage_deletions пакетами remove_objects.
+    Пути, которые не удалось удалить, остаются в очереди до следующего запуска.
+    """
+    deleted_files: List[str] = []
+    last_path = ""
+    while True:
+        with db_service.get_session() as session:
+            paths = [
+                row.object_path
+                for row in session.query(StorageDeletion.object_path)
+                .filter(StorageDeletion.object_path > last_path)
+                .order_by(StorageDeletion.object_path)
+                .limit(batch_size)
+                .all()
+            ]
+        if not paths:
+            return deleted_files
+        last_path = paths[-1]
+
+        removed = minio.delete_images(paths)
+        if removed:
+            with db_service.get_session() as session:
+                session.query(StorageDeletion).filter(
+                    StorageDeletion.object_path.in_(removed)
+                ).delete(synchronize_session=False)
+                session.commit()
+            deleted_files.extend(removed)
+
+
+def purge_expired_generations(minio: MinioService, cutoff: datetime, log_prefix: str) -> Tuple[int, List[str]]:
+    """
+    Удаляет генерации старше cutoff, их результаты и референсы, которые больше нигде не используются.
+    Работает пачками по RETENTION_PURGE_BATCH_SIZE, файлы удаляет после каждой пачки;
+    прерванный запуск продолжается со следующего (storage_deletions).
+    Возвращает (число удалённых генераций, удалённые файлы MinIO).
+    """
+    deleted_generations = 0
+    # Сначала дочищаем файлы, оставшиеся от прерванного запуска
+    deleted_files = _drain_storage_deletions(minio, app_settings.RETENTION_STORAGE_BATCH_SIZE)
+
+    while True:
+        purged = _purge_generation_batch(cutoff, app_settings.RETENTION_PURGE_BATCH_SIZE)
+        if not purged:
+            break
+        deleted_generations += purged
+        deleted_files.extend(_drain_storage_deletions(minio, app_settings.RETENTION_STORAGE_BATCH_SIZE))
+        logger.info(f"[{log_prefix}] Удалена пачка генераций старше {cutoff}: {purged} (всего {deleted_generations})")
+
+    evicted = prune_result_cache(cutoff, app_settings.RESULT_CACHE_MAX_ENTRIES)
+    if evicted:
+        logger.info(f"[{log_prefix}] Удалено записей кэша результатов: {evicted}")
+    return deleted_generations, deleted_files
+
+
+def prune_result_cache(cutoff: datetime, max_entries: int) -> int:
+    """
+    Удаляет записи кэша результатов, чьи файлы старше cutoff (их уже удалила очистка),
+    и самые давно использованные записи сверх max_entries. Файлы MinIO не трогает —
+    они принадлежат генерациям.
+    """
+    with db_service.get_session() as session:
+        expired = session.execute(
+            delete(GenerationResultCache).where(GenerationResultCache.stored_at < cutoff)
+        ).rowcount
+        least_recent = (
+            select(GenerationResultCache.cache_key)
+            .order_by(GenerationResultCache.last_used_at.desc())
+            .offset(max_entries)
+        )
+        evicted = session.execute(
+            delete(GenerationResultCache).where(GenerationResultCache.cache_key.in_(least_recent))
+        ).rowcount
+        session.commit()
+    return expired + evicted
+
+
+# Фоновая задача автоочистки старых генераций и связанных файлов,
+# а также сброса "зависших" генераций
+async def auto_cleanup_task():
+    """
+    Периодически удаляет генерации и файлы старше 7 дней
+    и помечает слишком долго висящие генерации как завершившиеся с ошибкой.
+    """
+    # Небольшая задержка после старта приложения, чтобы всё инициализировалось
+    await asyncio.sleep(60)
+    retention_days = RETENTION_DAYS
+    # Порог для "зависших" генераций (если висят дольше этого времени в статусе running/pending)
+    stuck_minutes = 20
+
+    while True:
+        try:
+            cutoff = datetime.utcnow() - timedelta(days=retention_days)
+            stuck_cutoff = datetime.utcnow() - timedelta(minutes=stuck_minutes)
+            fixed_stuck = 0
+
+            # Синхронная работа с БД и MinIO — в отдельном потоке, чтобы не блокировать event loop
+            deleted_generations, deleted_files = await asyncio.to_thread(
+                purge_expired_generations, minio_background, cutoff, "AUTO_CLEANUP"
+            )
+
+            with db_service.get_session() as session:
+                # Дополнительно: помечаем "зависшие" генерации как failed,
+                # чтобы они не висели бесконечно в статусе running/pending.
+                # Генерации с живой задачей в generation_jobs не трогаем — их судьбу решает аренда.
+                queued_ids = job_queue.active_generation_ids(session)
+                stuck_query = (
+                    session.query(Generation)
+                    .filter(Generation.created_at < stuck_cutoff)
+                    .filter(Generation.status.in_(["running", "pending"]))
+                )
+                if queued_ids:
+                    stuck_query = stuck_query.filter(Generation.id.notin_(queued_ids))
+                stuck_generations: List[Generation] = stuck_query.all()
+
+                for gen in stuck_generations:
+                    gen.status = "failed"
+                    gen.completed_at = datetime.utcnow()
+                    if not gen.generation_metadata:
+                        gen.generation_metadata = {}
+                    gen.generation_metadata["error"] = (
+                        f"Генерация была автоматически помечена как неудачная, "
+                        f"так как выполнялась дольше {stuck_minutes} минут без завершения."
+                    )
+                    fixed_stuck += 1
+
+                session.commit()
+
+            if deleted_generations or deleted_files or fixed_stuck:
+                logger.info(
+                    f"[AUTO_CLEANUP] Автоочистка завершена: "
+                    f"удалено генераций={deleted_generations}, файлов в MinIO={len(deleted_files)}, "
+                    f"сброшено зависших генераций={fixed_stuck}"
+                )
+        except Exception as e:
+            logger.error(f"[AUTO_CLEANUP] Ошибка автоочистки: {e}", exc_info=True)
+
+        # Запускаем проверку чаще (каждые 5 минут),
+        # чтобы оперативно сбрасывать зависшие генерации и чуть чаще чистить старые.
+        await asyncio.sleep(5 * 60)
@@ -0,0 +1,58 @@
+"""
+Задержка повторной попытки генерации: экспоненциальный рост с полным jitter.
+
+Задержка k-й повторной попытки — случайная величина из [0, min(cap, base * 2^k)],
+поэтому повторы после кратковременного сбоя провайдера расходятся во времени,
+а не бьют в него одновременно. Подсказка провайдера (Retry-After или "available in
+N seconds") задаёт нижнюю границу. Ожидание идёт в durable-очереди (available_at),
+поток воркера не спит.
+"""
+import random
+import re
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+
+# "Expected available in 5 seconds", "resets in ~5s", "try again in 10 sec"
+_RETRY_HINT_RE = re.compile(
+    r"(?:available in|resets in|retry after|try again in)\s*~?\s*(\d+(?:\.\d+)?)\s*(?:s\b|sec|second)", re.I
+)
+
+
+def backoff_delay(
+    retry: int,
+    base_seconds: float,
+    max_seconds: float,
+    retry_after: Optional[float] = None,
+    rand: Callable[[], float] = random.random,
+) -> float:
+    """Через сколько секунд повторить попытку номер retry (с нуля)."""
+    ceiling = min(max_seconds, base_seconds * (2 ** max(retry, 0)))
+    delay = ceiling * rand()
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_seconds))
+    return delay
+
+
+def parse_retry_after(value: Any) -> Optional[float]:
+    """Заголовок Retry-After: число секунд или HTTP-дата. None, если разобрать нельзя."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def retry_after_from_text(text: Optional[str]) -> Optional[float]:
+    """Подсказка провайдера в тексте ошибки, секунды. None, если её нет."""
+    match = _RETRY_HINT_RE.search(text or "")
+    return float(match.group(1)) if match else None
@@ -0,0 +1,55 @@
+"""
+Token bucket с обучаемым бюджетом для лимита запросов к провайдеру.
+
+Бюджет — сколько запросов разрешено за окно (window_seconds); ведро пополняется
+равномерно со скоростью budget / window. На ответ провайдера "слишком много запросов"
+бюджет уменьшается вдвое (не ниже min_budget), на каждый успешный вызов растёт
+на единицу (не выше max_budget). Хранение состояния — забота вызывающего
+(Postgres или память процесса), здесь только арифметика.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+class TokenBucket:
+    __slots__ = ("budget", "tokens", "updated_at", "throttled_until")
+
+    def __init__(
+        self,
+        budget: float,
+        tokens: Optional[float] = None,
+        updated_at: Optional[datetime] = None,
+        throttled_until: Optional[datetime] = None,
+    ):
+        self.budget = budget
+        self.tokens = budget if tokens is None else tokens
+        self.updated_at = updated_at
+        self.throttled_until = throttled_until
+
+    def _refill(self, now: datetime, window_seconds: float):
+        if self.updated_at is not None and now > self.updated_at:
+            elapsed = (now - self.updated_at).total_seconds()
+            self.tokens = min(self.budget, self.tokens + elapsed * self.budget / window_seconds)
+        self.updated_at = now
+
+    def take(self, now: datetime, window_seconds: float) -> float:
+        """Забирает токен. Возвращает 0, если запрос можно выполнять сейчас, иначе — сколько секунд подождать."""
+        self._refill(now, window_seconds)
+        if self.throttled_until is not None and now < self.throttled_until:
+            return (self.throttled_until - now).total_seconds()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) * window_seconds / self.budget
+
+    def throttle(self, now: datetime, window_seconds: float, min_budget: float, retry_after: Optional[float] = None):
+        """Провайдер ответил rate limit: уменьшаем бюджет и ждём retry_after (или интервал одного токена)."""
+        self._refill(now, window_seconds)
+        self.budget = max(min_budget, self.budget / 2)
+        self.tokens = 0.0
+        pause = retry_after if retry_after is not None else window_seconds / self.budget
+        self.throttled_until = now + timedelta(seconds=pause)
+
+    def reward(self, max_budget: float):
+        """Успешный вызов: понемногу возвращаем бюджет к настроенному максимуму."""
+        self.budget = min(max_budget, self.budget + 1)
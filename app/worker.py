@@ -0,0 +1,60 @@
+"""
+Отдельный процесс воркера генераций: python -m app.worker
+
+Выполняет только фоновую работу — задачи из очереди generation_jobs, ретраи,
+paused-очередь и автоочистку. HTTP не обслуживает, поэтому API и воркеры
+масштабируются независимо (в API-процессе при этом RUN_WORKERS_IN_API=false).
+
+По SIGTERM/SIGINT воркер перестаёт забирать задачи, передаёт paused-очередь
+в generation_jobs и ждёт выполняющиеся генерации до SHUTDOWN_DRAIN_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import signal
+from app.config import settings
+from app.services.ErrorLogger import setup_logging
+from app.services.DBService import db_service
+from app.services.generation_worker import drain_generation_workers, start_generation_workers, WORKER_ID
+from app.services.retention import auto_cleanup_task
+
+logger = logging.getLogger(__name__)
+
+
+async def run_worker():
+    """
+    Инициализирует БД, запускает потоки обработки генераций и цикл автоочистки.
+    По сигналу останавливается; возвращает число генераций, не завершившихся за время drain.
+    """
+    db_service.create_tables()
+    start_generation_workers()
+    logger.info(f"[WORKER] Воркер {WORKER_ID} запущен")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    cleanup = asyncio.create_task(auto_cleanup_task())
+    await stop.wait()
+
+    cleanup.cancel()
+    logger.info(f"[WORKER] Воркер {WORKER_ID} останавливается, ждём выполняющиеся генерации")
+    return await asyncio.to_thread(drain_generation_workers, settings.SHUTDOWN_DRAIN_SECONDS)
+
+
+def main():
+    setup_logging("nano_banana_worker.log")
+    unfinished = 0
+    try:
+        unfinished = asyncio.run(run_worker())
+    except KeyboardInterrupt:
+        pass
+    logger.info(f"[WORKER] Воркер {WORKER_ID} остановлен")
+    if unfinished:
+        # Их задачи уже в очереди; не ждём потоки пула, которые интерпретатор иначе дожидается при выходе
+        logging.shutdown()
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
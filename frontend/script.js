@@ -7,6 +7,12 @@ let referenceImages = []; // Массив объектов {file, dataUrl, id}
 let aspectRatioAutoSelected = false; // Флаг для автоматического выбора Юзер1
 let galleryUpdateInProgress = false; // Флаг для предотвращения параллельных обновлений галереи
 let lastGalleryHash = null; // Хеш последнего состояния галереи для предотвращения ненужных обновлений
+let generationEventsSource = null; // SSE поток статусов генераций (GET /images/events)
+let generationEventsConnected = false; // Пока поток подключен, галерею не опрашиваем
+let galleryRefreshTimer = null; // Отложенное обновление галереи по событиям SSE
+let galleryRenderTimer = null; // Отложенная перерисовка карточек, изменённых событиями SSE
+let galleryGenerations = []; // Последний загруженный список генераций (к нему применяются события SSE)
+let galleryMeta = null; // Метаданные последнего списка (лимиты, срок хранения)
 
 // Модели Imagen: только описание, соотношение сторон, seed (без разрешения, шагов, guidance, негативного промпта, референсов)
 const IMAGEN_MODEL_IDS = ['imagen-4', 'imagen-4-fast', 'imagen-4-ultra'];
@@ -147,6 +153,34 @@ function removeApiKey() {
     return setApiKey(null);
 }
 
+// Ключ для hedged-запросов (необязательный, Replicate или Banana Lab)
+function getHedgeApiKey() {
+    const storage = getStorage();
+    if (!storage) return null;
+    try {
+        return storage.getItem('hedgeApiKey');
+    } catch (e) {
+        console.error('[STORAGE] Ошибка чтения ключа для hedged-запросов:', e);
+        return null;
+    }
+}
+
+function setHedgeApiKey(key) {
+    const storage = getStorage();
+    if (!storage) return false;
+    try {
+        if (key) {
+            storage.setItem('hedgeApiKey', key);
+        } else {
+            storage.removeItem('hedgeApiKey');
+        }
+        return true;
+    } catch (e) {
+        console.error('[STORAGE] Ошибка сохранения ключа для hedged-запросов:', e);
+        return false;
+    }
+}
+
 // Функции для работы с выбранной моделью
 function getSelectedModel() {
     const storage = getStorage();
@@ -808,9 +842,9 @@ document.addEventListener('DOMContentLoaded', () => {
     updateParamsForModel();
     refreshModelSelectForCurrentKey();
     
-    // Обновление галереи каждые 5 секунд (только если есть активные генерации)
+    // Резервное обновление галереи каждые 5 секунд (только если SSE поток недоступен и есть активные генерации)
     setInterval(async () => {
-        if (authToken) {
+        if (authToken && !generationEventsConnected) {
             try {
                 const response = await fetch(`${API_URL}/images/list?limit=50`, {
                     headers: {
@@ -980,6 +1014,7 @@ async function loadUserInfo() {
             console.log('[AUTH] Пользователь загружен:', currentUser.username);
             showUserMenu();
             checkApiKeyStatus();
+            connectGenerationEvents();
             // Загружаем галерею после успешной загрузки пользователя
             console.log('[AUTH] Загружаем галерею после успешной аутентификации...');
             await loadGallery();
@@ -1295,6 +1330,7 @@ async function handleGenerate(e) {
             negative_prompt: document.getElementById('negativePrompt').value || null,
             generation_mode: document.querySelector('input[name="generationMode"]:checked').value,
             model_name: selectedModel, // Добавляем выбранную модель
+            allow_fallback: document.getElementById('allowFallback').checked,
             resolution: document.getElementById('resolution').value,
             num_inference_steps: parseInt(document.getElementById('numSteps').value),
             guidance_scale: parseFloat(document.getElementById('guidance').value),
@@ -1355,6 +1391,10 @@ async function handleGenerate(e) {
         }
         
         formData.api_key = apiKey;
+        const hedgeApiKey = getHedgeApiKey();
+        if (hedgeApiKey && hedgeApiKey.trim() !== '') {
+            formData.hedge_api_key = hedgeApiKey;
+        }
         const storage = getStorage();
         const storageType = storage === localStorage ? 'localStorage' : 'sessionStorage';
         console.log(`[GENERATE] API ключ найден в ${storageType}, добавляем в запрос`);
@@ -1442,6 +1482,11 @@ async function handleGenerate(e) {
         let checkCount = 0;
         const maxChecks = 150; // 5 минут при обновлении каждые 2 секунды
         const checkInterval = setInterval(async () => {
+            // Статусы приходят через SSE — опрос не нужен
+            if (generationEventsConnected) {
+                clearInterval(checkInterval);
+                return;
+            }
             checkCount++;
             await loadGallery();
             // Останавливаем проверку через 5 минут или если нет активных генераций
@@ -1634,7 +1679,7 @@ async function handleApiKeySave(e) {
     }
     
     const storageType = storage === localStorage ? 'localStorage' : 'sessionStorage';
-    const saved = setApiKey(apiKey);
+    const saved = setApiKey(apiKey) && setHedgeApiKey(document.getElementById('hedgeApiKeyInput').value.trim());
     
     if (saved) {
         if (apiKey) {
@@ -1664,7 +1709,7 @@ async function handleApiKeyDelete() {
     if (!confirm('Удалить API ключ из локального хранилища?')) return;
 
     // ВАЖНО: Ключи НЕ сохраняются на сервере, удаляем только локально
-    const removed = removeApiKey();
+    const removed = removeApiKey() && setHedgeApiKey(null);
     if (removed) {
         showToast('API ключ удален из локального хранилища', 'success');
     } else {
@@ -1676,6 +1721,7 @@ async function handleApiKeyDelete() {
 
 // Выход
 function handleLogout() {
+    disconnectGenerationEvents();
     localStorage.removeItem('authToken');
     authToken = null;
     currentUser = null;
@@ -1684,8 +1730,104 @@ function handleLogout() {
     showToast('Выход выполнен', 'info');
 }
 
+// Подписка на SSE поток статусов генераций вместо периодического опроса /images/list
+function connectGenerationEvents() {
+    disconnectGenerationEvents();
+    if (!authToken || typeof EventSource === 'undefined') {
+        return;
+    }
+
+    const source = new EventSource(`${API_URL}/images/events?token=${encodeURIComponent(authToken)}`);
+    generationEventsSource = source;
+
+    source.onopen = () => {
+        generationEventsConnected = true;
+        console.log('[EVENTS] SSE поток статусов подключен');
+    };
+    source.addEventListener('generation', (e) => {
+        let data;
+        try {
+            data = JSON.parse(e.data);
+        } catch (error) {
+            // Некорректное событие — обновим галерею целиком
+            scheduleGalleryRefresh();
+            return;
+        }
+        console.log('[EVENTS] Генерация', data.id, '->', data.status);
+        if (applyGenerationEvent(data)) {
+            scheduleGalleryRender();
+        } else {
+            // Генерации нет на странице (например, только что созданный пакет) — нужен список
+            scheduleGalleryRefresh();
+        }
+    });
+    source.onerror = () => {
+        // Пока EventSource переподключается, работает резервный опрос
+        generationEventsConnected = false;
+        if (source.readyState === EventSource.CLOSED && generationEventsSource === source) {
+            generationEventsSource = null;
+            setTimeout(() => {
+                if (authToken && !generationEventsSource) {
+                    connectGenerationEvents();
+                }
+            }, 10000);
+        }
+    };
+}
+
+function disconnectGenerationEvents() {
+    if (generationEventsSource) {
+        generationEventsSource.close();
+        generationEventsSource = null;
+    }
+    generationEventsConnected = false;
+}
+
+// Несколько событий подряд (например, пакет генераций) — одно обновление галереи
+function scheduleGalleryRefresh() {
+    if (galleryRefreshTimer) {
+        return;
+    }
+    galleryRefreshTimer = setTimeout(async () => {
+        galleryRefreshTimer = null;
+        await loadGallery();
+    }, 500);
+}
+
+// Применяет дельту статуса к карточке из последнего списка. false — генерации нет на странице.
+function applyGenerationEvent(data) {
+    const gen = galleryGenerations.find(g => g.id === data.id);
+    if (!gen) {
+        return false;
+    }
+    gen.status = data.status;
+    if (data.result_url) {
+        gen.result_url = data.result_url;
+    }
+    if (data.error) {
+        gen.error_message = data.error;
+    }
+    return true;
+}
+
+// Перерисовка изменённых карточек без запроса /images/list
+function scheduleGalleryRender() {
+    if (galleryRenderTimer) {
+        return;
+    }
+    galleryRenderTimer = setTimeout(async () => {
+        galleryRenderTimer = null;
+        if (galleryUpdateInProgress) {
+            // Идёт загрузка списка — применим дельту после неё
+            scheduleGalleryRender();
+            return;
+        }
+        await loadGallery({ generations: galleryGenerations, meta: galleryMeta });
+    }, 200);
+}
+
 // Загрузка галереи
-async function loadGallery() {
+async function loadGallery(cachedData = null) {
     // Предотвращаем параллельные обновления
     if (galleryUpdateInProgress) {
         console.log('[GALLERY] Обновление уже выполняется, пропускаем');
@@ -1718,66 +1860,72 @@ async function loadGallery() {
     let meta = null;
     
     try {
-        // Пробуем сначала без параметров, чтобы избежать 422
-        const url = `${API_URL}/images/list`;
-        console.log('[GALLERY] Запрос к:', url);
-        let response = await fetch(url, {
-            headers: {
-                'Authorization': `Bearer ${authToken}`
-            }
-        });
+        if (cachedData) {
+            // Событие SSE уже применено к последнему списку — перерисовываем без запроса
+            generations = cachedData.generations;
+            meta = cachedData.meta;
+        } else {
+            // Пробуем сначала без параметров, чтобы избежать 422
+            const url = `${API_URL}/images/list`;
+            console.log('[GALLERY] Запрос к:', url);
+            let response = await fetch(url, {
+                headers: {
+                    'Authorization': `Bearer ${authToken}`
+                }
+            });
         
-        console.log('[GALLERY] Ответ получен:', response.status, response.statusText);
+            console.log('[GALLERY] Ответ получен:', response.status, response.statusText);
 
-        if (!response.ok) {
-            let errorData;
-            try {
-                errorData = await response.json();
-            } catch (e) {
-                errorData = { detail: `Ошибка ${response.status}` };
-            }
-            console.error('[GALLERY] Ошибка загрузки:', response.status, errorData);
+            if (!response.ok) {
+                let errorData;
+                try {
+                    errorData = await response.json();
+                } catch (e) {
+                    errorData = { detail: `Ошибка ${response.status}` };
+                }
+                console.error('[GALLERY] Ошибка загрузки:', response.status, errorData);
             
-            // Если 422, пробуем запрос без параметров (уже пробуем без параметров, так что это не должно происходить)
-            if (response.status === 422) {
-                console.warn('[GALLERY] Ошибка 422 даже без параметров, проверяем детали ошибки:', errorData);
-                // Показываем сообщение об ошибке, но не блокируем интерфейс
-                grid.innerHTML = '<div class="col-12"><div class="alert alert-warning">Ошибка загрузки списка генераций. Попробуйте обновить страницу.</div></div>';
-                return;
-            } else if (response.status === 401) {
-                // Неавторизован - очищаем токен и показываем форму входа
-                console.warn('[GALLERY] Токен недействителен, очищаем и показываем форму входа');
-                localStorage.removeItem('authToken');
-                authToken = null;
-                showLoginButton();
-                grid.innerHTML = '<div class="col-12"><div class="alert alert-info">Сессия истекла. Войдите снова.</div></div>';
-                return;
+                // Если 422, пробуем запрос без параметров (уже пробуем без параметров, так что это не должно происходить)
+                if (response.status === 422) {
+                    console.warn('[GALLERY] Ошибка 422 даже без параметров, проверяем детали ошибки:', errorData);
+                    // Показываем сообщение об ошибке, но не блокируем интерфейс
+                    grid.innerHTML = '<div class="col-12"><div class="alert alert-warning">Ошибка загрузки списка генераций. Попробуйте обновить страницу.</div></div>';
+                    return;
+                } else if (response.status === 401) {
+                    // Неавторизован - очищаем токен и показываем форму входа
+                    console.warn('[GALLERY] Токен недействителен, очищаем и показываем форму входа');
+                    localStorage.removeItem('authToken');
+                    authToken = null;
+                    showLoginButton();
+                    grid.innerHTML = '<div class="col-12"><div class="alert alert-info">Сессия истекла. Войдите снова.</div></div>';
+                    return;
+                } else {
+                    throw new Error(errorData.detail || `Ошибка ${response.status}`);
+                }
             } else {
-                throw new Error(errorData.detail || `Ошибка ${response.status}`);
-            }
-        } else {
-            const data = await response.json();
+                const data = await response.json();
             
-            // Поддерживаем как старый формат (массив), так и новый (объект с метаданными)
-            if (Array.isArray(data)) {
-                generations = data;
-                meta = null;
-            } else if (data.generations && Array.isArray(data.generations)) {
-                generations = data.generations;
-                meta = data.meta || null;
-            } else {
-                console.error('[GALLERY] Неверный формат данных');
-                grid.innerHTML = '<div class="col-12"><div class="alert alert-danger">Ошибка загрузки данных</div></div>';
-                galleryUpdateInProgress = false;
-                return;
-            }
+                // Поддерживаем как старый формат (массив), так и новый (объект с метаданными)
+                if (Array.isArray(data)) {
+                    generations = data;
+                    meta = null;
+                } else if (data.generations && Array.isArray(data.generations)) {
+                    generations = data.generations;
+                    meta = data.meta || null;
+                } else {
+                    console.error('[GALLERY] Неверный формат данных');
+                    grid.innerHTML = '<div class="col-12"><div class="alert alert-danger">Ошибка загрузки данных</div></div>';
+                    galleryUpdateInProgress = false;
+                    return;
+                }
             
-            console.log('[GALLERY] Загружено генераций:', generations.length);
-            if (meta) {
-                console.log('[GALLERY] Метаданные:', meta);
+                console.log('[GALLERY] Загружено генераций:', generations.length);
+                if (meta) {
+                    console.log('[GALLERY] Метаданные:', meta);
+                }
             }
         }
-        
+
         // Проверяем, что generations определен
         if (!generations) {
             console.error('[GALLERY] generations не определен');
@@ -1785,6 +1933,8 @@ async function loadGallery() {
             galleryUpdateInProgress = false;
             return;
         }
+        galleryGenerations = generations;
+        galleryMeta = meta;
         
         console.log('[GALLERY] Получено генераций:', generations.length);
         console.log('[GALLERY] Статусы генераций:', generations.map(g => ({id: g.id, status: g.status, error_message: g.error_message ? g.error_message.substring(0, 50) + '...' : null})));
@@ -1872,7 +2022,9 @@ async function loadGallery() {
                 const attemptHintHtml = (gen.status === 'pending' || gen.status === 'running')
                     ? '<p class="mt-2 mb-0 text-info small">Попытка ' + attemptNumber + '/' + maxRetries + '</p>'
                     : '';
-                const placeholderInner = gen.status === 'failed'
+                const placeholderInner = gen.status === 'cancelled'
+                    ? '<div class="text-center"><i class="fas fa-ban text-secondary" style="font-size: 3rem;"></i><p class="mt-3 mb-0 text-light fw-bold">Генерация отменена</p></div>'
+                    : gen.status === 'failed'
                     ? '<div class="text-center"><i class="fas fa-exclamation-triangle text-danger" style="font-size: 3rem;"></i><p class="mt-3 mb-0 text-light fw-bold">Ошибка генерации</p><p class="mt-2 mb-0 text-danger small">' + (gen.error_message || 'Не удалось сгенерировать изображение').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;').replace(/'/g, '&#39;') + '</p></div>'
                     : '<div class="text-center"><div class="spinner-border text-warning" role="status" style="width: 3rem; height: 3rem;"><span class="visually-hidden">Загрузка...</span></div><p class="mt-3 mb-0 text-light fw-bold">' + (gen.status === 'pending' ? 'В очереди...' : gen.status === 'running' ? 'Генерируется...' : gen.status === 'paused' ? 'Пауза модели, ожидаем...' : 'Ошибка') + '</p>' + attemptHintHtml + '</div>';
                 imageBlock = '<div class="position-absolute top-0 start-0 w-100 h-100 d-flex align-items-center justify-content-center" style="z-index: 1; background: linear-gradient(135deg, #1a1a2e 0%, #252547 100%); border-radius: 0 0 12px 12px;">' + placeholderInner + '</div>';
@@ -1885,7 +2037,7 @@ async function loadGallery() {
                 : '';
             const statusBg = gen.status === 'completed' ? 'linear-gradient(135deg, rgba(74, 85, 104, 0.7) 0%, rgba(72, 187, 120, 0.5) 100%)' : gen.status === 'failed' ? 'linear-gradient(135deg, rgba(74, 85, 104, 0.7) 0%, rgba(229, 62, 62, 0.5) 100%)' : gen.status === 'paused' ? 'linear-gradient(135deg, rgba(74, 85, 104, 0.7) 0%, rgba(246, 173, 85, 0.6) 100%)' : 'linear-gradient(135deg, rgba(74, 85, 104, 0.7) 0%, rgba(102, 126, 234, 0.5) 100%)';
             const statusBorder = gen.status === 'completed' ? 'rgba(72, 187, 120, 0.6)' : gen.status === 'failed' ? 'rgba(229, 62, 62, 0.6)' : gen.status === 'paused' ? 'rgba(246, 173, 85, 0.7)' : 'rgba(102, 126, 234, 0.6)';
-            const statusText = gen.status === 'completed' ? 'Завершено' : gen.status === 'running' ? 'Генерируется' : gen.status === 'pending' ? 'В очереди' : gen.status === 'paused' ? 'Пауза модели' : 'Ошибка';
+            const statusText = gen.status === 'completed' ? 'Завершено' : gen.status === 'running' ? 'Генерируется' : gen.status === 'pending' ? 'В очереди' : gen.status === 'paused' ? 'Пауза модели' : gen.status === 'cancelled' ? 'Отменено' : 'Ошибка';
             const promptEscaped = (gen.prompt || '').replace(/</g, '&lt;').replace(/>/g, '&gt;');
             const dataImageUrl = hasImage ? gen.result_url.replace(/'/g, "\\'") : '';
             const dataPrompt = hasImage ? (gen.prompt || '').replace(/'/g, "\\'").replace(/"/g, '&quot;') : '';
@@ -1,5 +1,19 @@
-"""Локальные проверки без реальных вызовов API."""
+"""
+Локальные проверки без реальных вызовов API.
+
+Классы на базе ServiceTestCase импортируют модули воркера и роутеров; MinIO им не нужен.
+Классы на базе PostgresTestCase проверяют SQL на настоящем Postgres и запускаются только
+с TEST_POSTGRES=1 (подключение — переменные POSTGRES_* из окружения). Тесты создают
+своих пользователей и удаляют их вместе с генерациями.
+"""
+import os
 import unittest
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock
+
+# Настройкам приложения нужен SECRET_KEY; для тестов подходит любой
+os.environ.setdefault("SECRET_KEY", "test-secret")
 
 from app.services.generation_prompt import enhance_prompt_for_image_generation
 from app.services.image_api_provider import infer_image_api_provider
@@ -69,5 +83,1514 @@ class TestBananalabParse(unittest.TestCase):
         self.assertTrue(u.startswith("https://api.bananalab.pw/"))
 
 
+class TestTokenBucket(unittest.TestCase):
+    def test_budget_then_wait(self):
+        from datetime import datetime
+        from app.services.token_bucket import TokenBucket
+
+        now = datetime(2026, 1, 1)
+        bucket = TokenBucket(2)
+        self.assertEqual(bucket.take(now, 60), 0.0)
+        self.assertEqual(bucket.take(now, 60), 0.0)
+        self.assertAlmostEqual(bucket.take(now, 60), 30.0)
+
+    def test_throttle_halves_budget_and_reward_restores(self):
+        from datetime import datetime, timedelta
+        from app.services.token_bucket import TokenBucket
+
+        now = datetime(2026, 1, 1)
+        bucket = TokenBucket(10)
+        bucket.throttle(now, 60, min_budget=1, retry_after=5)
+        self.assertEqual(bucket.budget, 5)
+        self.assertAlmostEqual(bucket.take(now + timedelta(seconds=1), 60), 4.0)
+        bucket.reward(max_budget=6)
+        bucket.reward(max_budget=6)
+        self.assertEqual(bucket.budget, 6)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def test_aimd(self):
+        from app.services.concurrency_limiter import AdaptiveConcurrencyLimiter
+
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=4, latency_tolerance=2.0)
+        target = ("bananalab", "nano-banana-pro")
+        self.assertTrue(limiter.try_acquire(target))
+        self.assertFalse(limiter.try_acquire(target))
+        self.assertEqual(limiter.saturated_targets(), [target])
+
+        for _ in range(20):
+            limiter.record(target, "success", 30.0)
+        self.assertEqual(limiter.snapshot()[0]["limit"], 4)
+        self.assertTrue(limiter.try_acquire(target))
+
+        limiter.record(target, "throttled")
+        self.assertEqual(limiter.snapshot()[0]["limit"], 2)
+        limiter.record(target, "success", 90.0)
+        self.assertEqual(limiter.snapshot()[0]["limit"], 1.8)
+
+
+class TestRetryBackoff(unittest.TestCase):
+    def test_full_jitter_and_retry_after(self):
+        from app.services.retry_backoff import backoff_delay, parse_retry_after, retry_after_from_text
+
+        self.assertEqual(backoff_delay(3, 5, 300, rand=lambda: 1.0), 40)
+        self.assertEqual(backoff_delay(10, 5, 300, rand=lambda: 1.0), 300)
+        self.assertEqual(backoff_delay(0, 5, 300, rand=lambda: 0.0), 0)
+        self.assertEqual(backoff_delay(0, 5, 300, retry_after=12, rand=lambda: 0.1), 12)
+        self.assertEqual(parse_retry_after("7"), 7.0)
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertEqual(retry_after_from_text("Request was throttled. Your rate limit resets in ~5s."), 5.0)
+
+
+class TestPausedScheduler(unittest.TestCase):
+    def test_probe_then_paced_release(self):
+        from app.services.paused_scheduler import PausedScheduler
+
+        now = [1000.0]
+        scheduler = PausedScheduler(release_per_second=2, probe_timeout=900, clock=lambda: now[0])
+        pro, flash = ("bananalab", "nano-banana-pro"), ("bananalab", "nano-banana")
+        for generation_id in (1, 2, 3):
+            scheduler.add({"generation_id": generation_id}, pro, paused_for=30)
+        now[0] += 10
+        scheduler.add({"generation_id": 4}, flash, paused_for=30)
+        self.assertEqual(scheduler.pop_ready(), (None, 20.0))
+
+        # Срок паузы наступил: одна проба на модель, генерации остаются в очереди
+        now[0] += 20
+        (target, item, probe), _ = scheduler.pop_ready()
+        self.assertEqual((target, item["generation_id"], probe), (pro, 1, True))
+        self.assertEqual(scheduler.pop_ready(), (None, 10.0))
+        self.assertEqual(len(scheduler), 4)
+
+        scheduler.mark_available(pro)
+        released = [scheduler.pop_ready()[0][1]["generation_id"]]
+        self.assertEqual(scheduler.pop_ready(), (None, 0.5))
+        now[0] += 0.5
+        released.append(scheduler.pop_ready()[0][1]["generation_id"])
+        self.assertEqual(released, [1, 2])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open_half_open_close(self):
+        from app.services.circuit_breaker import CircuitBreaker
+
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=3, open_seconds=60, clock=lambda: now[0])
+        target = ("replicate", "nano-banana-pro")
+        self.assertFalse(breaker.record(target, failed=True))
+        self.assertFalse(breaker.record(target, failed=True))
+        self.assertTrue(breaker.record(target, failed=True))
+        self.assertFalse(breaker.allow(target))
+        self.assertTrue(breaker.is_open(target))
+
+        # После открытого периода проходит одна пробная генерация
+        now[0] += 60
+        self.assertTrue(breaker.allow(target))
+        self.assertFalse(breaker.allow(target))
+        self.assertTrue(breaker.record(target, failed=True))
+
+        now[0] += 60
+        self.assertTrue(breaker.allow(target))
+        breaker.record(target, failed=False)
+        self.assertTrue(breaker.allow(target))
+        self.assertTrue(breaker.allow(target))
+
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_quantile_after_min_samples(self):
+        from app.services.latency_tracker import LatencyTracker
+
+        tracker = LatencyTracker(min_samples=10, window_size=10)
+        key = ("replicate", "nano-banana-pro", "1K")
+        for seconds in range(1, 10):
+            tracker.record(key, float(seconds))
+        self.assertIsNone(tracker.quantile(key, 0.9))
+        tracker.record(key, 10.0)
+        self.assertEqual(tracker.quantile(key, 0.9), 9.0)
+        self.assertEqual(tracker.quantile(key, 0.5), 5.0)
+
+        # Окно скользящее: старые значения вытесняются
+        for _ in range(10):
+            tracker.record(key, 100.0)
+        self.assertEqual(tracker.quantile(key, 0.5), 100.0)
+        self.assertIsNone(tracker.quantile(("bananalab", "nano-banana-pro", "1K"), 0.9))
+
+
+class TestGenerationFingerprint(unittest.TestCase):
+    def test_same_content_references_match(self):
+        import base64
+        from app.services.generation_fingerprint import generation_fingerprint
+
+        request = {"provider": "replicate", "model_name": "nano-banana-pro", "prompt": "cat", "seed": 7}
+        ref = "data:image/png;base64," + base64.b64encode(b"png-bytes").decode()
+        ref_jpeg_header = "data:image/jpeg;base64," + base64.b64encode(b"png-bytes").decode()
+        self.assertEqual(
+            generation_fingerprint(request, [ref]),
+            generation_fingerprint(request, [ref_jpeg_header]),
+        )
+        self.assertNotEqual(
+            generation_fingerprint(request, [ref]),
+            generation_fingerprint({**request, "seed": 8}, [ref]),
+        )
+        self.assertIsNone(generation_fingerprint({**request, "seed": None}, [ref]))
+
+    def test_result_cache_key_uses_final_prompt(self):
+        from app.services.generation_fingerprint import generation_fingerprint, result_cache_key
+
+        request = {"provider": "replicate", "model_name": "imagen-4", "prompt": "red apple", "seed": 1}
+        self.assertEqual(result_cache_key(request), result_cache_key(dict(request)))
+        self.assertNotEqual(result_cache_key(request), generation_fingerprint(request))
+        self.assertIsNone(result_cache_key({**request, "seed": None}))
+
+
+class TestCancellationToken(unittest.TestCase):
+    def test_registry_cancels_running_generation(self):
+        from app.services.cancellation import CancellationRegistry
+
+        registry = CancellationRegistry()
+        token = registry.register(42)
+        fired = []
+        token.add_callback(lambda: fired.append("poller"))
+        self.assertFalse(registry.cancel(7))
+        self.assertTrue(registry.cancel(42))
+        self.assertTrue(token.is_cancelled)
+        self.assertTrue(token.wait(0))
+        token.add_callback(lambda: fired.append("late"))
+        self.assertEqual(fired, ["poller", "late"])
+        registry.unregister(42, token)
+        self.assertFalse(registry.cancel(42))
+
+
+class ServiceTestCase(unittest.TestCase):
+    """Модули воркера и роутеров создают MinioService() при импорте — бакет в тестах не проверяем."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._minio_patch = mock.patch(
+            "app.services.MinioService.MinioService._ensure_bucket_exists", lambda self: None
+        )
+        cls._minio_patch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._minio_patch.stop()
+
+
+class TestWorkerShutdown(ServiceTestCase):
+    def test_signal_stops_and_drains(self):
+        import asyncio
+        import signal
+        from app import worker
+        from app.config import settings
+
+        drained = []
+
+        async def cleanup_task():
+            # Цикл автоочистки уже запущен — самое время прислать SIGTERM
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.Event().wait()
+
+        def drain(timeout):
+            drained.append(timeout)
+            return 2
+
+        with mock.patch.object(worker.db_service, "create_tables"), mock.patch.object(
+            worker, "start_generation_workers"
+        ) as start, mock.patch.object(worker, "auto_cleanup_task", cleanup_task), mock.patch.object(
+            worker, "drain_generation_workers", drain
+        ):
+            unfinished = asyncio.run(worker.run_worker())
+        start.assert_called_once_with()
+        self.assertEqual(drained, [settings.SHUTDOWN_DRAIN_SECONDS])
+        self.assertEqual(unfinished, 2)
+
+    def test_exit_skips_pool_threads_only_when_unfinished(self):
+        from app import worker
+
+        for unfinished, exits in ((0, []), (3, [0])):
+            async def run_worker():
+                return unfinished
+
+            with mock.patch.object(worker, "setup_logging"), mock.patch.object(
+                worker, "run_worker", run_worker
+            ), mock.patch.object(worker.logging, "shutdown"), mock.patch.object(worker.os, "_exit") as exit_:
+                worker.main()
+            self.assertEqual([call.args[0] for call in exit_.call_args_list], exits)
+
+    def test_api_shutdown_exits_when_jobs_unfinished(self):
+        import asyncio
+        from app import main
+
+        for unfinished, exits in ((0, []), (2, [0])):
+            with mock.patch.object(main.app_settings, "RUN_WORKERS_IN_API", True), mock.patch.object(
+                main, "drain_generation_workers", return_value=unfinished
+            ), mock.patch.object(main.db_service, "dispose_async_engine", mock.AsyncMock()), mock.patch.object(
+                main.logging, "shutdown"
+            ), mock.patch.object(main.os, "_exit") as exit_:
+                asyncio.run(main.shutdown_event())
+            self.assertEqual([call.args[0] for call in exit_.call_args_list], exits)
+
+
+class TestModelProbe(ServiceTestCase):
+    def test_replicate_probe_creates_and_cancels_prediction(self):
+        from types import SimpleNamespace
+        from app.services.ReplicateService import ReplicateService
+
+        service = ReplicateService(api_token="r8_test")
+        service.client = mock.Mock()
+        service.client.models.predictions.create.return_value = SimpleNamespace(id="probe-1", status="starting", error=None)
+        self.assertIsNone(service.probe_model("nano-banana-pro"))
+        service.client.predictions.cancel.assert_called_once_with("probe-1")
+        self.assertNotIn("image_input", service.client.models.predictions.create.call_args.kwargs["input"])
+
+        service.client.models.predictions.create.side_effect = RuntimeError("Model is paused")
+        self.assertIn("is paused", service.probe_model("nano-banana-pro"))
+
+    def test_paused_model_reroutes_opted_in_generations(self):
+        from app.services.generation_worker import _reroute_immediately
+
+        request_data = {"api_key": "r8_test", "model_name": "nano-banana-pro", "allow_fallback": True}
+        self.assertTrue(_reroute_immediately(request_data, model_paused=True))
+        self.assertFalse(_reroute_immediately({**request_data, "allow_fallback": False}, model_paused=True))
+        self.assertFalse(_reroute_immediately({**request_data, "api_key": "nb_test"}, model_paused=True))
+
+
+class TestCrossProviderHedging(ServiceTestCase):
+    def test_plan_requires_explicit_cross_provider_setting(self):
+        from app.services import generation_worker
+        from app.services.latency_tracker import LatencyTracker
+
+        tracker = LatencyTracker(min_samples=1)
+        for provider in ("replicate", "bananalab"):
+            tracker.record((provider, "nano-banana-pro", "1K"), 30.0)
+
+        def plan(provider, hedge_key, model_name="nano-banana-pro"):
+            context = {"provider": provider, "model_name": model_name}
+            request_data = {"hedge_api_key": hedge_key, "model_name": model_name, "resolution": "1K"}
+            result = generation_worker._hedge_plan(context, request_data)
+            return result and result["provider"]
+
+        settings = generation_worker.settings
+        with mock.patch.object(generation_worker, "generation_latency", tracker):
+            with mock.patch.object(settings, "HEDGING_ENABLED", False):
+                self.assertIsNone(plan("replicate", "r8_hedge"))
+            with mock.patch.object(settings, "HEDGING_ENABLED", True), \
+                    mock.patch.object(settings, "HEDGE_CROSS_PROVIDER", False):
+                self.assertEqual(plan("replicate", "r8_hedge"), "replicate")
+                self.assertIsNone(plan("replicate", "nb_hedge"))
+                self.assertIsNone(plan("bananalab", "r8_hedge"))
+            with mock.patch.object(settings, "HEDGING_ENABLED", True), \
+                    mock.patch.object(settings, "HEDGE_CROSS_PROVIDER", True):
+                self.assertEqual(plan("replicate", "nb_hedge"), "bananalab")
+                self.assertEqual(plan("bananalab", "r8_hedge"), "replicate")
+                self.assertIsNone(plan("bananalab", "nb_hedge"))
+                self.assertIsNone(plan("replicate", "nb_hedge", model_name="missing-model"))
+
+    def race(self, primary, hedge_provider_cls, hedge_provider):
+        from app.services import generation_worker
+        from app.services.cancellation import CancellationToken
+
+        plan = {"provider": hedge_provider, "provider_label": hedge_provider, "api_key": "hedge-key", "delay": 0.05,
+                "target": (hedge_provider, "nano-banana-pro")}
+        context = {"provider": "replicate", "provider_label": "Replicate", "model_name": "nano-banana-pro",
+                   "service": primary}
+        request_data = {"api_key": "r8_main", "model_name": "nano-banana-pro", "result_cache_key": "key"}
+        patched = "BananalabService" if hedge_provider == "bananalab" else "ReplicateService"
+        with mock.patch.object(generation_worker, patched, hedge_provider_cls), \
+                mock.patch.object(generation_worker, "_admit_hedge", return_value=True), \
+                mock.patch.object(generation_worker, "_release_hedge"), \
+                mock.patch.object(generation_worker, "_record_provider_outcome"):
+            result, hedge_won = generation_worker._generate_hedged(
+                1, context, plan, request_data, {}, CancellationToken()
+            )
+        return result, hedge_won, generation_worker._hedge_winner_request(request_data, plan)
+
+    def test_bananalab_hedge_wins_and_primary_prediction_is_cancelled(self):
+        from app.services.cancellation import GenerationCancelled
+
+        class SlowReplicate:
+            cancellation = None
+
+            def generate_image(self, **kwargs):
+                if self.cancellation.wait(5):
+                    raise GenerationCancelled()
+                return {"success": True, "provider": "replicate"}
+
+        class FastBananalab:
+            def __init__(self, api_key):
+                self.api_key = api_key
+
+            def generate_image(self, **kwargs):
+                return {"success": True, "provider": "bananalab"}
+
+        primary = SlowReplicate()
+        result, hedge_won, winner_request = self.race(primary, FastBananalab, "bananalab")
+        self.assertTrue(hedge_won)
+        self.assertEqual(result["provider"], "bananalab")
+        self.assertTrue(primary.cancellation.is_cancelled)
+        # Результат Banana Lab не детерминирован — в кэш Replicate не попадает
+        self.assertEqual(winner_request["api_key"], "hedge-key")
+        self.assertNotIn("result_cache_key", winner_request)
+
+    def test_losing_bananalab_hedge_result_is_discarded(self):
+        import threading
+        from app.services.cancellation import GenerationCancelled
+
+        hedge_started = threading.Event()
+        hedges = []
+
+        class Replicate:
+            cancellation = None
+
+            def generate_image(self, **kwargs):
+                hedge_started.wait(5)
+                return {"success": True, "provider": "replicate"}
+
+        class SlowBananalab:
+            def __init__(self, api_key):
+                hedges.append(self)
+
+            def generate_image(self, **kwargs):
+                hedge_started.set()
+                # Задача Banana Lab у провайдера продолжается — перестаём только ждать её
+                if self.cancellation.wait(5):
+                    raise GenerationCancelled()
+                return {"success": True, "provider": "bananalab"}
+
+        result, hedge_won, _ = self.race(Replicate(), SlowBananalab, "bananalab")
+        self.assertFalse(hedge_won)
+        self.assertEqual(result["provider"], "replicate")
+        self.assertTrue(hedges[0].cancellation.is_cancelled)
+
+
+class TestAsyncBananalab(unittest.TestCase):
+    def test_shared_loop_runs_coroutines_from_worker_threads(self):
+        import asyncio
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from app.services.async_runtime import AsyncRuntime
+
+        runtime = AsyncRuntime()
+        self.addCleanup(runtime.shutdown)
+
+        async def where(i):
+            await asyncio.sleep(0.01)
+            return i, threading.current_thread().name, asyncio.get_running_loop()
+
+        # Потоки пула отправляют корутины одновременно: loop создаётся один раз и выполняет всё
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: runtime.submit(where(i)).result(5), range(16)))
+        self.assertEqual([i for i, _, _ in results], list(range(16)))
+        self.assertEqual({name for _, name, _ in results}, {"async-runtime"})
+        self.assertEqual({loop for _, _, loop in results}, {runtime.start()})
+
+    def test_generate_polls_job_and_downloads_result(self):
+        import httpx
+        from app.services.async_runtime import async_runtime
+        from app.services.AsyncBananalabService import AsyncBananalabService
+        from app.services.bananalab_poller import BananalabJobPoller
+
+        statuses = iter([{"status": "processing"}, {"status": "done", "result": {"image_url": "https://cdn.test/j1.png"}}])
+        seen = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            seen.append(f"{request.method} {request.url}")
+            if request.method == "POST":
+                return httpx.Response(200, json={"job_id": "j1", "status_url": "/v1/jobs/j1"})
+            if request.url.host == "cdn.test":
+                return httpx.Response(200, content=b"image-bytes")
+            return httpx.Response(200, json=next(statuses))
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.addCleanup(lambda: async_runtime.submit(client.aclose()).result(5))
+        with mock.patch.object(async_runtime, "http_client", lambda: client), mock.patch(
+            "app.services.AsyncBananalabService.bananalab_poller", BananalabJobPoller(interval=0.01)
+        ):
+            service = AsyncBananalabService(api_key="key", base_url="https://bananalab.test")
+            result = async_runtime.submit(service.generate_image("cat")).result(10)
+
+        self.assertTrue(result["success"])
+        self.assertEqual(result["image_data"], b"image-bytes")
+        self.assertEqual(
+            seen,
+            [
+                "POST https://bananalab.test/v1/nb2/text-generations",
+                "GET https://bananalab.test/v1/jobs/j1",
+                "GET https://bananalab.test/v1/jobs/j1",
+                "GET https://cdn.test/j1.png",
+            ],
+        )
+
+
+class TestBananalabPoller(unittest.TestCase):
+    def test_one_pass_resolves_many_jobs(self):
+        import asyncio
+        import httpx
+        from app.services.async_runtime import async_runtime
+        from app.services.bananalab_poller import BananalabJobPoller
+
+        seen, active, peak = [], [0], [0]
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            seen.append(request.url.path)
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.02)
+            active[0] -= 1
+            job_id = request.url.path.rsplit("/", 1)[-1]
+            return httpx.Response(200, json={"status": "done", "result": {"image_url": f"https://cdn.test/{job_id}.png"}})
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.addCleanup(lambda: async_runtime.submit(client.aclose()).result(5))
+        job_ids = [f"j{i}" for i in range(5)]
+
+        # Все задачи созрели к одному проходу поллера; max_in_flight ограничивает одновременные GET
+        for max_in_flight, expected_peak in ((10, 5), (2, 2)):
+            seen.clear()
+            peak[0] = 0
+            poller = BananalabJobPoller(interval=0.01, max_in_flight=max_in_flight)
+
+            async def wait_all():
+                return await asyncio.gather(
+                    *(
+                        poller.wait(f"https://bananalab.test/v1/jobs/{job_id}", {}, {"job_id": job_id, "status": "queued"}, 30)
+                        for job_id in job_ids
+                    )
+                )
+
+            with mock.patch.object(async_runtime, "http_client", lambda: client):
+                results = async_runtime.submit(wait_all()).result(10)
+            self.assertEqual(
+                [result["result"]["image_url"] for result in results], [f"https://cdn.test/{job_id}.png" for job_id in job_ids]
+            )
+            self.assertEqual(sorted(seen), [f"/v1/jobs/{job_id}" for job_id in job_ids])
+            self.assertEqual(peak[0], expected_peak)
+            self.assertEqual(poller.pending_count, 0)
+
+    def test_sync_client_parks_created_job(self):
+        from app.services.BananalabService import BananalabService
+
+        def response(json=None, content=b""):
+            return mock.Mock(status_code=200, json=mock.Mock(return_value=json), content=content, text="")
+
+        service = BananalabService(api_key="key", base_url="https://bananalab.test")
+        service.park_jobs = True
+        service.provider_job_callback = mock.Mock()
+        with mock.patch(
+            "app.services.BananalabService.requests.post",
+            return_value=response({"job_id": "j1", "status_url": "/v1/jobs/j1"}),
+        ):
+            parked = service.generate_image("cat")
+        handle = {"provider": "bananalab", "job_id": "j1", "status_url": "https://bananalab.test/v1/jobs/j1"}
+        self.assertEqual((parked["parked"], parked["provider_job"]), (True, handle))
+        # Хэндл сохраняет воркер вместе с парковкой; поток не ждёт поллер
+        service.provider_job_callback.assert_not_called()
+
+        statuses = [
+            response({"status": "processing"}),
+            response({"status": "done", "result": {"image_url": "https://cdn.test/j1.png"}}),
+            response(content=b"image-bytes"),
+        ]
+        with mock.patch("app.services.BananalabService.requests.get", side_effect=statuses):
+            self.assertIsNone(service.check_job(handle))
+            result = service.check_job(handle)
+        self.assertTrue(result["success"])
+        self.assertEqual(result["image_data"], b"image-bytes")
+
+
+class TestGenerationEvents(ServiceTestCase):
+    def test_bus_fans_out_per_user_and_unsubscribes(self):
+        import asyncio
+        from app.services.generation_events import GenerationEventBus
+
+        bus = GenerationEventBus()
+
+        async def scenario():
+            first, second, other = bus.subscribe(1), bus.subscribe(1), bus.subscribe(2)
+            bus.publish({"id": 10, "user_id": 1, "status": "completed"})
+            # Дельты приходят и из потоков воркера (LISTEN-соединение, after_flush)
+            await asyncio.to_thread(bus.publish, {"id": 11, "user_id": 2, "status": "failed"})
+            received = [(await asyncio.wait_for(queue.get(), 1))["id"] for queue in (first, second, other)]
+
+            bus.unsubscribe(1, first)
+            bus.publish({"id": 12, "user_id": 1, "status": "running"})
+            received.append((await asyncio.wait_for(second.get(), 1))["id"])
+            self.assertTrue(first.empty())
+            bus.unsubscribe(1, second)
+            bus.unsubscribe(2, other)
+            return received
+
+        self.assertEqual(asyncio.run(scenario()), [10, 10, 11, 12])
+        self.assertEqual(bus._subscribers, {})
+
+    def test_events_stream_accepts_query_token(self):
+        import asyncio
+        from fastapi.testclient import TestClient
+        from starlette.requests import Request
+        from app.main import app
+        from app.routers.images import generation_events_stream
+        from app.services.AuthService import auth_service
+        from app.services.generation_events import generation_events
+
+        client = TestClient(app)
+        self.assertEqual(client.get("/api/v1/images/events").status_code, 401)
+        self.assertEqual(client.get("/api/v1/images/events", params={"token": "not-a-jwt"}).status_code, 401)
+
+        user_id = 10 ** 9 + os.getpid()
+        token = auth_service.create_token(
+            {"sub": "sse", "user_id": user_id, "email": "sse@example.com", "is_active": True, "is_admin": False}
+        )
+        # EventSource не передаёт заголовки: пользователь берётся из ?token=
+        user = asyncio.run(auth_service.get_current_user_from_query(token=token, credentials=None))
+        self.assertEqual(user.user_id, user_id)
+
+        disconnected = []
+
+        async def receive():
+            if disconnected:
+                return {"type": "http.disconnect"}
+            await asyncio.sleep(3600)
+
+        async def scenario():
+            request = Request({"type": "http", "method": "GET", "headers": [], "query_string": b""}, receive)
+            body = (await generation_events_stream(request, user)).body_iterator
+            chunks = [await body.__anext__()]
+            generation_events.publish({"id": 5, "user_id": user_id, "status": "completed", "result_url": "u"})
+            chunks.append(await asyncio.wait_for(body.__anext__(), 5))
+            disconnected.append(True)
+            with self.assertRaises(StopAsyncIteration):
+                await body.__anext__()
+            return chunks
+
+        retry, event = asyncio.run(scenario())
+        self.assertEqual(retry, "retry: 5000\n\n")
+        self.assertTrue(event.startswith("event: generation\ndata: "))
+        self.assertIn('"status": "completed"', event)
+        # Закрытое соединение отписалось от шины
+        self.assertNotIn(user_id, generation_events._subscribers)
+
+
+@unittest.skipUnless(os.environ.get("TEST_POSTGRES"), "нужна тестовая БД Postgres (TEST_POSTGRES=1)")
+class PostgresTestCase(ServiceTestCase):
+    """Проверки на Postgres: пользователи теста создаются в setUp и удаляются с генерациями в tearDown."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import app.models.base  # noqa: F401 — регистрирует таблицы
+        from app.services.DBService import db_service
+
+        db_service.create_tables()
+
+    def setUp(self):
+        self.tag = uuid.uuid4().hex[:12]
+        # Уникальный провайдер изолирует задачи теста: claim(providers=...) не видит чужих
+        self.provider = f"test-{self.tag}"
+        self.user_ids = []
+
+    def tearDown(self):
+        from app.models.base import Generation, User
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            session.query(Generation).filter(Generation.user_id.in_(self.user_ids)).delete(synchronize_session=False)
+            session.query(User).filter(User.id.in_(self.user_ids)).delete(synchronize_session=False)
+            session.commit()
+
+    def create_user(self) -> int:
+        from app.models.base import User
+        from app.services.DBService import db_service
+
+        name = f"test-{self.tag}-{len(self.user_ids)}"
+        with db_service.get_session() as session:
+            user = User(username=name, email=f"{name}@example.com", hashed_password="x")
+            session.add(user)
+            session.commit()
+            self.user_ids.append(user.id)
+            return user.id
+
+    def create_generation(self, user_id: int, **fields) -> int:
+        from app.models.base import Generation
+        from app.services.DBService import db_service
+
+        values = {"prompt": "test", "generation_mode": "text-to-image", "status": "pending", **fields}
+        with db_service.get_session() as session:
+            generation = Generation(user_id=user_id, **values)
+            session.add(generation)
+            session.commit()
+            return generation.id
+
+    def job_row(self, generation_id: int):
+        from app.models.base import GenerationJob
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            job = session.query(GenerationJob).filter(GenerationJob.generation_id == generation_id).one()
+            return job.status, job.attempts, job.lease_owner
+
+    def expire_lease(self, generation_id: int):
+        from app.models.base import GenerationJob
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            session.query(GenerationJob).filter(GenerationJob.generation_id == generation_id).update(
+                {"lease_expires_at": datetime.utcnow() - timedelta(seconds=1)}, synchronize_session=False
+            )
+            session.commit()
+
+
+class TestModelAvailability(PostgresTestCase):
+    def tearDown(self):
+        from app.models.base import ModelAvailability
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            session.query(ModelAvailability).filter(ModelAvailability.model_name == self.provider).delete()
+            session.commit()
+        super().tearDown()
+
+    def expire_pause(self, target):
+        from app.models.base import ModelAvailability
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            session.query(ModelAvailability).filter(
+                ModelAvailability.provider == target[0], ModelAvailability.model_name == target[1]
+            ).update({"paused_until": datetime.utcnow() - timedelta(seconds=1)})
+            session.commit()
+
+    def test_replicate_probe_decides_without_requeueing_generation(self):
+        from app.services import generation_worker
+        from app.services.ModelAvailabilityService import model_availability
+
+        target = ("replicate", self.provider)
+        item = {"generation_id": 1, "user_id": 1, "request_data": {"api_key": "r8_test", "model_name": self.provider}}
+        model_availability.record_paused(*target, error="Model is paused")
+
+        outcomes = ["Model is paused", None]
+        with mock.patch.object(generation_worker, "_probe_replicate_model", side_effect=lambda *a: outcomes.pop(0)) as probe, \
+                mock.patch.object(generation_worker, "submit_generation_job") as submit, \
+                mock.patch.object(generation_worker, "paused_queue") as queue:
+            # Срок не наступил — пробы нет
+            generation_worker._check_model_availability(target, item)
+            probe.assert_not_called()
+
+            self.expire_pause(target)
+            generation_worker._check_model_availability(target, item)
+            self.assertIsNotNone(model_availability.paused_for(*target))
+            queue.mark_paused.assert_called()
+
+            self.expire_pause(target)
+            generation_worker._check_model_availability(target, item)
+            self.assertIsNone(model_availability.paused_for(*target))
+            queue.mark_available.assert_called_once_with(target)
+
+        self.assertEqual(probe.call_count, 2)
+        # Пробой служит отдельный запрос: paused-генерация в очередь не возвращается
+        submit.assert_not_called()
+        queue.remove.assert_not_called()
+
+
+class TestJobQueue(PostgresTestCase):
+    def enqueued(self, queue, count: int = 1):
+        user_id = self.create_user()
+        generation_ids = [self.create_generation(user_id) for _ in range(count)]
+        for generation_id in generation_ids:
+            queue.enqueue(generation_id, user_id, {"prompt": "test"}, provider=self.provider, model_name="m")
+        return generation_ids
+
+    def test_claim_skips_locked_rows(self):
+        from app.models.base import GenerationJob
+        from app.services.DBService import db_service
+        from app.services.JobQueueService import JobQueueService
+
+        queue = JobQueueService()
+        locked_id, free_id = self.enqueued(queue, 2)
+        with db_service.get_session() as session:
+            # Строку держит другой воркер: claim не ждёт блокировку, а берёт следующую
+            session.query(GenerationJob).filter(GenerationJob.generation_id == locked_id).with_for_update().one()
+            claimed = queue.claim("w1", limit=10, providers=(self.provider,))
+            session.rollback()
+        self.assertEqual([job["generation_id"] for job in claimed], [free_id])
+        self.assertEqual(self.job_row(locked_id), ("queued", 0, None))
+
+    def test_expired_lease_is_reclaimed(self):
+        from app.services.JobQueueService import JobQueueService
+
+        queue = JobQueueService(max_attempts=2)
+        generation_id, = self.enqueued(queue)
+        first, = queue.claim("w1", providers=(self.provider,))
+        self.assertEqual(queue.claim("w2", providers=(self.provider,)), [])
+
+        self.expire_lease(generation_id)
+        second, = queue.claim("w2", providers=(self.provider,))
+        self.assertEqual(second["job_id"], first["job_id"])
+        self.assertEqual(self.job_row(generation_id), ("leased", 2, "w2"))
+        # Упавший воркер больше не может завершить задачу
+        self.assertFalse(queue.complete(first["job_id"], "w1"))
+
+        # Исчерпанные попытки: задача и генерация помечаются failed
+        self.expire_lease(generation_id)
+        self.assertEqual(queue.claim("w3", providers=(self.provider,)), [])
+        self.assertEqual(self.job_row(generation_id)[0], "failed")
+
+    def test_release_does_not_spend_attempt(self):
+        from app.services.JobQueueService import JobQueueService
+
+        queue = JobQueueService()
+        generation_id, = self.enqueued(queue)
+        job, = queue.claim("w1", providers=(self.provider,))
+        self.assertEqual(job["attempts"], 1)
+        self.assertTrue(queue.release(job["job_id"], "w1"))
+        self.assertEqual(self.job_row(generation_id), ("queued", 0, None))
+        job, = queue.claim("w1", providers=(self.provider,))
+        self.assertEqual(job["attempts"], 1)
+
+    def test_park_and_take_waiting(self):
+        from app.services.JobQueueService import JobQueueService
+
+        queue = JobQueueService()
+        generation_id, = self.enqueued(queue)
+        job, = queue.claim("w1", providers=(self.provider,))
+        payload = {**job["request_data"], "provider_job": {"provider": "replicate", "id": "p1"}}
+        self.assertTrue(queue.park(generation_id, "w1", payload, delay_seconds=60))
+        self.assertEqual(self.job_row(generation_id), ("waiting", 1, None))
+        self.assertEqual(queue.claim("w1", providers=(self.provider,)), [])
+
+        taken = queue.take_waiting(generation_id, "w2")
+        self.assertEqual(taken["request_data"]["provider_job"]["id"], "p1")
+        self.assertEqual(self.job_row(generation_id), ("leased", 1, "w2"))
+        self.assertIsNone(queue.take_waiting(generation_id, "w2"))
+
+        # Опрос запаркованной задачи из очереди не считается новой попыткой
+        self.assertTrue(queue.park(generation_id, "w2", payload, delay_seconds=0))
+        job, = queue.claim("w1", providers=(self.provider,))
+        self.assertEqual(job["attempts"], 1)
+
+
+class TestFairShareQueue(PostgresTestCase):
+    def enqueue_for(self, queue, user_id: int, count: int, weight: float = 1.0):
+        generation_ids = [self.create_generation(user_id) for _ in range(count)]
+        for generation_id in generation_ids:
+            queue.enqueue(generation_id, user_id, {"prompt": "test"}, provider=self.provider, weight=weight)
+        return generation_ids
+
+    def fair_queue(self):
+        from app.services.JobQueueService import JobQueueService
+
+        queue = JobQueueService()
+        queue.fair_share = True
+        return queue
+
+    def test_users_interleave_by_virtual_time(self):
+        queue = self.fair_queue()
+        heavy, light = self.create_user(), self.create_user()
+        h1, h2, h3 = self.enqueue_for(queue, heavy, 3)
+        l1, = self.enqueue_for(queue, light, 1)
+        claimed = queue.claim("w1", limit=4, providers=(self.provider,))
+        # Пачка пользователя не задерживает чужую задачу дольше, чем на одну свою
+        self.assertEqual([job["generation_id"] for job in claimed], [h1, l1, h2, h3])
+
+    def test_in_flight_weight_and_waiting_first(self):
+        queue = self.fair_queue()
+        busy, polling, admin = self.create_user(), self.create_user(), self.create_user()
+        b1, b2 = self.enqueue_for(queue, busy, 2)
+        running, = queue.claim("w1", providers=(self.provider,))
+        self.assertEqual(running["generation_id"], b1)
+        # У busy задача в работе: b2 получает (1 + 1) / 1 = 2, новая задача polling — 1
+        p1, = self.enqueue_for(queue, polling, 1)
+        job, = queue.claim("w1", providers=(self.provider,))
+        self.assertEqual(job["generation_id"], p1)
+        self.assertTrue(queue.park(p1, "w1", {"prompt": "test"}, delay_seconds=0))
+        # Вес 2 (админ): (0 + 1) / 2 и (0 + 2) / 2
+        a1, a2 = self.enqueue_for(queue, admin, 2, weight=2.0)
+
+        claimed = queue.claim("w1", limit=4, providers=(self.provider,))
+        # Опрос запаркованной задачи идёт первым
+        self.assertEqual([job["generation_id"] for job in claimed], [p1, a1, a2, b2])
+
+
+class TestReplicateWebhook(PostgresTestCase):
+    def test_parked_prediction_is_finalized_from_webhook(self):
+        import asyncio
+        import json
+        from fastapi import BackgroundTasks, HTTPException
+        from starlette.requests import Request
+        from app.config import settings
+        from app.routers.images import replicate_webhook
+        from app.services import generation_worker
+        from app.services.JobQueueService import JobQueueService
+
+        class FakeReplicate:
+            TIMEOUT = 600
+            created = []
+
+            def __init__(self, api_token=None):
+                pass
+
+            def create_prediction(self, **kwargs):
+                self.created.append(kwargs)
+                return {"success": True, "prediction_id": "prediction-1"}
+
+            def prediction_result(self, prediction):
+                return {"success": True} if prediction["status"] == "succeeded" else None
+
+        def webhook(token, prediction):
+            async def receive():
+                return {"type": "http.request", "body": json.dumps(prediction).encode(), "more_body": False}
+
+            tasks = BackgroundTasks()
+            request = Request({"type": "http", "method": "POST", "headers": [], "query_string": b""}, receive)
+            response = asyncio.run(replicate_webhook(request, tasks, generation_id, token))
+            asyncio.run(tasks())
+            return response
+
+        queue = JobQueueService()
+        user_id = self.create_user()
+        generation_id = self.create_generation(user_id)
+        queue.enqueue(generation_id, user_id, {"prompt": "test", "api_key": "r8_test"}, provider=self.provider)
+        job, = queue.claim(generation_worker.WORKER_ID, providers=(self.provider,))
+
+        finalized = []
+        with mock.patch.object(generation_worker, "ReplicateService", FakeReplicate), mock.patch.object(
+            generation_worker, "_finalize_generation", lambda *args: finalized.append(args)
+        ), mock.patch.multiple(settings, REPLICATE_ASYNC_PREDICTIONS=True, PUBLIC_API_URL="https://api.test"):
+            generation_worker.process_generation_async(generation_id, user_id, job["request_data"])
+            # Поток освобождён сразу: задача ждёт webhook, prediction создан с подписанным адресом
+            self.assertEqual(self.job_row(generation_id), ("waiting", 1, None))
+            token = generation_worker.replicate_webhook_token(generation_id)
+            self.assertIn(f"generation_id={generation_id}&token={token}", FakeReplicate.created[0]["webhook_url"])
+
+            prediction = {"id": "prediction-1", "status": "succeeded"}
+            with self.assertRaises(HTTPException) as denied:
+                webhook("forged", prediction)
+            self.assertEqual(denied.exception.status_code, 403)
+            self.assertEqual(self.job_row(generation_id)[0], "waiting")
+
+            self.assertEqual(webhook(token, prediction), {"status": "accepted"})
+
+        (finalized_id, finalized_user, request_data, result, _), = finalized
+        self.assertEqual((finalized_id, finalized_user, result), (generation_id, user_id, {"success": True}))
+        self.assertNotIn("provider_job", request_data)
+        self.assertEqual(self.job_row(generation_id)[0], "done")
+
+
+class TestProviderJobResume(PostgresTestCase):
+    def test_reclaimed_job_resumes_provider_prediction(self):
+        from app.services import generation_worker
+        from app.services.JobQueueService import JobQueueService
+
+        class FakeReplicate:
+            TIMEOUT = 600
+            created = []
+            polled = []
+
+            def __init__(self, api_token=None):
+                pass
+
+            def create_prediction(self, **kwargs):
+                self.created.append(kwargs)
+
+            def get_prediction(self, prediction_id):
+                self.polled.append(prediction_id)
+                status = "processing" if len(self.polled) == 1 else "succeeded"
+                return {"id": prediction_id, "status": status}
+
+            def prediction_result(self, prediction):
+                return {"success": True} if prediction["status"] == "succeeded" else None
+
+        queue = JobQueueService()
+        user_id = self.create_user()
+        generation_id = self.create_generation(user_id)
+        queue.enqueue(generation_id, user_id, {"prompt": "test", "api_key": "r8_test"}, provider=self.provider)
+        crashed, = queue.claim("crashed-worker", providers=(self.provider,))
+        started_at = datetime.utcnow() - timedelta(seconds=30)
+        handle = {"provider": "replicate", "id": "prediction-1", "started_at": started_at.isoformat()}
+        self.assertTrue(
+            queue.attach_provider_job(generation_id, "crashed-worker", {**crashed["request_data"], "provider_job": handle})
+        )
+
+        # Воркер упал: после истечения аренды задачу забирает другой вместе с хэндлом prediction
+        self.expire_lease(generation_id)
+        worker_id = generation_worker.WORKER_ID
+        job, = queue.claim(worker_id, providers=(self.provider,))
+        self.assertEqual(job["request_data"]["provider_job"], handle)
+
+        finalized = []
+        with mock.patch.object(generation_worker, "ReplicateService", FakeReplicate), mock.patch.object(
+            generation_worker, "_finalize_generation", lambda *args: finalized.append(args)
+        ):
+            generation_worker.resume_provider_job(job)
+            # prediction ещё выполняется — задача запаркована до следующего опроса
+            self.assertEqual(self.job_row(generation_id)[0], "waiting")
+            job = queue.take_waiting(generation_id, worker_id)
+            generation_worker.resume_provider_job(job)
+
+        self.assertEqual(FakeReplicate.created, [])
+        self.assertEqual(FakeReplicate.polled, ["prediction-1", "prediction-1"])
+        (finalized_id, finalized_user, request_data, result, finalized_started_at), = finalized
+        self.assertEqual((finalized_id, finalized_user, result), (generation_id, user_id, {"success": True}))
+        self.assertNotIn("provider_job", request_data)
+        # Длительность считается от создания prediction, а не от перезапуска
+        self.assertEqual(finalized_started_at, started_at)
+
+    def test_parked_bananalab_job_is_polled_from_queue(self):
+        from app.services import generation_worker
+        from app.services.JobQueueService import JobQueueService
+
+        queue = JobQueueService()
+        user_id = self.create_user()
+        generation_id = self.create_generation(user_id)
+        queue.enqueue(generation_id, user_id, {"prompt": "test", "api_key": "nb_test"}, provider=self.provider)
+        worker_id = generation_worker.WORKER_ID
+        job, = queue.claim(worker_id, providers=(self.provider,))
+        started_at = datetime.utcnow() - timedelta(seconds=30)
+        handle = {"provider": "bananalab", "job_id": "j1", "status_url": "https://bananalab.test/v1/jobs/j1"}
+        generation_worker._park_bananalab_job(generation_id, job["request_data"], handle, started_at)
+        self.assertEqual(self.job_row(generation_id), ("waiting", 1, None))
+
+        checks = iter([None, {"success": True}])
+        finalized = []
+        with mock.patch.object(
+            generation_worker.BananalabService, "check_job", lambda service, provider_job: next(checks)
+        ), mock.patch.object(generation_worker, "_finalize_generation", lambda *args: finalized.append(args)):
+            generation_worker.resume_provider_job(queue.take_waiting(generation_id, worker_id))
+            # Задача ещё выполняется — снова запаркована, поток свободен
+            self.assertEqual(self.job_row(generation_id)[0], "waiting")
+            generation_worker.resume_provider_job(queue.take_waiting(generation_id, worker_id))
+
+        (finalized_id, _, request_data, result, finalized_started_at), = finalized
+        self.assertEqual((finalized_id, result, finalized_started_at), (generation_id, {"success": True}, started_at))
+        self.assertNotIn("provider_job", request_data)
+
+
+class TestGracefulDrain(PostgresTestCase):
+    def test_drain_releases_running_jobs_and_fails_readiness(self):
+        import asyncio
+        import json
+        from concurrent.futures import ThreadPoolExecutor
+        from app.main import health_ready
+        from app.services import generation_worker
+        from app.services.JobQueueService import JobQueueService
+
+        queue = JobQueueService()
+        user_id = self.create_user()
+        generation_id = self.create_generation(user_id)
+        queue.enqueue(generation_id, user_id, {"prompt": "test"}, provider=self.provider)
+        job, = queue.claim(generation_worker.WORKER_ID, providers=(self.provider,))
+        self.assertEqual(asyncio.run(health_ready()), {"status": "ready"})
+
+        self.addCleanup(generation_worker.draining.clear)
+        self.addCleanup(generation_worker.active_jobs.pop, job["job_id"], None)
+        generation_worker.active_jobs[job["job_id"]] = job
+        # drain останавливает пул процесса — подменяем его, чтобы не трогать общий
+        with mock.patch.object(generation_worker, "executor", ThreadPoolExecutor(max_workers=1)):
+            not_finished = generation_worker.drain_generation_workers(0)
+
+        self.assertEqual(not_finished, 1)
+        # Незавершённая генерация вернулась в очередь без траты попытки
+        self.assertEqual(self.job_row(generation_id), ("queued", 0, None))
+        response = asyncio.run(health_ready())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.body), {"status": "draining"})
+
+    def test_released_job_thread_does_not_finalize(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from app.services import generation_worker
+        from app.services.JobQueueService import JobQueueService
+        from app.services.cancellation import GenerationCancelled
+
+        waiting = threading.Event()
+
+        class SlowProvider:
+            def __init__(self, cancellation):
+                self.cancellation = cancellation
+
+            def generate_image(self, **kwargs):
+                waiting.set()
+                if self.cancellation.wait(10):
+                    raise GenerationCancelled()
+                return {"success": True}
+
+        def prepare(generation_id, user_id, request_data, cancellation=None, on_provider_job=None):
+            return {"provider": "test", "provider_label": "Test", "model_name": "m", "service": SlowProvider(cancellation)}
+
+        queue = JobQueueService()
+        user_id = self.create_user()
+        generation_id = self.create_generation(user_id)
+        queue.enqueue(generation_id, user_id, {"prompt": "test"}, provider=self.provider)
+        job, = queue.claim(generation_worker.WORKER_ID, providers=(self.provider,))
+
+        self.addCleanup(generation_worker.draining.clear)
+        self.addCleanup(generation_worker.active_jobs.pop, job["job_id"], None)
+        generation_worker.active_jobs[job["job_id"]] = job
+        with mock.patch.object(generation_worker, "_prepare_generation", prepare), \
+                mock.patch.object(generation_worker, "_hedge_plan", return_value=None), \
+                mock.patch.object(generation_worker, "_finalize_generation") as finalize, \
+                mock.patch.object(generation_worker, "_fail_on_provider_exception") as fail, \
+                mock.patch.object(generation_worker, "_handle_generation_exception") as handle:
+            thread = threading.Thread(
+                target=generation_worker.process_generation_async, args=(generation_id, user_id, job["request_data"])
+            )
+            thread.start()
+            self.assertTrue(waiting.wait(5))
+            with mock.patch.object(generation_worker, "executor", ThreadPoolExecutor(max_workers=1)):
+                self.assertEqual(generation_worker.drain_generation_workers(0), 1)
+            # Поток прерван токеном отмены и выходит, не завершая генерацию, которую заберёт другой воркер
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        finalize.assert_not_called()
+        fail.assert_not_called()
+        handle.assert_not_called()
+        self.assertEqual(self.job_row(generation_id), ("queued", 0, None))
+
+
+class TestListCursor(PostgresTestCase):
+    def test_keyset_cursor_round_trip(self):
+        import asyncio
+        import json
+        from starlette.requests import Request
+        from app.models.token import TokenPayload
+        from app.routers.images import _decode_list_cursor, _encode_list_cursor, list_generations
+        from app.services.DBService import db_service
+
+        user_id = self.create_user()
+        base = datetime(2024, 1, 1, 12, 0, 0, 123456)
+        # Две генерации с одинаковым created_at: порядок между ними решает id
+        created = [base, base, base + timedelta(seconds=1), base + timedelta(seconds=2), base + timedelta(seconds=3)]
+        generation_ids = [self.create_generation(user_id, created_at=created_at) for created_at in created]
+        expected = [generation_id for _, generation_id in sorted(zip(created, generation_ids), reverse=True)]
+        self.assertEqual(_decode_list_cursor(_encode_list_cursor(base, 42)), (base, 42))
+        self.assertIsNone(_decode_list_cursor("not-a-cursor"))
+
+        user = TokenPayload(username="test", user_id=user_id, email="test@example.com", is_active=True, is_admin=False)
+
+        async def pages():
+            seen, cursor = [], None
+            try:
+                while True:
+                    query = "limit=2" + (f"&cursor={cursor}" if cursor else "")
+                    request = Request({"type": "http", "query_string": query.encode(), "headers": []})
+                    body = json.loads((await list_generations(request, user)).body)
+                    seen.append([generation["id"] for generation in body["generations"]])
+                    cursor = body["meta"]["next_cursor"]
+                    if cursor is None:
+                        return seen
+            finally:
+                await db_service.dispose_async_engine()
+
+        seen = asyncio.run(pages())
+        self.assertEqual([len(page) for page in seen], [2, 2, 1])
+        self.assertEqual([generation_id for page in seen for generation_id in page], expected)
+
+
+class TestAsyncSession(PostgresTestCase):
+    def test_auth_and_read_endpoints_on_async_engine(self):
+        import asyncio
+        import json
+        from fastapi.security import HTTPAuthorizationCredentials
+        from starlette.requests import Request
+        from app.models.schemas import UserCreateRequest, UserLoginRequest
+        from app.routers.auth import get_current_user_info, login, register
+        from app.routers.images import list_generations
+        from app.services.AuthService import auth_service
+        from app.services.DBService import db_service
+
+        name = f"test-{self.tag}-async"
+        email = f"{name}@example.com"
+
+        async def scenario():
+            try:
+                tokens = await register(UserCreateRequest(username=name, email=email, password="secret-pass"))
+                user = await auth_service.get_current_user(
+                    HTTPAuthorizationCredentials(scheme="Bearer", credentials=tokens.access_token)
+                )
+                self.user_ids.append(user.user_id)
+                me = await get_current_user_info(user)
+                relogin = await login(UserLoginRequest(username_or_email=email, password="secret-pass"))
+                request = Request({"type": "http", "query_string": b"limit=5", "headers": []})
+                listed = json.loads((await list_generations(request, user)).body)
+                return user, me, relogin, listed
+            finally:
+                await db_service.dispose_async_engine()
+
+        user, me, relogin, listed = asyncio.run(scenario())
+        self.assertEqual((me.id, me.username, me.email), (user.user_id, name, email))
+        self.assertEqual(auth_service.decode_token(relogin.access_token).user_id, user.user_id)
+        self.assertEqual(listed["generations"], [])
+        self.assertIsNone(listed["meta"]["next_cursor"])
+
+class TestGenerationBatch(PostgresTestCase):
+    def test_batch_creates_group_and_respects_limit(self):
+        import asyncio
+        from unittest import mock
+        from fastapi import HTTPException
+        from app.config import settings
+        from app.models.base import Generation
+        from app.models.schemas import GenerationVariation, ImageBatchGenerationRequest
+        from app.models.token import TokenPayload
+        from app.routers import images
+        from app.routers.images import generate_image_batch, get_generation_group
+        from app.services.DBService import db_service
+
+        count_active = images._active_generation_count
+
+        async def slow_count(session, user_id):
+            # Окно между подсчётом и INSERT, в которое без блокировки успевает второй батч
+            active = await count_active(session, user_id)
+            await asyncio.sleep(0.2)
+            return active
+
+        user_id = self.create_user()
+        user = TokenPayload(username="test", user_id=user_id, email="test@example.com", is_active=True, is_admin=False)
+
+        def batch(*seeds):
+            return ImageBatchGenerationRequest(
+                prompt="test", api_key="r8_test", variations=[GenerationVariation(seed=seed) for seed in seeds]
+            )
+
+        async def scenario():
+            try:
+                created = await generate_image_batch(batch(1, 2), user)
+                group = await get_generation_group(created.group_id, user)
+                # Два параллельных батча по 2 варианта при двух свободных слотах: проходит только один
+                results = await asyncio.gather(
+                    generate_image_batch(batch(3, 4), user),
+                    generate_image_batch(batch(5, 6), user),
+                    return_exceptions=True,
+                )
+                with self.assertRaises(HTTPException) as missing:
+                    await get_generation_group("missing", user)
+                return created, group, results, missing.exception
+            finally:
+                await db_service.dispose_async_engine()
+
+        with mock.patch.object(settings, "MAX_CONCURRENT_GENERATIONS", 4), \
+                mock.patch("app.routers.images._active_generation_count", slow_count), \
+                mock.patch("app.routers.images.submit_generation_group") as submit:
+            created, group, results, missing = asyncio.run(scenario())
+
+        self.assertEqual(len(created.image_ids), 2)
+        self.assertEqual([job[0] for job in submit.call_args_list[0].args[1]], created.image_ids)
+        self.assertEqual(group["total"], 2)
+        self.assertEqual(group["counts"], {"pending": 2})
+        self.assertEqual([row["id"] for row in group["generations"]], created.image_ids)
+        self.assertEqual([row["seed"] for row in group["generations"]], [1, 2])
+        rejected = [result for result in results if isinstance(result, HTTPException)]
+        self.assertEqual([error.status_code for error in rejected], [429])
+        self.assertEqual(missing.status_code, 404)
+        with db_service.get_session() as session:
+            self.assertEqual(session.query(Generation).filter(Generation.user_id == user_id).count(), 4)
+
+class TestDeleteGeneration(PostgresTestCase):
+    def test_delete_cancels_running_generation_first(self):
+        import asyncio
+        from unittest import mock
+        from app.models.base import Generation, GenerationJob
+        from app.models.token import TokenPayload
+        from app.routers.images import delete_generation
+        from app.services.DBService import db_service
+        from app.services.JobQueueService import job_queue
+        from app.services.cancellation import cancellation_registry
+        from app.services.generation_events import generation_events, start_generation_event_listener
+        from app.services.generation_worker import _on_generation_status
+
+        user_id = self.create_user()
+        user = TokenPayload(username="test", user_id=user_id, email="test@example.com", is_active=True, is_admin=False)
+        probe_id = self.create_generation(user_id)
+        generation_id = self.create_generation(user_id, status="running")
+        job_queue.enqueue(generation_id, user_id, {"prompt": "test", "api_key": "r8_test"}, provider=self.provider)
+        job, = job_queue.claim("test-worker", providers=(self.provider,))
+        handle = {"provider": "replicate", "id": "prediction-1"}
+        job_queue.attach_provider_job(generation_id, "test-worker", {**job["request_data"], "provider_job": handle})
+        token = cancellation_registry.register(generation_id)
+
+        def set_status(status: str):
+            with db_service.get_session() as session:
+                session.query(Generation).filter(Generation.id == probe_id).one().status = status
+                session.commit()
+
+        async def scenario():
+            queue = generation_events.subscribe(user_id)
+            try:
+                start_generation_event_listener()
+                # Ждём, пока LISTEN-соединение начнёт получать события
+                for attempt in range(20):
+                    await asyncio.to_thread(set_status, ("running", "pending")[attempt % 2])
+                    try:
+                        await asyncio.wait_for(queue.get(), 0.5)
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+                else:
+                    self.fail("NOTIFY generation_status не дошёл до подписчика")
+                response = await delete_generation(generation_id, user)
+                while True:
+                    event = await asyncio.wait_for(queue.get(), 5)
+                    if event["id"] == generation_id:
+                        return response, event
+            finally:
+                generation_events.unsubscribe(user_id, queue)
+                await db_service.dispose_async_engine()
+
+        try:
+            with mock.patch("app.routers.images.ReplicateService") as replicate:
+                response, event = asyncio.run(scenario())
+            # Событие отмены доходит до воркера, выполняющего генерацию
+            _on_generation_status(event)
+            self.assertTrue(token.is_cancelled)
+        finally:
+            cancellation_registry.unregister(generation_id, token)
+
+        self.assertEqual(response, {"message": "Генерация удалена"})
+        self.assertEqual(event["status"], "cancelled")
+        replicate.assert_called_once_with(api_token="r8_test")
+        replicate.return_value.cancel_prediction.assert_called_once_with("prediction-1")
+        with db_service.get_session() as session:
+            self.assertIsNone(session.get(Generation, generation_id))
+            self.assertEqual(session.query(GenerationJob).filter(GenerationJob.generation_id == generation_id).count(), 0)
+
+
+class TestGenerationReferences(PostgresTestCase):
+    def test_orphaned_references_anti_join(self):
+        from app.config import settings
+        from app.services.DBService import db_service
+        from app.services.retention import _orphaned_reference_paths, record_generation_references
+
+        user_id = self.create_user()
+        first, second, third = (self.create_generation(user_id) for _ in range(3))
+        shared, own = f"references/{self.tag}-shared.png", f"references/{self.tag}-own.png"
+        url = f"http://minio/{settings.MINIO_BUCKET}/"
+        with db_service.get_session() as session:
+            record_generation_references(session, first, [url + shared, url + own, url + own, "data:image/png;base64,AA"])
+            record_generation_references(session, second, [url + shared, "https://example.com/external.png"])
+            session.commit()
+
+            # shared ещё нужен второй генерации — удаляется только own
+            self.assertEqual(_orphaned_reference_paths(session, [first]), [own])
+            self.assertEqual(sorted(_orphaned_reference_paths(session, [first, second])), sorted([shared, own]))
+            self.assertEqual(_orphaned_reference_paths(session, [third]), [])
+
+
+class TestRetentionPurge(PostgresTestCase):
+    def test_purge_resumes_from_storage_checkpoint(self):
+        from app.config import settings
+        from app.models.base import Generation, StorageDeletion
+        from app.services.DBService import db_service
+        from app.services import retention
+        from app.services.retention import purge_expired_generations, record_generation_references
+
+        class FakeMinio:
+            def __init__(self, tag):
+                self.tag = tag
+                self.available = False
+                self.removed = []
+
+            def delete_images(self, paths):
+                if not self.available:
+                    return []
+                removed = [path for path in paths if self.tag in path]
+                self.removed.extend(removed)
+                return removed
+
+        def cleanup():
+            with db_service.get_session() as session:
+                session.query(StorageDeletion).filter(StorageDeletion.object_path.contains(self.tag)).delete(
+                    synchronize_session=False
+                )
+                session.commit()
+
+        self.addCleanup(cleanup)
+        user_id = self.create_user()
+        expired_at = datetime(2000, 1, 1)
+        cutoff = expired_at + timedelta(days=1)
+        results = [f"results/{self.tag}-{i}.png" for i in range(3)]
+        expired = [self.create_generation(user_id, created_at=expired_at, result_path=path) for path in results]
+        fresh = self.create_generation(user_id)
+        shared, own = f"references/{self.tag}-shared.png", f"references/{self.tag}-own.png"
+        url = f"http://minio/{settings.MINIO_BUCKET}/"
+        with db_service.get_session() as session:
+            record_generation_references(session, expired[0], [url + shared, url + own])
+            record_generation_references(session, fresh, [url + shared])
+            session.commit()
+
+        minio = FakeMinio(self.tag)
+        with mock.patch.object(settings, "RETENTION_PURGE_BATCH_SIZE", 2):
+            # MinIO недоступен: строки удалены пачками, пути остаются в storage_deletions
+            batches = []
+            purge_batch = retention._purge_generation_batch
+
+            def counted_batch(*args):
+                batches.append(purge_batch(*args))
+                return batches[-1]
+
+            with mock.patch.object(retention, "_purge_generation_batch", counted_batch):
+                purged, files = purge_expired_generations(minio, cutoff, "TEST")
+            self.assertEqual((purged, files), (3, []))
+            self.assertEqual(batches, [2, 1, 0])
+            with db_service.get_session() as session:
+                pending = session.query(StorageDeletion.object_path).filter(
+                    StorageDeletion.object_path.contains(self.tag)
+                ).all()
+                self.assertEqual(sorted(row.object_path for row in pending), sorted(results + [own]))
+                remaining = session.query(Generation.id).filter(Generation.user_id == user_id).all()
+                self.assertEqual([row.id for row in remaining], [fresh])
+
+            # Следующий запуск сначала дочищает файлы прерванного
+            minio.available = True
+            purged, files = purge_expired_generations(minio, cutoff, "TEST")
+        self.assertEqual(purged, 0)
+        self.assertEqual(sorted(files), sorted(results + [own]))
+        self.assertNotIn(shared, minio.removed)
+
+class TestResultCache(PostgresTestCase):
+    def tearDown(self):
+        from app.models.base import GenerationResultCache
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            session.query(GenerationResultCache).filter(
+                GenerationResultCache.cache_key.like(f"{self.tag}-%")
+            ).delete(synchronize_session=False)
+            session.commit()
+        super().tearDown()
+
+    def add_entry(self, key: str, stored_at, last_used_at=None):
+        from app.models.base import GenerationResultCache
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            session.add(GenerationResultCache(
+                cache_key=f"{self.tag}-{key}",
+                result_path=f"images/{self.tag}-{key}.jpg",
+                result_url=f"http://minio/images/{self.tag}-{key}.jpg",
+                stored_at=stored_at,
+                last_used_at=last_used_at or stored_at,
+                hits=0,
+            ))
+            session.commit()
+
+    def entry(self, key: str):
+        from app.models.base import GenerationResultCache
+        from app.services.DBService import db_service
+
+        with db_service.get_session() as session:
+            row = session.get(GenerationResultCache, f"{self.tag}-{key}")
+            return None if row is None else (row.result_path, row.stored_at, row.hits)
+
+    def test_hit_copies_object_without_extending_entry_lifetime(self):
+        from datetime import datetime, timedelta
+        from app.models.base import Generation
+        from app.services.DBService import db_service
+        from app.services.result_cache import complete_from_cache
+
+        class FakeMinio:
+            def __init__(self):
+                self.copied = []
+                self.missing = set()
+
+            def copy_image(self, source_path, filename):
+                if source_path in self.missing:
+                    raise RuntimeError("NoSuchKey")
+                self.copied.append(source_path)
+                return {"path": f"images/{filename}", "url": f"http://minio/images/{filename}"}
+
+        minio = FakeMinio()
+        user_id = self.create_user()
+        stored_at = datetime.utcnow() - timedelta(days=3)
+        self.add_entry("hit", stored_at)
+        self.add_entry("expired", datetime.utcnow() - timedelta(days=30))
+        self.add_entry("gone", stored_at)
+        minio.missing.add(f"images/{self.tag}-gone.jpg")
+
+        first, second = self.create_generation(user_id), self.create_generation(user_id)
+        first_url = complete_from_cache(first, f"{self.tag}-hit", minio)
+        second_url = complete_from_cache(second, f"{self.tag}-hit", minio)
+
+        self.assertNotEqual(first_url, second_url)
+        # Обе копии сняты с исходного объекта, запись на копии не переводится
+        self.assertEqual(minio.copied, [f"images/{self.tag}-hit.jpg"] * 2)
+        self.assertEqual(self.entry("hit"), (f"images/{self.tag}-hit.jpg", stored_at, 2))
+        with db_service.get_session() as session:
+            generation = session.get(Generation, first)
+            self.assertEqual((generation.status, generation.result_url), ("completed", first_url))
+            self.assertTrue(generation.generation_metadata["cache_hit"])
+
+        third = self.create_generation(user_id)
+        self.assertIsNone(complete_from_cache(third, f"{self.tag}-miss", minio))
+        self.assertIsNone(complete_from_cache(third, f"{self.tag}-expired", minio))
+        self.assertIsNone(complete_from_cache(third, f"{self.tag}-gone", minio))
+        self.assertIsNone(self.entry("expired"))
+        self.assertIsNone(self.entry("gone"))
+        with db_service.get_session() as session:
+            self.assertEqual(session.get(Generation, third).status, "pending")
+
+    def test_prune_drops_expired_and_least_recently_used(self):
+        from datetime import datetime, timedelta
+        from app.services.retention import prune_result_cache
+
+        now = datetime.utcnow()
+        # last_used_at в будущем — записи теста свежее любых других в таблице
+        self.add_entry("expired", now - timedelta(days=30), now + timedelta(days=4))
+        self.add_entry("old", now - timedelta(days=1), now + timedelta(days=1))
+        self.add_entry("recent", now - timedelta(days=1), now + timedelta(days=2))
+        self.add_entry("newest", now - timedelta(days=1), now + timedelta(days=3))
+
+        self.assertGreaterEqual(prune_result_cache(now - timedelta(days=7), 2), 2)
+        self.assertIsNone(self.entry("expired"))
+        self.assertIsNone(self.entry("old"))
+        self.assertIsNotNone(self.entry("recent"))
+        self.assertIsNotNone(self.entry("newest"))
+
+
+class TestGenerationStatusNotify(PostgresTestCase):
+    def test_status_change_reaches_subscribers_after_commit(self):
+        import asyncio
+        from app.models.base import Generation
+        from app.services.DBService import db_service
+        from app.services.generation_events import generation_events, start_generation_event_listener
+
+        user_id = self.create_user()
+        generation_id = self.create_generation(user_id)
+
+        def set_status(status: str, commit: bool = True):
+            with db_service.get_session() as session:
+                session.query(Generation).filter(Generation.id == generation_id).one().status = status
+                session.flush()
+                if commit:
+                    session.commit()
+                else:
+                    session.rollback()
+
+        async def scenario():
+            queue = generation_events.subscribe(user_id)
+            try:
+                start_generation_event_listener()
+                # LISTEN-соединение поднимается в фоне: меняем статус, пока первое событие не дойдёт
+                for attempt in range(20):
+                    await asyncio.to_thread(set_status, ("running", "pending")[attempt % 2])
+                    try:
+                        event = await asyncio.wait_for(queue.get(), 0.5)
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+                else:
+                    self.fail("NOTIFY generation_status не дошёл до подписчика")
+                self.assertEqual((event["id"], event["user_id"]), (generation_id, user_id))
+
+                # NOTIFY отправляется в транзакции: откат изменения событий не порождает
+                await asyncio.to_thread(set_status, "failed", commit=False)
+                await asyncio.to_thread(set_status, "completed")
+                statuses = []
+                while not statuses or statuses[-1] != "completed":
+                    statuses.append((await asyncio.wait_for(queue.get(), 5))["status"])
+                self.assertNotIn("failed", statuses)
+            finally:
+                generation_events.unsubscribe(user_id, queue)
+
+        asyncio.run(scenario())
+
+
 if __name__ == "__main__":
     unittest.main()